@@ -0,0 +1,25 @@
+# Read by gunicorn from the working directory: gunicorn wsgi:app
+import gc
+import os
+import importlib
+
+bind = f"0.0.0.0:{os.getenv('PORT', 8050)}"
+workers = int(os.getenv('WEB_CONCURRENCY', 4))
+# Each open dashboard holds a thread for its live update stream, up to
+# LIVE_STREAMS (8) per worker; the other threads serve the Dash callbacks
+threads = int(os.getenv('GUNICORN_THREADS', 16))
+# The app is imported and built once in the master and forked into every
+# worker, which share those pages copy-on-write instead of each paying the
+# import and layout cost again
+preload_app = os.getenv('PRELOAD_APP', '1').lower() in ('1', 'true', 'yes')
+
+
+def when_ready(server):
+    # Runs in the master after the app was loaded and before the workers are
+    # forked. Modules the first requests would import are loaded here so they
+    # are shared too, then everything allocated so far is moved out of the
+    # collector's reach: collections in the workers would otherwise touch, and
+    # so copy, the shared pages.
+    if preload_app:
+        importlib.import_module('pandas')  # the history views build frames
+        gc.freeze()
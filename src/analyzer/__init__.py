@@ -1,7 +1,39 @@
-import random
-import pandas as pd
-from datetime import datetime, timedelta
+import sys
+import importlib
+import numpy as np
 import time
+from custom_types import PacketBatch, PROTOCOLS, PROTOCOL_CODES, format_addresses
+from tools.metrics import stage, PACKETS, BYTES
+from .aggregate import SlidingWindowAggregator, CaptureSummary, NS_PER_SECOND
+from .flows import FlowTable, stitch_flows
+
+# Everything else is imported from its submodule on first use, so importing
+# the package for TrafficAnalyzer (e.g. the web app) does not load the
+# capture, evidence or merge code along with it
+_LAZY = {
+    'pcap': ['PcapReader', 'PcapError', 'read_pcap', 'split_capture', 'write_pcap'],
+    'parallel': ['CaptureAnalysis', 'analyze_capture', 'analyze_captures', 'new_detector'],
+    'merge': ['MergedCapture', 'estimate_offsets'],
+    'evidence': ['CaptureIndex', 'IndexWriter', 'incident_scopes'],
+    'decoders': ['DecoderStage', 'AppSummary', 'HttpDecoder', 'TlsDecoder', 'DnsDecoder'],
+    'synthetic': ['TrafficGenerator'],
+    'live': ['LiveFeed', 'build_snapshot', 'run_producer', 'CHART_WINDOW'],
+    'capture': ['LiveCapture', 'CaptureError', 'compile_bpf'],
+}
+_LAZY_NAMES = {name: module for module, names in _LAZY.items() for name in names}
+
+
+def __getattr__(name):
+    if name not in _LAZY_NAMES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module('.' + _LAZY_NAMES[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_NAMES))
+
 
 class TrafficAnalyzer:
     def __init__(self):
@@ -15,50 +47,118 @@ class TrafficAnalyzer:
             'SSH': 22,
             'FTP': 21
         }
+        self.batch_size = 65536
+        self.rng = np.random.default_rng()
+        self.aggregator = SlidingWindowAggregator()
+        self.stats_window = 60  # seconds covered by the dashboard statistics
+        self.flow_table = FlowTable()
+        self.store = None  # optional storage.TrafficStore keeping the history
+        # Live traffic is captured from this interface when set (see
+        # analyzer.capture), keeping the packets matching capture_filter
+        self.interface = None
+        self.capture_filter = None
+        self.capture = None
+        self._capture_error = None
+        self._last_mock_time = None
+
+    def __getstate__(self):
+        # The capture is opened by the process that reads it (see live_capture)
+        return dict(self.__dict__, capture=None, _capture_error=None)
         
     def generate_mock_traffic(self):
-        current_time = datetime.now()
-        num_packets = random.randint(50, 100)
+        # Whole-second timestamps since the previous call (the last minute on the
+        # first one), so consecutive calls behave like a live feed
+        current_time = time.time_ns() // NS_PER_SECOND * NS_PER_SECOND
+        span = 60 if self._last_mock_time is None else (current_time - self._last_mock_time) // NS_PER_SECOND
+        self._last_mock_time = current_time
+        num_packets = int(self.rng.integers(50, 101))
+        protocol_codes = np.array([PROTOCOL_CODES[p] for p in self.protocols], dtype=np.uint8)
+        ports = np.array(list(self.common_ports.values()), dtype=np.uint16)
         
-        packets = []
-        for _ in range(num_packets):
-            protocol = random.choice(self.protocols)
-            src_port = random.choice(list(self.common_ports.values()))
-            dst_port = random.choice(list(self.common_ports.values()))
-            
-            packet_data = {
-                'timestamp': (current_time - timedelta(seconds=random.randint(0, 60))).strftime('%Y-%m-%d %H:%M:%S'),
-                'src': f'192.168.1.{random.randint(2, 254)}',
-                'dst': f'10.0.0.{random.randint(2, 254)}',
-                'protocol': protocol,
-                'length': random.randint(64, 1500),
-                'src_port': src_port,
-                'dst_port': dst_port
+        batch = PacketBatch(
+            timestamp=current_time - self.rng.integers(0, max(span, 1), num_packets) * NS_PER_SECOND,
+            src=0xC0A80100 + self.rng.integers(2, 255, num_packets),  # 192.168.1.x
+            dst=0x0A000000 + self.rng.integers(2, 255, num_packets),  # 10.0.0.x
+            protocol=self.rng.choice(protocol_codes, num_packets),
+            length=self.rng.integers(64, 1501, num_packets),
+            src_port=self.rng.choice(ports, num_packets),
+            dst_port=self.rng.choice(ports, num_packets)
+        )
+        return batch[np.argsort(batch.timestamp, kind='stable')]
+    
+    def live_capture(self):
+        # The capture of `interface`, opened by the process that reads it. None
+        # without an interface, or if it cannot be opened (e.g. without
+        # CAP_NET_RAW), in which case generated traffic is shown instead.
+        if self.capture is None and self.interface and self._capture_error is None:
+            from .capture import LiveCapture
+            try:
+                self.capture = LiveCapture(self.interface, where=self.capture_filter,
+                                           batch_size=self.batch_size).open()
+            except (OSError, ValueError) as e:
+                self._capture_error = e
+                print(f"Cannot capture on {self.interface}: {e}; showing generated traffic", file=sys.stderr)
+        return self.capture
+
+    def capture_traffic(self, duration=None):
+        # Packets captured on `interface` over the next `duration` seconds
+        # (capture_duration by default)
+        from .capture import CaptureError
+        capture = self.live_capture()
+        if capture is None:
+            raise CaptureError(f"Cannot capture on {self.interface}: {self._capture_error or 'no interface set'}")
+        return PacketBatch.concat(list(capture.capture(self.capture_duration if duration is None else duration)))
+
+    def compute_stats(self, batch):
+        if not len(batch):
+            return {
+                'total_packets': 0,
+                'unique_sources': 0,
+                'unique_destinations': 0,
+                'protocols': {},
+                'avg_packet_size': 0.0,
+                'max_packet_size': 0,
+                'traffic_by_src': {}
             }
-            packets.append(packet_data)
-            
-        return sorted(packets, key=lambda x: x['timestamp'])
+        src_names, src_index = format_addresses(batch.src)
+        dst_names, _ = format_addresses(batch.dst)
+        protocol_counts = np.bincount(batch.protocol, minlength=len(PROTOCOLS))
+        bytes_by_src = np.bincount(src_index, weights=batch.length, minlength=len(src_names))
+        return {
+            'total_packets': len(batch),
+            'unique_sources': len(src_names),
+            'unique_destinations': len(dst_names),
+            'protocols': {PROTOCOLS[code]: int(count) for code, count in enumerate(protocol_counts) if count},
+            'avg_packet_size': float(batch.length.mean()),
+            'max_packet_size': int(batch.length.max()),
+            'traffic_by_src': dict(zip(src_names, bytes_by_src.astype(np.int64).tolist()))
+        }
     
     def analyze_traffic(self):
-        # Generate mock traffic data
-        traffic_data = self.generate_mock_traffic()
-        
-        # Convert to pandas DataFrame for analysis
-        df = pd.DataFrame(traffic_data)
-        
-        # Basic statistics
-        stats = {
-            'total_packets': len(df),
-            'unique_sources': len(df['src'].unique()),
-            'unique_destinations': len(df['dst'].unique()),
-            'protocols': df['protocol'].value_counts().to_dict(),
-            'avg_packet_size': df['length'].mean(),
-            'max_packet_size': df['length'].max(),
-            'traffic_by_src': df.groupby('src')['length'].sum().to_dict()
-        }
-        
-        # Add statistics to each packet
-        for packet in traffic_data:
-            packet['stats'] = stats
-            
-        return traffic_data
\ No newline at end of file
+        with stage('analyze_traffic'):
+            # What was captured since the last call, or mock traffic without a capture
+            capture = self.live_capture()
+            traffic_data = PacketBatch.concat(list(capture.pending())) if capture else self.generate_mock_traffic()
+
+            # Only the new packets are folded into the running window statistics,
+            # which travel with the batch instead of being copied into every packet
+            self.aggregator.add(traffic_data)
+            self.aggregator.advance(time.time_ns())
+            finished_flows = self.flow_table.add(traffic_data)
+            if self.store is not None:
+                with stage('store_traffic'):
+                    self.store.append('packets', traffic_data)
+                    self.store.append('flows', finished_flows)
+            traffic_data.stats = self.aggregator.stats(self.stats_window)
+        PACKETS.inc(len(traffic_data))
+        BYTES.inc(int(traffic_data.length.sum(dtype=np.int64)))
+        return traffic_data
+
+    def current_flows(self):
+        return self.flow_table.active()
+
+    def read_capture(self, source):
+        # Stream a pcap/pcapng capture as PacketBatch objects
+        from .pcap import PcapReader
+        with PcapReader(source, batch_size=self.batch_size) as reader:
+            yield from reader
@@ -0,0 +1,264 @@
+import threading
+import numpy as np
+from custom_types import PROTOCOLS, address_keys, address_hash, format_addresses
+from tools.sketches import HyperLogLog, SpaceSaving
+
+NS_PER_SECOND = 1_000_000_000
+WINDOWS = (60, 300, 3600)
+MINUTE = 60  # seconds per pre-merged top talkers summary
+
+
+class SlidingWindowAggregator:
+    # Traffic statistics over sliding windows, kept in a ring of per-second
+    # buckets. Adding a batch only touches the buckets its packets fall in and a
+    # window query reduces over at most `max(windows)` buckets, never packets.
+    # Top talkers are also kept per minute, so a long window merges its whole
+    # minutes and only the seconds at its edges.
+    def __init__(self, windows=WINDOWS, precision=10, top_k=64):
+        self.windows = tuple(sorted(windows))
+        self.slots = self.windows[-1]
+        self.precision = precision
+        self.top_k = top_k
+        self.head = None  # newest epoch second seen
+        self.late_packets = 0
+        self.version = 0  # bumped on every change, e.g. to key cached charts
+        self.seconds = np.full(self.slots, -1, dtype=np.int64)
+        self.packets = np.zeros(self.slots, dtype=np.int64)
+        self.bytes = np.zeros(self.slots, dtype=np.int64)
+        self.max_length = np.zeros(self.slots, dtype=np.uint16)
+        self.protocols = np.zeros((self.slots, len(PROTOCOLS)), dtype=np.int64)
+        self.src_registers = np.zeros((self.slots, 1 << precision), dtype=np.uint8)
+        self.dst_registers = np.zeros((self.slots, 1 << precision), dtype=np.uint8)
+        self.talkers = [None] * self.slots
+        # Enough minutes that the longest window never meets a reused one
+        self.minutes = np.full(self.slots // MINUTE + 2, -1, dtype=np.int64)
+        self.minute_talkers = [None] * len(self.minutes)
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks belong to one process, e.g. when sent to the live producer
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def add(self, batch):
+        if not len(batch):
+            return
+        seconds = batch.timestamp // NS_PER_SECOND
+        order = None
+        if np.any(seconds[1:] < seconds[:-1]):
+            order = np.argsort(seconds, kind='stable')
+            seconds = seconds[order]
+        buckets, starts = np.unique(seconds, return_index=True)
+        ends = np.append(starts[1:], len(seconds))
+
+        # Addresses are hashed and keyed once per distinct value, not per packet
+        src_keys, src_index = np.unique(address_keys(batch.src), return_inverse=True)
+        dst_keys, dst_index = np.unique(address_keys(batch.dst), return_inverse=True)
+        src_hashes = address_hash(src_keys)[src_index.ravel()]
+        dst_hashes = address_hash(dst_keys)[dst_index.ravel()]
+        src_index = src_index.ravel()
+
+        with self._lock:
+            self._advance(int(buckets[-1]))
+            late = buckets <= self.head - self.slots
+            self.late_packets += int((ends - starts)[late].sum())
+            for second, start, end in zip(buckets[~late].tolist(), starts[~late].tolist(), ends[~late].tolist()):
+                rows = slice(start, end) if order is None else order[start:end]
+                self._add_bucket(second, rows, batch, src_keys, src_index, src_hashes, dst_hashes)
+            # The seconds of a minute are next to each other in time order
+            minutes, first = np.unique(buckets[~late] // MINUTE, return_index=True)
+            bounds = np.append(starts[~late][first], ends[~late][-1] if len(minutes) else 0)
+            for minute, start, end in zip(minutes.tolist(), bounds[:-1].tolist(), bounds[1:].tolist()):
+                rows = slice(start, end) if order is None else order[start:end]
+                self._add_minute(minute, rows, batch, src_keys, src_index)
+            self.version += 1
+
+    def _add_bucket(self, second, rows, batch, src_keys, src_index, src_hashes, dst_hashes):
+        slot = second % self.slots
+        self.seconds[slot] = second
+        length = batch.length[rows]
+        self.packets[slot] += len(length)
+        self.bytes[slot] += int(length.sum(dtype=np.int64))
+        self.max_length[slot] = max(self.max_length[slot], length.max())
+        self.protocols[slot] += np.bincount(batch.protocol[rows], minlength=len(PROTOCOLS))
+        HyperLogLog(self.precision, self.src_registers[slot]).add_hashes(src_hashes[rows])
+        HyperLogLog(self.precision, self.dst_registers[slot]).add_hashes(dst_hashes[rows])
+        talker_bytes = np.bincount(src_index[rows], weights=length, minlength=len(src_keys))
+        present = np.flatnonzero(talker_bytes)
+        if self.talkers[slot] is None:
+            self.talkers[slot] = SpaceSaving(self.top_k)
+        self.talkers[slot].update(src_keys[present], talker_bytes[present])
+
+    def _add_minute(self, minute, rows, batch, src_keys, src_index):
+        slot = minute % len(self.minutes)
+        if self.minutes[slot] != minute:
+            self.minutes[slot] = minute
+            self.minute_talkers[slot] = SpaceSaving(self.top_k)
+        talker_bytes = np.bincount(src_index[rows], weights=batch.length[rows], minlength=len(src_keys))
+        present = np.flatnonzero(talker_bytes)
+        self.minute_talkers[slot].update(src_keys[present], talker_bytes[present])
+
+    def _window_talkers(self, window, slots):
+        # Summaries covering the window: its whole minutes, then the seconds
+        # before the first and after the last of them
+        first = -(-(self.head - window + 1) // MINUTE)
+        last = (self.head + 1) // MINUTE
+        minutes = np.arange(first, last)
+        minute_slots = minutes % len(self.minutes)
+        summaries = [self.minute_talkers[slot] for slot in minute_slots[self.minutes[minute_slots] == minutes].tolist()]
+        seconds = self.seconds[slots]
+        edges = slots[(seconds < first * MINUTE) | (seconds >= last * MINUTE)]
+        return summaries + [self.talkers[slot] for slot in edges.tolist()]
+
+    def advance(self, timestamp_ns):
+        # Move the window forward without new packets, e.g. to wall-clock time
+        with self._lock:
+            self._advance(int(timestamp_ns // NS_PER_SECOND))
+
+    def _advance(self, second):
+        if self.head is not None and second <= self.head:
+            return
+        start = second - self.slots + 1 if self.head is None else max(self.head + 1, second - self.slots + 1)
+        slots = np.arange(start, second + 1) % self.slots
+        self.seconds[slots] = -1
+        self.packets[slots] = 0
+        self.bytes[slots] = 0
+        self.max_length[slots] = 0
+        self.protocols[slots] = 0
+        self.src_registers[slots] = 0
+        self.dst_registers[slots] = 0
+        for slot in slots.tolist():
+            self.talkers[slot] = None
+        self.head = second
+        self.version += 1
+
+    def _window_slots(self, window):
+        if window > self.slots:
+            raise ValueError(f"Window of {window}s exceeds the {self.slots}s kept by the aggregator")
+        if self.head is None:
+            return np.zeros(0, dtype=np.intp)
+        expected = self.head - np.arange(window)
+        slots = expected % self.slots
+        return slots[self.seconds[slots] == expected]
+
+    def series(self, window=WINDOWS[0]):
+        # Per-second epoch seconds, packet and byte counts over the last `window`
+        # seconds, oldest first; seconds without traffic count as zero
+        with self._lock:
+            if self.head is None:
+                empty = np.zeros(0, dtype=np.int64)
+                return empty, empty, empty
+            self._window_slots(window)
+            seconds = self.head - np.arange(window - 1, -1, -1, dtype=np.int64)
+            slots = seconds % self.slots
+            present = self.seconds[slots] == seconds
+            packets = np.where(present, self.packets[slots], 0)
+            byte_counts = np.where(present, self.bytes[slots], 0)
+        return seconds, packets, byte_counts
+
+    def stats(self, window=WINDOWS[0], top_n=10):
+        # Same keys as TrafficAnalyzer.compute_stats, over the last `window` seconds
+        with self._lock:
+            slots = self._window_slots(window)
+            total_packets = int(self.packets[slots].sum())
+            total_bytes = int(self.bytes[slots].sum())
+            protocol_counts = self.protocols[slots].sum(axis=0)
+            unique_sources = unique_destinations = 0
+            if len(slots):
+                unique_sources = HyperLogLog.estimate(self.src_registers[slots].max(axis=0))
+                unique_destinations = HyperLogLog.estimate(self.dst_registers[slots].max(axis=0))
+            talkers = SpaceSaving.merged(self._window_talkers(window, slots) if len(slots) else [], self.top_k)
+            max_packet_size = int(self.max_length[slots].max()) if len(slots) else 0
+
+        keys, counts = talkers.top(top_n)
+        names, inverse = format_addresses(keys)
+        return {
+            'window': window,
+            'total_packets': total_packets,
+            'unique_sources': unique_sources,
+            'unique_destinations': unique_destinations,
+            'protocols': {PROTOCOLS[code]: int(count) for code, count in enumerate(protocol_counts) if count},
+            'avg_packet_size': total_bytes / total_packets if total_packets else 0.0,
+            'max_packet_size': max_packet_size,
+            'traffic_by_src': dict(zip(names[inverse].tolist(), counts.tolist()))
+        }
+
+
+class CaptureSummary:
+    # Statistics over a whole capture. Counts merge exactly and distinct hosts
+    # and top talkers merge as sketches, so summaries of separate chunks of a
+    # capture can be combined in any order.
+    def __init__(self, precision=14, top_k=64):
+        self.packets = 0
+        self.bytes = 0
+        self.max_length = 0
+        self.first_seen = None
+        self.last_seen = None
+        self.protocols = np.zeros(len(PROTOCOLS), dtype=np.int64)
+        self.sources = HyperLogLog(precision)
+        self.destinations = HyperLogLog(precision)
+        self.talkers = SpaceSaving(top_k)
+        self._seconds = []  # (seconds, counts) per batch, compacted lazily
+
+    def add(self, batch):
+        if not len(batch):
+            return
+        length = batch.length
+        self.packets += len(batch)
+        self.bytes += int(length.sum(dtype=np.int64))
+        self.max_length = max(self.max_length, int(length.max()))
+        self._span(int(batch.timestamp.min()), int(batch.timestamp.max()))
+        self.protocols += np.bincount(batch.protocol, minlength=len(PROTOCOLS))
+        src_keys, src_index = np.unique(address_keys(batch.src), return_inverse=True)
+        self.sources.add_hashes(address_hash(src_keys))
+        self.destinations.add_hashes(address_hash(np.unique(address_keys(batch.dst))))
+        self.talkers.update(src_keys, np.bincount(src_index.ravel(), weights=length, minlength=len(src_keys)))
+        self._seconds.append(np.unique(batch.timestamp // NS_PER_SECOND, return_counts=True))
+        if len(self._seconds) > 64:
+            self.per_second()
+
+    def _span(self, first, last):
+        self.first_seen = first if self.first_seen is None else min(self.first_seen, first)
+        self.last_seen = last if self.last_seen is None else max(self.last_seen, last)
+
+    def per_second(self):
+        # Packets per epoch second over the capture
+        if not self._seconds:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        seconds, inverse = np.unique(np.concatenate([s for s, _ in self._seconds]), return_inverse=True)
+        counts = np.bincount(inverse.ravel(), weights=np.concatenate([c for _, c in self._seconds]),
+                             minlength=len(seconds)).astype(np.int64)
+        self._seconds = [(seconds, counts)]
+        return seconds, counts
+
+    def merge(self, other):
+        self.packets += other.packets
+        self.bytes += other.bytes
+        self.max_length = max(self.max_length, other.max_length)
+        if other.first_seen is not None:
+            self._span(other.first_seen, other.last_seen)
+        self.protocols += other.protocols
+        self.sources.merge(other.sources)
+        self.destinations.merge(other.destinations)
+        self.talkers = SpaceSaving.merged([self.talkers, other.talkers], self.talkers.capacity)
+        self._seconds.extend(other._seconds)
+        self.per_second()
+
+    def stats(self, top_n=10):
+        # Same keys as TrafficAnalyzer.compute_stats
+        keys, counts = self.talkers.top(top_n)
+        names, inverse = format_addresses(keys)
+        return {
+            'total_packets': self.packets,
+            'unique_sources': self.sources.count(),
+            'unique_destinations': self.destinations.count(),
+            'protocols': {PROTOCOLS[code]: int(count) for code, count in enumerate(self.protocols) if count},
+            'avg_packet_size': self.bytes / self.packets if self.packets else 0.0,
+            'max_packet_size': self.max_length,
+            'traffic_by_src': dict(zip(names[inverse].tolist(), counts.tolist()))
+        }
@@ -0,0 +1,541 @@
+import mmap
+import time
+import ctypes
+import select
+import socket
+import struct
+import numpy as np
+from custom_types import PacketBatch, PROTOCOL_CODES
+from tools.metrics import REGISTRY
+from tools.filters import compile_filter, FilterVisitor
+from .pcap import (decode_records, pcap_header, BATCH_SIZE, MAX_RECORD, LINKTYPE_ETHERNET, LINKTYPE_RAW,
+                   HTTP_PORTS, HTTPS_PORTS)
+from .aggregate import NS_PER_SECOND
+
+BLOCK_SIZE = 1 << 20  # bytes per ring block, a multiple of the page size
+BLOCKS = 64  # blocks in the ring, about a second of a busy gigabit link
+FRAME_SIZE = 2048  # only checked by the kernel; TPACKET_V3 packs packets of any size into a block
+BLOCK_TIMEOUT = 100  # milliseconds before the kernel hands over a block that is not full
+
+# Linux <linux/if_packet.h> and <linux/filter.h>
+SOL_PACKET = 263
+PACKET_ADD_MEMBERSHIP = 1
+PACKET_MR_PROMISC = 1
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+PACKET_OUTGOING = 4
+ETH_P_ALL = 0x0003
+SO_ATTACH_FILTER = 26
+BPF_MAXINSNS = 4096
+# ARPHRD_* device types and the link type their frames have on a raw socket
+DEVICE_LINKTYPES = {1: LINKTYPE_ETHERNET, 772: LINKTYPE_ETHERNET, 65534: LINKTYPE_RAW}
+LOOPBACK = 772
+
+# Offsets in a block: tpacket_block_desc, then tpacket3_hdr and sockaddr_ll of
+# each packet
+BLOCK_STATUS = 8
+BLOCK_PACKETS = 12
+BLOCK_FIRST = 16
+PACKET_SEC = 4
+PACKET_NSEC = 8
+PACKET_SNAPLEN = 12
+PACKET_LEN = 16
+PACKET_MAC = 24
+PACKET_TYPE = 48 + 10  # sll_pkttype
+
+# Classic BPF opcodes
+_LD_W, _LD_H, _LD_B = 0x20, 0x28, 0x30
+_LD_IND_H, _LD_IND_B = 0x48, 0x50
+_LD_LEN = 0x80
+_LDX_MSH = 0xB1
+_AND = 0x54
+_JA, _JEQ, _JGT, _JGE, _JSET = 0x05, 0x15, 0x25, 0x35, 0x45
+_RET = 0x06
+
+_IP_PROTOCOLS = {4: {'tcp': 6, 'udp': 17, 'icmp': 1}, 6: {'tcp': 6, 'udp': 17, 'icmp': 58}}
+
+
+class CaptureError(OSError):
+    pass
+
+
+class _Program:
+    # Classic BPF assembler with forward labels; conditional jumps reach at
+    # most 255 instructions
+    def __init__(self):
+        self.code = []
+        self.positions = []
+
+    def label(self):
+        self.positions.append(None)
+        return len(self.positions) - 1
+
+    def place(self, label):
+        self.positions[label] = len(self.code)
+
+    def emit(self, code, k=0, true=None, false=None):
+        # `true` and `false` are the labels a conditional jump goes to, None
+        # being the next instruction
+        self.code.append((code, true, false, k))
+
+    def goto(self, label):
+        self.emit(_JA, label)
+
+    def assemble(self):
+        program = []
+        for index, (code, true, false, k) in enumerate(self.code):
+            if code == _JA:
+                k = self.positions[k] - index - 1
+            jumps = []
+            for label in (true, false):
+                offset = 0 if label is None else self.positions[label] - index - 1
+                if not 0 <= offset <= 255:
+                    raise ValueError("The filter is too long for a kernel filter")
+                jumps.append(offset)
+            program.append((code, jumps[0], jumps[1], k & 0xFFFFFFFF))
+        if len(program) > BPF_MAXINSNS:
+            raise ValueError("The filter is too long for a kernel filter")
+        return program
+
+
+class _BpfCompiler(FilterVisitor):
+    # Translates a compiled filter into classic BPF over the IP headers, for
+    # one address family at a time. What BPF cannot check exactly the way
+    # decode_records reads it (flow columns, lengths past 65534) is compiled
+    # to let the packet through, so the kernel only ever passes more than the
+    # filter matches and the capture applies the filter again.
+    # Packets too short for the headers a term reads are dropped by the kernel.
+    def __init__(self, program, family, base):
+        self.program = program
+        self.family = family
+        self.base = base  # offset of the IP header
+
+    def compile(self, node, true, false, negated=False):
+        if node.kind == 'not':
+            return self.compile(node.child, false, true, not negated)
+        if node.kind in ('and', 'or'):
+            for child in node.children[:-1]:
+                following = self.program.label()
+                if node.kind == 'and':
+                    self.compile(child, following, false, negated)
+                else:
+                    self.compile(child, true, following, negated)
+                self.program.place(following)
+            return self.compile(node.children[-1], true, false, negated)
+        if not self.visit(node, true, false):
+            # Unknown terms count as matching, or as not matching under an
+            # odd number of `not`s, so the whole expression can only widen
+            self.program.goto(false if negated else true)
+
+    def _directions(self, node, true, false, test):
+        # `test(direction, true, false)` for each direction, joined with
+        # `and` for `src and dst` and `or` otherwise
+        for direction in node.directions[:-1]:
+            following = self.program.label()
+            if node.combine:
+                test(direction, following, false)
+            else:
+                test(direction, true, following)
+            self.program.place(following)
+        test(node.directions[-1], true, false)
+
+    def visit_net(self, node, true, false):
+        program = self.program
+        if self.family == 4:
+            if node.v4 is None:
+                program.goto(false)
+                return True
+            base, mask = int(node.v4[0]), int(node.v4[1])
+            offsets = {'src': self.base + 12, 'dst': self.base + 16}
+            words = [(0, base, mask)]
+        else:
+            packed = int.from_bytes(node.packed, 'big')
+            length_mask = ((1 << 128) - 1) ^ ((1 << (128 - node.length)) - 1)
+            offsets = {'src': self.base + 8, 'dst': self.base + 24}
+            words = [(4 * i, packed >> (96 - 32 * i) & 0xFFFFFFFF, length_mask >> (96 - 32 * i) & 0xFFFFFFFF)
+                     for i in range(4)]
+        words = [word for word in words if word[2]]
+
+        def test(direction, yes, no):
+            if not words:
+                program.goto(yes)
+            for index, (offset, value, mask) in enumerate(words):
+                program.emit(_LD_W, offsets[direction] + offset)
+                if mask != 0xFFFFFFFF:
+                    program.emit(_AND, mask)
+                last = index == len(words) - 1
+                following = None if last else program.label()
+                program.emit(_JEQ, value, yes if last else following, no)
+                if not last:
+                    program.place(following)
+
+        self._directions(node, true, false, test)
+        return True
+
+    def _transport(self, protocols, ported, other):
+        # Falls through for unfragmented packets of the given IP protocols and
+        # leaves the offset of their transport header in X (IPv4) or jumps to
+        # `other`
+        program = self.program
+        numbers = [_IP_PROTOCOLS[self.family][name] for name in protocols]
+        program.emit(_LD_B, self.base + (9 if self.family == 4 else 6))
+        for number in numbers[:-1]:
+            program.emit(_JEQ, number, ported, None)
+        program.emit(_JEQ, numbers[-1], ported, other)
+        program.place(ported)
+        if self.family == 4:
+            following = program.label()
+            program.emit(_LD_H, self.base + 6)
+            program.emit(_JSET, 0x1FFF, other, following)
+            program.place(following)
+            program.emit(_LDX_MSH, self.base)
+
+    def _load_l4(self, size, offset):
+        if self.family == 4:
+            self.program.emit(_LD_IND_H if size == 2 else _LD_IND_B, self.base + offset)
+        else:
+            self.program.emit(_LD_H if size == 2 else _LD_B, self.base + 40 + offset)
+
+    def _range(self, low, high, true, false, limit):
+        program = self.program
+        if low == high:
+            program.emit(_JEQ, low, true, false)
+        elif low == 0 and high == limit:
+            program.goto(true)
+        elif low == 0:
+            program.emit(_JGT, high, false, true)
+        else:
+            following = program.label() if high != limit else true
+            program.emit(_JGE, low, following, false)
+            if high != limit:
+                program.place(following)
+                program.emit(_JGT, high, false, true)
+
+    def visit_port(self, node, true, false):
+        # Ports are 0 for anything but unfragmented TCP and UDP
+        other = self.program.label()
+        self._transport(('tcp', 'udp'), self.program.label(), other)
+
+        def test(direction, yes, no):
+            self._load_l4(2, 0 if direction == 'src' else 2)
+            self._range(node.low, node.high, yes, no, 0xFFFF)
+
+        self._directions(node, true, false, test)
+        self.program.place(other)
+        self.program.goto(true if node.low == 0 else false)
+        return True
+
+    def visit_protocol(self, node, true, false):
+        # The protocol codes of decode_records: ICMP, unfragmented TCP and
+        # UDP, TCP to or from a web port as HTTP or HTTPS, anything else OTHER
+        program = self.program
+        codes = set(node.codes.tolist())
+        outcome = {name: true if PROTOCOL_CODES[name] in codes else false for name in PROTOCOL_CODES}
+        numbers = _IP_PROTOCOLS[self.family]
+        tcp, udp = program.label(), program.label()
+        program.emit(_LD_B, self.base + (9 if self.family == 4 else 6))
+        program.emit(_JEQ, numbers['icmp'], outcome['ICMP'], None)
+        program.emit(_JEQ, numbers['tcp'], tcp, None)
+        program.emit(_JEQ, numbers['udp'], udp, outcome['OTHER'])
+        for label, name in ((udp, 'UDP'), (tcp, 'TCP')):
+            program.place(label)
+            if self.family == 4:
+                following = program.label()
+                program.emit(_LD_H, self.base + 6)
+                program.emit(_JSET, 0x1FFF, outcome['OTHER'], following)
+                program.place(following)
+            if name == 'UDP' or outcome['TCP'] == outcome['HTTP'] == outcome['HTTPS']:
+                program.goto(outcome[name])
+                continue
+            if self.family == 4:
+                program.emit(_LDX_MSH, self.base)
+            for web, ports in (('HTTPS', HTTPS_PORTS), ('HTTP', HTTP_PORTS)):
+                for offset in (0, 2):
+                    self._load_l4(2, offset)
+                    for port in ports:
+                        program.emit(_JEQ, port, outcome[web], None)
+            program.goto(outcome['TCP'])
+        return True
+
+    def visit_flags(self, node, true, false):
+        self._transport(('tcp',), self.program.label(), false)
+        self._load_l4(1, 13)
+        self.program.emit(_JSET, int(node.bits), true, false)
+        return True
+
+    def visit_compare(self, node, true, false):
+        # Lengths are kept as uint16, so only smaller values compare the same
+        if node.column != 'length' or not 0 <= node.value < 0xFFFF:
+            return False
+        program = self.program
+        program.emit(_LD_LEN)
+        code, swap = {'>': (_JGT, False), '>=': (_JGE, False), '<': (_JGE, True), '<=': (_JGT, True),
+                      '=': (_JEQ, False), '==': (_JEQ, False), '!=': (_JEQ, True)}[node.operator]
+        program.emit(code, node.value, false if swap else true, true if swap else false)
+        return True
+
+
+def compile_bpf(expression, linktype=LINKTYPE_ETHERNET, snaplen=MAX_RECORD):
+    # Classic BPF program (a list of (code, jt, jf, k) instructions, as
+    # `tcpdump -dd` prints them) that keeps at least the IP packets matching a
+    # tools.filters expression. Raises ValueError when the program would be
+    # too long for the kernel.
+    root = compile_filter(expression).root
+    program = _Program()
+    accept, reject = program.label(), program.label()
+    families = {4: program.label(), 6: program.label()}
+    if linktype == LINKTYPE_ETHERNET:
+        base = 14
+        program.emit(_LD_H, 12)
+        for ethertype, target in ((0x0800, families[4]), (0x86DD, families[6]),
+                                  (0x8100, accept), (0x88A8, accept), (0x9100, accept)):
+            # VLAN tags the device did not strip are left to the capture
+            program.emit(_JEQ, ethertype, target, None)
+    elif linktype == LINKTYPE_RAW:
+        base = 0
+        program.emit(_LD_B, 0)
+        program.emit(_AND, 0xF0)
+        program.emit(_JEQ, 0x40, families[4], None)
+        program.emit(_JEQ, 0x60, families[6], None)
+    else:
+        raise ValueError(f"No kernel filter for link type {linktype}")
+    program.goto(reject)
+    for family, label in families.items():
+        program.place(label)
+        _BpfCompiler(program, family, base).compile(root, accept, reject)
+    program.place(accept)
+    program.emit(_RET, snaplen)
+    program.place(reject)
+    program.emit(_RET, 0)
+    return program.assemble()
+
+
+def attach_filter(sock, program):
+    # SO_ATTACH_FILTER takes a struct sock_fprog pointing at the instructions
+    instructions = ctypes.create_string_buffer(b''.join(struct.pack('HBBI', *insn) for insn in program))
+    fprog = struct.pack('HL', len(program), ctypes.addressof(instructions))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+class LiveCapture:
+    # Packets of a Linux network interface, read through an AF_PACKET socket
+    # with a memory-mapped TPACKET_V3 ring. The kernel fills whole blocks of
+    # the ring with packets and hands them over without a system call per
+    # packet; each read decodes every block that is ready straight from the
+    # ring in one decode_records call and gives the blocks back. A `where`
+    # filter (tools.filters) is compiled to a kernel BPF program where it can
+    # be, and applied again to the decoded packets. Needs CAP_NET_RAW; the
+    # socket is only opened on the first read, in the process that reads.
+    def __init__(self, interface, where=None, batch_size=BATCH_SIZE, block_size=BLOCK_SIZE, blocks=BLOCKS,
+                 block_timeout=BLOCK_TIMEOUT, snaplen=MAX_RECORD, promiscuous=False):
+        self.interface = interface
+        self.where = compile_filter(where) if where else None
+        self.batch_size = batch_size
+        self.block_size = block_size
+        self.blocks = blocks
+        self.block_timeout = block_timeout
+        self.snaplen = snaplen
+        self.promiscuous = promiscuous
+        self.linktype = None
+        self.kernel_filter = False  # whether a BPF program was attached
+        self.packets_read = 0
+        self.packets_skipped = 0
+        self.packets_filtered = 0
+        self.packets_dropped = 0  # by the kernel, because the ring was full
+        self.packets_saved = 0
+        self._output = None
+        self._socket = None
+        self._ring = None
+        self._block = 0
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self):
+        if self._socket is not None:
+            return self
+        try:
+            with open(f'/sys/class/net/{self.interface}/type') as f:
+                device = int(f.read())
+        except OSError:
+            raise CaptureError(f"No network interface {self.interface!r}") from None
+        if device not in DEVICE_LINKTYPES:
+            raise CaptureError(f"Cannot capture on {self.interface!r}, device type {device}")
+        self.linktype = DEVICE_LINKTYPES[device]
+        self._loopback = device == LOOPBACK
+        # Protocol 0 receives nothing until bind, so no packet gets past the
+        # filter while it is attached
+        sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+        try:
+            sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+            if self.where is not None:
+                try:
+                    attach_filter(sock, compile_bpf(self.where, self.linktype, self.snaplen))
+                    self.kernel_filter = True
+                except ValueError:
+                    pass
+            frames = self.block_size // FRAME_SIZE * self.blocks
+            sock.setsockopt(SOL_PACKET, PACKET_RX_RING, struct.pack(
+                '7I', self.block_size, self.blocks, FRAME_SIZE, frames, self.block_timeout, 0, 0))
+            ring = mmap.mmap(sock.fileno(), self.block_size * self.blocks, mmap.MAP_SHARED,
+                             mmap.PROT_READ | mmap.PROT_WRITE)
+            index = socket.if_nametoindex(self.interface)
+            if self.promiscuous:
+                sock.setsockopt(SOL_PACKET, PACKET_ADD_MEMBERSHIP, struct.pack('iHH8s', index, PACKET_MR_PROMISC, 0, b''))
+            sock.bind((self.interface, ETH_P_ALL))
+        except BaseException:
+            sock.close()
+            raise
+        self._socket = sock
+        self._ring = ring
+        self._data = np.frombuffer(ring, dtype=np.uint8)
+        self._words = np.frombuffer(ring, dtype=np.uint32)
+        self._halves = np.frombuffer(ring, dtype=np.uint16)
+        self._status = memoryview(ring).cast('I')  # plain ints for the packet walk
+        self._poll = select.poll()
+        self._poll.register(sock, select.POLLIN | select.POLLERR)
+        self._block = 0
+        REGISTRY.counter('capture_packets', 'Packets of the live capture, by outcome', ['event'],
+                         function=self.stats)
+        return self
+
+    def close(self):
+        if self._socket is None:
+            return
+        # The ring cannot be unmapped while views of it are alive
+        self._status.release()
+        self._data = self._words = self._halves = self._status = None
+        self._ring.close()
+        self._ring = None
+        self._socket.close()
+        self._socket = None
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def save(self, output):
+        # From now on also writes the packets read to `output` (a binary file)
+        # as a pcap capture: the frames as the kernel captured them, with the
+        # interface's link type and their capture and wire lengths. Without a
+        # filter that is every frame, IP or not; with one, the matching packets.
+        self.open()
+        output.write(pcap_header(self.linktype, self.snaplen))
+        self._output = output
+
+    def stats(self):
+        if self._socket is not None:
+            # tpacket_stats_v3, reset by every read of it
+            _, drops, _ = struct.unpack('3I', self._socket.getsockopt(SOL_PACKET, PACKET_STATISTICS, 12))
+            self.packets_dropped += drops
+        return {'read': self.packets_read, 'skipped': self.packets_skipped, 'filtered': self.packets_filtered,
+                'dropped': self.packets_dropped}
+
+    def _ready(self, block):
+        return self._status[(block * self.block_size + BLOCK_STATUS) >> 2] & TP_STATUS_USER
+
+    def read(self, timeout=0.0):
+        # The packets of the blocks handed over so far, waiting up to
+        # `timeout` seconds for the first one; an empty batch if none came
+        self.open()
+        if not self._ready(self._block) and timeout > 0:
+            self._poll.poll(int(timeout * 1000))
+        status = self._status
+        offsets = []
+        released = []
+        block = self._block
+        while len(offsets) < self.batch_size and len(released) < self.blocks and self._ready(block):
+            start = block * self.block_size
+            position = start + status[(start + BLOCK_FIRST) >> 2]
+            for _ in range(status[(start + BLOCK_PACKETS) >> 2]):
+                offsets.append(position)
+                position += status[position >> 2]  # tp_next_offset
+            released.append(start)
+            block = (block + 1) % self.blocks
+        self._block = block
+        try:
+            return self._decode(np.array(offsets, dtype=np.int64))
+        finally:
+            # Decoding copies what it keeps, so the blocks can go back
+            for start in released:
+                status[(start + BLOCK_STATUS) >> 2] = TP_STATUS_KERNEL
+
+    def _decode(self, headers):
+        if self._loopback and len(headers):
+            # Loopback packets show up once leaving and once arriving
+            headers = headers[self._data[headers + PACKET_TYPE] != PACKET_OUTGOING]
+        self.packets_read += len(headers)
+        if not len(headers):
+            return PacketBatch.empty()
+        words = self._words
+        timestamps = (words[(headers + PACKET_SEC) >> 2].astype(np.int64) * NS_PER_SECOND +
+                      words[(headers + PACKET_NSEC) >> 2])
+        frames = headers + self._halves[(headers + PACKET_MAC) >> 1]
+        caplens = words[(headers + PACKET_SNAPLEN) >> 2]
+        wirelens = words[(headers + PACKET_LEN) >> 2]
+        batch, rows = decode_records(self._data, frames, caplens, wirelens, timestamps, self.linktype, rows=True)
+        self.packets_skipped += len(headers) - len(batch)
+        if self.where is not None and len(batch):
+            keep = self.where.mask(batch)
+            self.packets_filtered += len(batch) - int(np.count_nonzero(keep))
+            batch, rows = batch[keep], rows[keep]
+        if self._output is not None:
+            if self.where is not None:
+                frames, caplens, wirelens, timestamps = frames[rows], caplens[rows], wirelens[rows], timestamps[rows]
+            self._save(frames, caplens, wirelens, timestamps)
+        return batch
+
+    def _save(self, frames, caplens, wirelens, timestamps):
+        # pcap records of frames in the ring, written before it is given back
+        headers = np.empty((len(frames), 4), dtype='<u4')
+        headers[:, 0] = timestamps // NS_PER_SECOND
+        headers[:, 1] = timestamps % NS_PER_SECOND
+        headers[:, 2] = caplens
+        headers[:, 3] = wirelens
+        headers = headers.tobytes()
+        ring = self._ring
+        parts = []
+        for i, (start, size) in enumerate(zip(frames.tolist(), caplens.tolist())):
+            parts.append(headers[16 * i:16 * i + 16])
+            parts.append(ring[start:start + size])
+        self._output.write(b''.join(parts))
+        self.packets_saved += len(frames)
+
+    def __iter__(self):
+        # Batches for as long as the capture is open
+        self.open()
+        while self._socket is not None:
+            batch = self.read(self.block_timeout / 1000)
+            if len(batch):
+                yield batch
+
+    def pending(self):
+        # Batches of everything handed over since the last read, without waiting
+        self.open()
+        while self._ready(self._block):
+            batch = self.read()
+            if len(batch):
+                yield batch
+
+    def capture(self, duration):
+        # Batches of the packets that arrive within the next `duration`
+        # seconds; later packets in the last block are left out
+        self.open()
+        deadline = time.monotonic() + duration
+        while (remaining := deadline - time.monotonic()) > 0:
+            batch = self.read(remaining)
+            if len(batch):
+                yield batch
+        end = time.time_ns()
+        # The last packets sit in a block the kernel hands over after at most
+        # the block timeout
+        batch = self.read(2 * self.block_timeout / 1000)
+        batch = batch[batch.timestamp <= end]
+        if len(batch):
+            yield batch
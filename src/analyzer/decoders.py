@@ -0,0 +1,291 @@
+import socket
+import struct
+import hashlib
+from collections import Counter, OrderedDict
+import numpy as np
+from custom_types import PROTOCOLS, address_keys, format_addresses
+from tools.sketches import SpaceSaving
+from .pcap import payload_heads
+from .flows import _flow_keys
+
+FLOW_PACKETS = 4  # packets per flow handed to a decoder before the flow is skipped
+MAX_FLOWS = 65536  # flows whose decoded packets are counted, least recently seen dropped first
+HEAD_BYTES = 8  # payload bytes the decoders' signatures look at
+HTTP_HEAD = 2048  # most bytes of an HTTP message searched for the request line and Host
+MAX_PATH = 256
+DNS_ANSWERS = 8  # answers kept per DNS response
+
+TCP_PROTOCOLS = [PROTOCOLS.index(name) for name in ('TCP', 'HTTP', 'HTTPS')]
+UDP_PROTOCOLS = [PROTOCOLS.index('UDP')]
+
+HTTP_METHODS = [b'GET ', b'POST', b'PUT ', b'HEAD', b'DELE', b'OPTI', b'PATC', b'CONN', b'TRAC', b'HTTP']
+DNS_TYPES = {1: 'A', 2: 'NS', 5: 'CNAME', 6: 'SOA', 12: 'PTR', 15: 'MX', 16: 'TXT', 28: 'AAAA', 33: 'SRV',
+             65: 'HTTPS', 255: 'ANY'}
+DNS_RCODES = ['NOERROR', 'FORMERR', 'SERVFAIL', 'NXDOMAIN', 'NOTIMP', 'REFUSED']
+
+
+def _prefix(heads):
+    # First four payload bytes as big-endian integers
+    return np.ascontiguousarray(heads[:, :4]).view('>u4').ravel()
+
+
+def _grease(value):
+    # TLS GREASE values (RFC 8701), left out of JA3
+    return value & 0x0F0F == 0x0A0A and value >> 8 == value & 0xFF
+
+
+class HttpDecoder:
+    # Request line and Host header of HTTP/1.x requests, status of responses
+    name = 'HTTP'
+    signatures = np.array([int.from_bytes(method, 'big') for method in HTTP_METHODS], dtype=np.uint32)
+
+    def match(self, batch, rows, heads, lengths):
+        return np.isin(batch.protocol[rows], TCP_PROTOCOLS) & np.isin(_prefix(heads), self.signatures)
+
+    def decode(self, view, offset, length):
+        # Only the start of the message is copied, to search it for line ends
+        head = bytes(view[offset:offset + min(length, HTTP_HEAD)])
+        line_end = head.find(b'\r\n')
+        line = head[:line_end if line_end >= 0 else len(head)].decode('latin-1')
+        if line.startswith('HTTP/'):
+            return {'status': int(line.split(' ', 2)[1])}
+        method, path, version = line.split(' ', 2)
+        if not version.startswith('HTTP/'):
+            return None
+        record = {'method': method, 'path': path[:MAX_PATH], 'host': None}
+        start = head.lower().find(b'\r\nhost:')
+        if start >= 0:
+            stop = head.find(b'\r\n', start + 2)
+            record['host'] = head[start + 7:stop if stop >= 0 else len(head)].strip().decode('latin-1').lower()
+        return record
+
+
+class TlsDecoder:
+    # Server name and JA3 fingerprint of TLS ClientHello messages
+    name = 'TLS'
+
+    def match(self, batch, rows, heads, lengths):
+        # Handshake record of TLS 1.x holding a ClientHello
+        return (np.isin(batch.protocol[rows], TCP_PROTOCOLS) & (heads[:, 0] == 0x16) & (heads[:, 1] == 3) &
+                (heads[:, 5] == 1) & (lengths >= 43))
+
+    def decode(self, view, offset, length):
+        end = offset + length
+        # Reads past a truncated payload fail rather than run into the next record
+        view = view[:end]
+        version = struct.unpack_from('!H', view, offset + 9)[0]
+        pos = offset + 43  # record and handshake headers, version, random
+        pos += 1 + view[pos]  # session id
+        cipher_bytes = struct.unpack_from('!H', view, pos)[0]
+        ciphers = struct.unpack_from(f'!{cipher_bytes // 2}H', view, pos + 2)
+        pos += 2 + cipher_bytes
+        pos += 1 + view[pos]  # compression methods
+        extensions_end = min(pos + 2 + struct.unpack_from('!H', view, pos)[0], end)
+        pos += 2
+        sni = None
+        extensions, groups, point_formats = [], [], []
+        complete = True
+        while pos + 4 <= extensions_end:
+            kind, size = struct.unpack_from('!HH', view, pos)
+            pos += 4
+            if pos + size > extensions_end:
+                # The rest of a large ClientHello is in the next segment
+                complete = False
+                break
+            extensions.append(kind)
+            if kind == 0 and size >= 5 and view[pos + 2] == 0:
+                name_length = struct.unpack_from('!H', view, pos + 3)[0]
+                sni = bytes(view[pos + 5:pos + 5 + name_length]).decode('ascii', 'replace').lower()
+            elif kind == 10 and size >= 2:
+                groups = struct.unpack_from(f'!{struct.unpack_from("!H", view, pos)[0] // 2}H', view, pos + 2)
+            elif kind == 11 and size >= 1:
+                point_formats = bytes(view[pos + 1:pos + 1 + view[pos]])
+            pos += size
+        ja3 = None
+        if complete:
+            fields = [[version], ciphers, extensions, groups, point_formats]
+            ja3 = hashlib.md5(','.join('-'.join(str(value) for value in values if not _grease(value))
+                                       for values in fields).encode()).hexdigest()
+        return {'version': version, 'sni': sni, 'ja3': ja3}
+
+
+def _dns_name(view, message, pos, end):
+    # (name, position after it) for the name at `pos`, following compression
+    # pointers relative to the start of the message
+    labels = []
+    after = None
+    for _ in range(128):
+        if pos >= end:
+            raise ValueError('DNS name past the end of the packet')
+        size = view[pos]
+        if size == 0:
+            pos += 1
+            break
+        if size & 0xC0 == 0xC0:
+            if after is None:
+                after = pos + 2
+            pos = message + ((size & 0x3F) << 8 | view[pos + 1])
+            continue
+        labels.append(bytes(view[pos + 1:pos + 1 + size]).decode('ascii', 'replace'))
+        pos += 1 + size
+    else:
+        raise ValueError('DNS name with a pointer loop')
+    return '.'.join(labels).lower(), pos if after is None else after
+
+
+class DnsDecoder:
+    # Question of DNS queries and responses, and the addresses and names answered
+    name = 'DNS'
+
+    def match(self, batch, rows, heads, lengths):
+        return (np.isin(batch.protocol[rows], UDP_PROTOCOLS) & (lengths >= 17) &
+                ((batch.src_port[rows] == 53) | (batch.dst_port[rows] == 53)))
+
+    def decode(self, view, offset, length):
+        end = offset + length
+        view = view[:end]
+        flags, questions, answers = struct.unpack_from('!HHH', view, offset + 2)
+        if not questions or flags & 0x7800:  # standard queries only
+            return None
+        query, pos = _dns_name(view, offset, offset + 12, end)
+        qtype = struct.unpack_from('!H', view, pos)[0]
+        pos += 4
+        for _ in range(min(questions, 4) - 1):
+            pos = _dns_name(view, offset, pos, end)[1] + 4
+        record = {'query': query, 'qtype': DNS_TYPES.get(qtype, str(qtype)), 'response': bool(flags & 0x8000)}
+        if not record['response']:
+            return record
+        rcode = flags & 0x0F
+        record['rcode'] = DNS_RCODES[rcode] if rcode < len(DNS_RCODES) else str(rcode)
+        record['answers'] = []
+        for _ in range(min(answers, DNS_ANSWERS)):
+            pos = _dns_name(view, offset, pos, end)[1]
+            kind, _, _, size = struct.unpack_from('!HHIH', view, pos)
+            pos += 10
+            if pos + size > end:
+                break
+            if kind == 1 and size == 4:
+                record['answers'].append(socket.inet_ntop(socket.AF_INET, bytes(view[pos:pos + 4])))
+            elif kind == 28 and size == 16:
+                record['answers'].append(socket.inet_ntop(socket.AF_INET6, bytes(view[pos:pos + 16])))
+            elif kind == 5:
+                record['answers'].append(_dns_name(view, offset, pos, end)[0])
+            pos += size
+        return record
+
+
+def default_decoders():
+    return [HttpDecoder(), TlsDecoder(), DnsDecoder()]
+
+
+class DecoderStage:
+    # Application-layer decoding of the packets read from a capture. Payloads
+    # are only looked at where their first bytes match a decoder's signature
+    # (checked for the whole batch at once), and a flow is dropped after
+    # `flow_packets` of its packets were decoded, so most packets cost no more
+    # than reading their headers. Decoders read the capture buffer in place.
+    def __init__(self, decoders=None, flow_packets=FLOW_PACKETS, max_flows=MAX_FLOWS):
+        self.decoders = default_decoders() if decoders is None else list(decoders)
+        self.flow_packets = flow_packets
+        self.max_flows = max_flows
+        self.flows = OrderedDict()  # flow key -> packets decoded
+        self.decoded = 0
+        self.failed = 0
+
+    def decode(self, buf, data, batch, payload, payload_len):
+        # Records found in a batch, in packet order. `data` is the uint8 view of
+        # `buf` that `payload` offsets point into.
+        rows = np.flatnonzero(payload_len > 0)
+        if not len(rows) or not self.decoders:
+            return []
+        heads = payload_heads(data, payload[rows], payload_len[rows], HEAD_BYTES)
+        owner = np.full(len(rows), -1, dtype=np.int64)
+        for index, decoder in enumerate(self.decoders):
+            owner[(owner < 0) & decoder.match(batch, rows, heads, payload_len[rows])] = index
+        matched = np.flatnonzero(owner >= 0)
+        if not len(matched):
+            return []
+        rows, owner = rows[matched], owner[matched]
+        keys, _ = _flow_keys(address_keys(batch.src[rows]), address_keys(batch.dst[rows]),
+                             batch.src_port[rows], batch.dst_port[rows], batch.protocol[rows])
+        records, decoded_rows = [], []
+        with memoryview(buf) as view:
+            for row, index, key, offset, length in zip(rows.tolist(), owner.tolist(), keys.tolist(),
+                                                       payload[rows].tolist(), payload_len[rows].tolist()):
+                seen = self.flows.get(key, 0)
+                if seen >= self.flow_packets:
+                    self.flows.move_to_end(key)
+                    continue
+                self.flows[key] = seen + 1
+                self.flows.move_to_end(key)
+                if len(self.flows) > self.max_flows:
+                    self.flows.popitem(last=False)
+                decoder = self.decoders[index]
+                try:
+                    record = decoder.decode(view, offset, length)
+                except (ValueError, IndexError, struct.error):
+                    record = None
+                if record is None:
+                    self.failed += 1
+                    continue
+                record['protocol'] = decoder.name
+                records.append(record)
+                decoded_rows.append(row)
+        self.decoded += len(records)
+        if records:
+            decoded_rows = np.array(decoded_rows, dtype=np.int64)
+            src_names, src_index = format_addresses(batch.src[decoded_rows])
+            dst_names, dst_index = format_addresses(batch.dst[decoded_rows])
+            columns = zip(batch.timestamp[decoded_rows].tolist(), src_names[src_index], dst_names[dst_index],
+                          batch.src_port[decoded_rows].tolist(), batch.dst_port[decoded_rows].tolist())
+            for record, (timestamp, src, dst, src_port, dst_port) in zip(records, columns):
+                record.update(timestamp=timestamp, src=src, dst=dst, src_port=src_port, dst_port=dst_port)
+        return records
+
+
+class AppSummary:
+    # Most frequent HTTP hosts, TLS server names and fingerprints and DNS names
+    # in the decoded records of a capture. Merges like CaptureSummary, so each
+    # chunk of a capture can be summarised on its own.
+    fields = ['http_hosts', 'tls_sni', 'ja3', 'dns_queries', 'dns_failures']
+
+    def __init__(self, top_k=64):
+        self.top_k = top_k
+        self.records = Counter()  # protocol -> records decoded
+        self.sketches = {field: SpaceSaving(top_k, key_dtype='U1') for field in self.fields}
+
+    @staticmethod
+    def _values(records, field):
+        if field == 'http_hosts':
+            return [r['host'] for r in records if r['protocol'] == 'HTTP' and r.get('host')]
+        if field == 'tls_sni':
+            return [r['sni'] for r in records if r['protocol'] == 'TLS' and r['sni']]
+        if field == 'ja3':
+            return [r['ja3'] for r in records if r['protocol'] == 'TLS' and r['ja3']]
+        if field == 'dns_queries':
+            return [r['query'] for r in records if r['protocol'] == 'DNS' and not r['response']]
+        # Names whose lookup failed (NXDOMAIN, SERVFAIL, ...)
+        return [r['query'] for r in records if r['protocol'] == 'DNS' and r.get('rcode', 'NOERROR') != 'NOERROR']
+
+    def add(self, records):
+        if not records:
+            return
+        self.records.update(record['protocol'] for record in records)
+        for field in self.fields:
+            values = self._values(records, field)
+            if values:
+                self.sketches[field].update(np.array(values))
+
+    def merge(self, other):
+        self.records.update(other.records)
+        for field in self.fields:
+            if len(other.sketches[field]):
+                self.sketches[field] = SpaceSaving.merged([self.sketches[field], other.sketches[field]],
+                                                          self.top_k)
+
+    def top(self, n=10):
+        result = {'records': dict(self.records)}
+        for field in self.fields:
+            keys, counts = self.sketches[field].top(n)
+            result[field] = [[str(key), int(count)] for key, count in zip(keys, counts)]
+        return result
@@ -0,0 +1,313 @@
+import io
+import os
+import sys
+import json
+import mmap
+import time
+import uuid
+import shutil
+import numpy as np
+from custom_types import (UNSCOPED_INCIDENTS, SOURCE_INCIDENTS, address_keys, address_hash, address_hashes,
+                          hash_combine, format_addresses, parse_addresses)
+from storage import Segment
+from tools.filters import compile_filter
+from .pcap import PcapReader, PcapError, capture_header
+
+PART_ROWS = 1_000_000  # packets buffered before an index part is written
+DECODE_BYTES = 64 * 1024 * 1024  # candidate records decoded at a time to check a filter
+MAX_COPY = 0x7FFFF000  # most bytes a single write or sendfile moves on Linux
+# Linux copies between files in the kernel; elsewhere records are written
+# from a memory map of the capture
+SENDFILE = sys.platform.startswith('linux') and hasattr(os, 'sendfile')
+
+
+def _pair_keys(src, dst):
+    # One key for both directions between two hosts
+    return hash_combine(np.minimum(src, dst), np.maximum(src, dst))
+
+
+def _host_key(host):
+    return address_hash(address_keys(parse_addresses([host])))
+
+
+class IndexPart(Segment):
+    # A run of index rows sorted by time: where each packet's record is in
+    # which capture (capture, offset, length), and sorted (key, row) indexes of
+    # the hosts at either end ('host') and of the host pair ('pair')
+    @classmethod
+    def write(cls, path, columns, src, dst):
+        order = np.argsort(columns['timestamp'], kind='stable')
+        tmp = path + '.tmp'
+        os.makedirs(tmp)
+        for name, values in columns.items():
+            np.save(os.path.join(tmp, name + '.npy'), np.ascontiguousarray(values[order]))
+        src, dst = src[order], dst[order]
+        rows = np.arange(len(order), dtype=np.uint32)
+        for name, keys, key_rows in (('host', np.concatenate([src, dst]), np.tile(rows, 2)),
+                                     ('pair', _pair_keys(src, dst), rows)):
+            index = np.argsort(keys)
+            np.save(os.path.join(tmp, f'index.{name}.keys.npy'), keys[index])
+            np.save(os.path.join(tmp, f'index.{name}.rows.npy'), key_rows[index])
+        meta = {
+            'rows': len(order),
+            'start': int(columns['timestamp'].min()),
+            'end': int(columns['timestamp'].max()),
+            'created': time.time(),
+        }
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmp, path)
+        return cls(path)
+
+
+class IndexWriter:
+    # Adds the packets of batches read with `records` (PcapReader,
+    # MergedCapture) to the index at `root`, a part every `part_rows` packets.
+    # Several writers, e.g. one per worker process, can fill the same index.
+    def __init__(self, root, part_rows=PART_ROWS):
+        self.root = root
+        self.part_rows = part_rows
+        self._buffer = []
+        self._rows = 0
+
+    def add(self, batch):
+        if not len(batch):
+            return
+        capture = getattr(batch, 'capture', None)
+        self._buffer.append((batch.timestamp,
+                             np.zeros(len(batch), dtype=np.uint8) if capture is None else capture.astype(np.uint8),
+                             batch.record_offset, batch.record_length.astype(np.uint32),
+                             address_hashes(batch.src), address_hashes(batch.dst)))
+        self._rows += len(batch)
+        if self._rows >= self.part_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        timestamp, capture, offset, length, src, dst = (np.concatenate(column) for column in zip(*self._buffer))
+        self._buffer, self._rows = [], 0
+        # Names stay unique across processes
+        name = f"{time.time_ns():x}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        IndexPart.write(os.path.join(self.root, name),
+                        {'timestamp': timestamp, 'capture': capture, 'offset': offset, 'length': length}, src, dst)
+
+
+class CaptureIndex:
+    # Where the packets of one or more captures are in their files, so those of
+    # a time span, a host or a host pair can be copied out as evidence without
+    # reading the rest of the capture. Built by IndexWriter while the captures
+    # are analysed:
+    #
+    #   root/meta.json            the captures, as they were when indexed
+    #   root/<part>/<column>.npy  runs of rows sorted by time, see IndexPart
+    #
+    # Only IP packets are indexed. Captures merged into one timeline
+    # (MergedCapture) share an index: a packet seen by several of them is in
+    # it once, at its corrected time.
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.captures = [entry['path'] for entry in self.meta['captures']]
+        self.parts = [IndexPart(os.path.join(root, name)) for name in sorted(os.listdir(root))
+                      if not name.endswith('.tmp') and os.path.isdir(os.path.join(root, name))]
+
+    @staticmethod
+    def prepare(root):
+        # Empties `root` for a new index, which can be opened once committed
+        shutil.rmtree(root, ignore_errors=True)
+        os.makedirs(root)
+
+    @classmethod
+    def commit(cls, root, captures):
+        captures = [os.path.abspath(path) for path in captures]
+        meta = {'captures': [{'path': path, 'size': os.stat(path).st_size, 'mtime': os.stat(path).st_mtime_ns}
+                             for path in captures],
+                'created': time.time()}
+        with open(os.path.join(root, 'meta.json.tmp'), 'w') as f:
+            json.dump(meta, f)
+        os.replace(os.path.join(root, 'meta.json.tmp'), os.path.join(root, 'meta.json'))
+        return cls(root)
+
+    @classmethod
+    def open(cls, root):
+        # The index at `root`, or None if there is none or a capture changed
+        # since it was built
+        try:
+            index = cls(root)
+        except FileNotFoundError:
+            return None
+        for entry in index.meta['captures']:
+            try:
+                stat = os.stat(entry['path'])
+            except FileNotFoundError:
+                return None
+            if stat.st_size != entry['size'] or stat.st_mtime_ns != entry['mtime']:
+                return None
+        return index
+
+    @property
+    def rows(self):
+        return sum(part.rows for part in self.parts)
+
+    def find(self, start=None, end=None, host=None, peer=None, where=None):
+        # (timestamp, capture, offset, length) columns of the packets in
+        # [start, end] (epoch ns) to or from `host`, and `peer` at the other
+        # end, in time order. Hosts are matched by their 64-bit hash, and of
+        # `where` only the hosts it requires are looked up; carve checks the
+        # rest of the expression.
+        hosts = [_host_key(name) for name in (host, peer) if name]
+        if where:
+            hosts.extend(address_hash(address_keys(values)) for name, values in
+                         compile_filter(where).pushdown().items() if name in ('host', 'src', 'dst'))
+        names = ['timestamp', 'capture', 'offset', 'length']
+        parts = []
+        for part in self.parts:
+            if (start is not None and part.end < start) or (end is not None and part.start > end):
+                continue
+            lo, hi = part.time_range('timestamp', start, end, 0)
+            rows = None
+            if host and peer:
+                rows = part.lookup('pair', _pair_keys(hosts[0], hosts[1]))
+            for key in hosts[2 if host and peer else 0:]:
+                # A host talking to itself is in the host index twice
+                matched = np.unique(part.lookup('host', key))
+                rows = matched if rows is None else np.intersect1d(rows, matched, assume_unique=True)
+            rows = np.arange(lo, hi) if rows is None else rows[(rows >= lo) & (rows < hi)]
+            if len(rows):
+                parts.append(part.read(names, rows))
+        if not parts:
+            return {'timestamp': np.zeros(0, dtype=np.int64), 'capture': np.zeros(0, dtype=np.uint8),
+                    'offset': np.zeros(0, dtype=np.int64), 'length': np.zeros(0, dtype=np.uint32)}
+        columns = {name: np.concatenate([part[name] for part in parts]) for name in names}
+        order = np.lexsort((columns['offset'], columns['capture'], columns['timestamp']))
+        return {name: values[order] for name, values in columns.items()}
+
+    def carve(self, output, start=None, end=None, host=None, peer=None, where=None, captures=None):
+        # Copies the packets found (see find) into a new capture, `output` (a
+        # path or a binary file), byte for byte as they are in the captures and
+        # after the file headers of the first one. Records that follow each
+        # other in a capture are copied in one go, in the kernel where possible.
+        # With `where`, the candidate records, and only those, are decoded to
+        # check the expression. `captures` picks captures by number. Returns
+        # the number of packets written.
+        rows = self.find(start, end, host, peer, where)
+        if captures is not None:
+            rows = {name: values[np.isin(rows['capture'], captures)] for name, values in rows.items()}
+        used = np.unique(rows['capture']).tolist() or [captures[0] if captures else 0]
+        headers = {number: self._header(number) for number in used}
+        if len(set(headers.values())) > 1:
+            raise ValueError("The captures have different file headers, carve them one at a time")
+        if where:
+            keep = self._matching(rows, where, headers)
+            rows = {name: values[keep] for name, values in rows.items()}
+        capture, offset, length = rows['capture'], rows['offset'], rows['length'].astype(np.int64)
+        # Runs of records that are back to back in the same capture
+        starts = np.flatnonzero(np.r_[True, (capture[1:] != capture[:-1]) |
+                                      (offset[1:] != offset[:-1] + length[:-1])]) if len(offset) else offset
+        runs = zip(capture[starts].tolist(), offset[starts].tolist(),
+                   (np.add.reduceat(length, starts) if len(starts) else length).tolist())
+        owns = isinstance(output, (str, bytes, os.PathLike))
+        fd = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644) if owns else output.fileno()
+        sources = {}
+        try:
+            if not owns:
+                output.flush()
+            _write_all(fd, headers[used[0]])
+            for number, position, size in runs:
+                if number not in sources:
+                    sources[number] = _Source(self.captures[number])
+                sources[number].copy(fd, position, size)
+        finally:
+            for source in sources.values():
+                source.close()
+            if owns:
+                os.close(fd)
+        return len(offset)
+
+    def _header(self, number):
+        with open(self.captures[number], 'rb') as f:
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    return capture_header(buf)
+            except ValueError:
+                raise PcapError('Not a pcap or pcapng capture')
+
+    def _matching(self, rows, where, headers):
+        # Which of the rows match `where`: their records are gathered, a slice
+        # at a time, into a small capture of their own and decoded
+        keep = np.zeros(len(rows['offset']), dtype=bool)
+        for number, header in headers.items():
+            candidates = np.flatnonzero(rows['capture'] == number)
+            lengths = rows['length'][candidates].astype(np.int64)
+            slices = np.flatnonzero(np.diff(np.cumsum(lengths) // DECODE_BYTES, prepend=0)).tolist()
+            with open(self.captures[number], 'rb') as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as capture:
+                for first, last in zip([0] + slices, slices + [len(candidates)]):
+                    if first == last:
+                        continue
+                    chosen = candidates[first:last]
+                    offsets = rows['offset'][chosen].tolist()
+                    sizes = lengths[first:last]
+                    buf = b''.join([header] + [capture[o:o + n] for o, n in zip(offsets, sizes.tolist())])
+                    # Where each record starts in the buffer
+                    positions = len(header) + np.cumsum(sizes) - sizes
+                    with PcapReader(io.BytesIO(buf), where=where, records=True) as reader:
+                        matched = [batch.record_offset for batch in reader]
+                    if matched:
+                        keep[chosen[np.searchsorted(positions, np.concatenate(matched))]] = True
+        return keep
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while len(view):
+        view = view[os.write(fd, view[:MAX_COPY]):]
+
+
+class _Source:
+    # A capture records are copied from: with sendfile, or from a memory map
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = None if SENDFILE else mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def copy(self, fd, offset, size):
+        if self.map is not None:
+            if offset + size > len(self.map):
+                raise PcapError(f"{self.path} is shorter than its index")
+            _write_all(fd, memoryview(self.map)[offset:offset + size])
+            return
+        while size:
+            sent = os.sendfile(fd, self.file.fileno(), offset, min(size, MAX_COPY))
+            if not sent:
+                raise PcapError(f"{self.path} is shorter than its index")
+            offset += sent
+            size -= sent
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+
+def incident_scopes(incidents):
+    # What to carve as the evidence of each incident of an IncidentTable: its
+    # time span and the hosts it is about, as keyword arguments of carve.
+    # That is its src and dst, only its src for incidents about all of a
+    # host's peers, and any host for incidents about the whole link.
+    if not len(incidents):
+        return []
+    src_names, src_index = format_addresses(incidents.src)
+    dst_names, dst_index = format_addresses(incidents.dst)
+    scopes = []
+    for i, name in enumerate(incidents.type_names().tolist()):
+        scope = {'start': int(incidents.first_seen[i]), 'end': int(incidents.last_seen[i]),
+                 'host': None, 'peer': None}
+        if name not in UNSCOPED_INCIDENTS:
+            scope['host'] = src_names[src_index[i]]
+            if name not in SOURCE_INCIDENTS:
+                scope['peer'] = dst_names[dst_index[i]]
+        scopes.append(scope)
+    return scopes
@@ -0,0 +1,372 @@
+import threading
+import numpy as np
+from custom_types import (FlowBatch, FLOW_END_REASONS, address_keys, address_hash,
+                          hash_combine, narrow_addresses)
+
+NS_PER_SECOND = 1_000_000_000
+FIN = 0x01
+RST = 0x04
+
+# Per-flow state; `lo`/`hi` are the two endpoints in hash order so both
+# directions of a conversation land on the same key
+_STATE = {
+    'key': np.uint64, 'protocol': np.uint8, 'src': 'V16', 'dst': 'V16',
+    'src_port': np.uint16, 'dst_port': np.uint16, 'first_seen': np.int64, 'last_seen': np.int64,
+    'lo_packets': np.int64, 'lo_bytes': np.int64, 'hi_packets': np.int64, 'hi_bytes': np.int64,
+    'tcp_flags': np.uint8, 'src_is_lo': bool, 'resumed': bool,
+}
+
+
+def _empty_state():
+    return {name: np.empty(0, dtype=dtype) for name, dtype in _STATE.items()}
+
+
+def _select(state, index):
+    return {name: column[index] for name, column in state.items()}
+
+
+def _flow_keys(src_keys, dst_keys, src_port, dst_port, protocol):
+    # Direction-independent flow key and whether the source is the `lo` endpoint
+    src_hash = address_hash(src_keys)
+    dst_hash = address_hash(dst_keys)
+    src_is_lo = (src_hash < dst_hash) | ((src_hash == dst_hash) & (src_port <= dst_port))
+    lo_hash = np.where(src_is_lo, src_hash, dst_hash)
+    hi_hash = np.where(src_is_lo, dst_hash, src_hash)
+    lo_port = np.where(src_is_lo, src_port, dst_port).astype(np.uint64)
+    hi_port = np.where(src_is_lo, dst_port, src_port).astype(np.uint64)
+    key = hash_combine(hash_combine(hash_combine(lo_hash, hi_hash), lo_port << np.uint64(16) | hi_port), protocol)
+    return key, src_is_lo
+
+
+def _ended(tcp_flags, first_seen, last_seen, now, idle_timeout, active_timeout, close_timeout):
+    # Why a flow has ended by packet time `now`, as an index into
+    # FLOW_END_REASONS, or -1 while it goes on. Of the timeouts that passed, the
+    # one that fired first in packet time names it: ACTIVE, then CLOSED, then
+    # IDLE. Packets in the same tick (the close timeout) as its last one still
+    # belong to the flow, so these checks only run between ticks.
+    tick = max(close_timeout, 1)
+    reasons = np.full(len(last_seen), -1, dtype=np.int64)
+    gap = now - last_seen
+    reasons[gap > idle_timeout] = FLOW_END_REASONS.index('IDLE')
+    reasons[((tcp_flags & (FIN | RST)) != 0) & (gap > close_timeout)] = FLOW_END_REASONS.index('CLOSED')
+    active = (last_seen - first_seen >= active_timeout) & (now // tick != last_seen // tick)
+    reasons[active] = FLOW_END_REASONS.index('ACTIVE')
+    return reasons
+
+
+def stitch_flows(flows, idle_timeout=60, active_timeout=1800, close_timeout=5):
+    # Joins the pieces of flows cut between chunks of a capture. A piece goes on
+    # with the next piece of the same flow unless one FlowTable reading both
+    # chunks would have ended it in between, whatever reason it was exported
+    # with at the end of its chunk; only evicted pieces are left alone. Pieces
+    # still open at the end of the capture end as that table's last expiry
+    # would have ended them.
+    if not len(flows):
+        return flows
+    idle_timeout *= NS_PER_SECOND
+    active_timeout *= NS_PER_SECOND
+    close_timeout *= NS_PER_SECOND
+    src_keys = address_keys(flows.src)
+    key, _ = _flow_keys(src_keys, address_keys(flows.dst), flows.src_port, flows.dst_port, flows.protocol)
+    order = np.lexsort((flows.first_seen, key))
+    key = key[order]
+    first_seen = flows.first_seen[order]
+    last_seen = flows.last_seen[order]
+    tcp_flags = flows.tcp_flags[order]
+    evicted = flows.end_reason[order] == FLOW_END_REASONS.index('EVICTED')
+    gap = first_seen[1:] - last_seen[:-1]
+    pending = np.flatnonzero((key[1:] == key[:-1]) & ~evicted[:-1] & (gap <= idle_timeout)) + 1
+
+    # Whether a piece joins depends on the flow it would join, so a piece
+    # waits for the one before it; the state of that flow so far is carried on
+    joined = np.zeros(len(order), dtype=bool)
+    flow_first, flow_last, flow_flags = first_seen.copy(), last_seen.copy(), tcp_flags.copy()
+    while len(pending):
+        ready = ~np.isin(pending - 1, pending)
+        rows = pending[ready]
+        prev = rows - 1
+        goes_on = _ended(flow_flags[prev], flow_first[prev], flow_last[prev], first_seen[rows],
+                         idle_timeout, active_timeout, close_timeout) < 0
+        rows, prev = rows[goes_on], prev[goes_on]
+        joined[rows] = True
+        flow_first[rows] = flow_first[prev]
+        flow_last[rows] = np.maximum(flow_last[rows], flow_last[prev])
+        flow_flags[rows] |= flow_flags[prev]
+        pending = pending[~ready]
+
+    starts = np.flatnonzero(~joined)
+    ends = np.r_[starts[1:], len(order)] - 1
+    first = order[starts]
+    initiator = first[np.cumsum(~joined) - 1]
+    # A later piece may have started from the other end of the conversation
+    forward = (src_keys[order] == src_keys[initiator]) & (flows.src_port[order] == flows.src_port[initiator])
+
+    def total(column, reverse):
+        return np.add.reduceat(np.where(forward, column[order], reverse[order]), starts)
+
+    end_reason = flows.end_reason[order][ends]
+    flushed = np.flatnonzero(end_reason == FLOW_END_REASONS.index('FLUSH'))
+    if len(flushed):
+        expired = _ended(flow_flags[ends[flushed]], flow_first[ends[flushed]], flow_last[ends[flushed]],
+                         int(last_seen.max()), idle_timeout, active_timeout, close_timeout)
+        end_reason[flushed[expired >= 0]] = expired[expired >= 0]
+    stitched = FlowBatch(
+        first_seen=flow_first[ends],
+        last_seen=flow_last[ends],
+        src=flows.src[first],
+        dst=flows.dst[first],
+        protocol=flows.protocol[first],
+        src_port=flows.src_port[first],
+        dst_port=flows.dst_port[first],
+        packets=total(flows.packets, flows.rev_packets),
+        bytes=total(flows.bytes, flows.rev_bytes),
+        rev_packets=total(flows.rev_packets, flows.packets),
+        rev_bytes=total(flows.rev_bytes, flows.bytes),
+        tcp_flags=flow_flags[ends],
+        end_reason=end_reason,
+    )
+    return stitched[np.argsort(stitched.first_seen, kind='stable')]
+
+
+class FlowTable:
+    # Aggregates packets into bidirectional 5-tuple flows. Each batch is reduced
+    # to one row per flow with NumPy and merged into a key-sorted table with
+    # searchsorted; finished flows are returned as FlowBatch records. Flows
+    # that end on their own are looked for every `expire_interval` seconds of
+    # capture time, not every batch.
+    # With `resumed`, the table starts partway through a capture (a chunk after
+    # the first): a flow it first sees within the idle timeout may go on from
+    # before and have seen a FIN, so it is cut at its first close gap without
+    # one and exported as FLUSH for stitch_flows to join or end.
+    def __init__(self, idle_timeout=60, active_timeout=1800, close_timeout=5, max_flows=1_000_000,
+                 resumed=False, expire_interval=5):
+        self.idle_timeout = idle_timeout * NS_PER_SECOND
+        self.active_timeout = active_timeout * NS_PER_SECOND
+        self.close_timeout = close_timeout * NS_PER_SECOND  # grace period after FIN/RST
+        self.max_flows = max_flows
+        self.expire_interval = max(expire_interval * NS_PER_SECOND, 1)
+        self.resumed = resumed
+        self.exported = 0
+        self._state = _empty_state()
+        self._lock = threading.Lock()
+        self._started = False
+        self._now = None  # newest packet time seen
+        self._next_expire = None  # capture time of the next look for ended flows
+        self._resume_until = -1  # resumed flows are first seen until then
+        self._ended_keys = np.empty(0, dtype=np.uint64)  # flows ended while resumed ones may still start
+
+    def __getstate__(self):
+        # Locks belong to one process, e.g. when sent to the live producer
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._state['key'])
+
+    def add(self, batch):
+        if not len(batch):
+            return FlowBatch.empty()
+        now = int(batch.timestamp.max())
+        with self._lock:
+            if self.resumed and not self._started:
+                self._resume_until = int(batch.timestamp.min()) + self.idle_timeout
+            self._started = True
+            # A flow that may end inside the batch shows up as several runs;
+            # merging them in order ends it before the run that starts the next
+            update = self._reduce(batch)
+            rank = update.pop('rank')
+            finished = [self._merge(_select(update, rank == r)) for r in range(int(rank.max()) + 1)]
+            self._now = now if self._now is None else max(self._now, now)
+            # Ended flows wait for the next look; one that gets another packet
+            # first is ended by _merge, so the flows come out the same
+            if self._next_expire is None or now >= self._next_expire:
+                self._next_expire = (now // self.expire_interval + 1) * self.expire_interval
+                finished.append(self._expire(now))
+            if now > self._resume_until:
+                self._resume_until = -1
+                self._ended_keys = self._ended_keys[:0]
+        return FlowBatch.concat(finished)
+
+    def _reduce(self, batch):
+        src_keys = address_keys(batch.src)
+        dst_keys = address_keys(batch.dst)
+        key, src_is_lo = _flow_keys(src_keys, dst_keys, batch.src_port, batch.dst_port, batch.protocol)
+
+        # Sorted by flow, then time, so the first row of each run is the initiator
+        order = np.lexsort((batch.timestamp, key))
+        key = key[order]
+        timestamp = batch.timestamp[order]
+        new_key = np.r_[True, key[1:] != key[:-1]]
+        starts = np.flatnonzero(new_key | self._may_end(key, timestamp, batch.tcp_flags[order], new_key))
+        run = np.arange(len(starts))
+        rank = run - np.maximum.accumulate(np.where(new_key[starts], run, 0))
+        from_lo = src_is_lo[order]
+        length = batch.length[order].astype(np.int64)
+        packets = np.diff(np.r_[starts, len(key)])
+        lo_packets = np.add.reduceat(from_lo.astype(np.int64), starts)
+        lo_bytes = np.add.reduceat(np.where(from_lo, length, 0), starts)
+        first_row = order[starts]
+        return {
+            'key': key[starts],
+            'protocol': batch.protocol[first_row],
+            'src': src_keys[first_row],
+            'dst': dst_keys[first_row],
+            'src_port': batch.src_port[first_row],
+            'dst_port': batch.dst_port[first_row],
+            'first_seen': timestamp[starts],
+            'last_seen': timestamp[np.r_[starts[1:], len(key)] - 1],
+            'lo_packets': lo_packets,
+            'lo_bytes': lo_bytes,
+            'hi_packets': packets - lo_packets,
+            'hi_bytes': np.add.reduceat(length, starts) - lo_bytes,
+            'tcp_flags': np.bitwise_or.reduceat(batch.tcp_flags[order], starts),
+            'src_is_lo': src_is_lo[first_row],
+            'resumed': np.zeros(len(starts), dtype=bool),
+            'rank': rank,
+        }
+
+    def _may_end(self, key, timestamp, tcp_flags, new_key):
+        # Where a flow sorted by key and time could end before a packet: after
+        # an idle gap, after a close gap once it has seen a FIN or RST, or in a
+        # new tick once it may have reached the active timeout. Only the flows
+        # runs are merged into know for sure, so this errs towards a cut.
+        first = np.flatnonzero(new_key)
+        flow = np.cumsum(new_key) - 1
+        found, pos = self._match({'key': key[first]})
+        known_fin = np.zeros(len(first), dtype=bool)
+        known_first = timestamp[first].copy()
+        if found.any():
+            state = self._state
+            known_fin[found] = ((state['tcp_flags'][pos[found]] & (FIN | RST)) != 0) | state['resumed'][pos[found]]
+            known_first[found] = np.minimum(known_first[found], state['first_seen'][pos[found]])
+        known_fin[~found] = timestamp[first][~found] <= self._resume_until
+        fin = (tcp_flags & (FIN | RST)) != 0
+        fins = np.cumsum(fin)
+        fin_before = known_fin[flow][1:] | (fins[:-1] > (fins - fin)[first][flow][1:])
+        gap = np.diff(timestamp)
+        tick = max(self.close_timeout, 1)
+        active = ((timestamp[:-1] - known_first[flow][1:] >= self.active_timeout)
+                  & (timestamp[1:] // tick != timestamp[:-1] // tick))
+        return np.r_[False, (gap > self.idle_timeout) | (fin_before & (gap > self.close_timeout)) | active]
+
+    def _match(self, update):
+        keys = self._state['key']
+        if not len(keys):
+            return np.zeros(len(update['key']), dtype=bool), np.zeros(len(update['key']), dtype=np.intp)
+        pos = np.minimum(np.searchsorted(keys, update['key']), len(keys) - 1)
+        return keys[pos] == update['key'], pos
+
+    def _merge(self, update):
+        finished = []
+        found, pos = self._match(update)
+        # A known flow that ended before the update ends now; the update starts a new one
+        ended = np.full(len(found), -1, dtype=np.int64)
+        if found.any():
+            state = _select(self._state, pos[found])
+            ended[found] = self._ended(state, update['first_seen'][found])
+        stale = ended >= 0
+        if stale.any():
+            finished.append(self._export(pos[stale], ended[stale], remove=True))
+            found, pos = self._match(update)
+
+        state = self._state
+        idx = pos[found]
+        state['first_seen'][idx] = np.minimum(state['first_seen'][idx], update['first_seen'][found])
+        state['last_seen'][idx] = np.maximum(state['last_seen'][idx], update['last_seen'][found])
+        for column in ('lo_packets', 'lo_bytes', 'hi_packets', 'hi_bytes'):
+            state[column][idx] += update[column][found]
+        state['tcp_flags'][idx] |= update['tcp_flags'][found]
+
+        new = ~found
+        if new.any():
+            update['resumed'] = new & (update['first_seen'] <= self._resume_until)
+            if len(self._ended_keys):
+                update['resumed'] &= ~np.isin(update['key'], self._ended_keys)
+            # The update is key-sorted too, so its new flows go where searchsorted
+            # puts them instead of sorting the whole table again
+            at = np.searchsorted(state['key'], update['key'][new])
+            self._state = {name: np.insert(state[name], at, update[name][new]) for name in state}
+        return FlowBatch.concat(finished)
+
+    def _expire(self, now):
+        state = self._state
+        if not len(state['key']):
+            return FlowBatch.empty()
+        # Flows that have ended are only exported here, so which batch this
+        # runs after does not change the flows
+        reasons = self._ended(state, now)
+        overflow = len(reasons) - np.count_nonzero(reasons >= 0) - self.max_flows
+        if overflow > 0:
+            # Table full: export the least recently seen flows early
+            candidates = np.flatnonzero(reasons < 0)
+            oldest = candidates[np.argpartition(state['last_seen'][candidates], overflow - 1)[:overflow]]
+            reasons[oldest] = FLOW_END_REASONS.index('EVICTED')
+        done = np.flatnonzero(reasons >= 0)
+        if not len(done):
+            return FlowBatch.empty()
+        return self._export(done, reasons[done], remove=True)
+
+    def _ended(self, state, now):
+        resumed = state['resumed']
+        reasons = _ended(state['tcp_flags'] | np.where(resumed, FIN, 0).astype(np.uint8), state['first_seen'],
+                         state['last_seen'], now, self.idle_timeout, self.active_timeout, self.close_timeout)
+        # Only a FIN from before would have closed it
+        maybe = resumed & (reasons == FLOW_END_REASONS.index('CLOSED')) & ((state['tcp_flags'] & (FIN | RST)) == 0)
+        reasons[maybe] = FLOW_END_REASONS.index('FLUSH')
+        return reasons
+
+    def _remove(self, rows, reason):
+        return self._export(rows, np.full(len(rows), FLOW_END_REASONS.index(reason)), remove=True)
+
+    def _export(self, rows, reasons, remove=False):
+        flows = self._records(_select(self._state, rows), reasons)
+        if remove:
+            keep = np.ones(len(self._state['key']), dtype=bool)
+            keep[rows] = False
+            if self._resume_until >= 0:
+                self._ended_keys = np.union1d(self._ended_keys, self._state['key'][rows])
+            self._state = _select(self._state, keep)
+            self.exported += len(rows)
+        return flows
+
+    @staticmethod
+    def _records(state, reasons):
+        src_is_lo = state['src_is_lo']
+        n = len(src_is_lo)
+        addresses = narrow_addresses(np.concatenate([state['src'], state['dst']]).view(np.uint8).reshape(-1, 16))
+        src, dst = addresses[:n], addresses[n:]
+        return FlowBatch(
+            first_seen=state['first_seen'],
+            last_seen=state['last_seen'],
+            src=src,
+            dst=dst,
+            protocol=state['protocol'],
+            src_port=state['src_port'],
+            dst_port=state['dst_port'],
+            packets=np.where(src_is_lo, state['lo_packets'], state['hi_packets']),
+            bytes=np.where(src_is_lo, state['lo_bytes'], state['hi_bytes']),
+            rev_packets=np.where(src_is_lo, state['hi_packets'], state['lo_packets']),
+            rev_bytes=np.where(src_is_lo, state['hi_bytes'], state['lo_bytes']),
+            tcp_flags=state['tcp_flags'],
+            end_reason=reasons,
+        )
+
+    def active(self):
+        # Snapshot of the flows still in progress
+        with self._lock:
+            rows = np.arange(len(self._state['key']))
+            return self._records(_select(self._state, rows), np.full(len(rows), FLOW_END_REASONS.index('ACTIVE')))
+
+    def flush(self):
+        # Export every remaining flow, e.g. at the end of a capture; those that
+        # ended since the last look keep the reason they ended for
+        with self._lock:
+            finished = [self._expire(self._now)] if self._now is not None else []
+            rows = np.arange(len(self._state['key']))
+            finished.append(self._remove(rows, 'FLUSH'))
+            return FlowBatch.concat(finished)
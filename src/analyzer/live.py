@@ -0,0 +1,264 @@
+import os
+import sys
+import time
+import fcntl
+import signal
+import threading
+import multiprocessing
+from collections import deque
+import numpy as np
+from custom_types import PROTOCOL_CODES
+from tools.snapshots import SnapshotChannel
+from tools.metrics import REGISTRY, stage
+
+LIVE_INTERVAL = 1  # seconds between live snapshots
+CHART_WINDOW = 3600  # seconds of per-second byte counts in a snapshot
+SNAPSHOT_INCIDENTS = 200  # incidents kept in a snapshot, new and recent ones
+STALE_INTERVALS = 10  # missed snapshots before the producer is restarted
+FIRST_SNAPSHOT_WAIT = 5.0  # seconds a reader waits for a producer it just started, which imports its modules first
+WAIT_POLL = 0.1  # seconds between a worker's checks for a new snapshot, made by one thread for all its streams
+WATCH_IDLE = 60  # seconds that thread keeps checking after the last wait
+
+HTTP_PROTOCOLS = [PROTOCOL_CODES['HTTP'], PROTOCOL_CODES['HTTPS']]
+
+
+def build_snapshot(analyzer, traffic_data, incidents, chart_window=CHART_WINDOW, recent=None):
+    # Everything the dashboard shows, as aggregates small enough to publish.
+    # `recent` is a deque of the latest incidents, newest first, that this
+    # snapshot's incidents are added to; a full redraw shows it.
+    seconds, _, byte_counts = analyzer.aggregator.series(chart_window)
+    flows = analyzer.current_flows()
+    http_flows = flows[np.isin(flows.protocol, HTTP_PROTOCOLS)]
+    ports, counts = np.unique(http_flows.dst_port, return_counts=True)
+    records = incidents.to_records()
+    if recent is None:
+        recent = deque(maxlen=SNAPSHOT_INCIDENTS)
+    recent.extendleft(reversed(records[:SNAPSHOT_INCIDENTS]))
+    return {
+        'version': analyzer.aggregator.version,
+        'packets': len(traffic_data),
+        'stats': traffic_data.stats,
+        'volume': {
+            'start': int(seconds[0]) if len(seconds) else 0,
+            'bytes': byte_counts.tolist()
+        },
+        'http': {
+            'flows': len(http_flows),
+            'packets': int(http_flows.total_packets.sum()),
+            'bytes': int(http_flows.total_bytes.sum()),
+            'ports': ports.tolist(),
+            'counts': counts.tolist()
+        },
+        'incident_count': len(records),
+        'incidents': records[:SNAPSHOT_INCIDENTS],
+        'recent_incidents': list(recent)
+    }
+
+
+def _exit(signum, frame):
+    sys.exit(0)
+
+
+def _publish(channel, snapshot, errors):
+    # A snapshot too big for the channel, e.g. during an incident storm with
+    # long details, is published with fewer incidents rather than not at all
+    try:
+        return channel.publish(snapshot)
+    except ValueError:
+        errors.labels('publish').inc()
+    while snapshot['incidents'] or snapshot['recent_incidents']:
+        snapshot['incidents'] = snapshot['incidents'][:len(snapshot['incidents']) // 2]
+        snapshot['recent_incidents'] = snapshot['recent_incidents'][:len(snapshot['recent_incidents']) // 2]
+        try:
+            return channel.publish(snapshot)
+        except ValueError:
+            pass
+    return channel.publish(snapshot)
+
+
+def run_producer(analyzer, detector, name, lock_path, interval=LIVE_INTERVAL):
+    # Body of the live producer process. The lock file makes sure only one
+    # runs; any other returns straight away.
+    lock = open(lock_path, 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return
+    # Terminating still cleans up the shared memory
+    signal.signal(signal.SIGTERM, _exit)
+    signal.signal(signal.SIGINT, _exit)
+    parent = os.getppid()
+    channel = SnapshotChannel(name, create=True)
+    # The metrics of this process are published with every snapshot, so any
+    # worker can serve them
+    if detector.sink is not None:
+        REGISTRY.counter('incident_log_events', 'Incidents handled by the incident log, by outcome', ['event'],
+                         function=lambda: {event: value for event, value in detector.sink.stats().items()
+                                           if event not in ('queued', 'blocked_seconds')})
+        REGISTRY.gauge('incident_log_queued', 'Incidents waiting to be written to the incident log',
+                       function=lambda: detector.sink.stats()['queued'])
+    cycle = REGISTRY.histogram('live_cycle_seconds', 'Time to produce and publish one live snapshot')
+    errors = REGISTRY.counter('live_errors', 'Live snapshots that failed or had to be trimmed, by stage', ['stage'])
+    recent = deque(maxlen=SNAPSHOT_INCIDENTS)
+    # Generated traffic is scored like any other, but must not train the anomaly models
+    detector.train_live = analyzer.live_capture() is not None
+    try:
+        # Stop with the worker that started us; another one takes over
+        while os.getppid() == parent:
+            started = time.monotonic()
+            try:
+                with cycle.time():
+                    traffic_data = analyzer.analyze_traffic()
+                    incidents = detector.detect_incidents(traffic_data)
+                    with stage('build_snapshot'):
+                        snapshot = build_snapshot(analyzer, traffic_data, incidents, recent=recent)
+                    if detector.sink is not None:
+                        # Published so any worker can report on the incident log
+                        snapshot['incident_sink'] = detector.sink.stats()
+                    snapshot['metrics'] = REGISTRY.collect()
+                    _publish(channel, snapshot, errors)
+            except Exception as e:
+                # A failed cycle is skipped; restarting the producer would only
+                # lose its state and fail the same way
+                errors.labels('cycle').inc()
+                print(f"Live snapshot failed: {e!r}", file=sys.stderr)
+            time.sleep(max(interval - (time.monotonic() - started), 0))
+    finally:
+        if detector.sink is not None:
+            detector.sink.close()
+        channel.close(unlink=True)
+        lock.close()
+
+
+class LiveFeed:
+    # What a web worker sees of the live traffic: the latest snapshot published
+    # by the one producer process shared by all workers. The snapshot is only
+    # decoded when it changed, and the producer is (re)started when no fresh
+    # snapshot shows up. The producer is a fresh interpreter (the spawn start
+    # method) that the analyzer and detector are pickled to: forking a web
+    # worker, which runs many threads, could copy locks some other thread
+    # holds (logging, SQLite, the metrics registry) into the producer.
+    def __init__(self, analyzer, detector, name, lock_path, interval=LIVE_INTERVAL):
+        self.analyzer = analyzer
+        self.detector = detector
+        self.name = name
+        self.lock_path = lock_path
+        self.interval = interval
+        self.channel = None
+        self.process = None
+        self._latest = None  # (sequence, publish time, snapshot)
+        self._last_start = None
+        self._attached = 0.0
+        self._lock = threading.Lock()
+        # Waiting streams sleep on this until the watcher thread sees a new
+        # snapshot; _seen is the (sequence, snapshot) it saw last
+        self._changed = threading.Condition(threading.Lock())
+        self._seen = None
+        self._watcher = None
+        self._last_wait = 0.0
+
+    def start(self):
+        if self.process is not None:
+            if self.process.is_alive():
+                return
+            self.process.join()
+        self.process = multiprocessing.get_context('spawn').Process(
+            target=run_producer,
+            args=(self.analyzer, self.detector, self.name, self.lock_path, self.interval),
+            daemon=True)
+        self.process.start()
+        self._last_start = time.monotonic()
+
+    def _attach(self):
+        try:
+            self.channel = SnapshotChannel(self.name)
+            self._attached = time.monotonic()
+        except FileNotFoundError:
+            self.channel = None
+        return self.channel
+
+    def _stale(self):
+        limit = STALE_INTERVALS * self.interval
+        if self._latest is None:
+            return time.monotonic() - self._attached > limit
+        return time.time() - self._latest[1] > limit
+
+    def current(self):
+        # (sequence, snapshot) of the latest snapshot, or (0, None) without one
+        with self._lock:
+            if self.channel is None and self._attach() is None:
+                # Nobody is producing yet: start the producer and give it a
+                # moment to publish its first snapshot
+                self._restart()
+                deadline = time.monotonic() + FIRST_SNAPSHOT_WAIT
+                while time.monotonic() < deadline:
+                    if (self.channel or self._attach()) and self.channel.sequence():
+                        break
+                    time.sleep(0.05)
+                if self.channel is None:
+                    return 0, None
+            if self._latest is None or self.channel.sequence() != self._latest[0]:
+                self._latest = self.channel.read() or self._latest
+            latest = self._latest
+            if self._stale():
+                # The producer is gone, or a new one created a new segment; the
+                # last snapshot is still shown until a new one arrives
+                self.channel.close()
+                self.channel = None
+                self._latest = None
+                self._restart()
+            return (latest[0], latest[2]) if latest else (0, None)
+
+    def latest(self):
+        return self.current()[1]
+
+    def wait(self, sequence, timeout):
+        # The first (sequence, snapshot) newer than `sequence`, or None if
+        # nothing was published within `timeout` seconds. Only the watcher
+        # thread reads the channel, however many streams wait.
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            self._last_wait = deadline
+            if self._watcher is None or not self._watcher.is_alive():
+                self._watcher = threading.Thread(target=self._watch, name='live-watcher', daemon=True)
+                self._watcher.start()
+            while self._seen is None or self._seen[0] == sequence:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._changed.wait(remaining)
+            return self._seen
+
+    def _watch(self):
+        # Body of the watcher thread; it stops once nobody waited for a while
+        while True:
+            with self._changed:
+                if time.monotonic() - self._last_wait > WATCH_IDLE:
+                    self._watcher = None
+                    return
+            try:
+                latest, snapshot = self.current()
+            except Exception as e:
+                # E.g. a torn read; the next check tries again
+                print(f"Live snapshot check failed: {e!r}", file=sys.stderr)
+                latest, snapshot = 0, None
+            if snapshot is not None and (self._seen is None or self._seen[0] != latest):
+                with self._changed:
+                    self._seen = (latest, snapshot)
+                    self._changed.notify_all()
+            time.sleep(WAIT_POLL)
+
+    def _restart(self):
+        # At most one attempt per interval; it is a no-op while another
+        # worker's producer holds the lock
+        if self._last_start is None or time.monotonic() - self._last_start >= self.interval:
+            self.start()
+
+    def stop(self):
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        if self.channel is not None:
+            self.channel.close()
+            self.channel = None
@@ -0,0 +1,245 @@
+import heapq
+import numpy as np
+from custom_types import PacketBatch
+from .pcap import PcapReader, BATCH_SIZE
+from .aggregate import NS_PER_SECOND
+from .decoders import DecoderStage
+
+DEDUP_WINDOW = 0.001  # seconds within which the same packet seen by two captures is one packet
+SKEW_SAMPLE = 50000  # packets per capture compared to estimate clock offsets
+RECENT_RECORDS = 65536  # app-layer records remembered before the old ones are forgotten
+
+
+def _sample(source, sample):
+    # (header hashes, timestamps) of the first packets of a capture, leaving
+    # out hashes that occur more than once
+    with PcapReader(source, batch_size=sample, hashes=True) as reader:
+        batch = next(iter(reader), None)
+    if batch is None:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+    hashes, first, counts = np.unique(batch.header_hash, return_index=True, return_counts=True)
+    return hashes[counts == 1], batch.timestamp[first[counts == 1]]
+
+
+def estimate_offsets(sources, sample=SKEW_SAMPLE):
+    # Clock offsets (seconds) to add to each capture's timestamps to line it up
+    # with the first one: the median time difference of the packets both saw
+    # among their first `sample`, or 0 for captures with none in common
+    reference_hashes, reference_times = _sample(sources[0], sample)
+    offsets = [0.0]
+    for source in sources[1:]:
+        hashes, times = _sample(source, sample)
+        _, mine, theirs = np.intersect1d(hashes, reference_hashes, assume_unique=True, return_indices=True)
+        if not len(mine):
+            offsets.append(0.0)
+            continue
+        offsets.append(float(np.median(reference_times[theirs] - times[mine])) / NS_PER_SECOND)
+    return offsets
+
+
+class _Cursor:
+    # One capture of a MergedCapture: its current batch in corrected time
+    # order, and how far it has been merged
+    def __init__(self, index, reader, offset):
+        self.index = index
+        self.reader = reader
+        self.offset = offset  # nanoseconds
+        self.batches = iter(reader)
+        self.batch = None
+        self.hashes = None
+        self.records = None
+        self.app = None
+        self.position = 0
+
+    def advance(self):
+        # Loads the next batch with packets; False at the end of the capture
+        for batch in self.batches:
+            order = np.argsort(batch.timestamp, kind='stable')
+            app = batch.app
+            hashes = batch.header_hash[order]
+            records = (batch.record_offset[order], batch.record_length[order]) if self.reader.records else None
+            batch = batch[order]
+            batch.timestamp += self.offset
+            self.batch, self.hashes, self.records, self.app, self.position = batch, hashes, records, app, 0
+            return True
+        self.batch = self.hashes = self.records = self.app = None
+        return False
+
+    @property
+    def last(self):
+        return int(self.batch.timestamp[-1])
+
+    def take(self, horizon):
+        # Rows up to and including `horizon`, from where the last take ended
+        end = int(np.searchsorted(self.batch.timestamp, horizon, side='right'))
+        rows = slice(self.position, end)
+        self.position = end
+        records = (self.records[0][rows], self.records[1][rows]) if self.records else None
+        return self.batch[rows], self.hashes[rows], records
+
+
+class MergedCapture:
+    # The packets of several captures of the same traffic, e.g. one per tap or
+    # sensor, as one stream of time-ordered batches. A heap keeps the captures
+    # ordered by the last timestamp of the batch each has loaded. Every packet
+    # up to the smallest of these is final: it is merged (one stable sort of
+    # already sorted runs) and yielded, and the capture at the top of the heap
+    # loads its next batch. So memory stays at about one batch per capture,
+    # however large the captures are. Each capture is taken to be in time
+    # order from one batch to the next.
+    #
+    # `offsets` (seconds per capture, or 'auto' for estimate_offsets) are added
+    # to the timestamps to correct clock skew between sensors. A packet that
+    # another capture already had within `dedup_window` seconds, recognised by
+    # its header hash, is dropped and counted in packets_duplicate. With
+    # `app_layer`, batches get the application-layer records decoded from each
+    # capture as `batch.app`, dropping those of dropped duplicates that match
+    # on their endpoints. `where` filters every capture as PcapReader does.
+    # With `records`, batches get the record ranges of their packets as
+    # PcapReader gives them, and the capture each came from as `batch.capture`.
+    def __init__(self, sources, offsets=None, dedup_window=DEDUP_WINDOW, batch_size=BATCH_SIZE,
+                 app_layer=False, where=None, records=False):
+        self.sources = list(sources)
+        if offsets == 'auto':
+            offsets = estimate_offsets(self.sources)
+        self.offsets = [float(offset) for offset in offsets] if offsets else [0.0] * len(self.sources)
+        if len(self.offsets) != len(self.sources):
+            raise ValueError(f"Expected {len(self.sources)} clock offsets, got {len(self.offsets)}")
+        self.window = int(dedup_window * NS_PER_SECOND)
+        self.app_layer = app_layer
+        self.readers = [PcapReader(source, batch_size=batch_size, decoders=DecoderStage() if app_layer else None,
+                                   where=where, hashes=True, records=records) for source in self.sources]
+        self.packets_duplicate = 0
+        # Rows yielded within the last window, which later duplicates are checked against
+        self._recent = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64))
+        self._records = {}  # endpoints of recent app-layer records -> (corrected time, capture)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for reader in self.readers:
+            reader.close()
+
+    @property
+    def packets_read(self):
+        return sum(reader.packets_read for reader in self.readers)
+
+    @property
+    def packets_skipped(self):
+        return sum(reader.packets_skipped for reader in self.readers)
+
+    @property
+    def packets_filtered(self):
+        return sum(reader.packets_filtered for reader in self.readers)
+
+    @property
+    def bytes_read(self):
+        return sum(reader.bytes_read for reader in self.readers)
+
+    @property
+    def bytes_trailing(self):
+        return sum(reader.bytes_trailing for reader in self.readers)
+
+    def __iter__(self):
+        cursors = [_Cursor(index, reader, int(round(offset * NS_PER_SECOND)))
+                   for index, (reader, offset) in enumerate(zip(self.readers, self.offsets))]
+        heap = []
+        records = []
+        for cursor in cursors:
+            if cursor.advance():
+                heapq.heappush(heap, (cursor.last, cursor.index))
+                records.extend(self._app_records(cursor))
+        while heap:
+            horizon = heap[0][0]
+            parts = []
+            for cursor in cursors:
+                if cursor.batch is not None:
+                    batch, hashes, ranges = cursor.take(horizon)
+                    if len(batch):
+                        parts.append((batch, hashes, np.full(len(batch), cursor.index, dtype=np.int64), ranges))
+            # Every capture whose batch ends at the horizon is used up
+            used = []
+            while heap and heap[0][0] <= horizon:
+                used.append(cursors[heapq.heappop(heap)[1]])
+            for cursor in used:
+                if cursor.advance():
+                    heapq.heappush(heap, (cursor.last, cursor.index))
+                    records.extend(self._app_records(cursor))
+            batch = self._merge(parts)
+            if self.app_layer:
+                batch.app, records = records, []
+            if len(batch) or batch.app:
+                yield batch
+
+    def _merge(self, parts):
+        if not parts:
+            return PacketBatch.empty()
+        batch = PacketBatch.concat([part[0] for part in parts])
+        hashes = np.concatenate([part[1] for part in parts])
+        captures = np.concatenate([part[2] for part in parts])
+        records = None
+        if parts[0][3] is not None:
+            records = (np.concatenate([part[3][0] for part in parts]), np.concatenate([part[3][1] for part in parts]))
+        if len(parts) > 1:
+            order = np.argsort(batch.timestamp, kind='stable')
+            batch, hashes, captures = batch[order], hashes[order], captures[order]
+            if records is not None:
+                records = (records[0][order], records[1][order])
+        keep = self._unique(batch.timestamp, hashes, captures)
+        if not keep.all():
+            self.packets_duplicate += len(keep) - int(np.count_nonzero(keep))
+            batch, hashes, captures = batch[keep], hashes[keep], captures[keep]
+            if records is not None:
+                records = (records[0][keep], records[1][keep])
+        batch.header_hash = hashes
+        if records is not None:
+            batch.record_offset, batch.record_length = records
+            batch.capture = captures
+        return batch
+
+    def _unique(self, timestamps, hashes, captures):
+        # Rows not seen before: a row is a duplicate when the row before it in
+        # (hash, time) order has the same hash, is from another capture and is
+        # at most a window earlier. Rows yielded within the last window come
+        # first, so duplicates across batches are found too.
+        recent_times, recent_hashes, recent_captures = self._recent
+        times = np.concatenate([recent_times, timestamps])
+        all_hashes = np.concatenate([recent_hashes, hashes])
+        all_captures = np.concatenate([recent_captures, captures])
+        order = np.lexsort((times, all_hashes))
+        ordered_times = times[order]
+        duplicate = np.zeros(len(times), dtype=bool)
+        duplicate[order[1:]] = ((all_hashes[order[1:]] == all_hashes[order[:-1]]) &
+                                (ordered_times[1:] - ordered_times[:-1] <= self.window) &
+                                (all_captures[order[1:]] != all_captures[order[:-1]]))
+        keep = ~duplicate[len(recent_times):]
+        if len(times):
+            recent = times >= times.max() - self.window
+            recent[len(recent_times):] &= keep
+            self._recent = (times[recent], all_hashes[recent], all_captures[recent])
+        return keep
+
+    def _app_records(self, cursor):
+        # Records of the batch a capture just loaded, in corrected time, less
+        # those another capture already had within the window
+        if not cursor.app:
+            return []
+        kept = []
+        for record in cursor.app:
+            record['timestamp'] += cursor.offset
+            key = (record['protocol'], record['src'], record['dst'], record['src_port'], record['dst_port'])
+            seen = self._records.get(key)
+            if seen is not None and seen[1] != cursor.index and abs(record['timestamp'] - seen[0]) <= self.window:
+                continue
+            self._records[key] = (record['timestamp'], cursor.index)
+            kept.append(record)
+        if len(self._records) > RECENT_RECORDS:
+            # Forget records that are too old to match any more
+            latest = max(time for time, _ in self._records.values())
+            self._records = {key: value for key, value in self._records.items()
+                             if value[0] >= latest - self.window}
+        return kept
@@ -0,0 +1,203 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from custom_types import FlowBatch, IncidentTable
+from storage import TrafficStore
+from tools.filters import compile_filter
+from .pcap import PcapReader, split_capture, BATCH_SIZE
+from .aggregate import CaptureSummary
+from .flows import FlowTable, stitch_flows
+from .decoders import DecoderStage, AppSummary
+from .merge import MergedCapture, DEDUP_WINDOW
+from .evidence import CaptureIndex, IndexWriter
+
+
+class CaptureAnalysis:
+    # Result of analysing a capture, or one chunk of it
+    def __init__(self, summary, flows, incidents, packets_read=0, packets_skipped=0, bytes_read=0, app=None,
+                 packets_filtered=0, packets_duplicate=0, offsets=None, bytes_trailing=0):
+        self.summary = summary
+        self.flows = flows
+        self.incidents = incidents
+        self.app = app  # AppSummary of the decoded payloads, if they were decoded
+        self.packets_read = packets_read
+        self.packets_skipped = packets_skipped
+        self.packets_filtered = packets_filtered  # IP packets left out by a filter
+        self.bytes_read = bytes_read
+        self.bytes_trailing = bytes_trailing  # bytes after the last whole record, left unread
+        # Of merged captures: packets seen by two of them, and the clock offsets applied
+        self.packets_duplicate = packets_duplicate
+        self.offsets = offsets
+
+
+def new_detector(detector_class, thresholds, window):
+    # A detector rebuilt in another process from its class and settings
+    detector = detector_class()
+    detector.thresholds = thresholds
+    detector.window = window
+    return detector
+
+
+def _analyze_batches(reader, detector, store, flow_table, app_layer, progress=None, index=None,
+                     resumed=False, cut=False):
+    # Runs the batches of a PcapReader (or MergedCapture) through the summary,
+    # flow table, store, detector and packet index; `resumed` and `cut` say the
+    # reader starts or stops partway through the capture
+    stream = detector.new_stream(resumed=resumed, cut=cut) if detector else None
+    summary = CaptureSummary()
+    app = AppSummary() if app_layer else None
+    flows, incidents = [], []
+    for batch in reader:
+        summary.add(batch)
+        if app is not None:
+            app.add(batch.app)
+        flows.append(flow_table.add(batch))
+        if store:
+            store.append('packets', batch)
+        if index:
+            index.add(batch)
+        if detector:
+            incidents.append(detector.detect_incidents(batch, stream))
+        if progress:
+            progress(reader.bytes_read, reader.packets_read)
+    if detector:
+        incidents.append(detector.finish_stream(stream))
+    # Flows still open at the end of the chunk are stitched to the next one
+    flows.append(flow_table.flush())
+    if store:
+        store.flush()
+    if index:
+        index.flush()
+    return CaptureAnalysis(summary, FlowBatch.concat(flows), IncidentTable.concat(incidents),
+                           reader.packets_read, reader.packets_skipped, reader.bytes_read, app,
+                           reader.packets_filtered, bytes_trailing=reader.bytes_trailing)
+
+
+def _analyze_range(source, header, byte_range, detector_args, batch_size, idle_timeout, active_timeout,
+                   store_root=None, app_layer=False, where=None, index_root=None, progress=None):
+    # Runs in a worker process, so everything it needs comes in picklable form
+    detector = new_detector(*detector_args) if detector_args else None
+    store = TrafficStore(store_root) if store_root else None
+    index = IndexWriter(index_root) if index_root else None
+    # Chunks after the first start partway through flows and host windows,
+    # chunks before the last stop partway through them
+    resumed = byte_range[0] > len(header)
+    cut = byte_range[1] < os.path.getsize(source)
+    flow_table = FlowTable(idle_timeout=idle_timeout, active_timeout=active_timeout, resumed=resumed)
+    with PcapReader(source, batch_size=batch_size, header=header, byte_range=byte_range,
+                    decoders=DecoderStage() if app_layer else None, where=where, records=bool(index)) as reader:
+        return _analyze_batches(reader, detector, store, flow_table, app_layer, progress, index, resumed, cut)
+
+
+def _check_index(index_root, where):
+    # An index of only the packets a filter kept would pass for the whole capture
+    if index_root and where is not None:
+        raise ValueError("A packet index is only built when the whole capture is analysed")
+
+
+def default_workers():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def analyze_capture(source, workers=None, detector=None, chunks=None, batch_size=BATCH_SIZE,
+                    idle_timeout=60, active_timeout=1800, store_root=None, app_layer=False, where=None,
+                    progress=None, index_root=None):
+    # Splits a capture file into record-aligned byte ranges, analyses them in a
+    # process pool and merges the partial results. The stateful detectors see
+    # each chunk on its own, so activity straddling a boundary can be missed:
+    # scans, beacons and exfiltration are chunk-local, and anomaly scoring
+    # leaves out the host windows a chunk edge cuts short. Bursts are counted
+    # again over the merged per-second totals, so they are not.
+    # Flows come out as from one pass, except that a flow reaching the active
+    # timeout in a chunk it did not start in is cut at the next chunk edge.
+    # `progress(bytes_read, packets_read)` is called as the analysis advances.
+    # With `store_root`, packets and flows are also kept in that TrafficStore.
+    # With `app_layer`, HTTP, TLS and DNS payloads are decoded and summarised.
+    # With `where`, a filter expression, only the matching packets are analysed.
+    # With `index_root`, a CaptureIndex of the packets is built there.
+    _check_index(index_root, where)
+    workers = workers or default_workers()
+    # More chunks than workers keeps every core busy until the end; one worker
+    # reads the capture in one go
+    header, ranges = split_capture(source, 1 if workers == 1 else chunks or workers * 4)
+    detector_args = (type(detector), detector.thresholds, detector.window) if detector else None
+    if where is not None:
+        # Fails here on a bad expression; workers get the text, which pickles
+        where = str(compile_filter(where))
+    if index_root:
+        CaptureIndex.prepare(index_root)
+    args = [(source, header, byte_range, detector_args, batch_size, idle_timeout, active_timeout, store_root,
+             app_layer, where, index_root) for byte_range in ranges]
+    if workers == 1 or len(ranges) == 1:
+        parts = []
+        for a in args:
+            done_bytes = sum(part.bytes_read for part in parts)
+            done_packets = sum(part.packets_read for part in parts)
+            report = (lambda b, p: progress(done_bytes + b, done_packets + p)) if progress else None
+            parts.append(_analyze_range(*a, progress=report))
+    else:
+        with ProcessPoolExecutor(min(workers, len(ranges))) as pool:
+            futures = [pool.submit(_analyze_range, *a) for a in args]
+            if progress:
+                done_bytes = done_packets = 0
+                for future in as_completed(futures):
+                    done_bytes += future.result().bytes_read
+                    done_packets += future.result().packets_read
+                    progress(done_bytes, done_packets)
+            parts = [future.result() for future in futures]
+
+    summary = CaptureSummary()
+    for part in parts:
+        summary.merge(part.summary)
+    flows = stitch_flows(FlowBatch.concat([part.flows for part in parts]), idle_timeout, active_timeout)
+    if index_root:
+        CaptureIndex.commit(index_root, [source])
+    if store_root:
+        store = TrafficStore(store_root)
+        store.append('flows', flows)
+        store.flush()
+    app = None
+    if app_layer:
+        app = AppSummary()
+        for part in parts:
+            app.merge(part.app)
+    incidents = IncidentTable.empty()
+    if detector:
+        incidents = detector.merge_incidents([part.incidents for part in parts], summary.per_second())
+    return CaptureAnalysis(summary, flows, incidents,
+                           sum(part.packets_read for part in parts),
+                           sum(part.packets_skipped for part in parts),
+                           sum(part.bytes_read for part in parts), app,
+                           sum(part.packets_filtered for part in parts),
+                           bytes_trailing=sum(part.bytes_trailing for part in parts))
+
+
+def analyze_captures(sources, detector=None, offsets=None, dedup_window=DEDUP_WINDOW, batch_size=BATCH_SIZE,
+                     idle_timeout=60, active_timeout=1800, store_root=None, app_layer=False, where=None,
+                     progress=None, index_root=None):
+    # Analyses captures of the same traffic from several taps or sensors as one
+    # capture, their packets merged in time order and told apart from copies
+    # seen twice (see MergedCapture; `offsets` may be 'auto'). Everything runs
+    # in this process, as one flow table and one detector see the whole
+    # timeline. Other arguments are as for analyze_capture; the captures share
+    # one index.
+    _check_index(index_root, where)
+    store = TrafficStore(store_root) if store_root else None
+    index = None
+    if index_root:
+        CaptureIndex.prepare(index_root)
+        index = IndexWriter(index_root)
+    flow_table = FlowTable(idle_timeout=idle_timeout, active_timeout=active_timeout)
+    with MergedCapture(sources, offsets, dedup_window, batch_size, app_layer, where, records=bool(index)) as merged:
+        result = _analyze_batches(merged, detector, store, flow_table, app_layer, progress, index)
+        result.packets_duplicate = merged.packets_duplicate
+        result.offsets = merged.offsets
+    if index_root:
+        CaptureIndex.commit(index_root, sources)
+    if store:
+        store.append('flows', result.flows)
+        store.flush()
+    if detector:
+        result.incidents = detector.merge_incidents([result.incidents], result.summary.per_second())
+    return result
@@ -0,0 +1,656 @@
+import mmap
+import os
+import struct
+import numpy as np
+from custom_types import PacketBatch, PROTOCOLS, ipv4_to_mapped, narrow_addresses, address_hashes, hash_combine
+from tools.filters import compile_filter
+
+# Link-layer header types (https://www.tcpdump.org/linktypes.html)
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+
+HTTP_PORTS = [80, 8000, 8080]
+HTTPS_PORTS = [443, 8443]
+
+PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1000),  # little endian, microseconds
+    b'\xa1\xb2\xc3\xd4': ('>', 1000),
+    b'\x4d\x3c\xb2\xa1': ('<', 1),     # little endian, nanoseconds
+    b'\xa1\xb2\x3c\x4d': ('>', 1),
+}
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 0x00000001
+PCAPNG_PB = 0x00000002
+PCAPNG_SPB = 0x00000003
+PCAPNG_NRB = 0x00000004
+PCAPNG_ISB = 0x00000005
+PCAPNG_EPB = 0x00000006
+PCAPNG_BLOCKS = {PCAPNG_IDB, PCAPNG_PB, PCAPNG_SPB, PCAPNG_NRB, PCAPNG_ISB, PCAPNG_EPB}
+
+CHUNK_SIZE = 4 * 1024 * 1024
+BATCH_SIZE = 65536
+MAX_RECORD = 0x40000  # largest snapshot length libpcap writes
+MAX_BLOCK = 16 * 1024 * 1024  # largest pcapng block libpcap reads
+RESYNC_RECORDS = 8  # consecutive valid records needed to trust a resync point
+
+
+class PcapError(ValueError):
+    pass
+
+
+def _u8(data, pos):
+    return data[np.minimum(pos, len(data) - 1)]
+
+
+def _u16(data, pos):
+    return (_u8(data, pos).astype(np.uint16) << 8) | _u8(data, pos + 1)
+
+
+def _u32(data, pos):
+    return (_u16(data, pos).astype(np.uint32) << 16) | _u16(data, pos + 2)
+
+
+def _bytes16(data, pos):
+    idx = np.minimum(pos[:, None] + np.arange(16), len(data) - 1)
+    return data[idx]
+
+
+def payload_heads(data, offsets, lengths, size=8):
+    # First `size` bytes of each payload as (n, size) uint8 rows, zero past its end
+    idx = offsets[:, None] + np.arange(size)
+    heads = data[np.minimum(idx, len(data) - 1)]
+    heads[idx >= (offsets + lengths)[:, None]] = 0
+    return heads
+
+
+def _header_hashes(data, end, l3, l4, v4, ip_proto, batch):
+    # Hash of what stays the same while a packet crosses the network, to tell
+    # one packet seen at two taps from another: the addresses, the IP length
+    # and identification (IPv4) or flow label (IPv6), and the first 16 bytes
+    # from the transport header on (ports, sequence numbers, checksums). TTL
+    # and the IP checksum change at every hop and are left out.
+    ip = np.where(v4, _u16(data, l3 + 2).astype(np.uint64) << np.uint64(32) | _u32(data, l3 + 4),
+                  (_u32(data, l3) & 0xFFFFF).astype(np.uint64) << np.uint64(16) | _u16(data, l3 + 4))
+    transport = payload_heads(data, l4, np.maximum(end - l4, 0), 16).view('<u8')
+    digest = hash_combine(hash_combine(address_hashes(batch.src), address_hashes(batch.dst)), ip)
+    digest = hash_combine(hash_combine(digest, ip_proto), transport[:, 0])
+    return hash_combine(digest, transport[:, 1])
+
+
+def decode_records(data, offsets, caplens, wirelens, timestamps, linktypes, payloads=False, hashes=False,
+                   rows=False):
+    # Vectorized decode of the link, network and transport headers of a batch
+    # of records. `data` is a uint8 view of the buffer holding the records and
+    # `offsets` point at the first link-layer byte of each of them. With
+    # `payloads`, also returns where each kept packet's TCP/UDP payload starts
+    # in `data` and how long it is; with `hashes`, then a hash of the headers
+    # of each kept packet that identifies it across captures; with `rows`,
+    # then the position of each kept packet among the records.
+    offsets = np.asarray(offsets, dtype=np.int64)
+    caplens = np.asarray(caplens, dtype=np.int64)
+    linktypes = np.broadcast_to(np.asarray(linktypes, dtype=np.int64), offsets.shape)
+    n = len(offsets)
+
+    etype = np.zeros(n, dtype=np.uint16)
+    l3 = offsets.copy()
+
+    eth = linktypes == LINKTYPE_ETHERNET
+    if eth.any():
+        etype[eth] = _u16(data, offsets[eth] + 12)
+        l3[eth] = offsets[eth] + 14
+        # Up to two stacked 802.1Q / 802.1ad tags
+        for _ in range(2):
+            tagged = eth & np.isin(etype, (0x8100, 0x88A8, 0x9100))
+            if not tagged.any():
+                break
+            etype[tagged] = _u16(data, l3[tagged] + 2)
+            l3[tagged] += 4
+
+    sll = linktypes == LINKTYPE_LINUX_SLL
+    if sll.any():
+        etype[sll] = _u16(data, offsets[sll] + 14)
+        l3[sll] = offsets[sll] + 16
+
+    null = (linktypes == LINKTYPE_NULL) | (linktypes == LINKTYPE_LOOP)
+    if null.any():
+        # 4-byte address family in either byte order, only one byte is set
+        family = _u8(data, offsets[null]) | _u8(data, offsets[null] + 3)
+        etype[null] = np.where(family == 2, 0x0800,
+                               np.where(np.isin(family, (24, 28, 30)), 0x86DD, 0))
+        l3[null] = offsets[null] + 4
+
+    raw = np.isin(linktypes, (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6))
+    if raw.any():
+        version = _u8(data, offsets[raw]) >> 4
+        etype[raw] = np.where(version == 4, 0x0800, np.where(version == 6, 0x86DD, 0))
+
+    first = _u8(data, l3)
+    l3_len = caplens - (l3 - offsets)
+    v4 = (etype == 0x0800) & (first >> 4 == 4) & (l3_len >= 20)
+    v6 = (etype == 0x86DD) & (first >> 4 == 6) & (l3_len >= 40)
+
+    ip_proto = np.where(v4, _u8(data, l3 + 9), np.where(v6, _u8(data, l3 + 6), 0)).astype(np.uint8)
+    fragment = v4 & ((_u16(data, l3 + 6) & 0x1FFF) != 0)
+    l4 = np.where(v4, l3 + (first & 0x0F).astype(np.int64) * 4, l3 + 40)
+    l4_len = caplens - (l4 - offsets)
+
+    tcp = (v4 | v6) & (ip_proto == 6) & ~fragment
+    udp = (v4 | v6) & (ip_proto == 17) & ~fragment
+    icmp = (v4 & (ip_proto == 1)) | (v6 & (ip_proto == 58))
+    ported = (tcp | udp) & (l4_len >= 4)
+
+    src_port = np.where(ported, _u16(data, l4), 0).astype(np.uint16)
+    dst_port = np.where(ported, _u16(data, l4 + 2), 0).astype(np.uint16)
+    tcp_flags = np.where(tcp & (l4_len >= 14), _u8(data, l4 + 13), 0).astype(np.uint8)
+
+    protocol = np.zeros(n, dtype=np.uint8)
+    protocol[tcp] = PROTOCOLS.index('TCP')
+    protocol[udp] = PROTOCOLS.index('UDP')
+    protocol[icmp] = PROTOCOLS.index('ICMP')
+    http = tcp & (np.isin(dst_port, HTTP_PORTS) | np.isin(src_port, HTTP_PORTS))
+    https = tcp & (np.isin(dst_port, HTTPS_PORTS) | np.isin(src_port, HTTPS_PORTS))
+    protocol[http] = PROTOCOLS.index('HTTP')
+    protocol[https] = PROTOCOLS.index('HTTPS')
+
+    # Frames without an IP header (ARP, LLDP, ...) are dropped
+    keep = v4 | v6
+    if v6.any():
+        src = ipv4_to_mapped(_u32(data, l3 + 12))
+        dst = ipv4_to_mapped(_u32(data, l3 + 16))
+        src[v6] = _bytes16(data, l3[v6] + 8)
+        dst[v6] = _bytes16(data, l3[v6] + 24)
+    else:
+        src = _u32(data, l3 + 12)
+        dst = _u32(data, l3 + 16)
+    batch = PacketBatch(
+        timestamp=np.asarray(timestamps, dtype=np.int64)[keep],
+        src=src[keep],
+        dst=dst[keep],
+        protocol=protocol[keep],
+        length=np.minimum(np.asarray(wirelens)[keep], 0xFFFF),
+        src_port=src_port[keep],
+        dst_port=dst_port[keep],
+        tcp_flags=tcp_flags[keep],
+    )
+    if not payloads and not hashes and not rows:
+        return batch
+    extra = []
+    if payloads:
+        extra.extend(_payloads(data, offsets, caplens, v4, tcp, udp, l3, l4, l4_len, keep))
+    if hashes:
+        extra.append(_header_hashes(data, (offsets + caplens)[keep], l3[keep], l4[keep], v4[keep],
+                                    ip_proto[keep], batch))
+    if rows:
+        extra.append(np.flatnonzero(keep))
+    return (batch, *extra)
+
+
+def _payloads(data, offsets, caplens, v4, tcp, udp, l3, l4, l4_len, keep):
+    # The payload ends at the captured length or the IP length, whichever comes
+    # first, so Ethernet padding of short frames is not taken for payload
+    ip_end = np.where(v4, l3 + _u16(data, l3 + 2), l3 + 40 + _u16(data, l3 + 4))
+    tcp_header = (_u8(data, l4 + 12) >> 4).astype(np.int64) * 4
+    start = np.where(tcp, l4 + tcp_header, l4 + 8)
+    valid = (tcp & (l4_len >= 20) & (tcp_header >= 20)) | (udp & (l4_len >= 8))
+    payload_len = np.where(valid, np.maximum(np.minimum(offsets + caplens, ip_end) - start, 0), 0)
+    return start[keep], payload_len[keep]
+
+
+class PcapReader:
+    # `header` and `byte_range` read a slice of a capture on its own: the header
+    # holds the file (and pcapng interface) headers and the range must start on
+    # a record boundary, as found by `find_record`. With a `decoders` stage
+    # (analyzer.decoders.DecoderStage), each batch also gets the application
+    # layer records found in its payloads as `batch.app`. With a `where`
+    # filter (tools.filters), only the matching packets are kept, before any
+    # payload is decoded. With `hashes`, each batch gets the header hashes of
+    # its packets as `batch.header_hash`, see decode_records. With `records`,
+    # it gets where the record (or pcapng block) of each packet starts in the
+    # file and how long it is as `batch.record_offset` and `batch.record_length`.
+    def __init__(self, source, batch_size=BATCH_SIZE, use_mmap=True, chunk_size=CHUNK_SIZE,
+                 header=None, byte_range=None, decoders=None, where=None, hashes=False, records=False):
+        self.batch_size = batch_size
+        self.decoders = decoders
+        self.hashes = hashes
+        self.records = records
+        self.where = compile_filter(where) if where else None
+        self.packets_filtered = 0
+        self.chunk_size = chunk_size
+        self.header = header
+        self.packets_read = 0
+        self.packets_skipped = 0
+        self.bytes_read = 0
+        self.bytes_trailing = 0  # bytes after the last whole record, e.g. of a capture cut short
+        self._owns_file = isinstance(source, (str, bytes, os.PathLike))
+        self._file = open(source, 'rb') if self._owns_file else source
+        self._end = None
+        self._base = 0  # file offset of the buffer the walker is in
+        if byte_range is not None:
+            self._file.seek(byte_range[0])
+            self._end = byte_range[1]
+        self._mmap = None
+        self._view = None
+        if use_mmap:
+            try:
+                self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (AttributeError, OSError, ValueError):
+                self._mmap = None
+        if self._mmap is not None:
+            self._view = self._mmap if self._end is None else memoryview(self._mmap)[:self._end]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if isinstance(self._view, memoryview):
+            self._view.release()
+        self._view = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._owns_file:
+            self._file.close()
+
+    def __iter__(self):
+        for buf, offsets, caplens, wirelens, timestamps, linktypes, records in self._iter_records():
+            data = np.frombuffer(buf, dtype=np.uint8)
+            if self.decoders is None and not self.hashes and not self.records:
+                batch, extra = decode_records(data, offsets, caplens, wirelens, timestamps, linktypes), []
+            else:
+                batch, *extra = decode_records(data, offsets, caplens, wirelens, timestamps, linktypes,
+                                               payloads=self.decoders is not None, hashes=self.hashes,
+                                               rows=self.records)
+            self.packets_read += len(offsets)
+            self.packets_skipped += len(offsets) - len(batch)
+            if self.where is not None and len(batch):
+                keep = self.where.mask(batch)
+                self.packets_filtered += len(batch) - int(np.count_nonzero(keep))
+                batch = batch[keep]
+                extra = [column[keep] for column in extra]
+            if self.records:
+                rows = extra.pop()
+                batch.record_offset = self._base + records[0][rows]
+                batch.record_length = records[1][rows]
+            if self.hashes:
+                batch.header_hash = extra.pop()
+            if self.decoders is not None:
+                batch.app = self.decoders.decode(buf, data, batch, *extra)
+            del data
+            if len(batch):
+                yield batch
+
+    def _iter_chunks(self):
+        # Yields (buffer, start) pairs and is sent back how far the walker got,
+        # so the unconsumed tail of one chunk is carried over to the next.
+        if self._mmap is not None:
+            pos = self._file.tell()
+            while pos < len(self._view):
+                consumed = yield self._view, pos
+                if consumed == pos:
+                    return
+                # Let the kernel drop the pages we have already decoded
+                page_start = pos - pos % mmap.PAGESIZE
+                page_end = consumed - consumed % mmap.PAGESIZE
+                if page_end > page_start and hasattr(mmap, 'MADV_DONTNEED'):
+                    self._mmap.madvise(mmap.MADV_DONTNEED, page_start, page_end - page_start)
+                pos = consumed
+            return
+        tail = b''
+        eof = False
+        starved = False
+        self._base = self._file.tell()
+        remaining = None if self._end is None else self._end - self._base
+        while True:
+            if not eof and (starved or len(tail) < self.chunk_size):
+                size = self.chunk_size if remaining is None else min(self.chunk_size, remaining)
+                chunk = self._file.read(size) if size else b''
+                if remaining is not None:
+                    remaining -= len(chunk)
+                eof = not chunk
+                tail += chunk
+            if not tail:
+                return
+            consumed = yield tail, 0
+            if consumed == 0 and eof:
+                return
+            # Nothing consumed means a record is split across the chunk boundary. The walkers
+            # reject oversized lengths, so the tail never grows past one chunk plus one block.
+            starved = consumed == 0
+            tail = tail[consumed:]
+            self._base += consumed
+
+    def _iter_records(self):
+        chunks = self._iter_chunks()
+        try:
+            buf, pos = next(chunks)
+        except StopIteration:
+            return
+        walker = self._walker(bytes(buf[pos:pos + 4]) if self.header is None else self.header[:4])
+        state = {}
+        if self.header is not None:
+            # Only sets up the walker state, the header holds no packets
+            walker(self.header, 0, state)
+        while True:
+            consumed, records = walker(buf, pos, state)
+            self.bytes_read += consumed - pos
+            if records is not None:
+                yield (buf,) + records
+            try:
+                buf, pos = chunks.send(consumed)
+            except StopIteration:
+                # The chunks stop once the walker gets no further
+                self.bytes_trailing = len(buf) - consumed
+                return
+
+    def _walker(self, magic):
+        if magic in PCAP_MAGIC:
+            return self._walk_pcap
+        if len(magic) == 4 and struct.unpack('<I', magic)[0] == PCAPNG_SHB:
+            return self._walk_pcapng
+        raise PcapError('Not a pcap or pcapng capture')
+
+    def _walk_pcap(self, buf, pos, state):
+        if 'endian' not in state:
+            if len(buf) - pos < 24:
+                return pos, None
+            state['endian'], state['scale'] = PCAP_MAGIC[bytes(buf[pos:pos + 4])]
+            state['linktype'] = struct.unpack_from(state['endian'] + 'I', buf, pos + 20)[0] & 0x0FFFFFFF
+            state['record'] = struct.Struct(state['endian'] + 'IIII')
+            pos += 24
+        unpack = state['record'].unpack_from
+        end = len(buf)
+        offsets, caplens, wirelens, seconds, fractions = [], [], [], [], []
+        limit = self.batch_size
+        while len(offsets) < limit and pos + 16 <= end:
+            ts_sec, ts_frac, caplen, wirelen = unpack(buf, pos)
+            if caplen > MAX_RECORD or caplen > wirelen:
+                # Not a record header; waiting for `caplen` bytes would read the rest of the file
+                raise PcapError(f'Corrupt pcap record at offset {self._base + pos}')
+            if pos + 16 + caplen > end:
+                break
+            offsets.append(pos + 16)
+            caplens.append(caplen)
+            wirelens.append(wirelen)
+            seconds.append(ts_sec)
+            fractions.append(ts_frac)
+            pos += 16 + caplen
+        if not offsets:
+            return pos, None
+        timestamps = np.array(seconds, dtype=np.int64) * 1_000_000_000 + \
+            np.array(fractions, dtype=np.int64) * state['scale']
+        offsets = np.array(offsets, dtype=np.int64)
+        caplens = np.array(caplens, dtype=np.int64)
+        return pos, (offsets, caplens, np.array(wirelens, dtype=np.int64), timestamps, state['linktype'],
+                     (offsets - 16, caplens + 16))
+
+    def _walk_pcapng(self, buf, pos, state):
+        end = len(buf)
+        endian = state.get('endian', '<')
+        interfaces = state.setdefault('interfaces', [])
+        offsets, caplens, wirelens, ticks, ifaces, blocks = [], [], [], [], [], []
+        limit = self.batch_size
+        while len(offsets) < limit and pos + 12 <= end:
+            block_type, block_len = struct.unpack_from(endian + 'II', buf, pos)
+            if block_type == PCAPNG_SHB:
+                # The section header decides the byte order of everything after it
+                magic = bytes(buf[pos + 8:pos + 12])
+                endian = '<' if magic == b'\x4d\x3c\x2b\x1a' else '>'
+                block_len = struct.unpack_from(endian + 'I', buf, pos + 4)[0]
+            if block_len < 12 or block_len % 4 or block_len > MAX_BLOCK:
+                raise PcapError(f'Corrupt pcapng block at offset {self._base + pos}')
+            if pos + block_len > end:
+                break
+            if block_type == PCAPNG_EPB:
+                iface, ts_high, ts_low, caplen, wirelen = struct.unpack_from(endian + 'IIIII', buf, pos + 8)
+                if caplen > block_len - 32:
+                    raise PcapError(f'Corrupt pcapng block at offset {self._base + pos}')
+                offsets.append(pos + 28)
+                caplens.append(caplen)
+                wirelens.append(wirelen)
+                ticks.append(ts_high << 32 | ts_low)
+                ifaces.append(iface)
+                blocks.append((pos, block_len))
+            elif block_type == PCAPNG_SPB:
+                wirelen = struct.unpack_from(endian + 'I', buf, pos + 8)[0]
+                snaplen = interfaces[0][1] if interfaces and interfaces[0][1] else wirelen
+                offsets.append(pos + 12)
+                caplens.append(min(wirelen, snaplen, block_len - 16))
+                wirelens.append(wirelen)
+                ticks.append(0)
+                ifaces.append(0)
+                blocks.append((pos, block_len))
+            elif block_type == PCAPNG_PB:
+                iface, _, ts_high, ts_low, caplen, wirelen = struct.unpack_from(endian + 'HHIIII', buf, pos + 8)
+                if caplen > block_len - 32:
+                    raise PcapError(f'Corrupt pcapng block at offset {self._base + pos}')
+                offsets.append(pos + 28)
+                caplens.append(caplen)
+                wirelens.append(wirelen)
+                ticks.append(ts_high << 32 | ts_low)
+                ifaces.append(iface)
+                blocks.append((pos, block_len))
+            elif block_type == PCAPNG_IDB:
+                linktype, _, snaplen = struct.unpack_from(endian + 'HHI', buf, pos + 8)
+                interfaces.append((linktype, snaplen, self._tsresol(buf, pos, block_len, endian)))
+            elif block_type == PCAPNG_SHB:
+                # A new section starts with its own interface list
+                if offsets:
+                    break
+                interfaces.clear()
+            pos += block_len
+        state['endian'] = endian
+        if not offsets:
+            return pos, None
+        if not interfaces:
+            raise PcapError('pcapng packet block without an interface description')
+        ifaces = np.array(ifaces, dtype=np.int64)
+        if ifaces.max() >= len(interfaces):
+            raise PcapError('pcapng packet block refers to an unknown interface')
+        linktypes = np.array([i[0] for i in interfaces], dtype=np.int64)[ifaces]
+        ticks = np.array(ticks, dtype=np.uint64)
+        timestamps = np.zeros(len(ticks), dtype=np.int64)
+        for index, (_, _, resolution) in enumerate(interfaces):
+            mask = ifaces == index
+            if mask.any():
+                timestamps[mask] = _ticks_to_ns(ticks[mask], resolution)
+        blocks = np.array(blocks, dtype=np.int64)
+        return pos, (np.array(offsets, dtype=np.int64), np.array(caplens, dtype=np.int64),
+                     np.array(wirelens, dtype=np.int64), timestamps, linktypes, (blocks[:, 0], blocks[:, 1]))
+
+    @staticmethod
+    def _tsresol(buf, pos, block_len, endian):
+        # Walk the interface options looking for if_tsresol (code 9)
+        opt = pos + 16
+        stop = pos + block_len - 4
+        while opt + 4 <= stop:
+            code, length = struct.unpack_from(endian + 'HH', buf, opt)
+            if code == 0:
+                break
+            if code == 9 and length >= 1:
+                return buf[opt + 4]
+            opt += 4 + (length + 3) // 4 * 4
+        return 6
+
+
+def _ticks_to_ns(ticks, resolution):
+    if resolution & 0x80:
+        # Power of two resolution
+        shift = resolution & 0x7F
+        return ((ticks >> np.uint64(shift)) * np.uint64(1_000_000_000) +
+                (((ticks & np.uint64((1 << shift) - 1)) * np.uint64(1_000_000_000)) >> np.uint64(shift))).astype(np.int64)
+    if resolution <= 9:
+        return (ticks * np.uint64(10 ** (9 - resolution))).astype(np.int64)
+    return (ticks // np.uint64(10 ** (resolution - 9))).astype(np.int64)
+
+
+def read_pcap(source, batch_size=BATCH_SIZE):
+    with PcapReader(source, batch_size=batch_size) as reader:
+        yield from reader
+
+
+def encode_records(batch, first_id=0):
+    # pcap records (nanosecond timestamps) of Ethernet frames for an IPv4 batch.
+    # Only the headers are captured; the packet length is the wire length. IP
+    # ids count on from `first_id`, so a file does not depend on how it was batched.
+    src = narrow_addresses(batch.src)
+    dst = narrow_addresses(batch.dst)
+    if src.ndim != 1 or dst.ndim != 1:
+        raise ValueError('Only IPv4 packets can be written to a capture')
+    n = len(batch)
+    tcp = np.isin(batch.protocol, [PROTOCOLS.index(name) for name in ('TCP', 'HTTP', 'HTTPS')])
+    udp = batch.protocol == PROTOCOLS.index('UDP')
+    icmp = batch.protocol == PROTOCOLS.index('ICMP')
+    caplen = 34 + np.where(tcp, 20, np.where(udp | icmp, 8, 0))
+    wirelen = np.maximum(batch.length, caplen)
+    records = np.zeros((n, 16 + 54), dtype=np.uint8)
+
+    def put(offset, values, dtype):
+        values = np.ascontiguousarray(np.broadcast_to(values, n), dtype=dtype)
+        records[:, offset:offset + values.itemsize] = values.view(np.uint8).reshape(n, -1)
+
+    put(0, batch.timestamp // 1_000_000_000, '<u4')
+    put(4, batch.timestamp % 1_000_000_000, '<u4')
+    put(8, caplen, '<u4')
+    put(12, wirelen, '<u4')
+    put(28, 0x0800, '>u2')
+    ip = 30
+    records[:, ip] = 0x45
+    put(ip + 2, wirelen - 14, '>u2')
+    put(ip + 4, (first_id + np.arange(n)) & 0xFFFF, '>u2')
+    put(ip + 6, 0x4000, '>u2')  # don't fragment
+    records[:, ip + 8] = 64
+    records[:, ip + 9] = np.where(tcp, 6, np.where(udp, 17, np.where(icmp, 1, 255)))
+    put(ip + 12, src, '>u4')
+    put(ip + 16, dst, '>u4')
+    words = np.ascontiguousarray(records[:, ip:ip + 20]).view('>u2').sum(axis=1, dtype=np.uint32)
+    words = (words & 0xFFFF) + (words >> 16)
+    put(ip + 10, ~((words & 0xFFFF) + (words >> 16)) & 0xFFFF, '>u2')
+    l4 = ip + 20
+    ported = tcp | udp
+    put(l4, np.where(ported, batch.src_port, 0x0800), '>u2')  # ICMP echo request
+    put(l4 + 2, np.where(ported, batch.dst_port, 0), '>u2')
+    put(l4 + 4, np.where(udp, wirelen - 34, 0), '>u2')
+    records[:, l4 + 12] = np.where(tcp, 0x50, 0)
+    records[:, l4 + 13] = np.where(tcp, batch.tcp_flags, 0)
+    put(l4 + 14, np.where(tcp, 64240, 0), '>u2')
+    return records[np.arange(records.shape[1]) < (16 + caplen)[:, None]].tobytes()
+
+
+def pcap_header(linktype, snaplen=0xFFFF):
+    # File header of a pcap capture with nanosecond timestamps
+    return struct.pack('<IHHiIII', 0xA1B23C4D, 2, 4, 0, 0, snaplen, linktype)
+
+
+def write_pcap(path, batches):
+    # Writes packet batches to a pcap file, see encode_records. Returns the
+    # number of packets written.
+    written = 0
+    with open(path, 'wb') as f:
+        f.write(pcap_header(LINKTYPE_ETHERNET))
+        for batch in batches:
+            f.write(encode_records(batch, written))
+            written += len(batch)
+    return written
+
+
+def capture_header(buf):
+    # Headers a reader needs before any record: the pcap file header, or for
+    # pcapng the section header and interface blocks before the first packet
+    magic = bytes(buf[:4])
+    if magic in PCAP_MAGIC:
+        return bytes(buf[:24])
+    if len(magic) < 4 or struct.unpack('<I', magic)[0] != PCAPNG_SHB:
+        raise PcapError('Not a pcap or pcapng capture')
+    endian = '<' if bytes(buf[8:12]) == b'\x4d\x3c\x2b\x1a' else '>'
+    pos = 0
+    while pos + 12 <= len(buf):
+        block_type, block_len = struct.unpack_from(endian + 'II', buf, pos)
+        if block_type in (PCAPNG_EPB, PCAPNG_SPB, PCAPNG_PB):
+            break
+        if block_len < 12 or block_len % 4:
+            raise PcapError(f'Corrupt pcapng block at offset {pos}')
+        pos += block_len
+    return bytes(buf[:pos])
+
+
+def _pcap_record(buf, pos, state):
+    # End of the pcap record at `pos`, or None if it does not look like one
+    if pos + 16 > len(buf):
+        return None
+    ts_sec, ts_frac, caplen, wirelen = state['record'].unpack_from(buf, pos)
+    if ts_frac >= state['fractions'] or not 0 < wirelen <= MAX_RECORD or caplen > wirelen:
+        return None
+    if state['previous'] is not None and abs(ts_sec - state['previous']) > 3600:
+        return None
+    state['previous'] = ts_sec
+    return pos + 16 + caplen
+
+
+def _pcapng_block(buf, pos, state):
+    if pos + 12 > len(buf):
+        return None
+    block_type, block_len = struct.unpack_from(state['endian'] + 'II', buf, pos)
+    if block_len < 12 or block_len % 4 or pos + block_len > len(buf):
+        return None
+    if state['previous'] is None and block_type not in PCAPNG_BLOCKS:
+        return None
+    if struct.unpack_from(state['endian'] + 'I', buf, pos + block_len - 4)[0] != block_len:
+        return None
+    state['previous'] = block_type
+    return pos + block_len
+
+
+def find_record(buf, pos, header, limit=CHUNK_SIZE):
+    # First offset at or after `pos` where RESYNC_RECORDS records in a row (or
+    # all records up to the end of the capture) parse cleanly, or None
+    magic = header[:4]
+    if magic in PCAP_MAGIC:
+        endian, scale = PCAP_MAGIC[magic]
+        check = _pcap_record
+        state = {'record': struct.Struct(endian + 'IIII'), 'fractions': 1_000_000_000 // scale}
+        step = 1
+    else:
+        check = _pcapng_block
+        state = {'endian': '<' if header[8:12] == b'\x4d\x3c\x2b\x1a' else '>'}
+        # Block lengths are multiples of four, so blocks start on that alignment
+        pos += -pos % 4
+        step = 4
+    for start in range(pos, min(pos + limit, len(buf)), step):
+        state['previous'] = None
+        end = start
+        for _ in range(RESYNC_RECORDS):
+            end = check(buf, end, state)
+            if end is None or end == len(buf):
+                break
+        if end is not None:
+            return start
+    return None
+
+
+def split_capture(source, parts):
+    # Header and record-aligned (start, end) byte ranges cutting a capture file
+    # into about `parts` pieces that can be read independently. A pcapng file is
+    # assumed to have a single section, whose interfaces are in the header.
+    with open(source, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise PcapError('Not a pcap or pcapng capture')
+        with buf:
+            header = capture_header(buf)
+            size = len(buf)
+            bounds = [len(header)]
+            for i in range(1, parts):
+                bound = find_record(buf, max(size * i // parts, bounds[-1]), header)
+                if bound is not None and bound > bounds[-1]:
+                    bounds.append(bound)
+    bounds.append(size)
+    return header, [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
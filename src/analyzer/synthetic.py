@@ -0,0 +1,219 @@
+import ipaddress
+import numpy as np
+from custom_types import PacketBatch, PROTOCOL_CODES, hash_combine
+from .pcap import HTTP_PORTS, HTTPS_PORTS, BATCH_SIZE, write_pcap
+from .aggregate import NS_PER_SECOND
+
+START = 1704067200  # 2024-01-01 00:00 UTC, so generated traffic does not depend on the clock
+BLOCK_SECONDS = 10  # background traffic is generated per block of seconds, each from its own seed
+RESOLVERS = 4  # servers answering DNS and NTP
+
+# (destination port, protocol, share of the background packets); port None is
+# a high port that stays the same for each server
+SERVICES = [
+    (443, 'TCP', 0.48), (80, 'TCP', 0.12), (8080, 'TCP', 0.03), (25, 'TCP', 0.01), (22, 'TCP', 0.01),
+    (3389, 'TCP', 0.005), (None, 'TCP', 0.105), (53, 'UDP', 0.14), (123, 'UDP', 0.02), (None, 'UDP', 0.06),
+    (0, 'ICMP', 0.02)
+]
+# TCP flags of background packets: ACK, PSH+ACK, SYN, SYN+ACK, FIN+ACK, RST
+TCP_FLAGS = [(0x10, 0.55), (0x18, 0.36), (0x02, 0.03), (0x12, 0.03), (0x11, 0.02), (0x04, 0.01)]
+
+
+def _cdf(weights):
+    weights = np.asarray(weights, dtype=np.float64)
+    cdf = np.cumsum(weights / weights.sum())
+    cdf[-1] = 1.0
+    return cdf
+
+
+def _zipf_cdf(n, exponent):
+    return _cdf(1.0 / np.arange(1, n + 1) ** exponent)
+
+
+def _draw(rng, cdf, size):
+    # Indices drawn with the probabilities behind `cdf`
+    return np.searchsorted(cdf, rng.random(size), side='right')
+
+
+class TrafficGenerator:
+    # Reproducible synthetic IPv4 traffic at any volume. Background packets
+    # come from Zipf-distributed clients and servers at a rate that follows the
+    # time of day, with a realistic mix of services, sizes and TCP flags;
+    # port scans, host sweeps and traffic bursts are injected on top and listed
+    # in `events`. Everything is drawn column-wise with NumPy, and the output
+    # only depends on the seed and parameters, not on the batch size.
+    def __init__(self, seed=0, start=START, duration=3600, clients=5000, servers=2000, zipf=1.1,
+                 diurnal=0.6, peak_hour=14, variability=25, scans=2, sweeps=1, bursts=2,
+                 scan_ports=1000, sweep_hosts=500, burst_packets=20000):
+        self.seed = seed
+        self.start = start
+        self.duration = duration
+        self.diurnal = diurnal
+        self.peak_hour = peak_hour
+        self.variability = variability
+        rng = np.random.default_rng([seed, 0])
+        # Heavy hitters are spread over the address ranges, not the first addresses
+        index = rng.permutation(clients)
+        self.clients = (0x0A000000 | (index // 250 + 1) << 8 | (index % 250 + 2)).astype(np.uint32)
+        self.servers = rng.integers(0x01000000, 0xDF000000, servers, dtype=np.uint32)
+        self.client_cdf = _zipf_cdf(clients, zipf)
+        self.server_cdf = _zipf_cdf(servers, zipf)
+        self.service_cdf = _cdf([share for _, _, share in SERVICES])
+        self.flag_cdf = _cdf([share for _, share in TCP_FLAGS])
+        self.events = []  # injected activity, for checking what the detectors find
+        self._events = self._inject(np.random.default_rng([seed, 1]), scans, sweeps, bursts, scan_ports,
+                                    sweep_hosts, burst_packets)
+
+    def rates(self):
+        # Relative packet rate of every second: a daily cycle peaking at
+        # `peak_hour` UTC, times gamma noise so some seconds are busier
+        rng = np.random.default_rng([self.seed, 2])
+        hours = (self.start + np.arange(self.duration)) % 86400 / 3600
+        cycle = 1 + self.diurnal * np.cos(2 * np.pi * (hours - self.peak_hour) / 24)
+        return cycle * rng.gamma(self.variability, 1 / self.variability, self.duration)
+
+    def _inject(self, rng, scans, sweeps, bursts, scan_ports, sweep_hosts, burst_packets):
+        parts = []
+        latest = max(self.duration - 60, 1)
+
+        def event(kind, start, src, dst, packets):
+            self.events.append({
+                'type': kind,
+                'start': int(start),
+                'src': str(ipaddress.IPv4Address(int(src))),
+                'dst': None if dst is None else str(ipaddress.IPv4Address(int(dst))),
+                'packets': packets
+            })
+
+        def add(start, rate, src, dst, protocol, dst_port, src_port, length, flags):
+            n = len(dst_port)
+            offsets = np.sort(rng.integers(0, max(int(n / rate * NS_PER_SECOND), 1), n))
+            parts.append(PacketBatch(
+                timestamp=start + offsets,
+                src=np.broadcast_to(np.uint32(src), n),
+                dst=np.broadcast_to(np.asarray(dst, dtype=np.uint32), n),
+                protocol=np.broadcast_to(np.uint8(protocol), n),
+                length=length,
+                src_port=np.broadcast_to(np.uint16(src_port), n),
+                dst_port=dst_port,
+                tcp_flags=np.broadcast_to(np.uint8(flags), n)
+            ))
+
+        for _ in range(scans):
+            # One outside host probing the low ports of one client, 500 a second
+            start = (self.start + int(rng.integers(0, latest))) * NS_PER_SECOND
+            src = rng.integers(0x01000000, 0xDF000000)
+            dst = self.clients[rng.integers(len(self.clients))]
+            ports = rng.permutation(np.arange(1, scan_ports + 1))
+            add(start, 500, src, dst, PROTOCOL_CODES['TCP'], ports, rng.integers(32768, 61000),
+                np.full(len(ports), 60), 0x02)
+            parts[-1].protocol = _classify(parts[-1].protocol, ports)
+            event('PORT_SCAN', start, src, dst, len(ports))
+        for _ in range(sweeps):
+            # One outside host trying SMB on many clients, 100 a second
+            start = (self.start + int(rng.integers(0, latest))) * NS_PER_SECOND
+            src = rng.integers(0x01000000, 0xDF000000)
+            hosts = rng.choice(self.clients, min(sweep_hosts, len(self.clients)), replace=False)
+            add(start, 100, src, hosts, PROTOCOL_CODES['TCP'], np.full(len(hosts), 445),
+                rng.integers(32768, 61000), np.full(len(hosts), 60), 0x02)
+            event('HOST_SCAN', start, src, None, len(hosts))
+        for _ in range(bursts):
+            # A client flooding one server over UDP within a second
+            start = (self.start + int(rng.integers(0, latest))) * NS_PER_SECOND
+            src = self.clients[rng.integers(len(self.clients))]
+            dst = self.servers[rng.integers(len(self.servers))]
+            add(start, burst_packets, src, dst, PROTOCOL_CODES['UDP'], np.full(burst_packets, 443),
+                rng.integers(32768, 61000), rng.integers(1200, 1400, burst_packets), 0)
+            event('TRAFFIC_BURST', start, src, dst, burst_packets)
+        events = PacketBatch.concat(parts)
+        return events[np.argsort(events.timestamp, kind='stable')]
+
+    def _background(self, block, first, counts):
+        # Background packets of the seconds from `first` on, `counts` per second
+        rng = np.random.default_rng([self.seed, 3, block])
+        n = int(counts.sum())
+        seconds = np.repeat(np.arange(first, first + len(counts), dtype=np.int64), counts)
+        timestamp = np.sort((self.start + seconds) * NS_PER_SECOND + rng.integers(0, NS_PER_SECOND, n))
+
+        client = self.clients[_draw(rng, self.client_cdf, n)]
+        server_index = _draw(rng, self.server_cdf, n)
+        service = _draw(rng, self.service_cdf, n)
+        ports = np.array([port or 0 for port, _, _ in SERVICES], dtype=np.int64)[service]
+        names = np.array([name for _, name, _ in SERVICES])[service]
+        tcp = names == 'TCP'
+        udp = names == 'UDP'
+        # Name and time servers are a handful of well known hosts
+        server_index = np.where(np.isin(ports, (53, 123)), server_index % RESOLVERS, server_index)
+        server = self.servers[server_index]
+        high = np.array([port is None for port, _, _ in SERVICES])[service]
+        ports = np.where(high, 1024 + server_index * 7919 % 40000, ports)
+        # Packets between the same hosts within a minute share a connection
+        pair = hash_combine(hash_combine(client, server), seconds // 60)
+        client_port = np.where(tcp | udp, 32768 + (pair % np.uint64(28232)).astype(np.int64), 0)
+
+        # Half the packets are answers, which are larger on average
+        reply = rng.random(n) < 0.5
+        size = rng.random(n)
+        small = size < np.where(reply, 0.25, 0.55)
+        large = size > np.where(reply, 0.35, 0.85)
+        length = np.where(small, rng.integers(54, 81, n),
+                          np.where(large, rng.integers(1200, 1515, n), rng.integers(81, 1200, n)))
+        length = np.where(udp, np.where(ports == 53, rng.integers(70, 300, n), length), length)
+        length = np.where(names == 'ICMP', 98, length)
+        flags = np.where(tcp, np.array([flag for flag, _ in TCP_FLAGS], dtype=np.uint8)[_draw(rng, self.flag_cdf, n)],
+                         0)
+
+        protocol = np.where(tcp, PROTOCOL_CODES['TCP'],
+                            np.where(udp, PROTOCOL_CODES['UDP'], PROTOCOL_CODES['ICMP'])).astype(np.uint8)
+        protocol = _classify(protocol, ports)
+        return PacketBatch(
+            timestamp=timestamp,
+            src=np.where(reply, server, client),
+            dst=np.where(reply, client, server),
+            protocol=protocol,
+            length=length,
+            src_port=np.where(reply, ports, client_port),
+            dst_port=np.where(reply, client_port, ports),
+            tcp_flags=flags
+        )
+
+    def batches(self, packets, batch_size=BATCH_SIZE):
+        # About `packets` background packets (plus the injected ones) in time
+        # order, as batches of `batch_size`
+        rng = np.random.default_rng([self.seed, 4])
+        rates = self.rates()
+        counts = rng.multinomial(packets, rates / rates.sum())
+        event_times = self._events.timestamp
+        pending = []
+        pending_rows = 0
+        for block, first in enumerate(range(0, self.duration, BLOCK_SECONDS)):
+            last = min(first + BLOCK_SECONDS, self.duration)
+            start, end = np.searchsorted(event_times, [(self.start + first) * NS_PER_SECOND,
+                                                        (self.start + last) * NS_PER_SECOND])
+            part = PacketBatch.concat([self._background(block, first, counts[first:last]),
+                                       self._events[start:end]])
+            pending.append(part[np.argsort(part.timestamp, kind='stable')])
+            pending_rows += len(part)
+            if pending_rows >= batch_size:
+                merged = PacketBatch.concat(pending)
+                cut = len(merged) - len(merged) % batch_size
+                for offset in range(0, cut, batch_size):
+                    yield merged[offset:offset + batch_size]
+                pending = [merged[cut:]]
+                pending_rows = len(merged) - cut
+        if pending_rows:
+            yield PacketBatch.concat(pending)
+
+    def generate(self, packets):
+        return PacketBatch.concat(list(self.batches(packets)))
+
+    def write(self, path, packets, batch_size=BATCH_SIZE):
+        # Writes the traffic as a pcap file; returns the number of packets
+        return write_pcap(path, self.batches(packets, batch_size))
+
+
+def _classify(protocol, ports):
+    # TCP on web ports is reported as HTTP/HTTPS, as decode_records does
+    tcp = protocol == PROTOCOL_CODES['TCP']
+    protocol = np.where(tcp & np.isin(ports, HTTP_PORTS), PROTOCOL_CODES['HTTP'], protocol)
+    return np.where(tcp & np.isin(ports, HTTPS_PORTS), PROTOCOL_CODES['HTTPS'], protocol).astype(np.uint8)
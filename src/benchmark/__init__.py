@@ -0,0 +1,339 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import tempfile
+import subprocess
+import numpy as np
+
+CASES = ['analyze', 'detect', 'visualize', 'dashboard', 'startup']
+PACKETS = 1_000_000  # background packets of synthetic traffic per case
+REPEAT = 3  # runs of the whole-capture analysis
+ITERATIONS = 50  # rendering calls timed by the visualize and dashboard cases
+STARTUP_RUNS = 5  # cold starts timed by the startup case
+TOLERANCE = 0.10  # relative change reported as a regression
+SOURCE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cold start of the dashboard in phases, run with -X importtime; prints the
+# phase times as JSON
+_STARTUP_SCRIPT = """
+import json
+import time
+phases = []
+def timed(name, function, *args):
+    started = time.perf_counter()
+    value = function(*args)
+    phases.append([name, time.perf_counter() - started])
+    return value
+for package in ('analyzer', 'detector', 'visualizer', 'web_interface'):
+    timed('import ' + package, __import__, package)
+import main
+app = timed('create_app', main.create_app)
+client = app.server.test_client()
+timed('first page', client.get, '/')
+timed('first layout', client.get, '/_dash-layout')
+print(json.dumps(phases))
+"""
+
+
+def _peak_rss_mb():
+    # Largest resident set of this process and of the children it waited for
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak / 1024 if sys.platform != 'darwin' else peak / 1024 / 1024
+
+
+def _result(items, latencies, unit='packets', **extra):
+    # Throughput is `items` (packets, or calls) per second over all the calls
+    latencies = np.asarray(latencies, dtype=np.float64)
+    return dict({
+        'items': items,
+        'unit': unit,
+        'seconds': float(latencies.sum()),
+        'throughput': items / latencies.sum() if latencies.sum() else 0.0,
+        'latency_ms': {
+            'p50': float(np.percentile(latencies, 50) * 1000),
+            'p95': float(np.percentile(latencies, 95) * 1000),
+            'p99': float(np.percentile(latencies, 99) * 1000),
+            'max': float(latencies.max() * 1000)
+        },
+        'calls': len(latencies)
+    }, **extra)
+
+
+def _timed(function, *args, **kwargs):
+    started = time.perf_counter()
+    value = function(*args, **kwargs)
+    return time.perf_counter() - started, value
+
+
+def _capture(workdir, packets, seed):
+    # Synthetic capture shared by runs with the same size and seed
+    from analyzer.synthetic import TrafficGenerator
+    path = os.path.join(workdir, f'synthetic-{seed}-{packets}.pcap')
+    if not os.path.exists(path):
+        TrafficGenerator(seed=seed).write(path + '.tmp', packets)
+        os.replace(path + '.tmp', path)
+    return path
+
+
+def bench_analyze(packets, seed, workdir):
+    # Whole capture through analyze_capture, with detection, on every CPU
+    from analyzer import analyze_capture
+    from detector import IncidentDetector
+    path = _capture(workdir, packets, seed)
+    latencies = []
+    for _ in range(REPEAT):
+        elapsed, result = _timed(analyze_capture, path, None, IncidentDetector())
+        latencies.append(elapsed)
+    return _result(result.packets_read * len(latencies), latencies, bytes=os.path.getsize(path),
+                   incidents=len(result.incidents))
+
+
+def bench_detect(packets, seed, workdir):
+    # IncidentDetector over in-memory batches; latency is per batch
+    from analyzer.synthetic import TrafficGenerator
+    from detector import IncidentDetector
+    batches = list(TrafficGenerator(seed=seed).batches(packets))
+    detector = IncidentDetector()
+    stream = detector.new_stream()
+    latencies, incidents = [], 0
+    for batch in batches:
+        elapsed, found = _timed(detector.detect_incidents, batch, stream)
+        latencies.append(elapsed)
+        incidents += len(found)
+    return _result(sum(len(b) for b in batches), latencies, incidents=incidents)
+
+
+def _fill(analyzer, packets, seed, chart_window):
+    # Feeds the analyzer the last `chart_window` seconds of synthetic traffic
+    from analyzer.synthetic import TrafficGenerator
+    now = time.time_ns()
+    generator = TrafficGenerator(seed=seed, start=now // 1_000_000_000 - chart_window, duration=chart_window)
+    for batch in generator.batches(packets):
+        analyzer.aggregator.add(batch)
+        analyzer.flow_table.add(batch)
+    analyzer.aggregator.advance(now)
+
+
+def bench_visualize(packets, seed, workdir):
+    # Dashboard figures built from the per-second aggregates and serialised
+    from analyzer import TrafficAnalyzer, CHART_WINDOW
+    from visualizer.charts import traffic_volume_figure, protocol_figure, port_figure
+    analyzer = TrafficAnalyzer()
+    _fill(analyzer, packets, seed, CHART_WINDOW)
+    flows = analyzer.current_flows()
+
+    def render():
+        seconds, _, byte_counts = analyzer.aggregator.series(CHART_WINDOW)
+        stats = analyzer.aggregator.stats(analyzer.stats_window)
+        ports, counts = np.unique(flows.dst_port, return_counts=True)
+        figures = [traffic_volume_figure(seconds, byte_counts), protocol_figure(stats['protocols']),
+                   port_figure(ports[:50], counts[:50], 'Flows by Port')]
+        return [figure.to_json() for figure in figures]
+
+    latencies = [_timed(render)[0] for _ in range(ITERATIONS)]
+    return _result(len(latencies), latencies, 'calls', flows=len(flows))
+
+
+def bench_dashboard(packets, seed, workdir):
+    # The whole update_metrics callback over HTTP: latest live snapshot from
+    # shared memory, rendering and Dash serialisation, with the figure cache
+    # emptied before every call. Throughput is callbacks per second.
+    os.environ['UPLOAD_DIR'] = os.path.join(workdir, f'dashboard-{os.getpid()}')
+    os.environ['INCIDENT_LOG'] = os.path.join(os.environ['UPLOAD_DIR'], 'incidents.log')
+    os.environ['LIVE_SEGMENT'] = f'network-forensics-benchmark-{os.getpid()}'
+    os.environ['INCIDENT_CONSOLE_RATE'] = '0'
+    from analyzer import TrafficAnalyzer, CHART_WINDOW
+    from detector import IncidentDetector
+    from visualizer import DataVisualizer
+    from web_interface import WebInterface
+    analyzer = TrafficAnalyzer()
+    _fill(analyzer, packets, seed, CHART_WINDOW)
+    web = WebInterface(analyzer, IncidentDetector(), DataVisualizer())
+    client = web.app.server.test_client()
+    outputs = [('stats-container', 'children'), ('traffic-volume-graph', 'figure'), ('protocol-dist-graph', 'figure'),
+               ('http-analysis', 'children'), ('incidents-table', 'children')]
+    body = {
+        'output': '..' + '...'.join(f'{i}.{p}' for i, p in outputs) + '..',
+        'outputs': [{'id': i, 'property': p} for i, p in outputs],
+        'inputs': [{'id': 'interval-component', 'property': 'n_intervals', 'value': 1},
+                   {'id': 'tabs', 'property': 'value', 'value': 'live-tab'},
+                   {'id': 'live-resync', 'property': 'data', 'value': 0}],
+        'changedPropIds': ['interval-component.n_intervals']
+    }
+    try:
+        # The first call starts the live producer and waits for its snapshot
+        client.post('/_dash-update-component', json=body)
+        latencies, size = [], 0
+        for _ in range(ITERATIONS):
+            web.figures.clear()
+            elapsed, response = _timed(client.post, '/_dash-update-component', json=body)
+            if response.status_code != 200:
+                raise RuntimeError(f"update_metrics returned {response.status_code}")
+            latencies.append(elapsed)
+            size = len(response.data)
+        return _result(len(latencies), latencies, 'calls', response_bytes=size)
+    finally:
+        web.live.stop()
+        web.incident_detector.sink.close()
+        shutil.rmtree(os.environ['UPLOAD_DIR'], ignore_errors=True)
+
+
+def _env(directory=None):
+    # Environment of a child interpreter that imports the app from source;
+    # with `directory`, the app keeps its files there
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [SOURCE, os.environ.get('PYTHONPATH')])))
+    if directory:
+        env.update(UPLOAD_DIR=directory, INCIDENT_LOG=os.path.join(directory, 'incidents.log'),
+                   LIVE_SEGMENT=f'network-forensics-startup-{os.getpid()}', INCIDENT_CONSOLE_RATE='0')
+    return env
+
+
+def bench_startup(packets, seed, workdir):
+    # Interpreter start to a built dashboard app, in a new process each time
+    directory = os.path.join(workdir, f'startup-{os.getpid()}')
+    env = _env(directory)
+    latencies = []
+    try:
+        for _ in range(STARTUP_RUNS):
+            elapsed, _ = _timed(subprocess.run, [sys.executable, '-c', 'import main; main.create_app()'],
+                                env=env, stdout=subprocess.DEVNULL, check=True)
+            latencies.append(elapsed)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return _result(len(latencies), latencies, 'starts')
+
+
+BENCHMARKS = {
+    'analyze': bench_analyze,
+    'detect': bench_detect,
+    'visualize': bench_visualize,
+    'dashboard': bench_dashboard,
+    'startup': bench_startup
+}
+
+
+def _run_case(name, packets, seed, workdir, output):
+    # Body of the interpreter started for one case, see run_benchmarks
+    result = BENCHMARKS[name](packets, seed, workdir)
+    result['peak_rss_mb'] = _peak_rss_mb()
+    save_results(output, result)
+
+
+def run_benchmarks(cases=None, packets=PACKETS, seed=0, workdir=None, report=None):
+    cases = cases or CASES
+    unknown = set(cases) - set(BENCHMARKS)
+    if unknown:
+        raise ValueError(f"Unknown benchmark: {', '.join(sorted(unknown))}")
+    workdir = workdir or os.path.join(tempfile.gettempdir(), 'network-forensics-benchmark')
+    os.makedirs(workdir, exist_ok=True)
+    results = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'packets': packets,
+            'seed': seed,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count()
+        },
+        'results': {}
+    }
+    # Every case runs in a fresh interpreter, so its peak RSS is its own
+    env = _env()
+    for name in cases:
+        output = os.path.join(workdir, f'{name}-{os.getpid()}.json')
+        subprocess.run([sys.executable, '-c', 'import sys; from benchmark import _run_case; '
+                        '_run_case(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), sys.argv[4], sys.argv[5])',
+                        name, str(packets), str(seed), workdir, output],
+                       env=env, stdout=subprocess.DEVNULL, check=True)
+        results['results'][name] = load_results(output)
+        os.remove(output)
+        if report:
+            report(name, results['results'][name])
+    return results
+
+
+def profile_startup(top=15):
+    # Time from interpreter start to a dashboard that served its first page,
+    # per phase, and the packages that take longest to import (cumulative,
+    # so a package's time includes what it imports first). Measured in a
+    # fresh interpreter; -X importtime itself adds a little to every phase.
+    directory = tempfile.mkdtemp(prefix='network-forensics-startup-')
+    try:
+        started = time.perf_counter()
+        done = subprocess.run([sys.executable, '-X', 'importtime', '-c', _STARTUP_SCRIPT], env=_env(directory),
+                              capture_output=True, text=True, check=True)
+        total = time.perf_counter() - started
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    phases = json.loads(done.stdout.strip().splitlines()[-1])
+    packages = {}
+    for line in done.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        package = name.strip().split('.')[0]
+        packages[package] = max(packages.get(package, 0.0), int(cumulative) / 1e6)
+    return {
+        'total': total,
+        'phases': [['interpreter', total - sum(seconds for _, seconds in phases)]] + phases,
+        'packages': sorted(packages.items(), key=lambda item: -item[1])[:top]
+    }
+
+
+def format_startup(report):
+    lines = [f"Startup: {report['total']:.3f}s"]
+    lines.extend(f"  {name:<24} {seconds:>8.3f}s" for name, seconds in report['phases'])
+    lines.append("Slowest imports (cumulative):")
+    lines.extend(f"  {name:<24} {seconds:>8.3f}s" for name, seconds in report['packages'])
+    return '\n'.join(lines)
+
+
+def compare(current, baseline, tolerance=TOLERANCE):
+    # (case, metric, baseline, current, relative change, regressed) for the
+    # cases both runs have. Lower throughput or higher latency and memory
+    # than `tolerance` allows count as regressions.
+    rows = []
+    for name, result in current['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        metrics = [('throughput', before['throughput'], result['throughput'], False),
+                   ('p50 ms', before['latency_ms']['p50'], result['latency_ms']['p50'], True),
+                   ('p95 ms', before['latency_ms']['p95'], result['latency_ms']['p95'], True),
+                   ('peak RSS MB', before['peak_rss_mb'], result['peak_rss_mb'], True)]
+        for metric, old, new, lower_is_better in metrics:
+            change = (new - old) / old if old else 0.0
+            regressed = change > tolerance if lower_is_better else change < -tolerance
+            rows.append((name, metric, old, new, change, regressed))
+    return rows
+
+
+def format_result(name, result):
+    latency = result['latency_ms']
+    return (f"{name:<10} {result['throughput']:>14,.1f} {result['unit']}/s  p50 {latency['p50']:>9.2f} ms  "
+            f"p95 {latency['p95']:>9.2f} ms  p99 {latency['p99']:>9.2f} ms  "
+            f"peak RSS {result['peak_rss_mb']:>8.1f} MB")
+
+
+def format_comparison(rows):
+    lines = [f"{'case':<10} {'metric':<12} {'baseline':>14} {'current':>14} {'change':>8}"]
+    for name, metric, old, new, change, regressed in rows:
+        flag = '  REGRESSION' if regressed else ''
+        lines.append(f"{name:<10} {metric:<12} {old:>14,.2f} {new:>14,.2f} {change:>+8.1%}{flag}")
+    return '\n'.join(lines)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_results(path, results):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
@@ -1,12 +1,379 @@
-class TrafficData:
-    def __init__(self, source_ip, destination_ip, protocol, size):
-        self.source_ip = source_ip
-        self.destination_ip = destination_ip
-        self.protocol = protocol
-        self.size = size
+import ipaddress
+import numpy as np
+# pandas is only imported by the methods that build frames: the columnar code
+# paths, and every process that only runs them, start without it
+
+PROTOCOLS = ['OTHER', 'TCP', 'UDP', 'ICMP', 'HTTP', 'HTTPS']
+PROTOCOL_CODES = {name: code for code, name in enumerate(PROTOCOLS)}
+
+SEVERITIES = ['LOW', 'MEDIUM', 'HIGH']
+INCIDENT_TYPES = ['LARGE_PACKET', 'SUSPICIOUS_PORT', 'TRAFFIC_BURST',
+                  'PORT_SCAN', 'HOST_SCAN', 'BEACONING', 'EXFILTRATION', 'WATCHLIST', 'ANOMALY']
+INCIDENT_DETAILS = {
+    'LARGE_PACKET': "Large packet detected: {value} bytes",
+    'SUSPICIOUS_PORT': "Suspicious port detected: {value}",
+    'TRAFFIC_BURST': "Traffic burst detected: {value} packets/second",
+    'PORT_SCAN': "Port scan detected: {value} ports probed on one host",
+    'HOST_SCAN': "Host sweep detected: {value} hosts probed on one port",
+    'BEACONING': "Periodic beaconing detected: every {value} seconds ({count} intervals)",
+    'EXFILTRATION': "Outbound volume anomaly: {value} bytes in one interval",
+    'WATCHLIST': "Traffic with a watchlisted address (feed #{value})",
+    'ANOMALY': "Unusual host behaviour: anomaly score {value}/1000 over {count} packets",
+}
+# Incident types that describe the whole link rather than a src/dst pair
+UNSCOPED_INCIDENTS = {'TRAFFIC_BURST'}
+# Incident types about everything their src did; dst is only one of its peers
+SOURCE_INCIDENTS = {'HOST_SCAN', 'EXFILTRATION', 'ANOMALY'}
+# Incident types aggregated from individual matching packets
+PACKET_INCIDENTS = {'LARGE_PACKET', 'SUSPICIOUS_PORT', 'WATCHLIST'}
+
+_V4_MAPPED_PREFIX = np.array([0] * 10 + [0xFF, 0xFF], dtype=np.uint8)
+
+
+def ipv4_to_mapped(addr4):
+    # uint32 IPv4 addresses as 16-byte IPv4-mapped IPv6 addresses (::ffff:a.b.c.d)
+    out = np.zeros((len(addr4), 16), dtype=np.uint8)
+    out[:, :12] = _V4_MAPPED_PREFIX
+    out[:, 12:] = addr4.astype('>u4').view(np.uint8).reshape(-1, 4)
+    return out
+
+
+def address_keys(values):
+    # Canonical 16-byte keys (numpy V16) so an IPv4 host compares equal whether it
+    # came from an IPv4-only batch or as a mapped address in a mixed batch
+    if values.ndim == 1:
+        values = ipv4_to_mapped(values)
+    return np.ascontiguousarray(values).view('V16').ravel()
+
+
+def address_hash(keys):
+    # 64-bit hashes of canonical address keys
+    halves = np.ascontiguousarray(keys).view('>u8').reshape(-1, 2).astype(np.uint64)
+    return _mix64(_mix64(halves[:, 0]) ^ halves[:, 1])
+
+
+def address_hashes(values):
+    # Per-row address hashes. Hashing every row is cheaper than finding the
+    # distinct addresses first, which sorts 16-byte keys.
+    return address_hash(address_keys(values))
+
+
+def narrow_addresses(values):
+    # 16-byte addresses back to uint32 when every row is IPv4-mapped
+    if values.ndim == 2 and len(values) and (values[:, :12] == _V4_MAPPED_PREFIX).all():
+        return np.ascontiguousarray(values[:, 12:]).view('>u4').ravel().astype(np.uint32)
+    return values
+
+
+def hash_combine(a, b):
+    # Order-dependent combination of two uint64 hash (or small integer) columns
+    return _mix64(np.asarray(a, dtype=np.uint64) ^ _mix64(np.asarray(b, dtype=np.uint64)))
+
+
+def _mix64(z):
+    # splitmix64 finalizer
+    with np.errstate(over='ignore'):
+        z = z + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+def parse_addresses(values):
+    # Dotted/colon address strings to a uint32 or (n, 16) uint8 column
+    uniq, inverse = np.unique(np.asarray(values, dtype=object).astype(str), return_inverse=True)
+    parsed = [ipaddress.ip_address(v) for v in uniq]
+    if all(a.version == 4 for a in parsed):
+        return np.array([int(a) for a in parsed], dtype=np.uint32)[inverse]
+    packed = np.array([list(a.packed if a.version == 6 else
+                            ipaddress.IPv6Address('::ffff:' + str(a)).packed) for a in parsed],
+                      dtype=np.uint8).reshape(-1, 16)
+    return packed[inverse]
+
+
+def format_addresses(values):
+    # Distinct addresses and the index of each row into them; strings are only
+    # built once per distinct address
+    if values.dtype.kind == 'V':
+        values = values.view(np.uint8).reshape(-1, 16)
+    if values.ndim == 1:
+        uniq, inverse = np.unique(values, return_inverse=True)
+        names = [str(ipaddress.IPv4Address(int(a))) for a in uniq]
+    else:
+        uniq, inverse = np.unique(np.ascontiguousarray(values).view('V16').ravel(), return_inverse=True)
+        names = []
+        for a in uniq:
+            addr = ipaddress.IPv6Address(bytes(a))
+            names.append(str(addr.ipv4_mapped or addr))
+    return np.array(names, dtype=object), inverse.ravel()
+
+
+class PacketBatch:
+    # Column-oriented batch of decoded packets. Addresses are uint32 for IPv4
+    # only batches and 16-byte rows (IPv4-mapped where needed) otherwise;
+    # timestamps are int64 epoch nanoseconds.
+    fields = ['timestamp', 'src', 'dst', 'protocol', 'length', 'src_port', 'dst_port', 'tcp_flags']
+
+    def __init__(self, timestamp, src, dst, protocol, length, src_port, dst_port, tcp_flags=None):
+        self.timestamp = np.asarray(timestamp, dtype=np.int64)
+        self.src = np.asarray(src, dtype=np.uint32 if np.ndim(src) == 1 else np.uint8)
+        self.dst = np.asarray(dst, dtype=np.uint32 if np.ndim(dst) == 1 else np.uint8)
+        if self.src.ndim != self.dst.ndim:
+            self.src, self.dst = self._as_ipv6(self.src), self._as_ipv6(self.dst)
+        self.protocol = np.asarray(protocol, dtype=np.uint8)
+        self.length = np.asarray(length, dtype=np.uint16)
+        self.src_port = np.asarray(src_port, dtype=np.uint16)
+        self.dst_port = np.asarray(dst_port, dtype=np.uint16)
+        if tcp_flags is None:
+            tcp_flags = np.zeros(len(self.timestamp), dtype=np.uint8)
+        self.tcp_flags = np.asarray(tcp_flags, dtype=np.uint8)
+        self.stats = None
+        self.app = None  # application-layer records, when payloads were decoded
+        self.header_hash = None  # per-packet header hashes, when a reader was asked for them
+
+    @classmethod
+    def empty(cls):
+        return cls(*[np.zeros(0)] * 7)
+
+    @classmethod
+    def from_records(cls, records):
+        # Build from the legacy list-of-dicts representation
+        if not records:
+            return cls.empty()
+        import pandas as pd
+        df = pd.DataFrame(records)
+        return cls(
+            timestamp=pd.to_datetime(df['timestamp']).to_numpy(dtype='datetime64[ns]').view(np.int64),
+            src=parse_addresses(df['src']),
+            dst=parse_addresses(df['dst']),
+            protocol=df['protocol'].map(PROTOCOL_CODES).fillna(0).to_numpy(),
+            length=df['length'].to_numpy(),
+            src_port=df['src_port'].to_numpy(),
+            dst_port=df['dst_port'].to_numpy(),
+            tcp_flags=df['tcp_flags'].to_numpy() if 'tcp_flags' in df else None,
+        )
+
+    @classmethod
+    def concat(cls, batches):
+        batches = [b for b in batches if len(b)]
+        if not batches:
+            return cls.empty()
+        ipv6 = any(b.ipv6 for b in batches)
+        columns = {}
+        for name in cls.fields:
+            parts = [getattr(b, name) for b in batches]
+            if ipv6 and name in ('src', 'dst'):
+                parts = [cls._as_ipv6(p) for p in parts]
+            columns[name] = np.concatenate(parts)
+        return cls(**columns)
+
+    @staticmethod
+    def _as_ipv6(addresses):
+        return addresses if addresses.ndim == 2 else ipv4_to_mapped(addresses)
+
+    @property
+    def ipv6(self):
+        return self.src.ndim == 2
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def __getitem__(self, index):
+        # Slices return views, masks and index arrays return copies
+        return PacketBatch(**{name: getattr(self, name)[index] for name in self.fields})
+
+    def protocol_names(self):
+        import pandas as pd
+        return pd.Categorical.from_codes(self.protocol, categories=PROTOCOLS)
+
+    def addresses(self, column):
+        import pandas as pd
+        names, inverse = format_addresses(getattr(self, column))
+        return pd.Categorical.from_codes(inverse, categories=names)
+
+    def to_frame(self, addresses=True):
+        # Numeric columns share memory with the batch. With addresses=False the
+        # raw address columns are used (IPv6 as big-endian hi/lo uint64 halves).
+        import pandas as pd
+        columns = {'timestamp': self.timestamp.view('datetime64[ns]')}
+        for column in ('src', 'dst'):
+            values = getattr(self, column)
+            if addresses:
+                columns[column] = self.addresses(column)
+            elif values.ndim == 1:
+                columns[column] = values
+            else:
+                halves = np.ascontiguousarray(values).view('>u8')
+                columns[column + '_hi'] = halves[:, 0]
+                columns[column + '_lo'] = halves[:, 1]
+        columns['protocol'] = self.protocol_names() if addresses else self.protocol
+        for column in ('length', 'src_port', 'dst_port', 'tcp_flags'):
+            columns[column] = getattr(self, column)
+        return pd.DataFrame(columns, copy=False)
+
+
+class IncidentTable:
+    # Column-oriented incidents, one row per (type, src, dst, window) with the
+    # number of matching packets and the largest matched value.
+    fields = ['type', 'severity', 'src', 'dst', 'window', 'first_seen', 'last_seen', 'count', 'value']
+
+    def __init__(self, type, severity, src, dst, window, first_seen, last_seen, count, value):
+        self.type = np.asarray(type, dtype=np.uint8)
+        self.severity = np.asarray(severity, dtype=np.uint8)
+        self.src = np.asarray(src, dtype=np.uint32 if np.ndim(src) == 1 else np.uint8)
+        self.dst = np.asarray(dst, dtype=np.uint32 if np.ndim(dst) == 1 else np.uint8)
+        if self.src.ndim != self.dst.ndim:
+            self.src, self.dst = PacketBatch._as_ipv6(self.src), PacketBatch._as_ipv6(self.dst)
+        self.window = np.asarray(window, dtype=np.int64)
+        self.first_seen = np.asarray(first_seen, dtype=np.int64)
+        self.last_seen = np.asarray(last_seen, dtype=np.int64)
+        self.count = np.asarray(count, dtype=np.int64)
+        self.value = np.asarray(value, dtype=np.int64)
+
+    @classmethod
+    def empty(cls):
+        return cls(*[np.zeros(0)] * 9)
+
+    @classmethod
+    def concat(cls, tables):
+        tables = [t for t in tables if len(t)]
+        if not tables:
+            return cls.empty()
+        ipv6 = any(t.src.ndim == 2 for t in tables)
+        columns = {}
+        for name in cls.fields:
+            parts = [getattr(t, name) for t in tables]
+            if ipv6 and name in ('src', 'dst'):
+                parts = [PacketBatch._as_ipv6(p) for p in parts]
+            columns[name] = np.concatenate(parts)
+        return cls(**columns)
+
+    def __len__(self):
+        return len(self.type)
+
+    def __getitem__(self, index):
+        return IncidentTable(**{name: getattr(self, name)[index] for name in self.fields})
+
+    def type_names(self):
+        return np.array(INCIDENT_TYPES, dtype=object)[self.type]
+
+    def to_records(self):
+        # Dicts in the shape the dashboard, report and incident log expect
+        if not len(self):
+            return []
+        times = np.datetime_as_string(self.first_seen.view('datetime64[ns]'), unit='s')
+        src_names, src_index = format_addresses(self.src)
+        dst_names, dst_index = format_addresses(self.dst)
+        records = []
+        for i, name in enumerate(self.type_names().tolist()):
+            count = int(self.count[i])
+            record = {
+                'type': name,
+                'severity': SEVERITIES[self.severity[i]],
+                'details': INCIDENT_DETAILS[name].format(value=int(self.value[i]), count=count),
+                'timestamp': times[i].replace('T', ' '),
+                'count': count
+            }
+            if name not in UNSCOPED_INCIDENTS:
+                record['src'] = src_names[src_index[i]]
+                record['dst'] = dst_names[dst_index[i]]
+            if name in PACKET_INCIDENTS and count > 1:
+                record['details'] += f" ({count} packets)"
+            records.append(record)
+        return records
+
+
+FLOW_END_REASONS = ['IDLE', 'ACTIVE', 'CLOSED', 'EVICTED', 'FLUSH']
+
+
+class FlowBatch:
+    # Column-oriented, NetFlow/IPFIX-like bidirectional flow records. `src` is
+    # the endpoint that sent the first packet; `rev_*` count the reply direction.
+    fields = ['first_seen', 'last_seen', 'src', 'dst', 'protocol', 'src_port', 'dst_port',
+              'packets', 'bytes', 'rev_packets', 'rev_bytes', 'tcp_flags', 'end_reason']
+
+    def __init__(self, first_seen, last_seen, src, dst, protocol, src_port, dst_port,
+                 packets, bytes, rev_packets, rev_bytes, tcp_flags, end_reason):
+        self.first_seen = np.asarray(first_seen, dtype=np.int64)
+        self.last_seen = np.asarray(last_seen, dtype=np.int64)
+        self.src = np.asarray(src, dtype=np.uint32 if np.ndim(src) == 1 else np.uint8)
+        self.dst = np.asarray(dst, dtype=np.uint32 if np.ndim(dst) == 1 else np.uint8)
+        if self.src.ndim != self.dst.ndim:
+            self.src, self.dst = PacketBatch._as_ipv6(self.src), PacketBatch._as_ipv6(self.dst)
+        self.protocol = np.asarray(protocol, dtype=np.uint8)
+        self.src_port = np.asarray(src_port, dtype=np.uint16)
+        self.dst_port = np.asarray(dst_port, dtype=np.uint16)
+        self.packets = np.asarray(packets, dtype=np.int64)
+        self.bytes = np.asarray(bytes, dtype=np.int64)
+        self.rev_packets = np.asarray(rev_packets, dtype=np.int64)
+        self.rev_bytes = np.asarray(rev_bytes, dtype=np.int64)
+        self.tcp_flags = np.asarray(tcp_flags, dtype=np.uint8)
+        self.end_reason = np.asarray(end_reason, dtype=np.uint8)
+
+    @classmethod
+    def empty(cls):
+        return cls(*[np.zeros(0)] * 13)
+
+    @classmethod
+    def concat(cls, flows):
+        flows = [f for f in flows if len(f)]
+        if not flows:
+            return cls.empty()
+        ipv6 = any(f.src.ndim == 2 for f in flows)
+        columns = {}
+        for name in cls.fields:
+            parts = [getattr(f, name) for f in flows]
+            if ipv6 and name in ('src', 'dst'):
+                parts = [PacketBatch._as_ipv6(p) for p in parts]
+            columns[name] = np.concatenate(parts)
+        return cls(**columns)
+
+    def __len__(self):
+        return len(self.first_seen)
+
+    def __getitem__(self, index):
+        return FlowBatch(**{name: getattr(self, name)[index] for name in self.fields})
+
+    @property
+    def duration(self):
+        return self.last_seen - self.first_seen
+
+    @property
+    def total_bytes(self):
+        return self.bytes + self.rev_bytes
+
+    @property
+    def total_packets(self):
+        return self.packets + self.rev_packets
+
+    def to_frame(self, addresses=True):
+        import pandas as pd
+        columns = {
+            'first_seen': self.first_seen.view('datetime64[ns]'),
+            'last_seen': self.last_seen.view('datetime64[ns]'),
+        }
+        for column in ('src', 'dst'):
+            values = getattr(self, column)
+            if addresses:
+                names, inverse = format_addresses(values)
+                columns[column] = pd.Categorical.from_codes(inverse, categories=names)
+            elif values.ndim == 1:
+                columns[column] = values
+            else:
+                halves = np.ascontiguousarray(values).view('>u8')
+                columns[column + '_hi'] = halves[:, 0]
+                columns[column + '_lo'] = halves[:, 1]
+        columns['protocol'] = (pd.Categorical.from_codes(self.protocol, categories=PROTOCOLS)
+                               if addresses else self.protocol)
+        for column in ('src_port', 'dst_port', 'packets', 'bytes', 'rev_packets', 'rev_bytes', 'tcp_flags'):
+            columns[column] = getattr(self, column)
+        columns['end_reason'] = (pd.Categorical.from_codes(self.end_reason, categories=FLOW_END_REASONS)
+                                 if addresses else self.end_reason)
+        return pd.DataFrame(columns, copy=False)
+
 
 class IncidentReport:
     def __init__(self, incident_type, description, timestamp):
         self.incident_type = incident_type
         self.description = description
-        self.timestamp = timestamp
\ No newline at end of file
+        self.timestamp = timestamp
@@ -1,76 +1,121 @@
-import pandas as pd
-from datetime import datetime
+import os
+import numpy as np
+from custom_types import IncidentTable, INCIDENT_TYPES
+from tools.metrics import stage, INCIDENTS
+from .rules import Rule, SizeRule, PortRule, BurstRule, WatchlistRule, merge_incidents
+from .streaming import StreamingDetector, ScanDetector, BeaconDetector, ExfiltrationDetector, StateTable
+from .sinks import IncidentSink, JsonLinesSink, SQLiteSink, SyslogSink, ConsoleSink
+from .watchlist import Watchlist, PrefixTable
+from .anomaly import (AnomalyDetector, AnomalyModel, ModelStore, HostWindows, Trainer, fit_model, FEATURES,
+                      ANOMALY_RATE)
 
 class IncidentDetector:
     def __init__(self):
         self.thresholds = {
             'large_packet': 9000,  # bytes
             'burst_rate': 1000,    # packets per second
-            'suspicious_ports': [22, 23, 3389]  # SSH, Telnet, RDP
+            'suspicious_ports': [22, 23, 3389],  # SSH, Telnet, RDP
+            'watchlists': [],  # files of IPs and CIDR blocks, one per line
+            'anomaly_models': None,  # directory of trained anomaly models; None turns scoring off
+            'anomaly_rate': ANOMALY_RATE  # share of ordinary host windows a new model reports
         }
+        self.window = 60  # seconds, repeated matches are aggregated per window
         self.incidents = []
+        self.streaming = None  # the live stream, made on first use
+        self.train_live = True  # whether the live stream trains the anomaly models; off for generated traffic
+        self.sink = None  # optional IncidentSink every detected incident is logged to
+        self._watchlist = None
+        self._models = None
+
+    def __getstate__(self):
+        # The watchlist and model store are opened again on first use, e.g. by
+        # the live producer
+        return dict(self.__dict__, _watchlist=None, _models=None)
         
-    def detect_incidents(self, traffic_data):
-        if not traffic_data:
-            return []
-            
-        df = pd.DataFrame(traffic_data)
-        incidents = []
+    def build_rules(self):
+        rules = [
+            SizeRule(self.thresholds['large_packet'], self.window),
+            PortRule(self.thresholds['suspicious_ports'], self.window),
+            BurstRule(self.thresholds['burst_rate'])
+        ]
+        watchlist = self.watchlist()
+        if watchlist is not None:
+            rules.append(WatchlistRule(watchlist, self.window))
+        return rules
         
-        # 1. Large packet detection
-        large_packets = df[df['length'] > self.thresholds['large_packet']]
-        for _, pkt in large_packets.iterrows():
-            incidents.append({
-                'type': 'LARGE_PACKET',
-                'severity': 'MEDIUM',
-                'details': f"Large packet detected: {pkt['length']} bytes",
-                'src': pkt['src'],
-                'dst': pkt['dst'],
-                'timestamp': pkt['timestamp']
-            })
+    def watchlist(self):
+        # Loaded on first use and kept, so feed files are only read again when
+        # they change (see Watchlist.check)
+        paths = tuple(self.thresholds.get('watchlists') or ())
+        if not paths:
+            return None
+        if self._watchlist is None or self._watchlist.paths != paths:
+            self._watchlist = Watchlist(paths)
+        return self._watchlist
         
-        # 2. Suspicious port detection
-        suspicious_ports = df[
-            df['dst_port'].isin(self.thresholds['suspicious_ports']) |
-            df['src_port'].isin(self.thresholds['suspicious_ports'])
-        ]
-        for _, pkt in suspicious_ports.iterrows():
-            incidents.append({
-                'type': 'SUSPICIOUS_PORT',
-                'severity': 'HIGH',
-                'details': f"Suspicious port detected: {pkt['dst_port']}",
-                'src': pkt['src'],
-                'dst': pkt['dst'],
-                'timestamp': pkt['timestamp']
-            })
+    def model_store(self):
+        # Opened on first use and kept, so the streams share the loaded model
+        root = self.thresholds.get('anomaly_models')
+        if not root:
+            return None
+        if self._models is None or self._models.root != os.path.abspath(root):
+            self._models = ModelStore(root)
+        return self._models
+
+    def new_stream(self, train=True, resumed=False, cut=False):
+        # Separate detector state, e.g. for an uploaded capture; `resumed` and
+        # `cut` say it starts or ends partway through one (see AnomalyDetector)
+        stream = StreamingDetector()
+        models = self.model_store()
+        if models is not None:
+            stream.detectors.append(AnomalyDetector(models, self.thresholds.get('anomaly_rate', ANOMALY_RATE),
+                                                    train=train, resumed=resumed, cut=cut))
+        return stream
         
-        # 3. Traffic burst detection
-        df['timestamp'] = pd.to_datetime(df['timestamp'])
-        packets_per_second = df.groupby(df['timestamp'].dt.second).size()
-        bursts = packets_per_second[packets_per_second > self.thresholds['burst_rate']]
+    def detect_incidents(self, traffic_data, stream=None):
+        if not len(traffic_data):
+            return IncidentTable.empty()
         
-        for second, count in bursts.items():
-            incidents.append({
-                'type': 'TRAFFIC_BURST',
-                'severity': 'LOW',
-                'details': f"Traffic burst detected: {count} packets/second",
-                'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            })
-            
+        # Every rule is a vectorized pass over the batch; the stateful detectors
+        # carry per-source state over from the previous batches of the stream
+        if stream is None:
+            if self.streaming is None:
+                self.streaming = self.new_stream(train=self.train_live)
+            stream = self.streaming
+        with stage('detect_incidents'):
+            incidents = [rule.evaluate(traffic_data, stream.rule_state) if isinstance(rule, BurstRule)
+                         else rule.evaluate(traffic_data) for rule in self.build_rules()]
+            incidents.append(stream.process(traffic_data))
+            incidents = IncidentTable.concat(incidents)
+        self._record(incidents)
+        return incidents
+
+    def finish_stream(self, stream):
+        # Incidents of the windows still open at the end of a stream
+        bursts = [rule.flush(stream.rule_state) for rule in self.build_rules() if isinstance(rule, BurstRule)]
+        incidents = IncidentTable.concat([stream.flush()] + bursts)
+        self._record(incidents)
         return incidents
-    
-    def log_incident(self, incident):
-        # Log to file with timestamp
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        with open('security_incidents.log', 'a') as f:
-            f.write(f"[{timestamp}] {incident['severity']} - {incident['type']}: {incident['details']}\n")
-        
-        # Also print to console
-        print(f"🚨 INCIDENT DETECTED: {incident['severity']} - {incident['type']}: {incident['details']}")
-    def detect_incident(self, traffic_data):
-        # Logic to analyze traffic data and detect incidents
-        pass
 
-    def log_incident(self, incident_details):
-        # Logic to log detected incidents
-        pass
\ No newline at end of file
+    def _record(self, incidents):
+        if len(incidents):
+            for code, count in enumerate(np.bincount(incidents.type, minlength=len(INCIDENT_TYPES)).tolist()):
+                if count:
+                    INCIDENTS.labels(INCIDENT_TYPES[code]).inc(count)
+        self.log_incidents(incidents)
+    
+    def merge_incidents(self, tables, per_second=None):
+        # Incidents found on separate chunks of a capture. A second can be split
+        # between chunks, so bursts are recounted from the merged per-second
+        # packet counts when they are given.
+        incidents = merge_incidents(tables)
+        if per_second is None:
+            return incidents
+        incidents = incidents[incidents.type != INCIDENT_TYPES.index('TRAFFIC_BURST')]
+        bursts = [rule.evaluate_counts(*per_second) for rule in self.build_rules() if isinstance(rule, BurstRule)]
+        return IncidentTable.concat([incidents] + bursts)
+    
+    def log_incidents(self, incidents):
+        # Queued for the incident sink, if there is one; never waits on I/O
+        if self.sink is not None:
+            self.sink.submit(incidents)
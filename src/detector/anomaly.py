@@ -0,0 +1,566 @@
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import pickle
+import subprocess
+try:
+    import fcntl
+except ImportError:  # no advisory locks, so one process must train a store at a time (e.g. on Windows)
+    fcntl = None
+import numpy as np
+from custom_types import (IncidentTable, INCIDENT_TYPES, PROTOCOL_CODES, address_keys, hash_combine,
+                          narrow_addresses)
+from tools.metrics import REGISTRY, stage
+
+NS_PER_SECOND = 1_000_000_000
+TCP_CODES = [PROTOCOL_CODES['TCP'], PROTOCOL_CODES['HTTP'], PROTOCOL_CODES['HTTPS']]
+SYN = 0x02
+ACK = 0x10
+
+# What a host did in one window, as seen from its own packets and those sent to it
+FEATURES = ['packets', 'bytes', 'mean_size', 'size_spread', 'fan_out', 'ports', 'service_ports',
+            'port_entropy', 'mean_gap', 'gap_spread', 'syn_share', 'udp_share', 'icmp_share', 'received_bytes']
+ANOMALY_WINDOW = 60  # seconds of a host's traffic scored as one feature vector
+ANOMALY_GRACE = 5  # seconds a window stays open for late packets
+ANOMALY_RATE = 0.001  # share of ordinary host windows reported, at the lowest severity
+NOVELTY = 0.2  # how far past the range seen in training (in spans of it) a feature is always HIGH
+SERVICE_PORTS = 1024  # destination ports below this are services, the rest mostly replies
+TREES = 100
+MIN_SAMPLES = 10_000  # host windows needed to train the first model
+MAX_SAMPLES = 100_000  # host windows kept to train the next model
+RETRAIN_INTERVAL = 3600  # seconds between retrainings
+RELOAD_INTERVAL = 30  # seconds between checks for a newer model
+KEEP_MODELS = 5  # versions kept on disk
+
+_MODEL_FILE = re.compile(r'^model-(\d+)\.pkl$')
+# Where the packages live, for the training process
+_SOURCE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_HOSTS = {
+    'key': np.uint64, 'host': 'V16', 'window': np.int64, 'packets': np.int64, 'bytes': np.int64,
+    'bytes_sq': np.float64, 'first': np.int64, 'last': np.int64, 'gaps': np.float64, 'gaps_sq': np.float64,
+    'syn': np.int64, 'udp': np.int64, 'icmp': np.int64,
+}
+# Distinct destinations of a host window; `peer_key` is the destination's own
+# host window, to which the bytes count as received
+_PEERS = {'key': np.uint64, 'group': np.uint64, 'count': np.int64, 'bytes': np.int64, 'peer': 'V16',
+          'peer_key': np.uint64}
+_PORTS = {'key': np.uint64, 'group': np.uint64, 'count': np.int64, 'port': np.uint16}
+_SUMS = {'packets', 'bytes', 'bytes_sq', 'syn', 'udp', 'icmp', 'count'}  # columns added up when rows merge
+
+# Models loaded by this process, shared by all its detectors: (directory, version) -> AnomalyModel
+_MODELS = {}
+# Sorted, so the newest version of each directory is the one kept
+REGISTRY.gauge('anomaly_model_version', 'Version of the anomaly model in use, by model directory', ['models'],
+               function=lambda: dict(sorted(_MODELS)))
+
+
+def _empty(columns):
+    return {name: np.empty(0, dtype=dtype) for name, dtype in columns.items()}
+
+
+def _select(state, index):
+    return {name: column[index] for name, column in state.items()}
+
+
+def _starts(keys):
+    if not len(keys):
+        return np.zeros(0, dtype=np.intp)
+    return np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+
+
+def _find(keys, values):
+    # Positions of `values` in the sorted `keys`, and which of them are there
+    if not len(keys):
+        return np.zeros(len(values), dtype=np.intp), np.zeros(len(values), dtype=bool)
+    pos = np.minimum(np.searchsorted(keys, values), len(keys) - 1)
+    return pos, keys[pos] == values
+
+
+def _merge(state, update):
+    # Merges rows with distinct keys into key-sorted state, as FlowTable does:
+    # known keys are added up in place and new ones inserted with a stable
+    # sort of two sorted runs
+    pos, found = _find(state['key'], update['key'])
+    rows = pos[found]
+    for name in _SUMS.intersection(state):
+        state[name][rows] += update[name][found]
+    if 'gaps' in state:
+        # The gap between the last packet so far and the first of the update
+        gap = np.maximum(update['first'][found] - state['last'][rows], 0) / NS_PER_SECOND
+        state['gaps'][rows] += update['gaps'][found] + gap
+        state['gaps_sq'][rows] += update['gaps_sq'][found] + gap * gap
+        state['first'][rows] = np.minimum(state['first'][rows], update['first'][found])
+        state['last'][rows] = np.maximum(state['last'][rows], update['last'][found])
+    new = ~found
+    if not new.any():
+        return state
+    merged = {name: np.concatenate([state[name], update[name][new]]) for name in state}
+    return _select(merged, np.argsort(merged['key'], kind='stable'))
+
+
+def _pairs(group, item, weights=None):
+    # Distinct (group, item) pairs with their counts (and sums of `weights`),
+    # and the first row of each
+    key = hash_combine(group, item)
+    order = np.argsort(key)
+    starts = _starts(key[order])
+    rows = order[starts]
+    pairs = {'key': key[rows], 'group': group[rows], 'count': np.diff(np.r_[starts, len(key)])}
+    if weights is not None:
+        pairs['bytes'] = np.add.reduceat(weights[order], starts)
+    return pairs, rows
+
+
+class HostFeatures:
+    # Feature vectors of finished host windows, with what an incident needs
+    def __init__(self, features, host, peer, window, first_seen, last_seen, packets):
+        self.features = features
+        self.host = host
+        self.peer = peer
+        self.window = window
+        self.first_seen = first_seen
+        self.last_seen = last_seen
+        self.packets = packets
+
+    def __len__(self):
+        return len(self.features)
+
+    def __getitem__(self, index):
+        return HostFeatures(self.features[index], self.host[index], self.peer[index], self.window[index],
+                            self.first_seen[index], self.last_seen[index], self.packets[index])
+
+
+class HostWindows:
+    # Traffic per host and fixed window, accumulated batch by batch. Each batch
+    # is reduced to one row per (host, window) with NumPy and merged into
+    # key-sorted columns, as in FlowTable; destinations and ports are kept as
+    # distinct pairs with counts, for fan-out and port entropy. A window is
+    # turned into a feature vector once it is over.
+    def __init__(self, interval=ANOMALY_WINDOW, grace=ANOMALY_GRACE):
+        self.interval = interval * NS_PER_SECOND
+        self.grace = grace * NS_PER_SECOND
+        self._hosts = _empty(_HOSTS)
+        self._peers = _empty(_PEERS)
+        self._ports = _empty(_PORTS)
+
+    def __len__(self):
+        return len(self._hosts['key']) + len(self._peers['key']) + len(self._ports['key'])
+
+    def add(self, batch, src_hash, dst_hash):
+        if not len(batch):
+            return
+        window = batch.timestamp // self.interval
+        sent = hash_combine(src_hash, window.astype(np.uint64))
+        length = batch.length.astype(np.int64)
+        syn = np.isin(batch.protocol, TCP_CODES) & ((batch.tcp_flags & (SYN | ACK)) == SYN)
+
+        # Sorted by host window, then time, for the gaps between packets; a
+        # stable sort keeps the time order of a batch that is in time order
+        if (batch.timestamp[1:] >= batch.timestamp[:-1]).all():
+            order = np.argsort(sent, kind='stable')
+        else:
+            order = np.lexsort((batch.timestamp, sent))
+        keys = sent[order]
+        timestamp = batch.timestamp[order]
+        starts = _starts(keys)
+        ends = np.r_[starts[1:], len(keys)]
+        gaps = np.diff(timestamp, prepend=timestamp[:1]) / NS_PER_SECOND
+        gaps[starts] = 0.0
+        size = length[order].astype(np.float64)
+        protocol = batch.protocol[order]
+        first = order[starts]
+        self._hosts = _merge(self._hosts, {
+            'key': keys[starts],
+            'host': address_keys(batch.src[first]),
+            'window': window[first],
+            'packets': ends - starts,
+            'bytes': np.add.reduceat(length[order], starts),
+            'bytes_sq': np.add.reduceat(size * size, starts),
+            'first': timestamp[starts],
+            'last': timestamp[ends - 1],
+            'gaps': np.add.reduceat(gaps, starts),
+            'gaps_sq': np.add.reduceat(gaps * gaps, starts),
+            'syn': np.add.reduceat(syn[order].astype(np.int64), starts),
+            'udp': np.add.reduceat((protocol == PROTOCOL_CODES['UDP']).astype(np.int64), starts),
+            'icmp': np.add.reduceat((protocol == PROTOCOL_CODES['ICMP']).astype(np.int64), starts),
+        })
+        peers, rows = _pairs(sent, dst_hash, length)
+        peers['peer'] = address_keys(batch.dst[rows])
+        peers['peer_key'] = hash_combine(dst_hash[rows], window[rows].astype(np.uint64))
+        self._peers = _merge(self._peers, peers)
+        ports, rows = _pairs(sent, batch.dst_port.astype(np.uint64))
+        ports['port'] = batch.dst_port[rows]
+        self._ports = _merge(self._ports, ports)
+
+    def close(self, now=None):
+        # Features of the windows that ended before `now` (nanoseconds), or of
+        # every window without it; None when there are none
+        hosts = self._hosts
+        if not len(hosts['key']):
+            return None
+        if now is None:
+            done = np.ones(len(hosts['key']), dtype=bool)
+        else:
+            done = (hosts['window'] + 1) * self.interval + self.grace <= now
+            if not done.any():
+                return None
+        finished = _select(hosts, done)
+        self._hosts = _select(hosts, ~done)
+        # Every pair belongs to a window its sender was active in
+        peers, self._peers = self._split(self._peers, finished['key'])
+        ports, self._ports = self._split(self._ports, finished['key'])
+        return self._features(finished, peers, ports)
+
+    @staticmethod
+    def _split(pairs, groups):
+        done = np.isin(pairs['group'], groups)
+        return _select(pairs, done), _select(pairs, ~done)
+
+    def _features(self, hosts, peers, ports):
+        # `hosts` is sorted by key; pairs are found by their group's key
+        keys = hosts['key']
+        packets = hosts['packets'].astype(np.float64)
+        mean_size = hosts['bytes'] / packets
+        size_spread = np.sqrt(np.maximum(hosts['bytes_sq'] / packets - mean_size * mean_size, 0.0))
+        intervals = np.maximum(packets - 1, 1)
+        mean_gap = np.where(packets > 1, hosts['gaps'] / intervals, self.interval / NS_PER_SECOND)
+        gap_std = np.sqrt(np.maximum(hosts['gaps_sq'] / intervals - mean_gap * mean_gap, 0.0))
+        gap_spread = np.where(packets > 1, gap_std / np.maximum(mean_gap, 1e-9), 0.0)
+
+        # Fan-out and the busiest peer, from the sorted destination pairs
+        order = np.lexsort((-peers['count'], peers['group']))
+        groups = peers['group'][order]
+        starts = _starts(groups)
+        fan_out = np.zeros(len(keys))
+        fan_out[np.searchsorted(keys, groups[starts])] = np.diff(np.r_[starts, len(groups)])
+        peer = hosts['host'].copy()
+        peer[np.searchsorted(keys, groups[starts])] = peers['peer'][order][starts]
+
+        # Destination ports: how many, how many of them services, and the
+        # entropy (bits) of their use
+        order = np.argsort(ports['group'])
+        groups = ports['group'][order]
+        counts = ports['count'][order].astype(np.float64)
+        starts = _starts(groups)
+        rows = np.searchsorted(keys, groups[starts])
+        port_count = np.zeros(len(keys))
+        service_count = np.zeros(len(keys))
+        entropy = np.zeros(len(keys))
+        if len(starts):
+            totals = np.add.reduceat(counts, starts)
+            port_count[rows] = np.diff(np.r_[starts, len(groups)])
+            service_count[rows] = np.add.reduceat((ports['port'][order] < SERVICE_PORTS).astype(np.float64), starts)
+            entropy[rows] = np.maximum(np.log2(totals) - np.add.reduceat(counts * np.log2(counts), starts) / totals,
+                                       0.0)
+
+        # Bytes received: what the senders of the same windows sent this host
+        order = np.argsort(peers['peer_key'])
+        starts = _starts(peers['peer_key'][order])
+        received = np.zeros(len(keys))
+        if len(starts):
+            rows, found = _find(keys, peers['peer_key'][order][starts])
+            received[rows[found]] = np.add.reduceat(peers['bytes'][order], starts)[found]
+
+        features = np.column_stack([
+            np.log1p(packets), np.log1p(hosts['bytes']), mean_size, size_spread, np.log1p(fan_out),
+            np.log1p(port_count), np.log1p(service_count), entropy, np.log1p(mean_gap), gap_spread, hosts['syn'] / packets,
+            hosts['udp'] / packets, hosts['icmp'] / packets, np.log1p(received),
+        ])
+        addresses = narrow_addresses(np.concatenate([hosts['host'], peer]).view(np.uint8).reshape(-1, 16))
+        return HostFeatures(features, addresses[:len(keys)], addresses[len(keys):],
+                            hosts['window'] * self.interval, hosts['first'], hosts['last'], hosts['packets'])
+
+
+class AnomalyModel:
+    # An isolation forest, the scores at which host windows are reported
+    # (ascending thresholds for LOW, MEDIUM and HIGH severity) and the range of
+    # every feature in training. A forest cannot tell a value just past the
+    # range it was trained on from one far past it, so those are HIGH too.
+    def __init__(self, forest, thresholds, low, high, trained=None, samples=0, rate=ANOMALY_RATE,
+                 features=FEATURES, version=None):
+        self.forest = forest
+        self.thresholds = np.asarray(thresholds, dtype=np.float64)
+        self.low = np.asarray(low, dtype=np.float64)
+        self.high = np.asarray(high, dtype=np.float64)
+        self.trained = trained  # epoch seconds
+        self.samples = samples
+        self.rate = rate
+        self.features = list(features)
+        self.version = version
+
+    def score(self, features):
+        # Anomaly scores in (0, 1]; higher is more unusual
+        return -self.forest.score_samples(features)
+
+    def severity(self, features, scores):
+        # Severity code of each window, -1 when it is not reported at all
+        severity = np.searchsorted(self.thresholds, scores, side='right') - 1
+        span = np.maximum(self.high - self.low, 1e-9)
+        novel = np.maximum(features - self.high, self.low - features) / span > NOVELTY
+        severity[novel.any(axis=1)] = len(self.thresholds) - 1
+        return severity
+
+    def state(self):
+        return {'forest': self.forest, 'thresholds': self.thresholds, 'low': self.low, 'high': self.high,
+                'trained': self.trained, 'samples': self.samples, 'rate': self.rate, 'features': self.features}
+
+
+def fit_model(features, rate=ANOMALY_RATE, trees=TREES, seed=None):
+    # scikit-learn is only imported by the processes that train or score
+    from sklearn.ensemble import IsolationForest
+    features = np.asarray(features, dtype=np.float64)
+    forest = IsolationForest(n_estimators=trees, max_samples=min(256, len(features)), random_state=seed)
+    forest.fit(features)
+    scores = -forest.score_samples(features)
+    # The `rate` most unusual training windows and a tenth of them. HIGH is
+    # as far past the strangest of them as that is past LOW, since the maximum
+    # of a sample alone says little about the tail of the traffic.
+    low, medium = np.quantile(scores, [1 - rate, 1 - rate / 10])
+    thresholds = np.r_[low, medium, 2 * scores.max() - low]
+    thresholds = np.maximum.accumulate(thresholds) + np.arange(3) * 1e-9
+    return AnomalyModel(forest, thresholds, features.min(axis=0), features.max(axis=0), time.time(),
+                        len(features), rate)
+
+
+class ModelStore:
+    # Versioned anomaly models in a directory: model-<version>.pkl with a JSON
+    # description next to it, each written to a temporary file and renamed.
+    # The newest model is kept loaded; the directory is checked for a newer
+    # one at most every `reload_interval` seconds.
+    def __init__(self, root, reload_interval=RELOAD_INTERVAL, keep=KEEP_MODELS):
+        self.root = os.path.abspath(root)
+        self.reload_interval = reload_interval
+        self.keep = keep
+        self._model = None
+        self._checked = None
+        os.makedirs(self.root, exist_ok=True)
+
+    def versions(self):
+        matches = (_MODEL_FILE.match(name) for name in os.listdir(self.root))
+        return sorted(int(match.group(1)) for match in matches if match)
+
+    def path(self, version, suffix='.pkl'):
+        return os.path.join(self.root, f"model-{version:06d}{suffix}")
+
+    def latest(self):
+        # The newest model, or None before the first one is trained
+        now = time.monotonic()
+        if self._checked is None or now - self._checked >= self.reload_interval:
+            self._checked = now
+            versions = self.versions()
+            if versions and (self._model is None or self._model.version != versions[-1]):
+                self._model = self.load(versions[-1]) or self._model
+        return self._model
+
+    def load(self, version):
+        key = (self.root, version)
+        model = _MODELS.get(key)
+        if model is None:
+            try:
+                with open(self.path(version), 'rb') as f:
+                    state = pickle.load(f)
+                # A state from another version of AnomalyModel does not fit its arguments
+                model = AnomalyModel(version=version, **state)
+            except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, TypeError) as e:
+                print(f"Cannot load anomaly model {self.path(version)}: {e}", file=sys.stderr)
+                return None
+            if model.features != FEATURES:
+                # Trained on features this version no longer extracts
+                return None
+            # Older versions of this store are not needed any more
+            for old in [k for k in _MODELS if k[0] == self.root and k[1] < version]:
+                del _MODELS[old]
+            _MODELS[key] = model
+        return model
+
+    def save(self, model):
+        # Stores `model` as the next version and returns it
+        with open(os.path.join(self.root, 'models.lock'), 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            versions = self.versions()
+            version = (versions[-1] if versions else 0) + 1
+            description = {
+                'version': version,
+                'trained': model.trained,
+                'samples': model.samples,
+                'rate': model.rate,
+                'features': FEATURES,
+                'thresholds': model.thresholds.tolist(),
+            }
+            for suffix, write, mode in (('.pkl', lambda f: pickle.dump(model.state(), f), 'wb'),
+                                        ('.json', lambda f: json.dump(description, f, indent=2), 'w')):
+                temporary = self.path(version, suffix) + '.tmp'
+                with open(temporary, mode) as f:
+                    write(f)
+                os.replace(temporary, self.path(version, suffix))
+            for old in versions[:max(len(versions) + 1 - self.keep, 0)]:
+                for suffix in ('.pkl', '.json'):
+                    try:
+                        os.unlink(self.path(old, suffix))
+                    except FileNotFoundError:
+                        pass
+        model.version = version
+        return version
+
+    def describe(self):
+        # The JSON descriptions of the stored models, newest first
+        descriptions = []
+        for version in reversed(self.versions()):
+            try:
+                with open(self.path(version, '.json')) as f:
+                    descriptions.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return descriptions
+
+
+def train(root, samples_path, rate=ANOMALY_RATE):
+    # Body of the training process started by Trainer: fits a model on the
+    # saved samples and stores it as the next version. If the store is
+    # already being trained, that training wins.
+    try:
+        with open(os.path.join(root, 'train.lock'), 'a') as lock:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            samples = np.load(samples_path)
+            return ModelStore(root).save(fit_model(samples, rate))
+    finally:
+        os.unlink(samples_path)
+
+
+class Trainer:
+    # Keeps a uniform sample of the host windows seen (reservoir sampling) and
+    # trains the next model from it in a separate process, so neither scoring
+    # nor the web workers ever wait for a fit. The first model is trained once
+    # there are `min_samples` windows; after that the store is retrained every
+    # `interval` seconds.
+    def __init__(self, store, rate=ANOMALY_RATE, min_samples=MIN_SAMPLES, max_samples=MAX_SAMPLES,
+                 interval=RETRAIN_INTERVAL, seed=None):
+        self.store = store
+        self.rate = rate
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.interval = interval
+        self.samples = np.empty((0, len(FEATURES)))
+        self.seen = 0
+        self.process = None
+        self._started = None
+        self._rng = np.random.default_rng(seed)
+
+    def add(self, features):
+        # New rows fill the sample until it is full; after that row i of the
+        # stream replaces a random one with probability max_samples / i
+        free = max(self.max_samples - len(self.samples), 0)
+        if free:
+            self.samples = np.concatenate([self.samples, features[:free]])
+        rest = features[free:]
+        if len(rest):
+            seen = np.arange(self.seen + free + 1, self.seen + len(features) + 1)
+            taken = self._rng.random(len(rest)) < self.max_samples / seen
+            self.samples[self._rng.integers(0, self.max_samples, int(taken.sum()))] = rest[taken]
+        self.seen += len(features)
+        self.check()
+
+    def check(self):
+        # Starts a training if one is due and none is running
+        if self.process is not None:
+            if self.process.poll() is None:
+                return
+            self.process = None
+        if len(self.samples) < self.min_samples:
+            return
+        now = time.monotonic()
+        if self._started is not None and now - self._started < self.interval:
+            return
+        model = self.store.latest()
+        if model is not None and model.trained is not None and time.time() - model.trained < self.interval:
+            return
+        self._started = now
+        self.start()
+
+    def start(self):
+        path = os.path.join(self.store.root, f"samples-{uuid.uuid4().hex}.npy")
+        np.save(path, self.samples)
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [_SOURCE_ROOT, env.get('PYTHONPATH')]))
+        # A plain child process, as the live producer is a daemon process
+        # that multiprocessing will not let have children of its own
+        self.process = subprocess.Popen(
+            [sys.executable, '-c', 'import sys; from detector.anomaly import train; '
+                                   'train(sys.argv[1], sys.argv[2], float(sys.argv[3]))',
+             self.store.root, path, repr(self.rate)],
+            env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+
+
+class AnomalyDetector:
+    # Scores the traffic of every host per window with the newest model of a
+    # ModelStore: all windows that end together are scored in one call, so the
+    # cost per batch is the vectorized bookkeeping of HostWindows. Windows
+    # scoring above the model's thresholds become ANOMALY incidents, their
+    # severity by how unusual they are. Until a model exists nothing is
+    # reported; unless `train` is off, the scored windows train the next model
+    # in the background. A stream over one chunk of a capture leaves out the
+    # windows the chunk edges cut short: those it joined partway through when
+    # it is `resumed`, and those still open at its end when it is `cut`.
+    def __init__(self, store, rate=ANOMALY_RATE, interval=ANOMALY_WINDOW, trainer=None, train=True,
+                 resumed=False, cut=False):
+        self.store = store
+        self.windows = HostWindows(interval)
+        self.trainer = trainer if trainer is not None else Trainer(store, rate)
+        self.train = train
+        self.resumed = resumed
+        self.cut = cut
+        self._first = None  # start of the first window of a resumed stream, in nanoseconds
+        self.tables = [self.windows]
+        self.scored = REGISTRY.counter('anomaly_windows', 'Host windows scored for anomalies')
+
+    def process(self, batch, src_hash, dst_hash, now):
+        if self.resumed and self._first is None:
+            interval = self.windows.interval
+            self._first = int(batch.timestamp.min()) // interval * interval
+        self.windows.add(batch, src_hash, dst_hash)
+        return self.score(self.windows.close(now))
+
+    def flush(self):
+        # Scores the windows still open, e.g. at the end of a capture
+        windows = self.windows.close()
+        return IncidentTable.empty() if self.cut else self.score(windows)
+
+    def score(self, windows):
+        if windows is not None and self._first is not None:
+            windows = windows[windows.window > self._first]
+        if windows is None or not len(windows):
+            return IncidentTable.empty()
+        if self.train:
+            self.trainer.add(windows.features)
+        model = self.store.latest()
+        if model is None:
+            return IncidentTable.empty()
+        with stage('anomaly_score'):
+            scores = model.score(windows.features)
+        self.scored.inc(len(windows))
+        severity = model.severity(windows.features, scores)
+        rows = np.flatnonzero(severity >= 0)
+        return IncidentTable(
+            type=np.full(len(rows), INCIDENT_TYPES.index('ANOMALY')),
+            severity=severity[rows],
+            src=windows.host[rows],
+            dst=windows.peer[rows],
+            window=windows.window[rows],
+            first_seen=windows.first_seen[rows],
+            last_seen=windows.last_seen[rows],
+            count=windows.packets[rows],
+            value=np.round(scores[rows] * 1000),
+        )
+
+    def expire(self, now):
+        # Windows end in process(); HostWindows holds nothing else
+        pass
+
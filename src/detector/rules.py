@@ -0,0 +1,196 @@
+import numpy as np
+from custom_types import IncidentTable, INCIDENT_TYPES, SEVERITIES
+
+NS_PER_SECOND = 1_000_000_000
+
+
+def _codes(values):
+    # Distinct addresses and each row's index into them
+    if values.ndim == 1:
+        uniq, inverse = np.unique(values, return_inverse=True)
+        return uniq, inverse.ravel()
+    uniq, inverse = np.unique(np.ascontiguousarray(values).view('V16').ravel(), return_inverse=True)
+    return uniq.view(np.uint8).reshape(-1, 16), inverse.ravel()
+
+
+def _group(*codes):
+    # Single group id per distinct combination of the integer code columns
+    dims = [int(c.max()) + 1 for c in codes]
+    if np.prod(dims, dtype=float) < 2 ** 62:
+        key = np.ravel_multi_index(codes, dims)
+        _, inverse = np.unique(key, return_inverse=True)
+    else:
+        _, inverse = np.unique(np.stack(codes, axis=1), axis=0, return_inverse=True)
+    return inverse.ravel()
+
+
+def merge_incidents(tables):
+    # Combines rows of the same (type, src, dst, window) found in separate parts
+    # of the traffic, e.g. chunks of a capture analysed in parallel
+    table = IncidentTable.concat(tables)
+    if not len(table):
+        return table
+    src, src_code = _codes(table.src)
+    dst, dst_code = _codes(table.dst)
+    _, window_code = np.unique(table.window, return_inverse=True)
+    group = _group(table.type.astype(np.int64), src_code, dst_code, window_code.ravel())
+    order = np.argsort(group, kind='stable')
+    starts = np.flatnonzero(np.r_[True, group[order][1:] != group[order][:-1]])
+    first = order[starts]
+    return IncidentTable(
+        type=table.type[first],
+        severity=np.maximum.reduceat(table.severity[order], starts),
+        src=src[src_code[first]],
+        dst=dst[dst_code[first]],
+        window=table.window[first],
+        first_seen=np.minimum.reduceat(table.first_seen[order], starts),
+        last_seen=np.maximum.reduceat(table.last_seen[order], starts),
+        count=np.add.reduceat(table.count[order], starts),
+        value=np.maximum.reduceat(table.value[order], starts),
+    )
+
+
+class Rule:
+    incident_type = None
+    severity = None
+
+    def __init__(self, window=60):
+        self.window = window  # seconds, incidents are aggregated per window
+
+    def mask(self, batch):
+        raise NotImplementedError
+
+    def values(self, batch, rows):
+        raise NotImplementedError
+
+    def evaluate(self, batch):
+        rows = np.flatnonzero(self.mask(batch))
+        if not len(rows):
+            return IncidentTable.empty()
+        timestamp = batch.timestamp[rows]
+        values = self.values(batch, rows)
+        src, src_code = _codes(batch.src[rows])
+        dst, dst_code = _codes(batch.dst[rows])
+        window = timestamp // (self.window * NS_PER_SECOND)
+        _, window_code = np.unique(window, return_inverse=True)
+        group = _group(src_code, dst_code, window_code.ravel())
+
+        order = np.argsort(group, kind='stable')
+        starts = np.flatnonzero(np.r_[True, group[order][1:] != group[order][:-1]])
+        first = order[starts]
+        return IncidentTable(
+            type=np.full(len(starts), INCIDENT_TYPES.index(self.incident_type)),
+            severity=np.full(len(starts), SEVERITIES.index(self.severity)),
+            src=src[src_code[first]],
+            dst=dst[dst_code[first]],
+            window=window[first] * self.window * NS_PER_SECOND,
+            first_seen=np.minimum.reduceat(timestamp[order], starts),
+            last_seen=np.maximum.reduceat(timestamp[order], starts),
+            count=np.diff(np.r_[starts, len(order)]),
+            value=np.maximum.reduceat(values[order], starts),
+        )
+
+
+class SizeRule(Rule):
+    incident_type = 'LARGE_PACKET'
+    severity = 'MEDIUM'
+
+    def __init__(self, threshold, window=60):
+        super().__init__(window)
+        self.threshold = threshold
+
+    def mask(self, batch):
+        return batch.length > self.threshold
+
+    def values(self, batch, rows):
+        return batch.length[rows].astype(np.int64)
+
+
+class PortRule(Rule):
+    incident_type = 'SUSPICIOUS_PORT'
+    severity = 'HIGH'
+
+    def __init__(self, ports, window=60):
+        super().__init__(window)
+        self.ports = np.asarray(ports, dtype=np.uint16)
+
+    def mask(self, batch):
+        return np.isin(batch.dst_port, self.ports) | np.isin(batch.src_port, self.ports)
+
+    def values(self, batch, rows):
+        dst_port = batch.dst_port[rows]
+        return np.where(np.isin(dst_port, self.ports), dst_port, batch.src_port[rows]).astype(np.int64)
+
+
+class WatchlistRule(Rule):
+    incident_type = 'WATCHLIST'
+    severity = 'HIGH'
+
+    def __init__(self, watchlist, window=60):
+        super().__init__(window)
+        self.watchlist = watchlist
+        self._feeds = None
+
+    def mask(self, batch):
+        # One lookup per distinct address; the destination's feed wins when
+        # both ends are listed
+        src_feed = self.watchlist.lookup(batch.src)
+        dst_feed = self.watchlist.lookup(batch.dst)
+        self._feeds = np.where(dst_feed >= 0, dst_feed, src_feed)
+        return self._feeds >= 0
+
+    def values(self, batch, rows):
+        return self._feeds[rows]
+
+
+class BurstRule(Rule):
+    incident_type = 'TRAFFIC_BURST'
+    severity = 'LOW'
+
+    def __init__(self, rate):
+        super().__init__(window=1)
+        self.rate = rate  # packets per second
+
+    def evaluate(self, batch, state=None):
+        # Buckets are true epoch seconds, not the second-of-minute. With
+        # `state`, a dict the stream keeps between batches, the newest second
+        # is held back until a later batch or flush(), so a second whose
+        # packets arrive in two batches is counted as a whole.
+        seconds, counts = np.unique(batch.timestamp // NS_PER_SECOND, return_counts=True)
+        if state is None:
+            return self.evaluate_counts(seconds, counts)
+        pending = state.pop('burst_second', None)
+        if pending is not None:
+            second, count = pending
+            i = int(np.searchsorted(seconds, second))
+            if i < len(seconds) and seconds[i] == second:
+                counts[i] += count
+            else:
+                seconds, counts = np.insert(seconds, i, second), np.insert(counts, i, count)
+        state['burst_second'] = (seconds[-1], counts[-1])
+        return self.evaluate_counts(seconds[:-1], counts[:-1])
+
+    def flush(self, state):
+        # The second held back by evaluate(), at the end of a stream
+        pending = state.pop('burst_second', None)
+        if pending is None:
+            return IncidentTable.empty()
+        return self.evaluate_counts(np.array([pending[0]]), np.array([pending[1]]))
+
+    def evaluate_counts(self, seconds, counts):
+        bursts = counts > self.rate
+        if not bursts.any():
+            return IncidentTable.empty()
+        n = int(bursts.sum())
+        start = seconds[bursts] * NS_PER_SECOND
+        return IncidentTable(
+            type=np.full(n, INCIDENT_TYPES.index(self.incident_type)),
+            severity=np.full(n, SEVERITIES.index(self.severity)),
+            src=np.zeros(n, dtype=np.uint32),
+            dst=np.zeros(n, dtype=np.uint32),
+            window=start,
+            first_seen=start,
+            last_seen=start + NS_PER_SECOND - 1,
+            count=counts[bursts],
+            value=counts[bursts],
+        )
@@ -0,0 +1,296 @@
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import threading
+from collections import deque
+from datetime import datetime
+
+QUEUE_ROWS = 100_000  # incidents waiting to be written before new ones are dropped
+BATCH_ROWS = 5_000  # most incidents handed to the sinks at once
+FLUSH_INTERVAL = 1.0  # seconds an incident may wait for a batch to fill
+
+SYSLOG_FACILITY = 16  # local0
+SYSLOG_SEVERITIES = {'HIGH': 2, 'MEDIUM': 4, 'LOW': 5}  # crit, warning, notice
+
+
+class JsonLinesSink:
+    # One JSON object per line in a file kept open between batches. The file is
+    # rotated (path.1, path.2, ...) once it reaches `max_bytes` or is older
+    # than `max_age` seconds. The time a file was started is kept next to it
+    # in path.opened, as neither its ctime nor mtime survives the next write.
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, max_age=24 * 3600, backups=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backups = backups
+        self._file = None
+        self._opened = 0.0
+
+    def __getstate__(self):
+        # Sinks are copied to the live producer before they write; the copy
+        # opens its own file, as the other sinks open their own connections
+        return dict(self.__dict__, _file=None)
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, 'a', encoding='utf-8')
+        # A file that already exists keeps its age across restarts
+        if self._file.tell():
+            try:
+                with open(self.path + '.opened', encoding='utf-8') as f:
+                    self._opened = float(f.read())
+                return
+            except (OSError, ValueError):
+                pass
+        self._opened = time.time()
+        with open(self.path + '.opened', 'w', encoding='utf-8') as f:
+            f.write(repr(self._opened))
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def write(self, records):
+        if self._file is None:
+            self._open()
+        if self._file.tell() and (self._file.tell() >= self.max_bytes or time.time() - self._opened >= self.max_age):
+            self._rotate()
+            self._open()
+        self._file.write(''.join(json.dumps(record) + '\n' for record in records))
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class SQLiteSink:
+    # Incidents in an SQLite table, one transaction per batch
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+
+    def __getstate__(self):
+        return dict(self.__dict__, _db=None)
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(self.path, timeout=30)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS incidents (timestamp TEXT, severity TEXT, type TEXT, '
+                         'src TEXT, dst TEXT, count INTEGER, details TEXT)')
+
+    def write(self, records):
+        if self._db is None:
+            self._connect()
+        with self._db:
+            self._db.executemany(
+                'INSERT INTO incidents VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(r['timestamp'], r['severity'], r['type'], r.get('src'), r.get('dst'), r['count'], r['details'])
+                 for r in records])
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class SyslogSink:
+    # One datagram per incident to the local syslog socket
+    def __init__(self, address='/dev/log', facility=SYSLOG_FACILITY, tag='network-forensics'):
+        self.address = address
+        self.facility = facility
+        self.tag = tag
+        self._socket = None
+
+    def __getstate__(self):
+        return dict(self.__dict__, _socket=None)
+
+    def write(self, records):
+        if self._socket is None:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._socket.connect(self.address)
+        try:
+            for record in records:
+                priority = self.facility * 8 + SYSLOG_SEVERITIES[record['severity']]
+                self._socket.send(f"<{priority}>{self.tag}: {json.dumps(record)}".encode())
+        except OSError:
+            # Reconnect on the next batch, e.g. after syslog restarted
+            self.close()
+            raise
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+class ConsoleSink:
+    # Prints at most `rate` incidents per second and how many were left out
+    def __init__(self, rate=5, stream=None):
+        self.rate = rate
+        self.stream = stream  # sys.stdout, as it is when writing, if None
+        self._second = None
+        self._printed = 0
+        self._suppressed = 0
+
+    def write(self, records):
+        lines = []
+        for record in records:
+            second = int(time.time())
+            if second != self._second:
+                if self._suppressed:
+                    lines.append(f"... {self._suppressed} more incidents not shown")
+                self._second, self._printed, self._suppressed = second, 0, 0
+            if self._printed < self.rate:
+                self._printed += 1
+                lines.append(f"🚨 INCIDENT DETECTED: {record['severity']} - {record['type']}: {record['details']}")
+            else:
+                self._suppressed += 1
+        if lines:
+            print('\n'.join(lines), file=self.stream or sys.stdout, flush=True)
+
+    def close(self):
+        pass
+
+
+class IncidentSink:
+    # Buffered incident log. submit() only queues the incident table, so
+    # detection never waits on disk; a background thread turns queued tables
+    # into records and hands them to the sinks in batches. When the queue holds
+    # `max_rows` incidents, new ones wait up to `block_timeout` seconds
+    # (backpressure) and are then dropped.
+    def __init__(self, sinks, max_rows=QUEUE_ROWS, batch_rows=BATCH_ROWS, flush_interval=FLUSH_INTERVAL,
+                 block_timeout=0.0):
+        self.sinks = list(sinks)
+        self.max_rows = max_rows
+        self.batch_rows = batch_rows
+        self.flush_interval = flush_interval
+        self.block_timeout = block_timeout
+        self.counters = {
+            'submitted': 0,  # incidents handed to submit()
+            'written': 0,  # incidents written by every sink
+            'dropped': 0,  # incidents dropped because the queue was full
+            'backpressure': 0,  # submit() calls that found the queue full
+            'blocked_seconds': 0.0,  # time submit() spent waiting for room
+            'errors': 0  # failed sink writes
+        }
+        self.errors = {}  # sink class -> last error
+        self._queue = deque()
+        self._queued_rows = 0
+        self._closing = False
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def __getstate__(self):
+        # A copy in another process, e.g. the live producer, starts with an
+        # empty queue and counters, as a forked one does
+        return {'sinks': self.sinks, 'max_rows': self.max_rows, 'batch_rows': self.batch_rows,
+                'flush_interval': self.flush_interval, 'block_timeout': self.block_timeout}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _start(self):
+        # The writer thread belongs to one process; a forked copy of the sink
+        # (e.g. in the live producer) starts its own with an empty queue
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._queue = deque()
+            self._queued_rows = 0
+            self._closing = False
+            self._thread = threading.Thread(target=self._run, name='incident-sink', daemon=True)
+            self._thread.start()
+
+    def submit(self, incidents):
+        rows = len(incidents)
+        if not rows:
+            return True
+        with self._changed:
+            self._start()
+            self.counters['submitted'] += rows
+            if self._closing:
+                self.counters['dropped'] += rows
+                return False
+            if self._queued_rows + rows > self.max_rows:
+                self.counters['backpressure'] += 1
+                started = time.monotonic()
+                self._changed.wait_for(lambda: self._queued_rows + rows <= self.max_rows, self.block_timeout)
+                self.counters['blocked_seconds'] += time.monotonic() - started
+                if self._queued_rows + rows > self.max_rows:
+                    self.counters['dropped'] += rows
+                    return False
+            self._queue.append(incidents)
+            self._queued_rows += rows
+            if self._queued_rows >= self.batch_rows:
+                self._changed.notify_all()
+        return True
+
+    def _take(self):
+        # Up to batch_rows queued incidents (whole tables), once there are
+        # enough or flush_interval has passed
+        with self._changed:
+            self._changed.wait_for(lambda: self._queued_rows >= self.batch_rows or self._closing,
+                                   self.flush_interval)
+            tables = []
+            rows = 0
+            while self._queue and (not tables or rows + len(self._queue[0]) <= self.batch_rows):
+                tables.append(self._queue.popleft())
+                rows += len(tables[-1])
+            self._queued_rows -= rows
+            self._changed.notify_all()
+            return tables, self._closing and not self._queue
+
+    def _run(self):
+        while True:
+            tables, done = self._take()
+            records = [record for table in tables for record in table.to_records()]
+            if records:
+                self._write(records)
+            if done:
+                break
+        for sink in self.sinks:
+            sink.close()
+
+    def _write(self, records):
+        failed = 0
+        for sink in self.sinks:
+            try:
+                sink.write(records)
+            except Exception as e:
+                failed += 1
+                self.errors[type(sink).__name__] = f"{datetime.now().isoformat(timespec='seconds')} {e}"
+        with self._lock:
+            self.counters['errors'] += failed
+            if not failed:
+                self.counters['written'] += len(records)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, queued=self._queued_rows)
+
+    def close(self, timeout=10):
+        # Writes what is still queued and closes the sinks
+        with self._changed:
+            if self._thread is None or self._pid != os.getpid():
+                return
+            self._closing = True
+            self._changed.notify_all()
+        self._thread.join(timeout)
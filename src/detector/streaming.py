@@ -0,0 +1,386 @@
+import math
+import threading
+from collections import OrderedDict
+import numpy as np
+from custom_types import (IncidentTable, INCIDENT_TYPES, SEVERITIES, PROTOCOL_CODES,
+                          address_keys, address_hashes, hash_combine)
+
+NS_PER_SECOND = 1_000_000_000
+TCP_CODES = [PROTOCOL_CODES['TCP'], PROTOCOL_CODES['HTTP'], PROTOCOL_CODES['HTTPS']]
+SYN = 0x02
+ACK = 0x10
+
+
+def _groups(keys):
+    # Start and end offsets of the runs of equal values in a sorted array
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return starts, np.r_[starts[1:], len(keys)]
+
+
+def _incidents(incident_type, severity, src, dst, first_seen, last_seen, count, value):
+    n = len(first_seen)
+    if not n:
+        return IncidentTable.empty()
+    return IncidentTable(
+        type=np.full(n, INCIDENT_TYPES.index(incident_type)),
+        severity=np.full(n, SEVERITIES.index(severity)),
+        src=src,
+        dst=dst,
+        window=first_seen,
+        first_seen=first_seen,
+        last_seen=last_seen,
+        count=count,
+        value=value,
+    )
+
+
+class StateTable:
+    # Per-key detector state, bounded by LRU eviction and a time-to-live
+    def __init__(self, factory, max_entries=100_000, ttl=300):
+        self.factory = factory
+        self.max_entries = max_entries
+        self.ttl = ttl * NS_PER_SECOND
+        self.entries = OrderedDict()
+        self.evicted = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, now):
+        entries = self.entries
+        entry = entries.get(key)
+        if entry is not None:
+            if now - entry.updated <= self.ttl:
+                entries.move_to_end(key)
+                entry.updated = now
+                return entry
+            del entries[key]
+            self.expired += 1
+        entry = entries[key] = self.factory(now)
+        if len(entries) > self.max_entries:
+            entries.popitem(last=False)
+            self.evicted += 1
+        return entry
+
+    def expire(self, now):
+        # Entries are kept in update order, so stale ones sit at the front
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if now - entry.updated <= self.ttl:
+                break
+            del self.entries[key]
+            self.expired += 1
+
+
+class _FanOut:
+    __slots__ = ('updated', 'started', 'first', 'items', 'alerted')
+
+    def __init__(self, now):
+        self.updated = now
+        self.started = now
+        self.first = None  # time of the first probe in the window
+        self.items = set()
+        self.alerted = False
+
+
+class ScanDetector:
+    # Distinct destination ports per (src, dst) for vertical scans and distinct
+    # destinations per (src, dst port) for horizontal sweeps, per window
+    def __init__(self, port_threshold=100, host_threshold=50, window=60, max_entries=20_000):
+        self.port_threshold = port_threshold
+        self.host_threshold = host_threshold
+        self.window = window * NS_PER_SECOND
+        self.vertical = StateTable(_FanOut, max_entries, ttl=window)
+        self.horizontal = StateTable(_FanOut, max_entries, ttl=window)
+        self.tables = [self.vertical, self.horizontal]
+
+    def probes(self, batch):
+        # Connection attempts: TCP SYNs (or any TCP packet when the capture has no
+        # flags, as in mock traffic) and UDP to non-ephemeral ports
+        tcp = np.isin(batch.protocol, TCP_CODES)
+        syn = (batch.tcp_flags & (SYN | ACK)) == SYN
+        udp = (batch.protocol == PROTOCOL_CODES['UDP']) & (batch.dst_port < 49152)
+        return (tcp & (syn | (batch.tcp_flags == 0))) | udp
+
+    def process(self, batch, src_hash, dst_hash, now):
+        rows = np.flatnonzero(self.probes(batch))
+        if not len(rows):
+            return IncidentTable.empty()
+        dst_port = batch.dst_port[rows]
+        return IncidentTable.concat([
+            self._fan_out(self.vertical, batch, rows, hash_combine(src_hash[rows], dst_hash[rows]),
+                          dst_port.astype(np.uint64), self.port_threshold, 'PORT_SCAN', now),
+            self._fan_out(self.horizontal, batch, rows, hash_combine(src_hash[rows], dst_port),
+                          dst_hash[rows], self.host_threshold, 'HOST_SCAN', now),
+        ])
+
+    def _fan_out(self, table, batch, rows, keys, items, threshold, incident_type, now):
+        # Reduce to distinct (key, item) pairs before touching per-key state
+        order = np.lexsort((items, keys))
+        keys, items, rows = keys[order], items[order], rows[order]
+        # When each key's probes in the batch start and end, so incidents carry
+        # the times of their packets rather than of the batch
+        times = batch.timestamp[rows]
+        key_starts, _ = _groups(keys)
+        first_times = np.minimum.reduceat(times, key_starts).tolist()
+        last_times = np.maximum.reduceat(times, key_starts).tolist()
+        distinct = np.r_[True, (keys[1:] != keys[:-1]) | (items[1:] != items[:-1])]
+        keys, items, rows = keys[distinct], items[distinct], rows[distinct]
+        starts, ends = _groups(keys)
+
+        alerts, first_seen, last_seen, values = [], [], [], []
+        groups = zip(keys[starts].tolist(), starts.tolist(), ends.tolist(), first_times, last_times)
+        for key, start, end, first, last in groups:
+            entry = table.get(key, now)
+            if now - entry.started > self.window:
+                entry.started = now
+                entry.first = None
+                entry.items.clear()
+                entry.alerted = False
+            if entry.alerted:
+                continue
+            if entry.first is None:
+                entry.first = first
+            entry.items.update(items[start:end].tolist())
+            if len(entry.items) >= threshold:
+                alerts.append(rows[start])
+                first_seen.append(entry.first)
+                last_seen.append(last)
+                values.append(len(entry.items))
+                entry.alerted = True
+                entry.items.clear()
+        alerts = np.array(alerts, dtype=np.int64)
+        return _incidents(incident_type, 'HIGH', batch.src[alerts], batch.dst[alerts],
+                          np.array(first_seen, dtype=np.int64), np.array(last_seen, dtype=np.int64), values, values)
+
+    def expire(self, now):
+        for table in self.tables:
+            table.expire(now)
+
+
+class _Beacon:
+    __slots__ = ('updated', 'first', 'last', 'count', 'total', 'total_sq', 'alerted')
+
+    def __init__(self, now):
+        self.updated = now
+        self.first = None
+        self.last = None
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.alerted = False
+
+
+class BeaconDetector:
+    # Regular inter-arrival times of activity between the same (src, dst, port).
+    # Activity within `gap` seconds of the previous packet counts as one event.
+    def __init__(self, min_intervals=8, max_jitter=0.1, min_period=5, gap=2, max_entries=100_000, ttl=3600):
+        self.min_intervals = min_intervals
+        self.max_jitter = max_jitter  # standard deviation / mean of the intervals
+        self.min_period = min_period
+        self.gap = gap
+        self.table = StateTable(_Beacon, max_entries, ttl=ttl)
+        self.tables = [self.table]
+
+    def process(self, batch, src_hash, dst_hash, now):
+        keys = hash_combine(hash_combine(src_hash, dst_hash), batch.dst_port)
+        seconds = batch.timestamp // NS_PER_SECOND
+        order = np.lexsort((seconds, keys))
+        keys, seconds = keys[order], seconds[order]
+        starts, ends = _groups(keys)
+
+        # Interval statistics within the batch, for every key at once
+        delta = np.r_[0, np.diff(seconds)]
+        interval = np.r_[False, keys[1:] == keys[:-1]] & (delta > self.gap)
+        counts = np.add.reduceat(interval.astype(np.int64), starts)
+        totals = np.add.reduceat(np.where(interval, delta, 0).astype(np.float64), starts)
+        totals_sq = np.add.reduceat(np.where(interval, delta, 0).astype(np.float64) ** 2, starts)
+
+        alerts, first_seen, intervals, periods = [], [], [], []
+        get = self.table.get
+        rows = zip(keys[starts].tolist(), seconds[starts].tolist(), seconds[ends - 1].tolist(),
+                   counts.tolist(), totals.tolist(), totals_sq.tolist(), order[starts].tolist())
+        for key, first, last, count, total, total_sq, row in rows:
+            entry = get(key, now)
+            if entry.last is None:
+                entry.first = first
+            elif first - entry.last > self.gap:
+                gap = first - entry.last
+                count += 1
+                total += gap
+                total_sq += gap * gap
+            if last > (entry.last or 0):
+                entry.last = last
+            entry.count += count
+            entry.total += total
+            entry.total_sq += total_sq
+            if entry.alerted or entry.count < self.min_intervals:
+                continue
+            mean = entry.total / entry.count
+            std = math.sqrt(max(entry.total_sq / entry.count - mean * mean, 0.0))
+            if mean >= self.min_period and std <= self.max_jitter * mean:
+                alerts.append(row)
+                first_seen.append(entry.first * NS_PER_SECOND)
+                intervals.append(entry.count)
+                periods.append(round(mean))
+                entry.alerted = True
+        alerts = np.array(alerts, dtype=np.int64)
+        return _incidents('BEACONING', 'MEDIUM', batch.src[alerts], batch.dst[alerts],
+                          np.array(first_seen, dtype=np.int64), np.full(len(alerts), now), intervals, periods)
+
+    def expire(self, now):
+        self.table.expire(now)
+
+
+class _Volume:
+    __slots__ = ('updated', 'bin', 'out', 'received', 'peer', 'peer_bytes', 'mean', 'var', 'intervals', 'address')
+
+    def __init__(self, now):
+        self.updated = now
+        self.bin = None
+        self.out = 0
+        self.received = 0
+        self.peer = None
+        self.peer_bytes = 0
+        self.mean = 0.0
+        self.var = 0.0
+        self.intervals = 0
+        self.address = None
+
+
+class ExfiltrationDetector:
+    # Bytes sent per host per interval against an EWMA baseline of its own past
+    # intervals; an interval is flagged when it is far above the baseline and
+    # the host sent much more than it received.
+    def __init__(self, interval=60, alpha=0.1, sigma=4.0, min_bytes=10_000_000, min_ratio=10.0,
+                 warmup=5, max_entries=100_000, ttl=3600):
+        self.interval = interval * NS_PER_SECOND
+        self.alpha = alpha
+        self.sigma = sigma
+        self.min_bytes = min_bytes
+        self.min_ratio = min_ratio
+        self.warmup = warmup
+        self.table = StateTable(_Volume, max_entries, ttl=ttl)
+        self.tables = [self.table]
+
+    def process(self, batch, src_hash, dst_hash, now):
+        n = len(batch)
+        rows = np.arange(n)
+        hosts = np.concatenate([src_hash, dst_hash])
+        bins = np.tile(batch.timestamp // self.interval, 2)
+        sent = np.concatenate([batch.length, np.zeros(n, dtype=np.uint16)]).astype(np.int64)
+        order = np.lexsort((bins, hosts))
+        hosts, bins, sent = hosts[order], bins[order], sent[order]
+        pair = np.r_[True, (hosts[1:] != hosts[:-1]) | (bins[1:] != bins[:-1])]
+        starts = np.flatnonzero(pair)
+        sent_bytes = np.add.reduceat(sent, starts)
+        received_bytes = np.add.reduceat(np.concatenate([np.zeros(n, dtype=np.int64),
+                                                         batch.length.astype(np.int64)])[order], starts)
+        # Canonical addresses of each group's host and of the peer of its first row
+        rows = np.concatenate([rows, rows])[order][starts]
+        outbound = order[starts] < n
+        src_keys = address_keys(batch.src[rows])
+        dst_keys = address_keys(batch.dst[rows])
+        host_keys = np.where(outbound, src_keys, dst_keys)
+        peer_keys = np.where(outbound, dst_keys, src_keys)
+
+        alerts = []
+        for i, (host, interval) in enumerate(zip(hosts[starts].tolist(), bins[starts].tolist())):
+            entry = self.table.get(host, now)
+            if entry.bin is None:
+                entry.bin = interval
+            elif interval > entry.bin:
+                if self._close(entry):
+                    alerts.append((entry.address, entry.peer, entry.bin, entry.out))
+                entry.bin = interval
+                entry.out = entry.received = entry.peer_bytes = 0
+                entry.peer = None
+            entry.address = host_keys[i]
+            entry.out += int(sent_bytes[i])
+            entry.received += int(received_bytes[i])
+            if outbound[i] and sent_bytes[i] > entry.peer_bytes:
+                entry.peer = peer_keys[i]
+                entry.peer_bytes = int(sent_bytes[i])
+        return self._incidents(alerts)
+
+    def flush(self):
+        # Closes the interval each host still has open, e.g. at the end of a capture
+        alerts = []
+        for entry in self.table.entries.values():
+            if entry.bin is None:
+                continue
+            if self._close(entry):
+                alerts.append((entry.address, entry.peer, entry.bin, entry.out))
+            entry.bin = None
+            entry.out = entry.received = entry.peer_bytes = 0
+            entry.peer = None
+        return self._incidents(alerts)
+
+    def _incidents(self, alerts):
+        # (host, peer, interval, bytes sent) of flagged intervals
+        if not alerts:
+            return IncidentTable.empty()
+        src = np.array([a[0] for a in alerts]).view(np.uint8).reshape(-1, 16)
+        dst = np.array([a[1] if a[1] is not None else a[0] for a in alerts]).view(np.uint8).reshape(-1, 16)
+        first_seen = np.array([a[2] for a in alerts], dtype=np.int64) * self.interval
+        volume = [a[3] for a in alerts]
+        return _incidents('EXFILTRATION', 'HIGH', src, dst, first_seen, first_seen + self.interval - 1,
+                          np.ones(len(alerts)), volume)
+
+    def _close(self, entry):
+        out = entry.out
+        anomalous = False
+        if entry.intervals >= self.warmup:
+            threshold = entry.mean + self.sigma * math.sqrt(entry.var)
+            anomalous = (out >= self.min_bytes and out > threshold and
+                         out >= self.min_ratio * max(entry.received, 1))
+        # Anomalous intervals are kept out of the baseline
+        if not anomalous:
+            if entry.intervals == 0:
+                entry.mean = float(out)
+            else:
+                diff = out - entry.mean
+                increment = self.alpha * diff
+                entry.mean += increment
+                entry.var = (1 - self.alpha) * (entry.var + diff * increment)
+            entry.intervals += 1
+        return anomalous
+
+    def expire(self, now):
+        self.table.expire(now)
+
+
+class StreamingDetector:
+    # Stateful detectors fed batch by batch; history is never reprocessed and
+    # per-key state is bounded by each detector's StateTable
+    def __init__(self, detectors=None):
+        if detectors is None:
+            detectors = [ScanDetector(), BeaconDetector(), ExfiltrationDetector()]
+        self.detectors = detectors
+        self.packets = 0
+        self.rule_state = {}  # what the rules carry over between batches, e.g. BurstRule's last second
+        self._lock = threading.Lock()
+
+    def process(self, batch):
+        if not len(batch):
+            return IncidentTable.empty()
+        src_hash = address_hashes(batch.src)
+        dst_hash = address_hashes(batch.dst)
+        now = int(batch.timestamp.max())
+        with self._lock:
+            tables = [detector.process(batch, src_hash, dst_hash, now) for detector in self.detectors]
+            for detector in self.detectors:
+                detector.expire(now)
+            self.packets += len(batch)
+        return IncidentTable.concat(tables)
+
+    def flush(self):
+        # Incidents the detectors that work in windows hold back for the
+        # windows still open, e.g. at the end of a capture
+        with self._lock:
+            return IncidentTable.concat([detector.flush() for detector in self.detectors
+                                         if hasattr(detector, 'flush')])
+
+    def state_size(self):
+        return sum(len(table) for detector in self.detectors for table in detector.tables)
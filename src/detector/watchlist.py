@@ -0,0 +1,190 @@
+import os
+import time
+import socket
+import threading
+import numpy as np
+
+RELOAD_INTERVAL = 30  # seconds between checks for changed feed files
+
+_V4_MAPPED = bytes(10) + b'\xff\xff'
+
+
+def _parse(line):
+    # (family, network bytes, prefix length) of an IP or CIDR, or None for a
+    # blank or comment line. Anything after the first comma or space is ignored,
+    # so simple CSV feeds load as they are.
+    entry = line.split('#', 1)[0].strip().split(',', 1)[0].split(None, 1)
+    if not entry:
+        return None
+    address, _, length = entry[0].partition('/')
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    packed = socket.inet_pton(family, address)
+    bits = len(packed) * 8
+    length = int(length) if length else bits
+    if not 0 <= length <= bits:
+        raise ValueError(f"Invalid prefix length in {entry[0]!r}")
+    return family, packed, length
+
+
+def _parents(starts, ends):
+    # For intervals sorted by (start, -end), the index of the closest interval
+    # that encloses each one, or -1. CIDR blocks either nest or are disjoint.
+    parents = np.full(len(starts), -1, dtype=np.int64)
+    ends = ends.tolist()
+    stack = []
+    for i, start in enumerate(starts.tolist()):
+        while stack and ends[stack[-1]] < start:
+            stack.pop()
+        if stack:
+            parents[i] = stack[-1]
+        stack.append(i)
+    return parents
+
+
+class PrefixTable:
+    # Longest-prefix match over sorted, nested intervals. Each lookup is a
+    # searchsorted for the interval with the largest start at or below the
+    # address, then a walk up to enclosing intervals for the (few) addresses
+    # that fall past its end.
+    def __init__(self, starts, ends, feeds):
+        # Of identical blocks, the one listed first is sorted last and wins
+        order = np.lexsort((-np.arange(len(starts)), _descending(ends), starts))
+        self.starts = starts[order]
+        self.ends = ends[order]
+        self.feeds = feeds[order]
+        self.parents = _parents(self.starts, self.ends)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lookup(self, addresses):
+        # Feed index of the longest matching prefix per address, or -1
+        if not len(self.starts):
+            return np.full(len(addresses), -1, dtype=np.int64)
+        index = np.searchsorted(self.starts, addresses, side='right') - 1
+        while True:
+            found = index >= 0
+            outside = np.flatnonzero(found & (addresses > self.ends[np.maximum(index, 0)]))
+            if not len(outside):
+                break
+            index[outside] = self.parents[index[outside]]
+        return np.where(index >= 0, self.feeds[np.maximum(index, 0)], -1)
+
+
+def _descending(values):
+    # Sort key that orders `values` from largest to smallest, for any dtype
+    _, rank = np.unique(values, return_inverse=True)
+    return -rank.ravel()
+
+
+class Watchlist:
+    # IPs and CIDR blocks loaded from feed files, one entry per line. Whole
+    # columns of addresses are matched at once; when a file changes, the tables
+    # are rebuilt in a background thread and swapped in, so lookups never wait.
+    def __init__(self, paths, reload_interval=RELOAD_INTERVAL):
+        self.paths = tuple(paths)
+        self.reload_interval = reload_interval
+        self.feeds = [os.path.splitext(os.path.basename(path))[0] for path in self.paths]
+        self.entries = 0
+        self.errors = {}  # path -> last error while loading it
+        self._mtimes = None
+        self._checked = time.monotonic()
+        self._reloading = None
+        self._lock = threading.Lock()
+        self._tables = self._build(self._stat())  # (IPv4, IPv6) prefix tables
+
+    def _stat(self):
+        mtimes = []
+        for path in self.paths:
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def _build(self, mtimes):
+        v4_starts, v4_ends, v4_feeds = [], [], []
+        v6_starts, v6_ends, v6_feeds = [], [], []
+        entries = 0
+        for feed, path in enumerate(self.paths):
+            invalid = []
+            try:
+                with open(path, encoding='utf-8', errors='replace') as f:
+                    for number, line in enumerate(f, 1):
+                        try:
+                            parsed = _parse(line)
+                        except (OSError, ValueError):
+                            invalid.append(number)
+                            continue
+                        if parsed is None:
+                            continue
+                        family, packed, length = parsed
+                        if family == socket.AF_INET6 and packed[:12] == _V4_MAPPED and length >= 96:
+                            # IPv4-mapped, as some feeds list IPv4 blocks; the
+                            # packets they match are plain IPv4
+                            family, packed, length = socket.AF_INET, packed[12:], length - 96
+                        if family == socket.AF_INET:
+                            value = int.from_bytes(packed, 'big')
+                            host = (1 << (32 - length)) - 1
+                            v4_starts.append(value & ~host)
+                            v4_ends.append(value | host)
+                            v4_feeds.append(feed)
+                            # The same block as IPv4-mapped IPv6 addresses
+                            packed, length = _V4_MAPPED + packed, length + 96
+                        value = int.from_bytes(packed, 'big')
+                        host = (1 << (128 - length)) - 1
+                        v6_starts.append((value & ~host).to_bytes(16, 'big'))
+                        v6_ends.append((value | host).to_bytes(16, 'big'))
+                        v6_feeds.append(feed)
+                        entries += 1
+            except OSError as e:
+                self.errors[path] = str(e)
+                continue
+            if invalid:
+                self.errors[path] = f"{len(invalid)} invalid entries, first on line {invalid[0]}"
+            else:
+                self.errors.pop(path, None)
+        v4 = PrefixTable(np.array(v4_starts, dtype=np.uint32), np.array(v4_ends, dtype=np.uint32),
+                         np.array(v4_feeds, dtype=np.int64))
+        v6 = PrefixTable(np.array(v6_starts, dtype='S16'), np.array(v6_ends, dtype='S16'),
+                         np.array(v6_feeds, dtype=np.int64))
+        self.entries = entries
+        self._mtimes = mtimes
+        return v4, v6
+
+    def _reload(self, mtimes):
+        # A single assignment, so a concurrent lookup sees old or new tables
+        self._tables = self._build(mtimes)
+        with self._lock:
+            self._reloading = None
+
+    def check(self):
+        # Starts a background reload if a feed file changed
+        now = time.monotonic()
+        if now - self._checked < self.reload_interval:
+            return
+        with self._lock:
+            self._checked = now
+            if self._reloading is not None:
+                return
+            mtimes = self._stat()
+            if mtimes == self._mtimes:
+                return
+            self._reloading = threading.Thread(target=self._reload, args=(mtimes,), name='watchlist-reload',
+                                               daemon=True)
+            self._reloading.start()
+
+    def lookup(self, addresses):
+        # Feed index of the longest matching entry for each address, or -1.
+        # Each distinct address is only looked up once.
+        self.check()
+        if not len(addresses):
+            return np.zeros(0, dtype=np.int64)
+        v4, v6 = self._tables
+        if addresses.ndim == 1:
+            table = v4
+            keys, inverse = np.unique(addresses, return_inverse=True)
+        else:
+            table = v6
+            keys, inverse = np.unique(np.ascontiguousarray(addresses).view('S16').ravel(), return_inverse=True)
+        return table.lookup(keys)[inverse.ravel()]
@@ -1,11 +1,25 @@
 
 import os
-from analyzer import TrafficAnalyzer
-from detector import IncidentDetector
-from visualizer import DataVisualizer
-from web_interface import WebInterface
+import sys
+import json
+import time
+import argparse
+from datetime import datetime, timezone
+
+# The packages live next to this file; put them on the path as wsgi.py does,
+# so that `python -m src.main` works as well as `python src/main.py`
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# The packages are imported by the commands that use them, so `analyze` does
+# not load Dash and importing this module costs next to nothing; see
+# --profile-startup
 
 def create_app():
+    from analyzer import TrafficAnalyzer
+    from detector import IncidentDetector
+    from visualizer import DataVisualizer
+    from web_interface import WebInterface
+
     # Initialize components
     traffic_analyzer = TrafficAnalyzer()
     incident_detector = IncidentDetector()
@@ -16,7 +30,7 @@ def create_app():
     
     return web_interface.app
 
-def main():
+def serve(args=None):
     print("Starting Network Forensics Web Application...")
     print("Initializing components...")
     
@@ -32,8 +46,290 @@ def main():
     # Run the web application
     app.run(debug=False, host='0.0.0.0', port=port)
 
-# Create the app instance for WSGI servers
-app = create_app()
+def _format_time(timestamp_ns):
+    if timestamp_ns is None:
+        return '-'
+    return datetime.fromtimestamp(timestamp_ns / 1e9, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+def _offsets(value, captures):
+    if value == 'auto':
+        return value
+    offsets = [float(offset) for offset in value.split(',')]
+    if len(offsets) != captures:
+        raise ValueError(f"--offsets needs one value per capture ({captures})")
+    return offsets
+
+def analyze(args):
+    # Offline analysis of a capture file, split over a pool of worker processes;
+    # several captures of the same traffic are merged into one timeline
+    from analyzer import analyze_capture, analyze_captures
+    from detector import IncidentDetector
+    detector = IncidentDetector()
+    detector.thresholds['anomaly_models'] = args.models
+    merged = len(args.capture) > 1
+    started = time.perf_counter()
+    if merged:
+        result = analyze_captures(args.capture, detector=detector, offsets=_offsets(args.offsets, len(args.capture)),
+                                  dedup_window=args.dedup_window, app_layer=not args.no_app_layer, where=args.filter,
+                                  index_root=args.index)
+    else:
+        result = analyze_capture(args.capture[0], workers=args.workers, detector=detector, chunks=args.chunks,
+                                 app_layer=not args.no_app_layer, where=args.filter, index_root=args.index)
+    elapsed = time.perf_counter() - started
+    stats = result.summary.stats(args.top)
+    incidents = result.incidents.to_records()
+    app = result.app.top(args.top) if result.app else None
+
+    if args.json:
+        output = {
+            'capture': args.capture if merged else args.capture[0],
+            'stats': stats,
+            'flows': len(result.flows),
+            'incidents': incidents,
+            'app': app,
+            'packets_skipped': result.packets_skipped,
+            'filter': args.filter,
+            'packets_filtered': result.packets_filtered,
+            'bytes_trailing': result.bytes_trailing,
+            'seconds': elapsed
+        }
+        if merged:
+            output.update(packets_duplicate=result.packets_duplicate, offsets=result.offsets)
+        json.dump(output, sys.stdout, indent=2)
+        print()
+        return 0
+
+    summary = result.summary
+    print(f"Capture: {', '.join(args.capture)}")
+    if merged:
+        offsets = ', '.join(f"{offset * 1000:+.3f} ms" for offset in result.offsets)
+        print(f"Merged: {result.packets_duplicate} duplicate packets dropped, clock offsets {offsets}")
+    if args.filter:
+        print(f"Filter: {args.filter} ({result.packets_filtered} packets left out)")
+    print(f"Time range: {_format_time(summary.first_seen)} - {_format_time(summary.last_seen)} UTC")
+    print(f"Packets: {stats['total_packets']} IP ({result.packets_skipped} other), {summary.bytes} bytes")
+    if result.bytes_trailing:
+        print(f"Truncated: the last {result.bytes_trailing} bytes do not hold a whole record")
+    print(f"Average Size: {stats['avg_packet_size']:.2f} bytes, largest {stats['max_packet_size']} bytes")
+    print(f"Unique Sources: {stats['unique_sources']}, Unique Destinations: {stats['unique_destinations']}")
+    print("Protocols: " + ", ".join(f"{name}: {count}" for name, count in stats['protocols'].items()))
+    print(f"Flows: {len(result.flows)}")
+    print("Top Talkers:")
+    for address, total in stats['traffic_by_src'].items():
+        print(f"  {address:<40} {total} bytes")
+    if app:
+        print("Application layer: " + (", ".join(f"{name}: {count}" for name, count in sorted(app['records'].items()))
+                                       or "nothing decoded"))
+        for field, title in (('http_hosts', "HTTP Hosts"), ('tls_sni', "TLS Server Names"),
+                             ('dns_queries', "DNS Queries"), ('dns_failures', "Failed DNS Lookups")):
+            if app[field]:
+                print(f"{title}:")
+                for name, count in app[field]:
+                    print(f"  {name:<40} {count}")
+    print(f"Incidents: {len(incidents)}")
+    for incident in incidents[:args.incidents]:
+        scope = f" {incident['src']} -> {incident['dst']}" if 'src' in incident else ''
+        print(f"  [{incident['timestamp']}] {incident['severity']} - {incident['type']}{scope}: {incident['details']}")
+    if len(incidents) > args.incidents:
+        print(f"  ... and {len(incidents) - args.incidents} more")
+    rate = result.bytes_read / elapsed / 1e6 if elapsed else 0.0
+    print(f"Analyzed {result.bytes_read} bytes in {elapsed:.2f}s ({rate:.1f} MB/s)")
+    return 0
+
+def carve(args):
+    # Copies packets out of captures indexed by `analyze --index`
+    from analyzer import CaptureIndex
+    from storage import to_ns
+    index = CaptureIndex.open(args.index)
+    if index is None:
+        raise ValueError("no index there, or a capture changed since it was built; run analyze --index again")
+    start, end = (to_ns(value.replace(' ', 'T')) if value else None for value in (args.start, args.end))
+    started = time.perf_counter()
+    count = index.carve(args.output, start=start, end=end, host=args.host, peer=args.peer, where=args.filter,
+                        captures=args.capture)
+    print(f"Wrote {count} packets to {args.output} in {time.perf_counter() - started:.2f}s")
+    return 0
+
+def capture(args):
+    # Live capture from a network interface for a fixed window
+    from analyzer import LiveCapture, CaptureSummary
+    source = LiveCapture(args.interface, where=args.filter, promiscuous=args.promiscuous).open()
+    summary = CaptureSummary()
+    output = None
+    try:
+        if args.output:
+            # The frames as captured, not just the decoded headers
+            output = open(args.output, 'wb')
+            source.save(output)
+        print(f"Capturing on {args.interface} for {args.duration:g}s...", file=sys.stderr)
+        for batch in source.capture(args.duration):
+            summary.add(batch)
+        counts = source.stats()
+    finally:
+        source.close()
+        if output is not None:
+            output.close()
+    stats = summary.stats(args.top)
+    if args.json:
+        json.dump({'interface': args.interface, 'filter': args.filter, 'kernel_filter': source.kernel_filter,
+                   'stats': stats, 'bytes': summary.bytes, 'capture': counts}, sys.stdout, indent=2)
+        print()
+        return 0
+    print(f"Interface: {args.interface}")
+    if args.filter:
+        where = 'in the kernel' if source.kernel_filter else 'after decoding'
+        print(f"Filter: {args.filter} (applied {where})")
+    print(f"Time range: {_format_time(summary.first_seen)} - {_format_time(summary.last_seen)} UTC")
+    print(f"Packets: {stats['total_packets']} IP ({counts['skipped']} other, {counts['dropped']} dropped by the kernel), "
+          f"{summary.bytes} bytes")
+    print("Protocols: " + ", ".join(f"{name}: {count}" for name, count in stats['protocols'].items()))
+    print("Top Talkers:")
+    for address, total in stats['traffic_by_src'].items():
+        print(f"  {address:<40} {total} bytes")
+    if args.output:
+        print(f"Wrote {source.packets_saved} packets to {args.output}")
+    return 0
+
+def generate(args):
+    # Synthetic capture for testing and benchmarks
+    from analyzer import TrafficGenerator
+    generator = TrafficGenerator(seed=args.seed, duration=args.duration, clients=args.clients,
+                                 servers=args.servers)
+    started = time.perf_counter()
+    written = generator.write(args.output, args.packets)
+    print(f"Wrote {written} packets to {args.output} in {time.perf_counter() - started:.1f}s")
+    for event in generator.events:
+        target = f" -> {event['dst']}" if event['dst'] else ''
+        print(f"  {_format_time(event['start'])} {event['type']}: {event['src']}{target}, {event['packets']} packets")
+    return 0
+
+def benchmark(args):
+    import benchmark as suite
+    cases = args.cases.split(',') if args.cases else None
+    results = suite.run_benchmarks(cases, packets=args.packets, seed=args.seed, workdir=args.workdir,
+                                   report=lambda name, result: print(suite.format_result(name, result), flush=True))
+    if args.output:
+        suite.save_results(args.output, results)
+    if args.compare:
+        rows = suite.compare(results, suite.load_results(args.compare), args.tolerance)
+        print()
+        print(suite.format_comparison(rows))
+        if any(row[-1] for row in rows):
+            return 1
+    return 0
+
+def profile_startup(args):
+    # Where the time to a ready dashboard goes, measured in fresh interpreters
+    import benchmark as suite
+    report = suite.profile_startup(args.top_modules)
+    print(suite.format_startup(report))
+    if report['total'] > args.startup_budget:
+        print(f"\nStartup took {report['total']:.2f}s, over the budget of {args.startup_budget:.2f}s")
+        return 1
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Network Forensics Web Application")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="report the import and app creation time of the dashboard and exit")
+    parser.add_argument('--startup-budget', type=float, default=1.5,
+                        help="seconds --profile-startup allows before exiting with status 1 (default: 1.5)")
+    parser.add_argument('--top-modules', type=int, default=15,
+                        help="slowest imported packages listed by --profile-startup")
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('serve', help="run the web dashboard (default)")
+    analyze_parser = commands.add_parser('analyze', help="analyze a pcap/pcapng capture file")
+    analyze_parser.add_argument('capture', nargs='+',
+                                help="path to the capture file; several captures of the same traffic "
+                                     "(e.g. from different taps) are merged into one timeline")
+    analyze_parser.add_argument('--workers', type=int, default=None,
+                                help="worker processes (default: number of CPUs); merged captures are "
+                                     "read by one")
+    analyze_parser.add_argument('--chunks', type=int, default=None,
+                                help="pieces to split the capture into (default: 4 per worker); not for "
+                                     "merged captures")
+    analyze_parser.add_argument('--top', type=int, default=10, help="number of top talkers to list")
+    analyze_parser.add_argument('--incidents', type=int, default=20, help="number of incidents to list")
+    analyze_parser.add_argument('--no-app-layer', action='store_true',
+                                help="skip decoding HTTP, TLS and DNS payloads")
+    analyze_parser.add_argument('--filter', help="only analyze the matching packets, e.g. "
+                                                 "'src net 10.0.0.0/8 and dst port 443 and len > 1000'")
+    analyze_parser.add_argument('--offsets', default='auto',
+                                help="clock offsets in seconds added to each merged capture, comma-separated, "
+                                     "or 'auto' to estimate them from the packets they share (default)")
+    analyze_parser.add_argument('--dedup-window', type=float, default=0.001,
+                                help="seconds within which the same packet in two merged captures is "
+                                     "counted once (default: 0.001)")
+    analyze_parser.add_argument('--models', help="directory of anomaly models to score host behaviour with; "
+                                "models are trained there in the background from the traffic seen")
+    analyze_parser.add_argument('--index', help="directory to build a packet index in, for carving evidence "
+                                "with the carve command (not with --filter)")
+    analyze_parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    carve_parser = commands.add_parser('carve', help="copy packets out of captures indexed by analyze --index")
+    carve_parser.add_argument('index', help="index directory")
+    carve_parser.add_argument('--output', required=True, help="capture file to write")
+    carve_parser.add_argument('--start', help="from this time (UTC), e.g. '2024-05-14 14:00'")
+    carve_parser.add_argument('--end', help="up to this time (UTC)")
+    carve_parser.add_argument('--host', help="packets to or from this address")
+    carve_parser.add_argument('--peer', help="with --host, only those between the two")
+    carve_parser.add_argument('--filter', help="only the matching packets, e.g. 'tcp and port 22 and len > 1000'")
+    carve_parser.add_argument('--capture', type=int, action='append',
+                              help="number of a merged capture to carve from (repeatable; default: all)")
+    capture_parser = commands.add_parser('capture', help="capture live traffic from a network interface (Linux)")
+    capture_parser.add_argument('interface', help="interface to capture from, e.g. eth0 or lo")
+    capture_parser.add_argument('--duration', type=float, default=10, help="seconds to capture")
+    capture_parser.add_argument('--filter', help="only keep the matching packets, checked in the kernel where possible")
+    capture_parser.add_argument('--output', help="also write the packets to this pcap file")
+    capture_parser.add_argument('--promiscuous', action='store_true',
+                                help="also capture traffic not addressed to this host")
+    capture_parser.add_argument('--top', type=int, default=10, help="number of top talkers to list")
+    capture_parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    generate_parser = commands.add_parser('generate', help="write a synthetic pcap capture")
+    generate_parser.add_argument('output', help="path of the capture to write")
+    generate_parser.add_argument('--packets', type=int, default=10_000_000, help="background packets")
+    generate_parser.add_argument('--duration', type=int, default=3600, help="seconds of traffic")
+    generate_parser.add_argument('--clients', type=int, default=5000, help="internal hosts")
+    generate_parser.add_argument('--servers', type=int, default=2000, help="external hosts")
+    generate_parser.add_argument('--seed', type=int, default=0, help="random seed")
+    benchmark_parser = commands.add_parser('benchmark', help="measure throughput, latency and memory")
+    benchmark_parser.add_argument('--cases', help="comma-separated cases (default: analyze,detect,visualize,dashboard,startup)")
+    benchmark_parser.add_argument('--packets', type=int, default=1_000_000, help="synthetic packets per case")
+    benchmark_parser.add_argument('--seed', type=int, default=0, help="random seed of the synthetic traffic")
+    benchmark_parser.add_argument('--workdir', help="where generated captures are kept between runs")
+    benchmark_parser.add_argument('--output', help="save the results as JSON")
+    benchmark_parser.add_argument('--compare', help="results JSON of an earlier run to compare with")
+    benchmark_parser.add_argument('--tolerance', type=float, default=0.10,
+                                  help="relative change reported as a regression (default: 0.10)")
+    args = parser.parse_args(argv)
+    if args.command == 'analyze' and len(args.capture) > 1 and (args.workers is not None or args.chunks is not None):
+        analyze_parser.error("--workers and --chunks split a single capture; merged captures are read in one pass")
+
+    if args.profile_startup:
+        return profile_startup(args)
+    if args.command == 'generate':
+        return generate(args)
+    if args.command == 'capture':
+        try:
+            return capture(args)
+        except (OSError, ValueError) as e:
+            print(f"Error capturing on {args.interface}: {e}", file=sys.stderr)
+            return 1
+    if args.command == 'benchmark':
+        return benchmark(args)
+    if args.command == 'carve':
+        try:
+            return carve(args)
+        except (OSError, ValueError) as e:
+            print(f"Error carving from {args.index}: {e}", file=sys.stderr)
+            return 1
+    if args.command == 'analyze':
+        try:
+            return analyze(args)
+        except (OSError, ValueError) as e:
+            print(f"Error analyzing {', '.join(args.capture)}: {e}", file=sys.stderr)
+            return 1
+    serve(args)
+    return 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1 @@
+from .store import TrafficStore, Segment, TABLES, to_ns
@@ -0,0 +1,540 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+try:
+    import fcntl
+except ImportError:  # no advisory locks, so no compaction (e.g. on Windows)
+    fcntl = None
+import numpy as np
+from custom_types import PacketBatch, FlowBatch, address_keys, address_hash, narrow_addresses, parse_addresses
+from tools.filters import compile_filter
+
+NS_PER_SECOND = 1_000_000_000
+PARTITION = 3600 * NS_PER_SECOND  # one directory per hour
+SEGMENT_ROWS = 1_000_000  # rows buffered per partition before a segment is written
+FLUSH_INTERVAL = 300  # seconds a partition may stay buffered in memory
+COMPACT_INTERVAL = 300  # seconds between the compactions and retention sweeps of timed flushes
+QUERY_CHUNK = 1024  # candidate rows of a segment first read by a query with a limit, doubling after
+ADDRESS_COLUMNS = ('src', 'dst')
+INDEXED_COLUMNS = ('src', 'dst', 'src_port', 'dst_port')
+
+# `time` orders and partitions the rows, `end` is when a row stops being
+# relevant to a time range and `lookback` how far before a partition such rows
+# may start (flows are exported at least every active timeout)
+TABLES = {
+    'packets': {'type': PacketBatch, 'time': 'timestamp', 'end': 'timestamp', 'lookback': 0},
+    'flows': {'type': FlowBatch, 'time': 'first_seen', 'end': 'last_seen', 'lookback': PARTITION},
+}
+
+
+def to_ns(value):
+    # Epoch nanoseconds from an int, datetime, numpy datetime64 or ISO string
+    # (naive times are UTC)
+    if value is None:
+        return None
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            return int(value.timestamp() * NS_PER_SECOND)
+        value = np.datetime64(value)
+    return int(np.datetime64(value, 'ns').astype(np.int64))
+
+
+def _partition_name(partition):
+    return str(np.datetime64(partition * PARTITION, 'ns').astype('datetime64[h]'))
+
+
+def _partition_start(name):
+    return int(np.datetime64(name, 'ns').astype(np.int64))
+
+
+@contextmanager
+def _partition_lock(directory, operation):
+    # Advisory lock on a partition directory: queries hold it shared while they
+    # list and read its segments, compaction and retention exclusively while
+    # they remove them. Yields False if the partition is gone or the lock was
+    # not taken without blocking.
+    if fcntl is None:
+        yield True
+        return
+    try:
+        lock = open(os.path.join(directory, '.lock'), 'w')
+    except FileNotFoundError:
+        yield False
+        return
+    with lock:
+        try:
+            fcntl.flock(lock, operation)
+        except OSError:
+            yield False
+            return
+        yield True
+
+
+def _columns(data):
+    # Column dict with addresses as 16-byte rows, the on-disk representation
+    columns = {name: getattr(data, name) for name in data.fields}
+    for name in ADDRESS_COLUMNS:
+        columns[name] = address_keys(columns[name]).view(np.uint8).reshape(-1, 16)
+    return columns
+
+
+def _index_keys(name, values):
+    if name in ADDRESS_COLUMNS:
+        return address_hash(address_keys(values))
+    return np.asarray(values).astype(np.uint64)
+
+
+class Segment:
+    # An immutable run of rows sorted by time: one .npy file per column,
+    # memory-mapped on read, and a sorted (key, row) index per indexed column
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.rows = self.meta['rows']
+        self.start = self.meta['start']
+        self.end = self.meta['end']
+        self._arrays = {}
+
+    def _array(self, name):
+        array = self._arrays.get(name)
+        if array is None:
+            array = self._arrays[name] = np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+        return array
+
+    def column(self, name):
+        return self._array(name)
+
+    @classmethod
+    def write(cls, path, table, columns):
+        spec = TABLES[table]
+        order = np.argsort(columns[spec['time']], kind='stable')
+        tmp = path + '.tmp'
+        os.makedirs(tmp)
+        for name, values in columns.items():
+            np.save(os.path.join(tmp, name + '.npy'), np.ascontiguousarray(values[order]))
+        for name in INDEXED_COLUMNS:
+            keys = _index_keys(name, columns[name][order])
+            index = np.argsort(keys, kind='stable').astype(np.uint32)
+            np.save(os.path.join(tmp, f'index.{name}.keys.npy'), keys[index])
+            np.save(os.path.join(tmp, f'index.{name}.rows.npy'), index)
+        meta = {
+            'table': table,
+            'rows': len(order),
+            'start': int(columns[spec['time']].min()),
+            'end': int(columns[spec['end']].max()),
+            'created': time.time(),
+        }
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        # Readers only ever see complete segments
+        os.rename(tmp, path)
+        return cls(path)
+
+    def time_range(self, time_column, start, end, lookback):
+        # Rows whose time falls in [start - lookback, end], by binary search
+        times = self._array(time_column)
+        lo = 0 if start is None else int(np.searchsorted(times, start - lookback, 'left'))
+        hi = self.rows if end is None else int(np.searchsorted(times, end, 'right'))
+        return lo, hi
+
+    def lookup(self, name, keys):
+        # Sorted row numbers whose indexed column hashes to one of `keys`
+        sorted_keys = self._array(f'index.{name}.keys')
+        rows = self._array(f'index.{name}.rows')
+        keys = np.unique(np.asarray(keys, dtype=np.uint64))
+        lo = np.searchsorted(sorted_keys, keys, 'left')
+        hi = np.searchsorted(sorted_keys, keys, 'right')
+        if not (hi - lo).any():
+            return np.zeros(0, dtype=np.int64)
+        return np.sort(np.concatenate([rows[a:b] for a, b in zip(lo.tolist(), hi.tolist())]).astype(np.int64))
+
+    def read(self, names, rows):
+        if len(rows) and rows[-1] - rows[0] == len(rows) - 1:
+            # A run of rows, e.g. a whole time range: sliced rather than gathered
+            rows = slice(int(rows[0]), int(rows[-1]) + 1)
+        return {name: np.asarray(self._array(name)[rows]) for name in names}
+
+
+class TrafficStore:
+    # Time-partitioned, columnar history of packets and flows on local disk.
+    #
+    #   root/<table>/<YYYY-MM-DDTHH>/<segment>/<column>.npy
+    #
+    # Appends are buffered per hourly partition and written as immutable
+    # segments. A query only opens the partitions overlapping its time range,
+    # binary-searches the time column of each segment and uses the address and
+    # port indexes, so it reads the matching rows and little else. With
+    # `retention` (seconds), compacting flushes drop the partitions nothing
+    # was stored in for that long. Appends flush every `flush_interval`
+    # seconds and compact at most every `compact_interval`.
+    def __init__(self, root, segment_rows=SEGMENT_ROWS, flush_interval=FLUSH_INTERVAL, retention=None,
+                 compact_interval=COMPACT_INTERVAL):
+        self.root = root
+        self.segment_rows = segment_rows
+        self.flush_interval = flush_interval
+        self.compact_interval = compact_interval
+        self.retention = retention
+        self._buffers = {table: {} for table in TABLES}
+        self._buffered_rows = {table: {} for table in TABLES}
+        self._last_flush = self._last_compact = time.monotonic()
+        self._written = {table: set() for table in TABLES}  # partitions flushed to since the last compaction
+        self._segments = {}  # path -> Segment, segments never change once written
+        self._lock = threading.RLock()
+        for table in TABLES:
+            os.makedirs(os.path.join(root, table), exist_ok=True)
+
+    def __getstate__(self):
+        # A copy in another process opens the same store; rows buffered here
+        # stay here
+        return {'root': self.root, 'segment_rows': self.segment_rows, 'flush_interval': self.flush_interval,
+                'retention': self.retention, 'compact_interval': self.compact_interval}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def append(self, table, data):
+        if not len(data):
+            return
+        spec = TABLES[table]
+        columns = _columns(data)
+        partitions = columns[spec['time']] // PARTITION
+        with self._lock:
+            for partition in np.unique(partitions).tolist():
+                rows = partitions == partition
+                self._buffers[table].setdefault(partition, []).append(
+                    {name: values[rows] for name, values in columns.items()})
+                count = self._buffered_rows[table].get(partition, 0) + int(rows.sum())
+                self._buffered_rows[table][partition] = count
+                if count >= self.segment_rows:
+                    self._flush_partition(table, partition)
+            # Time has moved past these, e.g. while reading a capture in order
+            newest = max(self._buffers[table], default=None)
+            for partition in [p for p in self._buffers[table] if p < newest - 1]:
+                self._flush_partition(table, partition)
+            now = time.monotonic()
+            if now - self._last_flush >= self.flush_interval:
+                self.flush(compact=now - self._last_compact >= self.compact_interval)
+
+    def flush(self, compact=True):
+        # Writes every buffered partition; with `compact`, also merges the
+        # segments written since and applies `retention`
+        with self._lock:
+            for table in TABLES:
+                for partition in list(self._buffers[table]):
+                    self._flush_partition(table, partition)
+                if compact:
+                    self.compact(table, partitions=self._written[table])
+            if compact:
+                self.expire()
+                self._last_compact = time.monotonic()
+            self._last_flush = time.monotonic()
+
+    def expire(self):
+        # Applies `retention` to every table; returns the partitions dropped
+        if not self.retention:
+            return 0
+        return sum(self.retain(table, self.retention) for table in TABLES)
+
+    def _flush_partition(self, table, partition):
+        parts = self._buffers[table].pop(partition, None)
+        self._buffered_rows[table].pop(partition, None)
+        if not parts:
+            return
+        columns = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+        directory = os.path.join(self.root, table, _partition_name(partition))
+        os.makedirs(directory, exist_ok=True)
+        self._written[table].add(_partition_name(partition))
+        # Names sort by creation time and stay unique across processes
+        name = f"{time.time_ns():x}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        path = os.path.join(directory, name)
+        self._segments[path] = Segment.write(path, table, columns)
+
+    def partitions(self, table, start=None, end=None):
+        # Partition directory names overlapping [start, end], oldest first
+        names = sorted(n for n in os.listdir(os.path.join(self.root, table)) if not n.startswith('.'))
+        lookback = TABLES[table]['lookback']
+        return [n for n in names
+                if (end is None or _partition_start(n) <= end) and
+                   (start is None or _partition_start(n) + PARTITION + lookback > start)]
+
+    def segments(self, table, start=None, end=None):
+        found = []
+        for name in self.partitions(table, start, end):
+            found.extend(self._listed_segments(os.path.join(self.root, table, name), start, end))
+        return found
+
+    def _listed_segments(self, directory, start=None, end=None):
+        # Segments of a partition overlapping [start, end]; cached segments
+        # that are no longer listed were removed by another process
+        try:
+            entries = sorted(os.listdir(directory))
+        except FileNotFoundError:
+            return []
+        paths = [os.path.join(directory, entry) for entry in entries
+                 if not entry.startswith('.') and not entry.endswith('.tmp')]
+        for path in [p for p in self._segments if os.path.dirname(p) == directory and p not in paths]:
+            del self._segments[path]
+        found = []
+        for path in paths:
+            segment = self._segments.get(path)
+            if segment is None:
+                try:
+                    segment = self._segments[path] = Segment(path)
+                except FileNotFoundError:
+                    # Removed by compaction or retention meanwhile
+                    continue
+            if (start is None or segment.end >= start) and (end is None or segment.start <= end):
+                found.append(segment)
+        return found
+
+    def query(self, table, start=None, end=None, host=None, src=None, dst=None, port=None,
+              src_port=None, dst_port=None, protocol=None, where=None, limit=None):
+        # Rows of `table` in the time range matching every given filter, as a
+        # PacketBatch or FlowBatch sorted by time. `host` matches either address
+        # and `port` either port; addresses may be strings or address columns.
+        # `where` is a filter expression (tools.filters); the hosts and ports
+        # it requires are looked up in the indexes like the keyword filters.
+        spec = TABLES[table]
+        start, end = to_ns(start), to_ns(end)
+        where = compile_filter(where) if where else None
+        filters = {name: self._filter_values(name, value) for name, value in
+                   (('src', src), ('dst', dst), ('src_port', src_port), ('dst_port', dst_port),
+                    ('host', host), ('port', port)) if value is not None}
+        if where is not None:
+            for name, value in where.pushdown().items():
+                if name not in filters:
+                    filters[name] = self._filter_values(name, value)
+        if limit is not None and limit <= 0:
+            return spec['type'].empty()
+        with self._lock:
+            names = {_partition_start(name) // PARTITION: name for name in self.partitions(table, start, end)}
+            buffered = {partition: list(parts) for partition, parts in self._buffers[table].items()}
+        # Every row of a partition is later than those of the partitions before
+        # it, so they are searched oldest first until `limit` rows are found,
+        # and of each segment only as many candidates are read as may be needed
+        found = []
+        count = 0
+        for partition in sorted(set(names) | set(buffered)):
+            need = None if limit is None else limit - count
+            parts = []
+            if partition in names:
+                directory = os.path.join(self.root, table, names[partition])
+                with _partition_lock(directory, fcntl.LOCK_SH if fcntl else None) as present:
+                    with self._lock:
+                        segments = self._listed_segments(directory, start, end) if present else []
+                    for segment in segments:
+                        parts.extend(self._segment_matches(segment, spec, start, end, filters, where, protocol,
+                                                           need))
+            # Rows not yet written to a segment are filtered in memory
+            for part in buffered.get(partition, []):
+                if where is not None:
+                    part = self._where(part, where)
+                part = self._matching([part], spec, start, end, filters, protocol)
+                if part is not None:
+                    parts.append(part)
+            if not parts:
+                continue
+            columns = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+            order = np.argsort(columns[spec['time']], kind='stable')[:need]
+            found.append({name: values[order] for name, values in columns.items()})
+            count += len(order)
+            if limit is not None and count >= limit:
+                break
+        if not found:
+            return spec['type'].empty()
+        columns = {name: np.concatenate([part[name] for part in found]) for name in found[0]}
+        n = len(columns[spec['time']])
+        addresses = narrow_addresses(np.concatenate([columns['src'], columns['dst']]))
+        columns['src'], columns['dst'] = addresses[:n], addresses[n:]
+        return spec['type'](**columns)
+
+    def _segment_matches(self, segment, spec, start, end, filters, where, protocol, need):
+        # Matching rows of a segment, as column dicts in time order. With
+        # `need`, candidates are read in growing chunks until that many match.
+        rows = self._segment_rows(segment, spec, start, end, filters)
+        chunk = len(rows) if need is None else max(need, QUERY_CHUNK)
+        parts = []
+        count = 0
+        first = 0
+        while first < len(rows):
+            part = segment.read(spec['type'].fields, rows[first:first + chunk])
+            first += chunk
+            chunk *= 2
+            if where is not None:
+                part = self._where(part, where)
+            part = self._matching([part], spec, start, end, filters, protocol)
+            if part is None:
+                continue
+            parts.append(part)
+            count += len(part[spec['time']])
+            if need is not None and count >= need:
+                break
+        return parts
+
+    @staticmethod
+    def _filter_values(name, value):
+        if name in ('src', 'dst', 'host'):
+            if isinstance(value, str):
+                value = [value]
+            if not isinstance(value, np.ndarray):
+                value = parse_addresses(value)
+            return address_keys(value)
+        return np.atleast_1d(np.asarray(value)).astype(np.uint64)
+
+    @staticmethod
+    def _segment_rows(segment, spec, start, end, filters):
+        lo, hi = segment.time_range(spec['time'], start, end, spec['lookback'])
+        rows = None
+        for name, values in filters.items():
+            if name in ('host', 'port'):
+                pair = ('src', 'dst') if name == 'host' else ('src_port', 'dst_port')
+                keys = address_hash(values) if name == 'host' else values
+                matched = np.union1d(segment.lookup(pair[0], keys), segment.lookup(pair[1], keys))
+            else:
+                keys = address_hash(values) if name in ADDRESS_COLUMNS else values
+                matched = segment.lookup(name, keys)
+            rows = matched if rows is None else np.intersect1d(rows, matched, assume_unique=True)
+            if not len(rows):
+                return rows
+        if rows is None:
+            # A range rather than an array, so a query with a limit never
+            # allocates a row number per row of the segment
+            return range(lo, hi)
+        return rows[(rows >= lo) & (rows < hi)]
+
+    @staticmethod
+    def _where(part, where):
+        matched = where.mask(part)
+        if matched.all():
+            return part
+        return {name: values[matched] for name, values in part.items()}
+
+    @staticmethod
+    def _matching(parts, spec, start, end, filters, protocol):
+        # Exact filtering of candidate rows: time overlap, the real addresses
+        # behind index hashes, and columns that have no index
+        parts = [part for part in parts if len(part[spec['time']])]
+        if not parts:
+            return None
+        columns = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+        keep = np.ones(len(columns[spec['time']]), dtype=bool)
+        if start is not None:
+            keep &= columns[spec['end']] >= start
+        if end is not None:
+            keep &= columns[spec['time']] <= end
+        for name, values in filters.items():
+            if name == 'host':
+                keep &= (np.isin(address_keys(columns['src']), values) |
+                         np.isin(address_keys(columns['dst']), values))
+            elif name == 'port':
+                keep &= np.isin(columns['src_port'], values) | np.isin(columns['dst_port'], values)
+            elif name in ADDRESS_COLUMNS:
+                keep &= np.isin(address_keys(columns[name]), values)
+            else:
+                keep &= np.isin(columns[name], values)
+        if protocol is not None:
+            keep &= np.isin(columns['protocol'], np.atleast_1d(protocol))
+        if not keep.any():
+            return None
+        return {name: values[keep] for name, values in columns.items()}
+
+    def compact(self, table, before=None, partitions=None):
+        # Merge the small segments of each partition that ends before `before`
+        # (by default, every partition but the current hour) into one, e.g. the
+        # many flushes of a live feed. Returns the number of segments merged.
+        if fcntl is None:
+            return 0
+        before = time.time_ns() // PARTITION * PARTITION if before is None else to_ns(before)
+        merged = 0
+        with self._lock:
+            names = self.partitions(table, end=before - PARTITION)
+            if partitions is not None:
+                names = [name for name in names if name in partitions]
+                partitions.difference_update(names)
+            for name in names:
+                directory = os.path.join(self.root, table, name)
+                # Skipped while another process compacts or reads it
+                with _partition_lock(directory, fcntl.LOCK_EX | fcntl.LOCK_NB) as locked:
+                    if locked:
+                        merged += self._compact_partition(table, directory)
+        return merged
+
+    def _partition_segments(self, directory):
+        segments = []
+        for entry in sorted(os.listdir(directory)):
+            if entry.startswith('.') or entry.endswith('.tmp'):
+                continue
+            path = os.path.join(directory, entry)
+            segments.append(self._segments.get(path) or Segment(path))
+        return segments
+
+    def _compact_partition(self, table, directory):
+        segments = self._partition_segments(directory)
+        if len(segments) < 2 or sum(s.rows for s in segments) > self.segment_rows:
+            return 0
+        columns = {field: np.concatenate([np.asarray(s.column(field)) for s in segments])
+                   for field in TABLES[table]['type'].fields}
+        path = os.path.join(directory, f"{time.time_ns():x}-{os.getpid()}-{uuid.uuid4().hex[:8]}")
+        self._segments[path] = Segment.write(path, table, columns)
+        for segment in segments:
+            self._segments.pop(segment.path, None)
+            shutil.rmtree(segment.path, ignore_errors=True)
+        return len(segments)
+
+    def retain(self, table, keep_seconds):
+        # Drop whole partitions nothing was stored in for `keep_seconds`. Age
+        # is when rows were written, not their timestamps, so an upload of old
+        # traffic is kept as long as live traffic. Partitions still buffered
+        # or being written to are kept.
+        cutoff = time.time() - keep_seconds
+        removed = 0
+        with self._lock:
+            buffered = {_partition_name(partition) for partition in self._buffers[table]}
+            for name in self.partitions(table):
+                directory = os.path.join(self.root, table, name)
+                if name in buffered:
+                    continue
+                try:
+                    if any(entry.endswith('.tmp') for entry in os.listdir(directory)):
+                        continue
+                    written = max((segment.meta['created'] for segment in self._partition_segments(directory)),
+                                  default=0)
+                except FileNotFoundError:
+                    # Compacted or dropped by another process meanwhile
+                    continue
+                if written > cutoff:
+                    continue
+                # Skipped while it is read or compacted; dropped next time
+                with _partition_lock(directory, fcntl.LOCK_EX | fcntl.LOCK_NB if fcntl else None) as locked:
+                    if not locked:
+                        continue
+                    for path in [p for p in self._segments if os.path.dirname(p) == directory]:
+                        del self._segments[path]
+                    # Moved out of the way first, so no query finds it half removed
+                    dropped = os.path.join(self.root, table, f'.dropped-{name}-{uuid.uuid4().hex[:8]}')
+                    os.rename(directory, dropped)
+                shutil.rmtree(dropped, ignore_errors=True)
+                removed += 1
+        return removed
+
+    def describe(self):
+        # Rows and time span kept per table
+        summary = {}
+        for table in TABLES:
+            segments = self.segments(table)
+            summary[table] = {
+                'partitions': len(self.partitions(table)),
+                'segments': len(segments),
+                'rows': sum(s.rows for s in segments),
+                'start': min((s.start for s in segments), default=None),
+                'end': max((s.end for s in segments), default=None),
+            }
+        return summary
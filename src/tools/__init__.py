@@ -1,3 +1,12 @@
+import os
+import numpy as np
+from custom_types import PacketBatch, FlowBatch, IncidentTable
+from .sketches import HyperLogLog, SpaceSaving
+from .jobs import JobStore, JobQueue, JobHandle
+from .filters import Filter, FilterError, FilterVisitor, compile_filter
+
+COLUMNAR_TYPES = {cls.__name__: cls for cls in (PacketBatch, FlowBatch, IncidentTable)}
+
 def process_data(data):
     # Function to process raw network data
     pass
@@ -7,9 +16,15 @@ def format_output(output):
     pass
 
 def save_to_file(data, filename):
-    # Function to save processed data to a file
-    pass
+    # Columnar packets, flows or incidents as an .npz archive of their columns
+    if type(data).__name__ not in COLUMNAR_TYPES:
+        raise TypeError(f"Cannot save {type(data).__name__}, expected one of {', '.join(COLUMNAR_TYPES)}")
+    np.savez(filename, kind=type(data).__name__, **{name: getattr(data, name) for name in data.fields})
 
 def load_from_file(filename):
-    # Function to load data from a file
-    pass
\ No newline at end of file
+    # numpy adds the .npz extension when saving if it is missing
+    if not os.path.exists(filename) and os.path.exists(filename + '.npz'):
+        filename += '.npz'
+    with np.load(filename, allow_pickle=False) as archive:
+        cls = COLUMNAR_TYPES[str(archive['kind'])]
+        return cls(**{name: archive[name] for name in cls.fields})
\ No newline at end of file
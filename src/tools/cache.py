@@ -0,0 +1,73 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    # LRU cache whose entries also expire `ttl` seconds after they were set.
+    # get_or_set computes a missing value once, however many threads ask for it
+    # at the same time; the others wait for that result.
+    def __init__(self, max_entries=128, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires, value)
+        self.hits = 0
+        self.misses = 0
+        self._pending = {}  # key -> Event set once the value is computed
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _lookup(self, key, now):
+        entry = self.entries.get(key)
+        if entry is None:
+            return False, None
+        if entry[0] < now:
+            del self.entries[key]
+            return False, None
+        self.entries.move_to_end(key)
+        return True, entry[1]
+
+    def get(self, key, default=None):
+        with self._lock:
+            found, value = self._lookup(key, time.monotonic())
+        return value if found else default
+
+    def set(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+    def _set(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get_or_set(self, key, compute):
+        while True:
+            with self._lock:
+                found, value = self._lookup(key, time.monotonic())
+                if found:
+                    self.hits += 1
+                    return value
+                pending = self._pending.get(key)
+                if pending is None:
+                    pending = self._pending[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # Someone else is computing it; use their result once it is ready
+            pending.wait()
+        try:
+            value = compute()
+            with self._lock:
+                self._set(key, value)
+            return value
+        finally:
+            with self._lock:
+                del self._pending[key]
+            pending.set()
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
@@ -0,0 +1,514 @@
+import re
+import ipaddress
+from functools import lru_cache
+import numpy as np
+from custom_types import PROTOCOL_CODES
+
+CACHE_SIZE = 256  # compiled expressions kept
+SUBSET_RATIO = 8  # later clauses only look at the selected rows once fewer than 1/8 are left
+PUSHDOWN_PORTS = 64  # widest port range turned into index lookups
+
+# Protocol keywords and the codes they match; HTTP and HTTPS are TCP too
+PROTOCOL_NAMES = {
+    'tcp': ['TCP', 'HTTP', 'HTTPS'],
+    'udp': ['UDP'],
+    'icmp': ['ICMP'],
+    'http': ['HTTP'],
+    'https': ['HTTPS'],
+    'other': ['OTHER'],
+}
+TCP_FLAG_BITS = {'fin': 0x01, 'syn': 0x02, 'rst': 0x04, 'psh': 0x08, 'ack': 0x10, 'urg': 0x20, 'ece': 0x40,
+                 'cwr': 0x80}
+# Numeric columns that can be compared, by their name in expressions
+FIELDS = {'len': 'length', 'length': 'length', 'packets': 'packets', 'bytes': 'bytes',
+          'rev_packets': 'rev_packets', 'rev_bytes': 'rev_bytes'}
+OPERATORS = {'>': np.greater, '>=': np.greater_equal, '<': np.less, '<=': np.less_equal,
+             '=': np.equal, '==': np.equal, '!=': np.not_equal}
+KEYWORDS = {'and', 'or', 'not', 'src', 'dst', 'host', 'net', 'port', 'portrange', 'proto', 'tcpflags'}
+
+_TOKEN = re.compile(r'\s*(?:(\(|\)|&&|\|\||!=|==|>=|<=|[<>=!])|([^\s()<>=!&|]+))')
+_V4_MAPPED = bytes(10) + b'\xff\xff'
+_ALL_BITS = (1 << 128) - 1
+_LOW_BITS = (1 << 64) - 1
+
+
+class FilterError(ValueError):
+    pass
+
+
+class _Columns:
+    # Columns of a batch (or of a dict of columns) as seen by a filter, either
+    # all rows or a subset. Derived columns are computed once per evaluation.
+    def __init__(self, data, rows=None):
+        self.data = data
+        self.rows = rows
+        self._cache = {}
+
+    def __len__(self):
+        if self.rows is not None:
+            return len(self.rows)
+        return len(next(iter(self.data.values()))) if isinstance(self.data, dict) else len(self.data)
+
+    def get(self, name):
+        values = self._cache.get(name)
+        if values is None:
+            try:
+                values = self.data[name] if isinstance(self.data, dict) else getattr(self.data, name)
+            except (KeyError, AttributeError):
+                raise FilterError(f"The filter uses '{name}', which these rows do not have") from None
+            if self.rows is not None:
+                values = values[self.rows]
+            self._cache[name] = values
+        return values
+
+    def halves(self, name):
+        # 16-byte addresses as big-endian (high, low) uint64 halves
+        key = name + '.halves'
+        halves = self._cache.get(key)
+        if halves is None:
+            values = np.ascontiguousarray(self.get(name)).view('>u8')
+            halves = self._cache[key] = (values[:, 0].astype(np.uint64), values[:, 1].astype(np.uint64))
+        return halves
+
+    def subset(self, rows):
+        return _Columns(self.data, rows if self.rows is None else self.rows[rows])
+
+
+class _Net:
+    # Address in a CIDR block, for `host`, `net` and bare addresses. Kept as
+    # an IPv4-mapped IPv6 block, plus the IPv4 form for uint32 columns.
+    kind = 'net'
+    cost = 2
+
+    def __init__(self, directions, combine, packed, length):
+        if len(packed) == 4:
+            packed, length = _V4_MAPPED + packed, length + 96
+        self.directions = directions
+        self.combine = combine
+        self.length = length
+        mask = _ALL_BITS ^ ((1 << (128 - length)) - 1)
+        base = int.from_bytes(packed, 'big') & mask
+        self.packed = base.to_bytes(16, 'big')
+        self.base = (np.uint64(base >> 64), np.uint64(base & _LOW_BITS))
+        self.mask = (np.uint64(mask >> 64), np.uint64(mask & _LOW_BITS))
+        self.v4 = None  # (base, mask) for uint32 columns, None if no IPv4 address matches
+        if length >= 96 and base >> 32 == 0xFFFF:
+            self.v4 = (np.uint32(base & 0xFFFFFFFF), np.uint32(mask & 0xFFFFFFFF))
+        elif length < 96 and (0xFFFF << 32) & mask == base:
+            self.v4 = (np.uint32(0), np.uint32(0))
+
+    def _match(self, columns, name):
+        values = columns.get(name)
+        if values.ndim == 1:
+            if self.v4 is None:
+                return np.zeros(len(values), dtype=bool)
+            return (values & self.v4[1]) == self.v4[0]
+        high, low = columns.halves(name)
+        # Whole halves are compared as they are, and ignored halves skipped
+        match = (high if self.mask[0] == _LOW_BITS else high & self.mask[0]) == self.base[0]
+        if self.mask[1]:
+            match &= (low if self.mask[1] == _LOW_BITS else low & self.mask[1]) == self.base[1]
+        return match
+
+    def evaluate(self, columns):
+        return _directions(self, columns, self.directions, self.combine)
+
+    def index_filter(self):
+        if self.length != 128 or self.combine:
+            return None
+        name = 'host' if len(self.directions) == 2 else self.directions[0]
+        return name, np.frombuffer(self.packed, dtype=np.uint8).reshape(1, 16)
+
+
+class _Port:
+    kind = 'port'
+    cost = 1
+
+    def __init__(self, directions, combine, low, high):
+        self.directions = directions
+        self.combine = combine
+        self.low = low
+        self.high = high
+
+    def _match(self, columns, name):
+        values = columns.get(name + '_port')
+        if self.low == self.high:
+            return values == self.low
+        return (values >= self.low) & (values <= self.high)
+
+    def evaluate(self, columns):
+        return _directions(self, columns, self.directions, self.combine)
+
+    def index_filter(self):
+        if self.combine or self.high - self.low >= PUSHDOWN_PORTS:
+            return None
+        name = 'port' if len(self.directions) == 2 else self.directions[0] + '_port'
+        return name, np.arange(self.low, self.high + 1, dtype=np.uint64)
+
+
+def _directions(predicate, columns, directions, combine):
+    mask = predicate._match(columns, directions[0])
+    for name in directions[1:]:
+        if combine:
+            mask &= predicate._match(columns, name)
+        else:
+            mask |= predicate._match(columns, name)
+    return mask
+
+
+class _Protocol:
+    kind = 'protocol'
+    cost = 1
+
+    def __init__(self, codes):
+        self.codes = np.array(sorted(codes), dtype=np.uint8)
+
+    def evaluate(self, columns):
+        values = columns.get('protocol')
+        if len(self.codes) == 1:
+            return values == self.codes[0]
+        # Protocol codes are small, so a lookup table beats isin
+        table = np.zeros(256, dtype=bool)
+        table[self.codes] = True
+        return table[values]
+
+    def index_filter(self):
+        return None
+
+
+class _Flags:
+    kind = 'flags'
+    cost = 1
+
+    def __init__(self, bits):
+        self.bits = np.uint8(bits)
+
+    def evaluate(self, columns):
+        return (columns.get('tcp_flags') & self.bits) != 0
+
+    def index_filter(self):
+        return None
+
+
+class _Compare:
+    kind = 'compare'
+    cost = 1
+
+    def __init__(self, column, operator, value):
+        self.column = column
+        self.operator = operator
+        self.value = min(max(value, -1 << 63), (1 << 63) - 1)
+
+    def evaluate(self, columns):
+        values = columns.get(self.column)
+        value = self.value
+        if values.dtype.kind in 'ui':
+            limits = np.iinfo(values.dtype)
+            # Compared in the column's own type unless the number does not fit
+            value = values.dtype.type(value) if limits.min <= value <= limits.max else np.int64(value)
+        return OPERATORS[self.operator](values, value)
+
+    def index_filter(self):
+        return None
+
+
+class _Not:
+    kind = 'not'
+
+    def __init__(self, child):
+        self.child = child
+        self.cost = child.cost
+
+    def evaluate(self, columns):
+        return ~self.child.evaluate(columns)
+
+    def index_filter(self):
+        return None
+
+
+class _And:
+    kind = 'and'
+
+    def __init__(self, children):
+        # Cheap clauses first, so the expensive ones see fewer rows
+        self.children = sorted(children, key=lambda child: child.cost)
+        self.cost = sum(child.cost for child in children)
+
+    def evaluate(self, columns):
+        mask = self.children[0].evaluate(columns)
+        for child in self.children[1:]:
+            selected = np.count_nonzero(mask)
+            if not selected:
+                break
+            if selected * SUBSET_RATIO < len(mask):
+                rows = np.flatnonzero(mask)
+                mask[rows] = child.evaluate(columns.subset(rows))
+            else:
+                mask &= child.evaluate(columns)
+        return mask
+
+    def index_filter(self):
+        return None
+
+
+class _Or:
+    kind = 'or'
+
+    def __init__(self, children):
+        self.children = children
+        self.cost = sum(child.cost for child in children)
+
+    def evaluate(self, columns):
+        mask = self.children[0].evaluate(columns)
+        for child in self.children[1:]:
+            remaining = len(mask) - np.count_nonzero(mask)
+            if not remaining:
+                break
+            if remaining * SUBSET_RATIO < len(mask):
+                rows = np.flatnonzero(~mask)
+                mask[rows] = child.evaluate(columns.subset(rows))
+            else:
+                mask |= child.evaluate(columns)
+        return mask
+
+    def index_filter(self):
+        # host a or host b -> both hosts, if every branch uses the same index
+        found = [child.index_filter() for child in self.children]
+        if not all(found) or len({name for name, _ in found}) != 1:
+            return None
+        return found[0][0], np.concatenate([values for _, values in found])
+
+
+class FilterVisitor:
+    # Walks the syntax tree of a compiled filter (Filter.root), as
+    # ast.NodeVisitor does: visit(node, ...) calls visit_<kind> for the
+    # node's kind, one of net, port, protocol, flags, compare, not, and, or,
+    # and generic_visit when there is no such method. Terms carry the
+    # attributes their constructors set above; `not` has a child, `and` and
+    # `or` a list of children.
+    def visit(self, node, *args):
+        return getattr(self, 'visit_' + node.kind, self.generic_visit)(node, *args)
+
+    def generic_visit(self, node, *args):
+        return None
+
+
+def _combine(kind, left, right):
+    # Flattens chains of the same operator
+    children = []
+    for node in (left, right):
+        children.extend(node.children if type(node) is kind else [node])
+    return kind(children)
+
+
+class _Parser:
+    # Recursive descent over the pcap-filter syntax subset described at
+    # compile_filter. As in tcpdump, `and` and `or` have the same precedence
+    # and group from the left; `not` binds tightest.
+    def __init__(self, text):
+        self.text = text
+        self.tokens = []
+        position = 0
+        while position < len(text):
+            match = _TOKEN.match(text, position)
+            if match is None or match.end() == position:
+                rest = text[position:]
+                if not rest.strip():
+                    break
+                position += len(rest) - len(rest.lstrip())
+                raise FilterError(f"Unexpected character {text[position]!r} at position {position}")
+            token = match.group(1) or match.group(2)
+            if token is not None:
+                self.tokens.append((token.lower() if match.group(2) else token, match.start(match.lastindex)))
+            position = match.end()
+        self.index = 0
+        self.last = None  # qualifiers of the last primitive, for `port 80 or 443`
+
+    def peek(self, ahead=0):
+        index = self.index + ahead
+        return self.tokens[index][0] if index < len(self.tokens) else None
+
+    def next(self):
+        if self.index >= len(self.tokens):
+            raise FilterError("Unexpected end of filter")
+        self.index += 1
+        return self.tokens[self.index - 1][0]
+
+    def error(self, message):
+        if self.index < len(self.tokens):
+            token, position = self.tokens[self.index]
+            return FilterError(f"{message}, found {token!r} at position {position}")
+        return FilterError(f"{message} at the end of the filter")
+
+    def parse(self):
+        if not self.tokens:
+            raise FilterError("Empty filter")
+        node = self.expression()
+        if self.index < len(self.tokens):
+            raise self.error("Expected 'and' or 'or'")
+        return node
+
+    def expression(self):
+        node = self.factor()
+        while self.peek() in ('and', '&&', 'or', '||'):
+            kind = _And if self.next() in ('and', '&&') else _Or
+            node = _combine(kind, node, self.factor())
+        return node
+
+    def factor(self):
+        token = self.peek()
+        if token in ('not', '!'):
+            self.next()
+            return _Not(self.factor())
+        if token == '(':
+            self.next()
+            node = self.expression()
+            if self.peek() != ')':
+                raise self.error("Expected ')'")
+            self.next()
+            return node
+        return self.primitive()
+
+    def directions(self):
+        # src, dst, `src or dst` (the default) or `src and dst`
+        if self.peek() not in ('src', 'dst'):
+            return ('src', 'dst'), False, False
+        first = self.next()
+        if first == 'src' and self.peek() in ('or', 'and') and self.peek(1) == 'dst':
+            combine = self.next() == 'and'
+            self.next()
+            return ('src', 'dst'), combine, True
+        return (first,), False, True
+
+    def primitive(self):
+        token = self.peek()
+        if token is None:
+            raise self.error("Expected a filter term")
+        if token in PROTOCOL_NAMES or token == 'proto':
+            self.next()
+            name = self.next() if token == 'proto' else token
+            if name not in PROTOCOL_NAMES:
+                raise FilterError(f"Unknown protocol {name!r}, expected one of {', '.join(PROTOCOL_NAMES)}")
+            return _Protocol(PROTOCOL_CODES[code] for code in PROTOCOL_NAMES[name])
+        if token == 'tcpflags':
+            self.next()
+            names = self.next().split(',')
+            unknown = [name for name in names if name not in TCP_FLAG_BITS]
+            if unknown:
+                raise FilterError(f"Unknown TCP flag {unknown[0]!r}, expected one of {', '.join(TCP_FLAG_BITS)}")
+            return _Flags(sum(TCP_FLAG_BITS[name] for name in names))
+        if token in FIELDS:
+            self.next()
+            operator = self.peek()
+            if operator not in OPERATORS:
+                raise self.error(f"Expected a comparison after {token!r}")
+            self.next()
+            return _Compare(FIELDS[token], operator, self.number(self.next()))
+        if token not in KEYWORDS and self.last is not None and _is_value(token):
+            # `port 80 or 443` repeats the qualifiers of the previous term
+            kind, directions, combine = self.last
+            return self.qualified(kind, directions, combine)
+        directions, combine, explicit = self.directions()
+        kind = self.peek()
+        if kind in ('host', 'net', 'port', 'portrange'):
+            self.next()
+        elif kind is not None and _is_value(kind) and kind not in KEYWORDS:
+            kind = 'net'  # a bare address or block is `host` or `net`
+        else:
+            raise self.error("Expected host, net, port, portrange, a protocol or a comparison"
+                             if not explicit else "Expected host, net, port or portrange")
+        return self.qualified(kind, directions, combine)
+
+    def qualified(self, kind, directions, combine):
+        self.last = (kind, directions, combine)
+        value = self.next()
+        if kind in ('host', 'net'):
+            if kind == 'host' and '/' in value:
+                raise FilterError(f"'host' takes an address, use 'net' for {value!r}")
+            try:
+                network = ipaddress.ip_network(value, strict=False)
+            except ValueError:
+                raise FilterError(f"Invalid address {value!r}") from None
+            return _Net(directions, combine, network.network_address.packed, network.prefixlen)
+        if kind == 'port':
+            return _Port(directions, combine, *[self.port(value)] * 2)
+        low, separator, high = value.partition('-')
+        if not separator:
+            raise FilterError(f"Expected a port range like 1-1024, found {value!r}")
+        low, high = self.port(low), self.port(high)
+        if low > high:
+            raise FilterError(f"Empty port range {value!r}")
+        return _Port(directions, combine, low, high)
+
+    @staticmethod
+    def number(token):
+        try:
+            return int(token, 0)
+        except ValueError:
+            raise FilterError(f"Expected a number, found {token!r}") from None
+
+    def port(self, token):
+        port = self.number(token)
+        if not 0 <= port <= 65535:
+            raise FilterError(f"Port out of range: {token}")
+        return port
+
+
+def _is_value(token):
+    return token[0].isdigit() or ':' in token
+
+
+class Filter:
+    # A compiled filter expression: one boolean mask per batch (or dict of
+    # columns), built from vectorized comparisons on the columns the
+    # expression names. Instances are immutable and shared through the
+    # compile_filter cache.
+    def __init__(self, text):
+        self.text = text
+        self.root = _Parser(text).parse()
+
+    def __str__(self):
+        return self.text
+
+    def mask(self, data):
+        columns = _Columns(data)
+        if not len(columns):
+            return np.zeros(0, dtype=bool)
+        return self.root.evaluate(columns)
+
+    def apply(self, data):
+        return data[self.mask(data)]
+
+    def pushdown(self):
+        # Index filters every matching row satisfies, in the form of
+        # TrafficStore.query's keyword filters: exact hosts and ports from the
+        # clauses the whole expression requires
+        clauses = self.root.children if isinstance(self.root, _And) else [self.root]
+        filters = {}
+        for clause in clauses:
+            found = clause.index_filter()
+            if found is not None and found[0] not in filters:
+                filters[found[0]] = found[1]
+        return filters
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _compile(text):
+    return Filter(text)
+
+
+def compile_filter(expression):
+    # A Filter for a pcap-filter style expression, e.g.
+    #   src net 192.168.1.0/24 and dst port 443 and len > 1000
+    #
+    #   [src|dst|src or dst|src and dst] host ADDR | net CIDR | port N | portrange N-M
+    #   tcp | udp | icmp | http | https | other    (proto NAME also works)
+    #   tcpflags syn[,ack...]                     (any of the flags set)
+    #   len|packets|bytes|rev_packets|rev_bytes  > >= < <= = != N
+    #   not, !, and, &&, or, ||, parentheses; a bare address means host/net,
+    #   and a bare value repeats the previous qualifiers (port 80 or 443)
+    #
+    # Expressions are parsed once; the same text returns the same Filter.
+    if isinstance(expression, Filter):
+        return expression
+    return _compile(' '.join(expression.split()))
@@ -0,0 +1,213 @@
+import os
+import re
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+JOB_STATES = ['queued', 'running', 'done', 'failed']
+PROGRESS_INTERVAL = 0.5  # seconds between progress writes
+
+_JOB_ID = re.compile(r'^[0-9a-f]{32}$')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    filename TEXT,
+    path TEXT,
+    size INTEGER DEFAULT 0,
+    status TEXT NOT NULL,
+    pid INTEGER,
+    bytes_done INTEGER DEFAULT 0,
+    packets INTEGER DEFAULT 0,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    result TEXT,
+    error TEXT
+)
+'''
+
+
+class JobStore:
+    # Job state in a local SQLite database, so any process (e.g. any gunicorn
+    # worker) can report on a job no matter which one is running it
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute(_SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # A short-lived connection per call keeps the store safe to use from
+        # threads and forked processes
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _update(self, job_id, **fields):
+        columns = ', '.join(f"{name} = ?" for name in fields)
+        with self._connect() as db:
+            db.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def create(self, kind, filename=None, path=None, size=None):
+        # `size` (bytes of input) defaults to the size of `path`
+        job_id = uuid.uuid4().hex
+        if size is None:
+            size = os.path.getsize(path) if path and os.path.exists(path) else 0
+        with self._connect() as db:
+            # Until a worker starts the job, `pid` is the process that queued it
+            db.execute("INSERT INTO jobs (id, kind, filename, path, size, status, pid, created) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       (job_id, kind, filename, path, size, 'queued', os.getpid(), time.time()))
+        return job_id
+
+    @staticmethod
+    def valid_id(job_id):
+        # Whether `job_id` is an id as create makes them
+        return bool(_JOB_ID.match(job_id))
+
+    def start(self, job_id):
+        self._update(job_id, status='running', pid=os.getpid(), started=time.time())
+
+    def progress(self, job_id, bytes_done, packets):
+        self._update(job_id, bytes_done=bytes_done, packets=packets)
+
+    def finish(self, job_id, result):
+        self._update(job_id, status='done', finished=time.time(), result=json.dumps(result))
+
+    def fail(self, job_id, error):
+        self._update(job_id, status='failed', finished=time.time(), error=error)
+
+    def get(self, job_id):
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._describe(row) if row else None
+
+    def list(self, limit=50):
+        with self._connect() as db:
+            rows = db.execute("SELECT * FROM jobs ORDER BY created DESC LIMIT ?", (limit,)).fetchall()
+        return [self._describe(row) for row in rows]
+
+    def counts(self):
+        # Jobs per status
+        with self._connect() as db:
+            rows = db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    @staticmethod
+    def _describe(row):
+        job = dict(row)
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        # Throughput and time left, from the progress reported so far
+        started = job['started']
+        elapsed = ((job['finished'] or time.time()) - started) if started else 0.0
+        job['elapsed'] = elapsed
+        job['rate'] = job['bytes_done'] / elapsed if elapsed > 0 else 0.0
+        remaining = max(job['size'] - job['bytes_done'], 0)
+        job['eta'] = remaining / job['rate'] if job['status'] == 'running' and job['rate'] else None
+        return job
+
+    def expire(self, before):
+        # Forget jobs that finished before `before` (epoch seconds)
+        with self._connect() as db:
+            db.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished < ?", (before,))
+
+    def recover(self):
+        # Fail jobs whose worker process is gone, e.g. after a restart
+        with self._connect() as db:
+            rows = db.execute("SELECT id, pid FROM jobs WHERE status IN ('queued', 'running')").fetchall()
+        for row in rows:
+            if not _alive(row['pid']):
+                self.fail(row['id'], 'Interrupted before it finished')
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobHandle:
+    # What a running job sees of the store; picklable, so it can be sent to a
+    # worker process. Progress writes are throttled.
+    def __init__(self, store_path, job_id):
+        self.store_path = store_path
+        self.job_id = job_id
+        self._store = None
+        self._last_progress = 0.0
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = JobStore(self.store_path)
+        return self._store
+
+    def progress(self, bytes_done, packets, force=False):
+        now = time.monotonic()
+        if force or now - self._last_progress >= PROGRESS_INTERVAL:
+            self._last_progress = now
+            self.store.progress(self.job_id, bytes_done, packets)
+
+
+def _run_job(target, handle, args):
+    # Entry point in the worker process
+    handle.store.start(handle.job_id)
+    try:
+        result = target(handle, *args)
+    except Exception as e:
+        handle.store.fail(handle.job_id, f"{type(e).__name__}: {e}")
+        return
+    handle.store.finish(handle.job_id, result)
+
+
+class JobQueue:
+    # Runs jobs in a local process pool and tracks them in a JobStore. The pool
+    # is only started by the first submit, so creating the queue is cheap.
+    def __init__(self, store, workers=2):
+        self.store = store
+        self.workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def submit(self, kind, target, *args, filename=None, path=None, size=None):
+        # `target(job, *args)` must be a module-level function; it reports
+        # progress through `job` and returns a JSON-serialisable result
+        job_id = self.store.create(kind, filename, path, size)
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.workers)
+            future = self._pool.submit(_run_job, target, JobHandle(self.store.path, job_id), args)
+        future.add_done_callback(lambda f: self._failed(job_id, f))
+        return job_id
+
+    def _failed(self, job_id, future):
+        # Covers jobs that never got to report, e.g. a worker that crashed
+        if future.cancelled():
+            self.store.fail(job_id, 'Cancelled')
+            return
+        error = future.exception()
+        if error is not None:
+            self.store.fail(job_id, f"{type(error).__name__}: {error}")
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=wait)
+                self._pool = None
@@ -0,0 +1,341 @@
+import os
+import sys
+import time
+import bisect
+import resource
+import threading
+from collections import Counter as _Tally
+
+PREFIX = 'network_forensics_'
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILE_INTERVAL = 0.01  # seconds between stack samples
+MAX_PROFILE_SECONDS = 120
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=(), function=None):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        # Value read when collected, e.g. a queue length owned by someone else
+        self.function = function
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._child())
+        return child
+
+    def samples(self):
+        # (suffix, label values, extra labels, value) of every series
+        if self.function is not None:
+            value = self.function()
+            if isinstance(value, dict):
+                return [('', (key,), (), number) for key, number in value.items()]
+            return [('', (), (), value)]
+        return [sample for values, child in list(self._children.items()) for sample in child.samples(values)]
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        # A lost update between threads is acceptable for monitoring; the GIL
+        # keeps it rare
+        self.value += amount
+
+    def samples(self, values):
+        return [('_total', values, (), self.value)]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def samples(self):
+        if self.function is not None:
+            return [('_total',) + sample[1:] for sample in super().samples()]
+        return super().samples()
+
+
+class _GaugeChild:
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def samples(self, values):
+        return [('', values, (), self.value)]
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+
+class _Timer:
+    __slots__ = ('child', 'started')
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.started)
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def samples(self, values):
+        samples = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            samples.append(('_bucket', values, (('le', _number(bound)),), total))
+        samples.append(('_sum', values, (), self.sum))
+        samples.append(('_count', values, (), total))
+        return samples
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def _child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+
+class MetricsRegistry:
+    # Process-wide metrics in the Prometheus text format. Recording a value is
+    # a dictionary lookup and an addition; everything else happens when the
+    # metrics are collected.
+    def __init__(self):
+        self.metrics = {}
+        self.builtin = set()  # names that survive reset()
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self.metrics.get(name)
+                if metric is None:
+                    metric = self.metrics[name] = cls(name, *args, **kwargs)
+        return metric
+
+    def counter(self, name, help, labels=(), function=None):
+        metric = self._get(Counter, name, help, labels, function)
+        if function is not None:
+            metric.function = function
+        return metric
+
+    def gauge(self, name, help, labels=(), function=None):
+        metric = self._get(Gauge, name, help, labels, function)
+        if function is not None:
+            metric.function = function
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def reset(self):
+        # Forgets recorded values and everything registered after import, e.g.
+        # the gauges of the web worker a process was forked from
+        with self._lock:
+            self.metrics = {name: metric for name, metric in self.metrics.items() if name in self.builtin}
+            for metric in self.metrics.values():
+                metric._children = {}
+
+    def collect(self):
+        # Plain, JSON-serialisable families, so another process can publish them
+        families = []
+        for metric in list(self.metrics.values()):
+            try:
+                samples = metric.samples()
+            except Exception:
+                # A gauge whose owner is gone must not break the whole page
+                continue
+            families.append({
+                'name': metric.name,
+                'type': metric.kind,
+                'help': metric.help,
+                'labels': list(metric.label_names),
+                'samples': [[suffix, list(values), [list(pair) for pair in extra], value]
+                            for suffix, values, extra, value in samples]
+            })
+        return families
+
+
+def render(*sources):
+    # Prometheus text exposition of collected families. Each source is
+    # (families, extra labels), so the same metric from several processes can
+    # be told apart; families with the same name are written together.
+    merged = {}
+    for families, extra in sources:
+        for family in families:
+            entry = merged.setdefault(family['name'], (family, []))
+            for suffix, values, labels, value in family['samples']:
+                entry[1].append((suffix, _labels(family['labels'], values, list(extra.items()) + labels), value))
+    lines = []
+    for name, (family, samples) in merged.items():
+        # Counter families are named after their samples in this format
+        header = PREFIX + name + ('_total' if family['type'] == 'counter' else '')
+        lines.append(f"# HELP {header} {family['help']}")
+        lines.append(f"# TYPE {header} {family['type']}")
+        lines.extend(f"{PREFIX}{name}{suffix}{labels} {_number(value)}" for suffix, labels, value in samples)
+    return '\n'.join(lines) + '\n'
+
+
+def _rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram('stage_seconds', 'Time spent in each stage of the pipeline', ['stage'])
+PACKETS = REGISTRY.counter('packets', 'Packets analysed')
+BYTES = REGISTRY.counter('bytes', 'Bytes of the packets analysed')
+INCIDENTS = REGISTRY.counter('incidents', 'Incidents detected, by type', ['type'])
+REGISTRY.gauge('resident_memory_bytes', 'Resident set size of the process', function=_rss_bytes)
+REGISTRY.gauge('peak_resident_memory_bytes', 'Largest resident set size of the process', function=_peak_rss_bytes)
+REGISTRY.gauge('threads', 'Live threads in the process', function=threading.active_count)
+REGISTRY.builtin.update(REGISTRY.metrics)
+
+
+def stage(name):
+    # Context manager timing one run of a pipeline stage
+    return STAGE_SECONDS.labels(name).time()
+
+
+class SamplingProfiler:
+    # Samples the Python stacks of every other thread of the process each
+    # `interval` seconds and counts them in the collapsed format read by
+    # flamegraph.pl and speedscope ("outer;inner;leaf count" lines). Nothing
+    # runs until it is started.
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = _Tally()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return self
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread, frame in sys._current_frames().items():
+                if thread == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    name = names.get(code)
+                    if name is None:
+                        name = names[code] = f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+                    stack.append(name)
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def profile(self, seconds):
+        # Samples for `seconds` and returns the collapsed stacks
+        self.start()
+        try:
+            time.sleep(min(seconds, MAX_PROFILE_SECONDS))
+        finally:
+            self.stop()
+        return self.collapsed()
@@ -0,0 +1,110 @@
+import math
+import numpy as np
+
+
+def _clz32(values):
+    # Leading zeros of uint32 values; float64 holds them exactly
+    _, exponent = np.frexp(values.astype(np.float64))
+    return 32 - exponent
+
+
+def leading_zeros64(values):
+    high = (values >> np.uint64(32)).astype(np.uint32)
+    low = (values & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+    return np.where(high != 0, _clz32(high), 32 + _clz32(low))
+
+
+class HyperLogLog:
+    # Distinct-count sketch over 64-bit hashes. `registers` may be a row of a
+    # larger bank so many sketches can be merged with one NumPy reduction.
+    def __init__(self, precision=12, registers=None):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = np.zeros(self.size, dtype=np.uint8) if registers is None else registers
+
+    def add_hashes(self, hashes):
+        if not len(hashes):
+            return
+        shift = np.uint64(self.precision)
+        index = (hashes >> (np.uint64(64) - shift)).astype(np.intp)
+        rank = np.minimum(leading_zeros64(hashes << shift) + 1, 64 - self.precision + 1)
+        np.maximum.at(self.registers, index, rank.astype(np.uint8))
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def count(self):
+        return self.estimate(self.registers)
+
+    @staticmethod
+    def estimate(registers):
+        size = registers.shape[-1]
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / np.sum(np.ldexp(1.0, -registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(registers == 0))
+        if estimate <= 2.5 * size and zeros:
+            # Linear counting is more accurate for small cardinalities
+            estimate = size * math.log(size / zeros)
+        return int(round(estimate))
+
+
+class SpaceSaving:
+    # Heavy-hitter summary keeping at most `capacity` weighted keys. Counts may
+    # overestimate by at most `error`, which grows with the weight of evicted keys.
+    def __init__(self, capacity=64, key_dtype='V16'):
+        self.capacity = capacity
+        self.keys = np.empty(0, dtype=key_dtype)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.error = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def update(self, keys, weights=None):
+        if not len(keys):
+            return
+        if weights is None:
+            weights = np.ones(len(keys), dtype=np.int64)
+        keys, inverse = np.unique(keys, return_inverse=True)
+        weights = np.bincount(inverse.ravel(), weights=weights, minlength=len(keys)).astype(np.int64)
+        # New keys take over the count of the smallest entry once the summary is full
+        floor = int(self.counts.min()) if len(self.counts) >= self.capacity else 0
+        if floor:
+            weights = weights + np.where(np.isin(keys, self.keys), 0, floor)
+            self.error = max(self.error, floor)
+        self._combine([self.keys, keys], [self.counts, weights])
+
+    def _combine(self, keys, counts):
+        keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+        counts = np.bincount(inverse.ravel(), weights=np.concatenate(counts), minlength=len(keys)).astype(np.int64)
+        self._keep(keys, counts)
+
+    def _keep(self, keys, counts):
+        if len(keys) > self.capacity:
+            keep = np.argpartition(counts, -self.capacity)[-self.capacity:]
+            self.error = max(self.error, int(np.delete(counts, keep).max()))
+            keys, counts = keys[keep], counts[keep]
+        self.keys, self.counts = keys, counts
+
+    @classmethod
+    def merged(cls, summaries, capacity=None):
+        summaries = [s for s in summaries if s is not None and len(s)]
+        result = cls(capacity or (summaries[0].capacity if summaries else 64))
+        if summaries:
+            # A full summary may have seen a key it lacks as often as its
+            # smallest count, so every key also gets the floors of the full
+            # summaries that do not hold it, to keep counts upper bounds
+            sizes = [len(s) for s in summaries]
+            floors = np.array([int(s.counts.min()) if len(s) >= s.capacity else 0 for s in summaries],
+                              dtype=np.int64)
+            keys, inverse = np.unique(np.concatenate([s.keys for s in summaries]), return_inverse=True)
+            inverse = inverse.ravel()
+            counts = np.bincount(inverse, weights=np.concatenate([s.counts for s in summaries]), minlength=len(keys))
+            held = np.bincount(inverse, weights=np.repeat(floors, sizes), minlength=len(keys))
+            result.error = sum(max(s.error, floor) if floor else s.error for s, floor in zip(summaries, floors.tolist()))
+            result._keep(keys, (counts - held).astype(np.int64) + int(floors.sum()))
+        return result
+
+    def top(self, n=None):
+        order = np.argsort(self.counts, kind='stable')[::-1][:n]
+        return self.keys[order], self.counts[order]
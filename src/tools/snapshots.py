@@ -0,0 +1,79 @@
+import json
+import time
+import struct
+from multiprocessing import shared_memory, resource_tracker
+
+SNAPSHOT_BYTES = 4 * 1024 * 1024  # shared memory reserved for one snapshot
+READ_RETRIES = 100
+
+_HEADER = struct.Struct('<QQd')  # sequence, payload length, publish time
+_SEQUENCE = struct.Struct('<Q')
+_PAYLOAD = struct.Struct('<Qd')  # payload length, publish time, after the sequence
+
+
+class SnapshotChannel:
+    # Latest-value channel in shared memory: one process publishes JSON
+    # snapshots and any number of processes read the newest one. The sequence
+    # number is odd while a write is in progress (a seqlock), so readers never
+    # take a lock; they retry a read that overlapped a write.
+    def __init__(self, name, size=SNAPSHOT_BYTES, create=False):
+        self.name = name
+        if create:
+            try:
+                self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+            except FileExistsError:
+                # Left behind by a writer that did not exit cleanly
+                self.shm = shared_memory.SharedMemory(name)
+        else:
+            # FileNotFoundError until a writer has created the channel
+            self.shm = shared_memory.SharedMemory(name)
+        # The writer unlinks the segment itself (close) and readers must not.
+        # The writer may share the readers' resource tracker (a spawned
+        # process does), so it is kept out of the tracker on both sides.
+        resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.size = self.shm.size
+        self._sequence = self._header()[0] & ~1
+
+    def _header(self):
+        return _HEADER.unpack_from(self.shm.buf, 0)
+
+    def publish(self, snapshot):
+        payload = json.dumps(snapshot, separators=(',', ':')).encode()
+        if len(payload) > self.size - _HEADER.size:
+            raise ValueError(f"Snapshot of {len(payload)} bytes does not fit in {self.size} bytes")
+        buf = self.shm.buf
+        # The sequence goes odd before anything else changes and even again
+        # only after everything else is written
+        self._sequence += 1
+        _SEQUENCE.pack_into(buf, 0, self._sequence)
+        buf[_HEADER.size:_HEADER.size + len(payload)] = payload
+        _PAYLOAD.pack_into(buf, _SEQUENCE.size, len(payload), time.time())
+        self._sequence += 1
+        _SEQUENCE.pack_into(buf, 0, self._sequence)
+        return self._sequence
+
+    def sequence(self):
+        # Changes with every publish; 0 until the first one
+        return _SEQUENCE.unpack_from(self.shm.buf, 0)[0]
+
+    def read(self):
+        # (sequence, publish time, snapshot), or None before the first publish
+        buf = self.shm.buf
+        for _ in range(READ_RETRIES):
+            sequence, length, published = self._header()
+            if sequence & 1:
+                time.sleep(0.001)
+                continue
+            if sequence == 0:
+                return None
+            payload = bytes(buf[_HEADER.size:_HEADER.size + length])
+            if self.sequence() == sequence:
+                return sequence, published, json.loads(payload)
+        raise TimeoutError(f"Snapshot channel {self.name} kept changing while being read")
+
+    def close(self, unlink=False):
+        self.shm.close()
+        if unlink:
+            # unlink() unregisters the segment again
+            resource_tracker.register(self.shm._name, 'shared_memory')
+            self.shm.unlink()
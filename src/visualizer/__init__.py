@@ -1,7 +1,3 @@
-import pandas as pd
-import matplotlib.pyplot as plt
-import plotly.express as px
-import plotly.graph_objects as go
 from datetime import datetime
 
 class DataVisualizer:
@@ -13,14 +9,14 @@ class DataVisualizer:
     def create_visualization(self, traffic_data, incidents):
         self.traffic_data = traffic_data
         self.incidents = incidents
-        self.df = pd.DataFrame(traffic_data)
+        self.df = traffic_data.to_frame()
         
     def generate_report(self):
-        if not self.traffic_data:
+        if self.traffic_data is None or not len(self.traffic_data):
             return "No data to generate report"
             
         # Basic statistics
-        stats = self.traffic_data[0]['stats']
+        stats = self.traffic_data.stats
         
         report = f"""
 Network Traffic Analysis Report
@@ -43,7 +39,7 @@ Protocol Distribution:
             
         report += "\nSecurity Incidents:\n------------------\n"
         if self.incidents:
-            for incident in self.incidents:
+            for incident in self.incidents.to_records():
                 report += f"- {incident['severity']} - {incident['type']}: {incident['details']}\n"
         else:
             report += "No security incidents detected.\n"
@@ -51,10 +47,13 @@ Protocol Distribution:
         return report
     
     def create_graphs(self):
+        # Imported here: matplotlib and plotly.express take longer to import
+        # than the rest of the app, and only these report files use them
+        import matplotlib.pyplot as plt
+        import plotly.express as px
         if not self.df.empty:
             # 1. Traffic Volume Over Time
             plt.figure(figsize=(12, 6))
-            self.df['timestamp'] = pd.to_datetime(self.df['timestamp'])
             traffic_over_time = self.df.groupby(self.df['timestamp'].dt.minute)['length'].sum()
             plt.plot(traffic_over_time.index, traffic_over_time.values)
             plt.title('Network Traffic Volume Over Time')
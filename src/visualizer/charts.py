@@ -0,0 +1,66 @@
+import numpy as np
+import plotly.graph_objects as go
+
+POINT_BUDGET = 500  # most points drawn for one time series
+
+_LAYOUT = {'plot_bgcolor': 'white', 'paper_bgcolor': 'white'}
+
+
+def lttb(x, y, points):
+    # Largest-Triangle-Three-Buckets downsampling: indices of `points` samples
+    # that keep the visual shape of the series, spikes included
+    n = len(x)
+    if points >= n or points < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # First and last points are kept; the rest is split into equal buckets
+    edges = np.linspace(1, n - 1, points - 1).astype(np.int64)
+    selected = np.empty(points, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    previous = 0
+    for i in range(points - 2):
+        start, end = edges[i], edges[i + 1]
+        # The third corner is the average of the next bucket
+        if i + 2 < len(edges):
+            next_x = x[end:edges[i + 2]].mean()
+            next_y = y[end:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        bucket_x = x[start:end]
+        bucket_y = y[start:end]
+        area = np.abs((x[previous] - next_x) * (bucket_y - y[previous]) -
+                      (x[previous] - bucket_x) * (next_y - y[previous]))
+        previous = start + int(np.argmax(area))
+        selected[i + 1] = previous
+    return selected
+
+
+def chart_times(seconds):
+    # Epoch seconds as the ISO strings used on time axes, so points pushed to
+    # a figure later compare and sort like the ones it was drawn with
+    times = np.asarray(seconds, dtype=np.int64).astype('datetime64[s]')
+    return np.datetime_as_string(times, unit='s').tolist()
+
+
+def traffic_volume_figure(seconds, byte_counts, points=POINT_BUDGET):
+    # Bytes per second from pre-binned counts, downsampled to the point budget
+    keep = lttb(seconds, byte_counts, points)
+    fig = go.Figure(go.Scatter(x=chart_times(np.asarray(seconds)[keep]), y=np.asarray(byte_counts)[keep].tolist(),
+                               mode='lines', name='Bytes'))
+    fig.update_layout(title='Network Traffic Volume', xaxis_title='Time', yaxis_title='Bytes per second',
+                      **_LAYOUT)
+    return fig
+
+
+def protocol_figure(protocol_counts):
+    fig = go.Figure(go.Pie(labels=list(protocol_counts), values=list(protocol_counts.values()), hole=0.3))
+    fig.update_layout(title='Protocol Distribution', **_LAYOUT)
+    return fig
+
+
+def port_figure(ports, counts, title):
+    fig = go.Figure(go.Bar(x=[str(p) for p in ports], y=counts))
+    fig.update_layout(title=title, xaxis_title='Port', yaxis_title='Flows', **_LAYOUT)
+    return fig
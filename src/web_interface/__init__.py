@@ -1,14 +1,142 @@
 import os
 import dash
 from dash import html, dcc, callback_context
-from dash.dependencies import Input, Output, State
-import plotly.express as px
-import plotly.graph_objects as go
-import pandas as pd
+from dash.dependencies import Input, Output, State, ClientsideFunction
+import numpy as np
 import base64
 import io
+import tempfile
+import uuid
 from datetime import datetime
 import json
+import time
+import hashlib
+import re
+import shutil
+import threading
+from flask import request, jsonify, Response, stream_with_context, send_file
+from analyzer.live import LiveFeed, CHART_WINDOW
+from tools.jobs import JobStore, JobQueue
+from detector import IncidentSink, JsonLinesSink, SQLiteSink, SyslogSink, ConsoleSink
+from tools.cache import TTLCache
+from tools.metrics import REGISTRY, SamplingProfiler, render as render_metrics_text, stage
+from visualizer.charts import traffic_volume_figure, protocol_figure, port_figure, chart_times
+from storage import TrafficStore, TABLES, to_ns
+
+UPLOAD_DECODE_CHUNK = 4 * 1024 * 1024  # base64 characters, multiple of 4
+UPLOAD_STREAM_CHUNK = 1024 * 1024  # bytes read at a time from a streamed upload
+UPLOAD_DIR = os.getenv('UPLOAD_DIR', os.path.join(tempfile.gettempdir(), 'network-forensics'))
+STORE_DIR = os.getenv('STORE_DIR', os.path.join(UPLOAD_DIR, 'store'))
+# Days history is kept after it was stored, live or from uploads, and uploaded
+# captures with their jobs after they finished; 0 keeps it all
+STORE_RETENTION = float(os.getenv('STORE_RETENTION_DAYS', 7)) * 86400
+LIVE_FLUSH_INTERVAL = 30  # seconds live history is buffered before it is written, and lost if the producer dies
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+RESULT_INCIDENTS = 500  # incidents kept in a job result
+RESULT_NAMES = 10  # top HTTP hosts, TLS server names and DNS names kept in a job result
+EVIDENCE_LINKS = 10  # incidents of a finished job listed with a link to their packets
+HISTORY_ROWS = 100  # rows shown for a history query
+HISTORY_API_ROWS = 10000  # most rows returned by /api/history
+REFRESH_INTERVAL = 1  # seconds between live traffic snapshots
+RESYNC_INTERVAL = 300  # seconds between full dashboard redraws; pushed updates fill the gaps
+STREAM_DURATION = 300  # seconds an update stream stays open before the browser reconnects
+STREAM_HEARTBEAT = 15  # seconds between keep-alive comments on an idle stream
+STREAM_RETRY = 1000  # milliseconds the browser waits before reconnecting
+# Update streams a worker serves at once. Each holds one of gunicorn's threads
+# (GUNICORN_THREADS, 16 by default), so this stays below that and leaves the
+# rest to Dash callbacks; dashboards over the limit redraw every 30 seconds.
+LIVE_STREAMS = int(os.getenv('LIVE_STREAMS', 8))
+FIGURE_TTL = 60  # seconds a rendered figure stays cached
+# Where live incidents are logged: a rotated JSON-lines file, plus optionally
+# an SQLite database and the local syslog socket (e.g. /dev/log)
+INCIDENT_LOG = os.getenv('INCIDENT_LOG', 'security_incidents.log')
+INCIDENT_DB = os.getenv('INCIDENT_DB')
+INCIDENT_SYSLOG = os.getenv('INCIDENT_SYSLOG')
+INCIDENT_CONSOLE_RATE = int(os.getenv('INCIDENT_CONSOLE_RATE', 5))  # incidents printed per second
+# IP/CIDR watchlist files, separated like PATH entries
+WATCHLISTS = [path for path in os.getenv('WATCHLISTS', '').split(os.pathsep) if path]
+# Directory of trained anomaly models, which turns anomaly scoring on. Uploads
+# and the live capture train them; generated live traffic only is scored.
+ANOMALY_MODELS = os.getenv('ANOMALY_MODELS')
+# Network interface the live traffic is captured from (needs CAP_NET_RAW) and
+# an optional filter expression; without one the live tab shows generated traffic
+CAPTURE_INTERFACE = os.getenv('CAPTURE_INTERFACE')
+CAPTURE_FILTER = os.getenv('CAPTURE_FILTER')
+# Serves /debug/profile, which samples the worker's Python stacks on request
+PROFILING = os.getenv('PROFILING', '').lower() in ('1', 'true', 'yes')
+PROFILE_SECONDS = 10  # default length of a /debug/profile capture
+# Shared memory segment for the live snapshots, one per upload directory
+LIVE_SEGMENT = os.getenv('LIVE_SEGMENT', 'network-forensics-' + hashlib.sha1(UPLOAD_DIR.encode()).hexdigest()[:12])
+
+# What upload_path names a saved upload, and its evidence index after it
+_UPLOAD_NAME = re.compile(r'^[0-9a-f]{32}-')
+
+def _job_result(job, result):
+    from analyzer.evidence import incident_scopes
+    job.progress(result.bytes_read, result.packets_read, force=True)
+    incidents = result.incidents.to_records()
+    # What /api/jobs/<id>/evidence carves for each incident kept
+    for record, scope in zip(incidents, incident_scopes(result.incidents[:RESULT_INCIDENTS])):
+        record['evidence'] = scope
+    return {
+        'stats': result.summary.stats(),
+        'bytes': result.summary.bytes,
+        'flows': len(result.flows),
+        'packets_skipped': result.packets_skipped,
+        'bytes_trailing': result.bytes_trailing,
+        'incident_count': len(incidents),
+        'incidents': incidents[:RESULT_INCIDENTS],
+        'app': result.app.top(RESULT_NAMES)
+    }
+
+def evidence_index(path):
+    # Where the packet index of an uploaded capture is kept, next to it
+    return path + '.index'
+
+def analyze_upload(job, path, detector_class, thresholds, window, store_root=None, index_root=None):
+    # Analysis job for an uploaded capture, run in a job worker process
+    from analyzer.parallel import analyze_capture, new_detector
+    result = analyze_capture(path, workers=1, chunks=1, detector=new_detector(detector_class, thresholds, window),
+                             store_root=store_root, app_layer=True, progress=job.progress, index_root=index_root)
+    _expire_history(store_root)
+    _expire_uploads(job, os.path.dirname(path))
+    return _job_result(job, result)
+
+def _expire_history(store_root):
+    # Upload jobs add to the history too, so they drop what has expired
+    if store_root:
+        TrafficStore(store_root, retention=STORE_RETENTION).expire()
+
+def _expire_uploads(job, upload_dir):
+    # Uploads, their packet indexes and their jobs are kept as long as the history
+    if not STORE_RETENTION:
+        return
+    before = time.time() - STORE_RETENTION
+    job.store.expire(before)
+    for name in os.listdir(upload_dir):
+        path = os.path.join(upload_dir, name)
+        try:
+            if not _UPLOAD_NAME.match(name) or os.path.getmtime(path) >= before:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            # Another job worker got to it first
+            pass
+
+def analyze_uploads(job, paths, detector_class, thresholds, window, store_root=None, offsets='auto',
+                    index_root=None):
+    # Analysis job for captures of the same traffic uploaded together, e.g.
+    # from several taps: one time-merged timeline without the packets seen twice
+    from analyzer.parallel import analyze_captures, new_detector
+    result = analyze_captures(paths, detector=new_detector(detector_class, thresholds, window), offsets=offsets,
+                              store_root=store_root, app_layer=True, progress=job.progress, index_root=index_root)
+    _expire_history(store_root)
+    _expire_uploads(job, os.path.dirname(paths[0]))
+    return dict(_job_result(job, result), captures=len(paths), packets_duplicate=result.packets_duplicate,
+                offsets=result.offsets)
 
 class WebInterface:
     def __init__(self, traffic_analyzer, incident_detector, data_visualizer):
@@ -20,6 +148,34 @@ class WebInterface:
         self.traffic_analyzer = traffic_analyzer
         self.incident_detector = incident_detector
         self.data_visualizer = data_visualizer
+        self.upload_dir = UPLOAD_DIR
+        os.makedirs(self.upload_dir, exist_ok=True)
+        self.jobs = JobQueue(JobStore(os.path.join(self.upload_dir, 'jobs.sqlite3')), JOB_WORKERS)
+        self.jobs.store.recover()
+        self.store = TrafficStore(STORE_DIR, retention=STORE_RETENTION, flush_interval=LIVE_FLUSH_INTERVAL)
+        if self.traffic_analyzer.store is None:
+            self.traffic_analyzer.store = self.store
+        if CAPTURE_INTERFACE and self.traffic_analyzer.interface is None:
+            self.traffic_analyzer.interface = CAPTURE_INTERFACE
+            self.traffic_analyzer.capture_filter = CAPTURE_FILTER
+        if WATCHLISTS:
+            self.incident_detector.thresholds['watchlists'] = WATCHLISTS
+        if ANOMALY_MODELS and not self.incident_detector.thresholds.get('anomaly_models'):
+            self.incident_detector.thresholds['anomaly_models'] = ANOMALY_MODELS
+        if self.incident_detector.sink is None:
+            self.incident_detector.sink = self.incident_sink()
+        self.figures = TTLCache(max_entries=64, ttl=FIGURE_TTL)
+        # Live traffic comes from one producer process shared by all workers
+        self.live = LiveFeed(traffic_analyzer, incident_detector, LIVE_SEGMENT,
+                             os.path.join(self.upload_dir, 'live.lock'), REFRESH_INTERVAL)
+        self.streams = REGISTRY.gauge('live_streams', 'Open live update streams')
+        self.streams.set(0)
+        self.stream_slots = threading.BoundedSemaphore(LIVE_STREAMS)
+        self.streams_refused = REGISTRY.counter('live_streams_refused',
+                                                'Live update streams refused because the worker had no slot left')
+        REGISTRY.counter('figure_cache_lookups', 'Dashboard figure cache lookups, by result', ['result'],
+                         function=lambda: {'hit': self.figures.hits, 'miss': self.figures.misses})
+        REGISTRY.gauge('jobs', 'Capture analysis jobs, by status', ['status'], function=self.jobs.store.counts)
         
         # Styling
         self.navbar_style = {
@@ -80,10 +236,15 @@ class WebInterface:
                         multiple=True
                     ),
                     html.Div(id='upload-output'),
+                    dcc.Store(id='upload-jobs', data=[]),
+                    dcc.Interval(id='job-interval', interval=1000, disabled=True),
                 ]),
                 
-                # Interval for real-time updates
-                dcc.Interval(id='interval-component', interval=5000, n_intervals=0),
+                # Live updates are pushed over /api/live/stream and applied in the
+                # browser; the interval only triggers an occasional full redraw
+                dcc.Interval(id='interval-component', interval=RESYNC_INTERVAL * 1000, n_intervals=0),
+                dcc.Interval(id='live-drain', interval=250),
+                dcc.Store(id='live-resync', data=0),
                 
                 # Tabs for different views
                 dcc.Tabs(id='tabs', value='live-tab', children=[
@@ -126,6 +287,23 @@ class WebInterface:
                 html.Div(style=self.card_style, children=[
                     html.H3("Security Incidents"),
                     html.Div(id='incidents-table')
+                ]),
+                
+                # Historical data review
+                html.Div(style=self.card_style, children=[
+                    html.H3("Traffic History"),
+                    html.Div(style={'display': 'flex', 'flexWrap': 'wrap', 'gap': '0.5rem'}, children=[
+                        dcc.Dropdown(id='history-table', options=[{'label': t.title(), 'value': t} for t in TABLES],
+                                     value='packets', clearable=False, style={'width': '150px'}),
+                        dcc.Input(id='history-start', type='text', placeholder='From (e.g. 2024-05-14 14:00)'),
+                        dcc.Input(id='history-end', type='text', placeholder='To (e.g. 2024-05-14 14:05)'),
+                        dcc.Input(id='history-host', type='text', placeholder='Host IP'),
+                        dcc.Input(id='history-port', type='number', placeholder='Port'),
+                        dcc.Input(id='history-filter', type='text', debounce=True, style={'flex': '1', 'minWidth': '300px'},
+                                  placeholder='Filter (e.g. src net 10.0.0.0/8 and dst port 443 and len > 1000)'),
+                        html.Button('Search', id='history-search', n_clicks=0, style=self.button_style)
+                    ]),
+                    html.Div(id='history-output', style={'marginTop': '1rem'})
                 ])
             ])
         ], style={
@@ -134,35 +312,462 @@ class WebInterface:
             'minHeight': '100vh'
         })
         
+        self.setup_routes()
         self.setup_callbacks()
     
+    def incident_sink(self):
+        sinks = [JsonLinesSink(INCIDENT_LOG)]
+        if INCIDENT_DB:
+            sinks.append(SQLiteSink(INCIDENT_DB))
+        if INCIDENT_SYSLOG:
+            sinks.append(SyslogSink(INCIDENT_SYSLOG))
+        if INCIDENT_CONSOLE_RATE:
+            sinks.append(ConsoleSink(INCIDENT_CONSOLE_RATE))
+        return IncidentSink(sinks)
+
+    def upload_path(self, filename):
+        return os.path.join(self.upload_dir, f"{uuid.uuid4().hex}-{os.path.basename(filename)}")
+
+    def submit_capture(self, path, filename):
+        # Queue the analysis of a capture already on disk and return the job id
+        detector = self.incident_detector
+        return self.jobs.submit('analyze', analyze_upload, path, type(detector), detector.thresholds,
+                                detector.window, self.store.root, evidence_index(path), filename=filename, path=path)
+
+    def submit_captures(self, paths, filenames, offsets='auto'):
+        # Queue the merged analysis of several captures of the same traffic
+        if len(paths) == 1:
+            return self.submit_capture(paths[0], filenames[0])
+        detector = self.incident_detector
+        return self.jobs.submit('analyze', analyze_uploads, paths, type(detector), detector.thresholds,
+                                detector.window, self.store.root, offsets, evidence_index(paths[0]),
+                                filename=' + '.join(filenames),
+                                path=paths[0], size=sum(os.path.getsize(path) for path in paths))
+
+    def save_upload(self, contents, filename):
+        # Writes a base64 data URL from the upload component to disk
+        content_type, content_string = contents.split(',', 1)
+        path = self.upload_path(filename)
+        with open(path, 'wb') as capture:
+            # Decode in slices so the capture is never held twice in memory
+            for start in range(0, len(content_string), UPLOAD_DECODE_CHUNK):
+                capture.write(base64.b64decode(content_string[start:start + UPLOAD_DECODE_CHUNK]))
+        return path
+
     def parse_pcap_contents(self, contents, filename):
-        content_type, content_string = contents.split(',')
-        decoded = base64.b64decode(content_string)
+        # Writes an upload to disk and queues its analysis; returns the job id,
+        # or a message for files that are not analysed
         try:
             if 'pcap' in filename:
-                # Process PCAP file
-                return f"Processing PCAP file: {filename}"
+                return {'job': self.submit_capture(self.save_upload(contents, filename), filename)}
             elif 'log' in filename:
                 # Process log file
-                return f"Processing log file: {filename}"
+                return {'message': f"Processing log file: {filename}"}
         except Exception as e:
-            return f"Error processing file: {str(e)}"
-    
+            return {'message': f"Error processing file: {str(e)}"}
+        return {'message': f"Unsupported file type: {filename}"}
+
+    def parse_pcap_group(self, list_of_contents, list_of_names):
+        # Captures uploaded together are taken to be of the same traffic and
+        # analysed as one merged timeline
+        try:
+            paths = [self.save_upload(contents, name) for contents, name in zip(list_of_contents, list_of_names)]
+            return {'job': self.submit_captures(paths, list_of_names)}
+        except Exception as e:
+            return {'message': f"Error processing files: {str(e)}"}
+
+    def describe_job(self, job):
+        if job['status'] == 'failed':
+            return f"Failed: {job['error']}"
+        if job['status'] == 'queued':
+            return "Queued"
+        if job['status'] == 'running':
+            percent = 100 * job['bytes_done'] / job['size'] if job['size'] else 0
+            eta = f", about {job['eta']:.0f}s left" if job['eta'] is not None else ''
+            return (f"Analyzing: {job['packets']} packets, {percent:.0f}% at "
+                    f"{job['rate'] / 1e6:.1f} MB/s{eta}")
+        result = job['result']
+        stats = result['stats']
+        breakdown = ', '.join(f"{protocol}: {count}" for protocol, count in sorted(stats['protocols'].items()))
+        names = ''
+        app = result.get('app')  # missing from jobs finished before payloads were decoded
+        if app:
+            top = [f"{title} {app[field][0][0]}" for field, title in
+                   (('http_hosts', 'HTTP host'), ('tls_sni', 'TLS server'), ('dns_queries', 'DNS name'))
+                   if app[field]]
+            names = f"; top {', '.join(top)}" if top else ''
+        merged = ''
+        if result.get('captures'):
+            skew = max(abs(offset) for offset in result['offsets'])
+            merged = (f"; merged {result['captures']} captures, {result['packets_duplicate']} duplicate packets"
+                      f" dropped, clocks up to {skew * 1000:.1f} ms apart")
+        truncated = ''
+        if result.get('bytes_trailing'):
+            truncated = f"; the last {result['bytes_trailing']} bytes are not a whole record and were not read"
+        return (f"Parsed {stats['total_packets']} packets ({result['bytes']} bytes) in {result['flows']} flows"
+                f" from {job['filename']} [{breakdown}], {result['incident_count']} incidents detected"
+                f" in {job['elapsed']:.1f}s{names}{merged}{truncated}")
+
+    def evidence_links(self, job):
+        # Downloads of the packets behind the first incidents of a finished
+        # job, and an export of any filtered slice of its capture
+        url = f"/api/jobs/{job['id']}/evidence"
+        link_style = dict(self.button_style, textDecoration='none', padding='0.2rem 0.6rem', marginLeft='0.5rem')
+        incidents = [(number, incident) for number, incident in enumerate(job['result']['incidents'])
+                     if 'evidence' in incident][:EVIDENCE_LINKS]  # jobs finished before evidence was indexed have none
+        if not incidents:
+            return []
+        return [
+            html.Ul([html.Li([
+                f"{incident['severity']} {incident['type']} {incident.get('src', '')}"
+                f"{' → ' + incident['dst'] if incident.get('dst') else ''} at {incident['timestamp']}",
+                html.A('Packets', href=f"{url}?incident={number}", style=link_style)
+            ]) for number, incident in incidents]),
+            html.Form(action=url, method='GET', style={'display': 'flex', 'flexWrap': 'wrap', 'gap': '0.5rem'},
+                      children=[
+                          dcc.Input(name='start', type='text', placeholder='From (e.g. 2024-05-14 14:00)'),
+                          dcc.Input(name='end', type='text', placeholder='To (e.g. 2024-05-14 14:05)'),
+                          dcc.Input(name='filter', type='text', style={'flex': '1', 'minWidth': '300px'},
+                                    placeholder='Filter (e.g. host 10.0.0.5 and tcp and port 22)'),
+                          html.Button('Export pcap', type='submit', style=self.button_style)
+                      ])
+        ]
+
+    def query_history(self, table, start=None, end=None, host=None, port=None, where=None, limit=None):
+        # Empty strings from the form mean no filter; times are UTC. `where` is
+        # a filter expression, compiled once per distinct text.
+        start = start.strip().replace(' ', 'T') if start else None
+        end = end.strip().replace(' ', 'T') if end else None
+        return self.store.query(table, start=start, end=end, host=host or None,
+                                port=port if port not in (None, '') else None,
+                                where=where.strip() if where and where.strip() else None, limit=limit)
+
+    @staticmethod
+    def evidence_time(value):
+        # Epoch nanoseconds from digits, else an ISO time (UTC)
+        value = (value or '').strip()
+        if not value:
+            return None
+        return int(value) if value.isdigit() else to_ns(value.replace(' ', 'T'))
+
+    def render_metrics(self, snapshot):
+        with stage('render_metrics'):
+            return self._render_metrics(snapshot)
+
+    def _render_metrics(self, snapshot):
+        # Stats
+        stats = snapshot['stats']
+        stats_div = html.Div([
+            html.Div([
+                html.H4("Total Packets"),
+                html.P(stats['total_packets'])
+            ], style={'textAlign': 'center', 'padding': '1rem'}),
+            html.Div([
+                html.H4("Unique Sources"),
+                html.P(stats['unique_sources'])
+            ], style={'textAlign': 'center', 'padding': '1rem'}),
+            html.Div([
+                html.H4("Unique Destinations"),
+                html.P(stats['unique_destinations'])
+            ], style={'textAlign': 'center', 'padding': '1rem'}),
+            html.Div([
+                html.H4("Avg Packet Size"),
+                html.P(f"{stats['avg_packet_size']:.2f} bytes")
+            ], style={'textAlign': 'center', 'padding': '1rem'})
+        ], style={'display': 'grid', 'gridTemplateColumns': 'repeat(auto-fit, minmax(200px, 1fr))', 'gap': '1rem'})
+        
+        # Traffic volume from the per-second byte counts, not raw packets
+        byte_counts = np.asarray(snapshot['volume']['bytes'], dtype=np.int64)
+        seconds = snapshot['volume']['start'] + np.arange(len(byte_counts))
+        traffic_fig = traffic_volume_figure(seconds, byte_counts)
+        
+        # Protocol distribution over the statistics window
+        protocol_fig = protocol_figure(stats['protocols'])
+        
+        # HTTP Analysis, over flows rather than individual packets
+        http = snapshot['http']
+        if http['flows'] > 0:
+            http_analysis = html.Div([
+                html.H4("HTTP/HTTPS Traffic"),
+                html.P(f"Active HTTP(S) Flows: {http['flows']}"),
+                html.P(f"Total HTTP(S) Packets: {http['packets']}"),
+                html.P(f"Average Size: {http['bytes'] / http['packets']:.2f} bytes"),
+                dcc.Graph(figure=port_figure(http['ports'], http['counts'], 'HTTP(S) Flows by Port'))
+            ])
+        else:
+            http_analysis = html.P("No HTTP/HTTPS traffic detected")
+        
+        # Incidents Table, with the incidents of earlier snapshots too
+        incidents = snapshot['recent_incidents']
+        if incidents:
+            incidents_div = html.Table([
+                html.Thead(html.Tr([
+                    html.Th(col, style={'padding': '0.5rem', 'backgroundColor': '#f8f9fa'})
+                    for col in ['Time', 'Severity', 'Type', 'Details']
+                ])),
+                html.Tbody([
+                    html.Tr([
+                        html.Td(incident['timestamp'], style={'padding': '0.5rem'}),
+                        html.Td(html.Span(incident['severity'],
+                                        style={'color': 'white',
+                                              'backgroundColor': {'HIGH': '#dc3545',
+                                                                'MEDIUM': '#ffc107',
+                                                                'LOW': '#28a745'}[incident['severity']],
+                                              'padding': '0.25rem 0.5rem',
+                                              'borderRadius': '4px'})),
+                        html.Td(incident['type'], style={'padding': '0.5rem'}),
+                        html.Td(incident['details'], style={'padding': '0.5rem'})
+                    ]) for incident in incidents
+                ])
+            ], style={'width': '100%', 'borderCollapse': 'collapse'})
+        else:
+            incidents_div = html.P("No incidents detected", style={'color': '#28a745'})
+        
+        return stats_div, traffic_fig, protocol_fig, http_analysis, incidents_div
+
+    def live_delta(self, previous, snapshot):
+        # What changed between two consecutive snapshots: the new points of the
+        # volume chart, the counters, the protocol totals and the new incidents
+        stats = snapshot['stats']
+        delta = {
+            'stats': [stats['total_packets'], stats['unique_sources'], stats['unique_destinations'],
+                      f"{stats['avg_packet_size']:.2f} bytes"],
+            'incidents': snapshot['incidents']
+        }
+        volume = snapshot['volume']
+        shown = previous['volume']['start'] + len(previous['volume']['bytes'])
+        skip = max(shown - volume['start'], 0)
+        delta['volume'] = {
+            'x': chart_times(volume['start'] + np.arange(skip, len(volume['bytes']))),
+            'y': volume['bytes'][skip:]
+        }
+        if stats['protocols'] != previous['stats']['protocols']:
+            delta['protocols'] = {'labels': list(stats['protocols']), 'values': list(stats['protocols'].values())}
+        return delta
+
+    def live_events(self, last_event_id=None):
+        # Event stream for one browser. It only wakes up for new snapshots and
+        # ends after STREAM_DURATION; the browser reconnects with the id of the
+        # last event, and is told to redraw if it missed any snapshot.
+        sequence, previous = self.live.current()
+        yield f"retry: {STREAM_RETRY}\n\n"
+        if last_event_id is not None and last_event_id != str(sequence):
+            yield self._event('resync', sequence, {})
+        deadline = time.monotonic() + STREAM_DURATION
+        self.streams.inc()
+        try:
+            while time.monotonic() < deadline:
+                update = self.live.wait(sequence, min(STREAM_HEARTBEAT, deadline - time.monotonic()))
+                if update is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                sequence, snapshot = update
+                if previous is None:
+                    yield self._event('resync', sequence, {})
+                else:
+                    yield self._event('delta', sequence, self.live_delta(previous, snapshot))
+                previous = snapshot
+        finally:
+            self.streams.dec()
+
+    @staticmethod
+    def _event(name, sequence, data):
+        return f"id: {sequence}\nevent: {name}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+    def setup_routes(self):
+        server = self.app.server
+
+        @server.route('/api/jobs', methods=['POST'])
+        def create_job():
+            # Streams the request body (or multipart files) straight to disk,
+            # so large captures never pass through a Dash callback. Several
+            # files are analysed as one merged capture; `offsets` gives their
+            # clock offsets in seconds, comma-separated, or 'auto'.
+            uploads = request.files.getlist('file')
+            offsets = request.args.get('offsets', 'auto')
+            if offsets != 'auto':
+                try:
+                    offsets = [float(offset) for offset in offsets.split(',')]
+                except ValueError:
+                    return jsonify({'error': f"Invalid offsets: {offsets}"}), 400
+                if len(offsets) != max(len(uploads), 1):
+                    return jsonify({'error': 'Expected one offset per file'}), 400
+            if uploads:
+                filenames = [upload.filename for upload in uploads]
+                paths = [self.upload_path(filename) for filename in filenames]
+                for upload, path in zip(uploads, paths):
+                    upload.save(path)
+            else:
+                filenames = [request.args.get('filename', 'upload.pcap')]
+                paths = [self.upload_path(filenames[0])]
+                with open(paths[0], 'wb') as capture:
+                    while True:
+                        chunk = request.stream.read(UPLOAD_STREAM_CHUNK)
+                        if not chunk:
+                            break
+                        capture.write(chunk)
+            job_id = self.submit_captures(paths, filenames, offsets)
+            return jsonify({'id': job_id, 'url': f"/api/jobs/{job_id}"}), 202
+
+        @server.route('/api/jobs/<job_id>')
+        def get_job(job_id):
+            if not JobStore.valid_id(job_id):
+                return jsonify({'error': 'Invalid job id'}), 400
+            job = self.jobs.store.get(job_id)
+            if job is None:
+                return jsonify({'error': 'Unknown job'}), 404
+            return jsonify(job)
+
+        @server.route('/api/jobs/<job_id>/evidence')
+        def get_evidence(job_id):
+            # The packets behind an incident of a finished job as a capture
+            # file, e.g. /api/jobs/<id>/evidence?incident=3, or those of a time
+            # range, hosts and filter: ?start=2024-05-14T14:00&end=2024-05-14T14:01
+            # &host=10.0.0.5&peer=10.0.0.9&filter=tcp and port 22 (URL-encoded).
+            # Times are ISO (UTC) or epoch nanoseconds; `capture` picks one of
+            # several captures uploaded together by number.
+            if not JobStore.valid_id(job_id):
+                return jsonify({'error': 'Invalid job id'}), 400
+            job = self.jobs.store.get(job_id)
+            if job is None:
+                return jsonify({'error': 'Unknown job'}), 404
+            if job['status'] != 'done':
+                return jsonify({'error': 'The job has not finished'}), 409
+            from analyzer.evidence import CaptureIndex
+            index = CaptureIndex.open(evidence_index(job['path']))
+            if index is None:
+                return jsonify({'error': 'No packet index for this job'}), 404
+            args = request.args
+            name = 'evidence'
+            try:
+                if 'incident' in args:
+                    incidents = job['result']['incidents']
+                    number = args.get('incident', type=int)
+                    if number is None or not 0 <= number < len(incidents) or 'evidence' not in incidents[number]:
+                        return jsonify({'error': 'Unknown incident'}), 404
+                    scope = incidents[number]['evidence']
+                    name = f"incident-{number}"
+                else:
+                    scope = {'start': self.evidence_time(args.get('start')), 'end': self.evidence_time(args.get('end')),
+                             'host': args.get('host') or None, 'peer': args.get('peer') or None}
+                capture = args.get('capture', type=int)
+                where = args.get('filter', '').strip() or None
+                output = tempfile.TemporaryFile(dir=self.upload_dir)
+                try:
+                    count = index.carve(output, where=where, captures=None if capture is None else [capture], **scope)
+                except BaseException:
+                    output.close()
+                    raise
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            output.seek(0)
+            extension = os.path.splitext(index.captures[0])[1] or '.pcap'
+            response = send_file(output, mimetype='application/vnd.tcpdump.pcap', as_attachment=True,
+                                 download_name=f"{job_id}-{name}{extension}")
+            response.headers['X-Packet-Count'] = str(count)
+            return response
+
+        @server.route('/api/live/stream')
+        def live_stream():
+            # Server-sent events with what changed in each live snapshot. The
+            # slot is given back when the server closes the response, even if
+            # the stream never started.
+            if not self.stream_slots.acquire(blocking=False):
+                self.streams_refused.inc()
+                return Response('Too many live update streams\n', status=503, mimetype='text/plain',
+                                headers={'Retry-After': '30'})
+            try:
+                events = self.live_events(request.headers.get('Last-Event-ID'))
+                response = Response(stream_with_context(events), mimetype='text/event-stream',
+                                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+            except BaseException:
+                self.stream_slots.release()
+                raise
+            response.call_on_close(self.stream_slots.release)
+            return response
+
+        @server.route('/metrics')
+        def metrics():
+            # Prometheus scrape target: this worker's metrics and those the
+            # live producer published with its latest snapshot
+            snapshot = self.live.latest()
+            text = render_metrics_text((REGISTRY.collect(), {'process': 'web'}),
+                                       ((snapshot or {}).get('metrics', []), {'process': 'producer'}))
+            return Response(text, mimetype='text/plain; version=0.0.4')
+
+        @server.route('/debug/profile')
+        def profile():
+            # Collapsed stacks of this worker for flame graphs, e.g.
+            # curl ".../debug/profile?seconds=30" | flamegraph.pl > profile.svg
+            if not PROFILING:
+                return jsonify({'error': 'Profiling is disabled, set PROFILING=1'}), 404
+            seconds = request.args.get('seconds', PROFILE_SECONDS, type=float)
+            interval = request.args.get('interval', 0.01, type=float)
+            stacks = SamplingProfiler(max(interval, 0.001)).profile(seconds)
+            return Response(stacks, mimetype='text/plain')
+
+        @server.route('/api/history/<table>')
+        def get_history(table):
+            # e.g. /api/history/packets?start=2024-05-14T14:00&end=2024-05-14T14:05&host=10.0.0.5
+            # or ?filter=src net 10.0.0.0/8 and dst port 443 (URL-encoded)
+            if table not in TABLES:
+                return jsonify({'error': 'Unknown table'}), 404
+            args = request.args
+            # A limit that is not a number gets the default, as a bad port does
+            limit = min(max(args.get('limit', HISTORY_API_ROWS, type=int), 1), HISTORY_API_ROWS)
+            try:
+                rows = self.query_history(table, args.get('start'), args.get('end'), args.get('host'),
+                                          args.get('port', type=int), args.get('filter'), limit=limit)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            frame = rows.to_frame()
+            return frame.to_json(orient='records', date_format='iso'), 200, {'Content-Type': 'application/json'}
+
     def setup_callbacks(self):
         @self.app.callback(
-            Output('upload-output', 'children'),
+            Output('upload-jobs', 'data'),
             Input('upload-data', 'contents'),
-            State('upload-data', 'filename')
+            State('upload-data', 'filename'),
+            State('upload-jobs', 'data')
+        )
+        def update_output(list_of_contents, list_of_names, uploads):
+            # Only queues the analysis; progress is polled by update_jobs
+            if list_of_contents is None:
+                return dash.no_update
+            files = list(zip(list_of_contents, list_of_names))
+            pcaps = [(c, n) for c, n in files if 'pcap' in n]
+            jobs = []
+            if len(pcaps) > 1:
+                # Captures dropped together are merged into one analysis
+                names = [n for _, n in pcaps]
+                jobs.append(dict(self.parse_pcap_group([c for c, _ in pcaps], names), filename=' + '.join(names)))
+                files = [(c, n) for c, n in files if 'pcap' not in n]
+            jobs.extend(dict(self.parse_pcap_contents(c, n), filename=n) for c, n in files)
+            return jobs + (uploads or [])
+
+        @self.app.callback(
+            [Output('upload-output', 'children'),
+             Output('job-interval', 'disabled')],
+            [Input('job-interval', 'n_intervals'),
+             Input('upload-jobs', 'data')]
         )
-        def update_output(list_of_contents, list_of_names):
-            if list_of_contents is not None:
-                return [
-                    html.Div([
-                        html.H5(f"Processing {name}..."),
-                        html.P(self.parse_pcap_contents(c, n))
-                    ]) for c, n in zip(list_of_contents, list_of_names)
-                ]
+        def update_jobs(n, uploads):
+            if not uploads:
+                return None, True
+            items = []
+            pending = False
+            for upload in uploads:
+                job = self.jobs.store.get(upload['job']) if upload.get('job') else None
+                if job is None:
+                    text = upload.get('message', "Unknown job")
+                else:
+                    pending = pending or job['status'] in ('queued', 'running')
+                    text = self.describe_job(job)
+                items.append(html.Div([
+                    html.H5(f"Processing {upload['filename']}..."),
+                    html.P(text)
+                ] + (self.evidence_links(job) if job is not None and job['status'] == 'done' else [])))
+            return items, not pending
         
         @self.app.callback(
             [Output('stats-container', 'children'),
@@ -171,98 +776,72 @@ class WebInterface:
              Output('http-analysis', 'children'),
              Output('incidents-table', 'children')],
             [Input('interval-component', 'n_intervals'),
-             Input('tabs', 'value')]
+             Input('tabs', 'value'),
+             Input('live-resync', 'data')]
         )
-        def update_metrics(n, tab):
-            traffic_data = self.traffic_analyzer.analyze_traffic()
-            incidents = self.incident_detector.detect_incidents(traffic_data)
-            
-            if not traffic_data:
+        def update_metrics(n, tab, resync):
+            snapshot = self.live.latest()
+            if snapshot is None or not snapshot['packets']:
                 return html.Div("No data available"), {}, {}, html.Div("No HTTP data"), html.Div("No incidents")
-            
-            df = pd.DataFrame(traffic_data)
-            
-            # Stats
-            stats = traffic_data[0]['stats']
-            stats_div = html.Div([
-                html.Div([
-                    html.H4("Total Packets"),
-                    html.P(stats['total_packets'])
-                ], style={'textAlign': 'center', 'padding': '1rem'}),
-                html.Div([
-                    html.H4("Unique Sources"),
-                    html.P(stats['unique_sources'])
-                ], style={'textAlign': 'center', 'padding': '1rem'}),
-                html.Div([
-                    html.H4("Unique Destinations"),
-                    html.P(stats['unique_destinations'])
-                ], style={'textAlign': 'center', 'padding': '1rem'}),
-                html.Div([
-                    html.H4("Avg Packet Size"),
-                    html.P(f"{stats['avg_packet_size']:.2f} bytes")
-                ], style={'textAlign': 'center', 'padding': '1rem'})
-            ], style={'display': 'grid', 'gridTemplateColumns': 'repeat(auto-fit, minmax(200px, 1fr))', 'gap': '1rem'})
-            
-            # Traffic Volume Graph
-            df['timestamp'] = pd.to_datetime(df['timestamp'])
-            traffic_fig = px.line(df, x='timestamp', y='length',
-                                title='Network Traffic Volume',
-                                labels={'timestamp': 'Time', 'length': 'Packet Size (bytes)'})
-            traffic_fig.update_layout(
-                plot_bgcolor='white',
-                paper_bgcolor='white'
-            )
-            
-            # Protocol Distribution
-            protocol_fig = px.pie(df, names='protocol',
-                                title='Protocol Distribution',
-                                hole=0.3)
-            protocol_fig.update_layout(
-                plot_bgcolor='white',
-                paper_bgcolor='white'
-            )
-            
-            # HTTP Analysis
-            http_data = df[df['protocol'].isin(['HTTP', 'HTTPS'])]
-            if len(http_data) > 0:
-                http_analysis = html.Div([
-                    html.H4("HTTP/HTTPS Traffic"),
-                    html.P(f"Total HTTP(S) Packets: {len(http_data)}"),
-                    html.P(f"Average Size: {http_data['length'].mean():.2f} bytes"),
-                    dcc.Graph(figure=px.bar(
-                        http_data.groupby('dst_port')['length'].count(),
-                        title='HTTP(S) Traffic by Port'
-                    ))
-                ])
-            else:
-                http_analysis = html.P("No HTTP/HTTPS traffic detected")
-            
-            # Incidents Table
-            if incidents:
-                incidents_div = html.Table([
+            # Every open dashboard shares one rendering per data version
+            key = ('metrics', snapshot['version'], self.traffic_analyzer.stats_window, CHART_WINDOW)
+            with stage('update_metrics'):
+                return self.figures.get_or_set(key, lambda: self.render_metrics(snapshot))
+
+        # Applies the updates pushed by the server without a round trip; see
+        # assets/live.js
+        self.app.clientside_callback(
+            ClientsideFunction(namespace='live', function_name='apply'),
+            [Output('traffic-volume-graph', 'extendData'),
+             Output('stats-container', 'children', allow_duplicate=True),
+             Output('protocol-dist-graph', 'figure', allow_duplicate=True),
+             Output('incidents-table', 'children', allow_duplicate=True),
+             Output('live-resync', 'data')],
+            Input('live-drain', 'n_intervals'),
+            [State('traffic-volume-graph', 'figure'),
+             State('stats-container', 'children'),
+             State('protocol-dist-graph', 'figure'),
+             State('incidents-table', 'children'),
+             State('live-resync', 'data')],
+            prevent_initial_call=True
+        )
+
+        @self.app.callback(
+            Output('history-output', 'children'),
+            [Input('history-search', 'n_clicks'),
+             Input('history-filter', 'n_submit')],
+            [State('history-table', 'value'),
+             State('history-start', 'value'),
+             State('history-end', 'value'),
+             State('history-host', 'value'),
+             State('history-port', 'value'),
+             State('history-filter', 'value')]
+        )
+        def update_history(n_clicks, n_submit, table, start, end, host, port, where):
+            if not n_clicks and not n_submit:
+                return html.P("Search stored packets and flows by time range, host and port, or with a filter")
+            try:
+                rows = self.query_history(table, start, end, host, port, where, limit=HISTORY_API_ROWS)
+            except ValueError as e:
+                return html.P(f"Invalid search: {e}", style={'color': '#dc3545'})
+            if not len(rows):
+                return html.P("No matching traffic")
+            frame = rows.to_frame()
+            shown = frame.head(HISTORY_ROWS)
+            return html.Div([
+                html.P(f"{len(frame)}{'+' if len(frame) == HISTORY_API_ROWS else ''} matching {table}" +
+                       (f", showing the first {HISTORY_ROWS}" if len(frame) > HISTORY_ROWS else '')),
+                html.Table([
                     html.Thead(html.Tr([
                         html.Th(col, style={'padding': '0.5rem', 'backgroundColor': '#f8f9fa'})
-                        for col in ['Time', 'Severity', 'Type', 'Details']
+                        for col in shown.columns
                     ])),
                     html.Tbody([
-                        html.Tr([
-                            html.Td(incident['timestamp'], style={'padding': '0.5rem'}),
-                            html.Td(html.Span(incident['severity'],
-                                            style={'color': 'white',
-                                                  'backgroundColor': {'HIGH': '#dc3545',
-                                                                    'MEDIUM': '#ffc107',
-                                                                    'LOW': '#28a745'}[incident['severity']],
-                                                  'padding': '0.25rem 0.5rem',
-                                                  'borderRadius': '4px'})),
-                            html.Td(incident['type'], style={'padding': '0.5rem'}),
-                            html.Td(incident['details'], style={'padding': '0.5rem'})
-                        ]) for incident in incidents
+                        html.Tr([html.Td(str(value), style={'padding': '0.5rem'}) for value in row])
+                        for row in shown.itertuples(index=False)
                     ])
                 ], style={'width': '100%', 'borderCollapse': 'collapse'})
-            else:
-                incidents_div = html.P("No incidents detected", style={'color': '#28a745'})
-            
-            return stats_div, traffic_fig, protocol_fig, http_analysis, incidents_div
+            ])
     
     def run(self, debug=True):
         # Get port from environment variable for cloud deployment
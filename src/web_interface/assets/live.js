@@ -0,0 +1,142 @@
+// Live dashboard updates. The server pushes what changed in each snapshot over
+// /api/live/stream; events are queued as they arrive and applied by the
+// `live.apply` clientside callback, which patches the figures in place.
+(function () {
+    var MAX_POINTS = 3600;  // points kept in the traffic volume chart
+    var MAX_INCIDENTS = 200;  // rows kept in the incidents table
+    var SEVERITY_COLORS = {'HIGH': '#dc3545', 'MEDIUM': '#ffc107', 'LOW': '#28a745'};
+    var BUSY_RETRY = 30000;  // milliseconds between redraws while the server has no stream to spare
+
+    var queue = [];
+    var source = null;
+    var retryAt = 0;
+
+    function connect() {
+        if (source || Date.now() < retryAt || typeof EventSource === 'undefined') {
+            return;
+        }
+        source = new EventSource('/api/live/stream');
+        source.addEventListener('delta', function (event) {
+            queue.push(JSON.parse(event.data));
+        });
+        source.addEventListener('resync', function () {
+            queue.push({resync: true});
+        });
+        source.onerror = function () {
+            // Closed for good when the server refused the stream (all its
+            // stream slots taken): redraw now and then, and try again
+            if (this.readyState === EventSource.CLOSED) {
+                source = null;
+                retryAt = Date.now() + BUSY_RETRY;
+                queue.push({resync: true});
+            }
+        };
+    }
+
+    function cell(children, style) {
+        return {namespace: 'dash_html_components', type: 'Td', props: {children: children, style: style}};
+    }
+
+    function incidentRow(incident) {
+        var padding = {padding: '0.5rem'};
+        var badge = {
+            namespace: 'dash_html_components',
+            type: 'Span',
+            props: {
+                children: incident.severity,
+                style: {
+                    color: 'white',
+                    backgroundColor: SEVERITY_COLORS[incident.severity],
+                    padding: '0.25rem 0.5rem',
+                    borderRadius: '4px'
+                }
+            }
+        };
+        return {
+            namespace: 'dash_html_components',
+            type: 'Tr',
+            props: {children: [
+                cell(incident.timestamp, padding),
+                cell(badge),
+                cell(incident.type, padding),
+                cell(incident.details, padding)
+            ]}
+        };
+    }
+
+    function tableBody(table) {
+        // The Tbody of the incidents table rendered by the server, if any
+        if (!table || table.type !== 'Table') {
+            return null;
+        }
+        var parts = table.props.children;
+        return parts && parts[1] && parts[1].type === 'Tbody' ? parts[1] : null;
+    }
+
+    function apply(n, volume, stats, protocols, incidents, resync) {
+        var noUpdate = window.dash_clientside.no_update;
+        connect();
+        if (!queue.length) {
+            return [noUpdate, noUpdate, noUpdate, noUpdate, noUpdate];
+        }
+        var events = queue.splice(0, queue.length);
+        var trace = volume && volume.data && volume.data[0];
+        var body = tableBody(incidents);
+        var newIncidents = [];
+        events.forEach(function (delta) {
+            newIncidents = delta.incidents ? delta.incidents.concat(newIncidents) : newIncidents;
+        });
+        // Anything the patches cannot express is left to a full redraw
+        if (events.some(function (delta) { return delta.resync; }) || !trace || !Array.isArray(trace.x)
+                || (newIncidents.length && !body)) {
+            return [noUpdate, noUpdate, noUpdate, noUpdate, (resync || 0) + 1];
+        }
+
+        // New volume points, skipping any the figure was already drawn with
+        var lastX = trace.x.length ? trace.x[trace.x.length - 1] : '';
+        var x = [];
+        var y = [];
+        events.forEach(function (delta) {
+            delta.volume.x.forEach(function (time, i) {
+                if (time > lastX) {
+                    x.push(time);
+                    y.push(delta.volume.y[i]);
+                    lastX = time;
+                }
+            });
+        });
+        var extend = x.length ? [{x: [x], y: [y]}, [0], MAX_POINTS] : noUpdate;
+
+        // Counters: the value under each heading of the statistics tiles
+        var latest = events[events.length - 1];
+        var tiles = stats && stats.props && stats.props.children;
+        var newStats = noUpdate;
+        if (Array.isArray(tiles) && tiles.length === latest.stats.length) {
+            newStats = JSON.parse(JSON.stringify(stats));
+            newStats.props.children.forEach(function (tile, i) {
+                tile.props.children[1].props.children = latest.stats[i];
+            });
+        }
+
+        var newProtocols = noUpdate;
+        var changed = events.filter(function (delta) { return delta.protocols; });
+        if (changed.length && protocols && protocols.data && protocols.data.length) {
+            var totals = changed[changed.length - 1].protocols;
+            newProtocols = Object.assign({}, protocols, {
+                data: [Object.assign({}, protocols.data[0], {labels: totals.labels, values: totals.values})]
+            });
+        }
+
+        var newTable = noUpdate;
+        if (newIncidents.length) {
+            newTable = JSON.parse(JSON.stringify(incidents));
+            var rows = newIncidents.map(incidentRow).concat(body.props.children || []);
+            newTable.props.children[1].props.children = rows.slice(0, MAX_INCIDENTS);
+        }
+        return [extend, newStats, newProtocols, newTable, noUpdate];
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        live: {apply: apply}
+    });
+})();
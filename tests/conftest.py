@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# The packages are imported from src, as wsgi.py and src/main.py do
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+# The web interface keeps uploads, history and the incident log out of the checkout
+_RUNTIME = tempfile.mkdtemp(prefix='network-forensics-tests-')
+os.environ.setdefault('UPLOAD_DIR', _RUNTIME)
+os.environ.setdefault('INCIDENT_LOG', os.path.join(_RUNTIME, 'incidents.log'))
+os.environ.setdefault('INCIDENT_CONSOLE_RATE', '0')
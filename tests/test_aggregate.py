@@ -0,0 +1,93 @@
+import time
+import numpy as np
+import pytest
+from analyzer.synthetic import TrafficGenerator
+from analyzer.aggregate import SlidingWindowAggregator, NS_PER_SECOND
+from custom_types import PacketBatch, PROTOCOL_CODES, format_addresses
+
+
+def _hour():
+    aggregator = SlidingWindowAggregator()
+    batches = list(TrafficGenerator(seed=4, duration=3600).batches(600000))
+    for batch in batches:
+        aggregator.add(batch)
+    return aggregator, batches
+
+
+def test_hour_window_stats_are_fast():
+    aggregator, _ = _hour()
+    aggregator.stats(3600)
+    started = time.perf_counter()
+    for _ in range(5):
+        aggregator.stats(3600)
+    assert (time.perf_counter() - started) / 5 < 0.05
+
+
+def test_window_talkers_bound_exact_bytes():
+    aggregator, batches = _hour()
+    src = np.concatenate([batch.src for batch in batches])
+    length = np.concatenate([batch.length for batch in batches]).astype(np.int64)
+    names, inverse = format_addresses(src)
+    exact = dict(zip(names, np.bincount(inverse.ravel(), weights=length).astype(np.int64).tolist()))
+    heaviest = sorted(exact, key=exact.get, reverse=True)[:5]
+    stats = aggregator.stats(3600)
+    # Within 5% above, well inside the summary's error on this traffic
+    for name in heaviest:
+        assert exact[name] <= stats['traffic_by_src'][name] <= exact[name] * 1.05
+    assert stats['total_packets'] == len(src)
+
+
+def _packets(seconds, src=0x0A000001, length=100, protocol=PROTOCOL_CODES['TCP']):
+    seconds = np.asarray(seconds, dtype=np.int64)
+    n = len(seconds)
+    return PacketBatch(seconds * NS_PER_SECOND + 1000, np.broadcast_to(np.asarray(src, dtype=np.uint32), n),
+                       np.full(n, 0x0A000063, dtype=np.uint32), np.full(n, protocol),
+                       np.broadcast_to(length, n), np.full(n, 40000), np.full(n, 443))
+
+
+def test_window_add_advance_and_evict():
+    aggregator = SlidingWindowAggregator(windows=(5, 10))
+    assert aggregator.stats(5)['total_packets'] == 0
+    aggregator.add(_packets([100, 101, 102, 103, 104], length=[100, 200, 300, 400, 500]))
+    # Out of order within a batch
+    aggregator.add(_packets([104, 102], length=1500, protocol=PROTOCOL_CODES['UDP']))
+    stats = aggregator.stats(5)
+    assert stats['total_packets'] == 7 and stats['max_packet_size'] == 1500
+    assert stats['protocols'] == {'TCP': 5, 'UDP': 2}
+    assert stats['unique_sources'] == 1 and stats['traffic_by_src'] == {'10.0.0.1': 4500}
+    seconds, packets, byte_counts = aggregator.series(5)
+    assert seconds.tolist() == [100, 101, 102, 103, 104]
+    assert packets.tolist() == [1, 1, 2, 1, 2] and byte_counts.tolist() == [100, 200, 1800, 400, 2000]
+
+    # Moving on without traffic drops the oldest seconds from the short window only
+    aggregator.advance(107 * NS_PER_SECOND)
+    assert aggregator.stats(5)['total_packets'] == 3
+    assert aggregator.stats(10)['total_packets'] == 7
+    assert aggregator.series(5)[1].tolist() == [1, 2, 0, 0, 0]
+    # A second past the ring reuses the slots of the evicted ones
+    aggregator.add(_packets([111]))
+    assert aggregator.stats(10)['total_packets'] == 6
+    assert aggregator.series(10)[0][0] == 102
+    aggregator.advance(200 * NS_PER_SECOND)
+    stats = aggregator.stats(10)
+    assert stats['total_packets'] == 0 and stats['traffic_by_src'] == {} and stats['unique_sources'] == 0
+    # Packets older than the ring are only counted as late
+    aggregator.add(_packets([150, 195]))
+    assert aggregator.late_packets == 1 and aggregator.stats(10)['total_packets'] == 1
+    with pytest.raises(ValueError):
+        aggregator.stats(60)
+
+
+def test_window_talkers_across_minutes():
+    # Whole minutes come from the per-minute summaries, the edges from seconds
+    aggregator = SlidingWindowAggregator(windows=(60, 300))
+    hosts = np.array([0x0A000001, 0x0A000002, 0x0A000003], dtype=np.uint32)
+    seconds = np.arange(1_700_000_000, 1_700_000_400)
+    for start in range(0, len(seconds), 37):
+        part = seconds[start:start + 37]
+        aggregator.add(_packets(part, src=hosts[part % 3], length=part % 1000 + 60))
+    for window in (60, 300):
+        kept = seconds[seconds > seconds[-1] - window]
+        expected = {f'10.0.0.{i + 1}': int((kept[kept % 3 == i] % 1000 + 60).sum()) for i in range(3)}
+        stats = aggregator.stats(window)
+        assert stats['traffic_by_src'] == expected and stats['total_packets'] == len(kept)
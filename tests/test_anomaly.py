@@ -0,0 +1,180 @@
+import pickle
+import numpy as np
+import pytest
+from custom_types import PacketBatch, PROTOCOL_CODES, INCIDENT_TYPES, address_hashes
+from detector.streaming import StreamingDetector
+from detector.anomaly import (HostWindows, HostFeatures, ModelStore, Trainer, AnomalyDetector, fit_model, FEATURES,
+                              NS_PER_SECOND)
+
+START = 1_700_000_040 * NS_PER_SECOND  # on a minute boundary
+HOST = 0x0A000001  # 10.0.0.1
+SERVER = 0x0A000002  # 10.0.0.2
+RESOLVER = 0x0A000003  # 10.0.0.3
+TCP, UDP = PROTOCOL_CODES['TCP'], PROTOCOL_CODES['UDP']
+
+
+def _window():
+    # HOST opens four SSH connections and sends a large packet to SERVER,
+    # asks RESOLVER twice, and gets one reply from SERVER
+    rows = [(0, HOST, SERVER, TCP, 60, 22, 0x02), (10, HOST, SERVER, TCP, 60, 22, 0x02),
+            (20, HOST, SERVER, TCP, 60, 22, 0x02), (30, HOST, SERVER, TCP, 60, 22, 0x02),
+            (5, HOST, RESOLVER, UDP, 100, 53, 0), (15, HOST, RESOLVER, UDP, 100, 53, 0),
+            (40, HOST, SERVER, TCP, 1500, 8080, 0x18), (45, SERVER, HOST, TCP, 500, 50000, 0x10)]
+    seconds, src, dst, protocol, length, dst_port, flags = (np.array(column) for column in zip(*rows))
+    return PacketBatch(START + seconds * NS_PER_SECOND, src.astype(np.uint32), dst.astype(np.uint32), protocol,
+                       length, np.full(len(rows), 50000), dst_port, flags)
+
+
+def _normal(n, scale=1.0, seed=0):
+    return np.random.default_rng(seed).normal(5.0, scale, (n, len(FEATURES)))
+
+
+def _detector(store):
+    # Never trains, so only the model saved by the test scores
+    return AnomalyDetector(store, trainer=Trainer(store, min_samples=10 ** 9))
+
+
+@pytest.fixture(scope='module')
+def model():
+    return fit_model(_normal(2000), trees=20, seed=1)
+
+
+def _features(parts):
+    windows = HostWindows()
+    for part in parts:
+        windows.add(part, address_hashes(part.src), address_hashes(part.dst))
+    return windows
+
+
+def test_window_features():
+    batch = _window()
+    windows = _features([batch])
+    assert windows.close(START + 64 * NS_PER_SECOND) is None
+    found = windows.close(START + 65 * NS_PER_SECOND)
+    assert len(found) == 2 and windows.close() is None
+    row = int(np.flatnonzero(found.host == HOST)[0])
+    features = dict(zip(FEATURES, found.features[row]))
+    assert features['packets'] == pytest.approx(np.log1p(7))
+    assert features['bytes'] == pytest.approx(np.log1p(1940))
+    assert features['mean_size'] == pytest.approx(1940 / 7)
+    assert features['fan_out'] == pytest.approx(np.log1p(2))
+    assert features['ports'] == pytest.approx(np.log1p(3))
+    assert features['service_ports'] == pytest.approx(np.log1p(2))
+    shares = np.array([4, 2, 1]) / 7
+    assert features['port_entropy'] == pytest.approx(-(shares * np.log2(shares)).sum())
+    assert features['mean_gap'] == pytest.approx(np.log1p(40 / 6))
+    assert features['syn_share'] == pytest.approx(4 / 7)
+    assert features['udp_share'] == pytest.approx(2 / 7)
+    assert features['icmp_share'] == 0
+    assert features['received_bytes'] == pytest.approx(np.log1p(500))
+    # The busiest peer, and the window's span
+    assert found.peer[row] == SERVER and found.packets[row] == 7
+    assert found.window[row] == START
+    assert (found.first_seen[row], found.last_seen[row]) == (START, START + 40 * NS_PER_SECOND)
+    # Batches are merged into the same windows; only the gaps between
+    # packets of different batches are left out
+    split = _features([batch[:4], batch[4:]]).close()
+    others = [FEATURES.index(name) for name in FEATURES if name not in ('mean_gap', 'gap_spread')]
+    np.testing.assert_allclose(split.features[:, others], found.features[:, others])
+
+
+def test_store_keeps_the_newest_versions(tmp_path, model):
+    store = ModelStore(str(tmp_path), reload_interval=0, keep=2)
+    assert store.latest() is None
+    assert [store.save(model) for _ in range(4)] == [1, 2, 3, 4]
+    assert store.versions() == [3, 4]
+    assert sorted(path.name for path in tmp_path.glob('model-*')) == [
+        'model-000003.json', 'model-000003.pkl', 'model-000004.json', 'model-000004.pkl']
+    assert [description['version'] for description in store.describe()] == [4, 3]
+    latest = store.latest()
+    assert latest.version == 4 and latest.features == FEATURES
+    np.testing.assert_array_equal(latest.thresholds, model.thresholds)
+    assert ModelStore(str(tmp_path)).load(3).version == 3
+
+
+def test_store_rejects_models_it_cannot_use(tmp_path, model, capsys):
+    store = ModelStore(str(tmp_path), reload_interval=0)
+    store.save(model)
+    assert store.latest().version == 1
+    # Trained on other features, from another AnomalyModel, and not a model at all
+    for version, state in ((2, {**model.state(), 'features': FEATURES[:-1]}),
+                           (3, {**model.state(), 'window': 60}),
+                           (4, None)):
+        with open(store.path(version), 'wb') as f:
+            if state is not None:
+                pickle.dump(state, f)
+        assert store.load(version) is None
+        # The model in use stays
+        assert store.latest().version == 1
+    errors = capsys.readouterr().err
+    assert 'model-000003.pkl' in errors and 'model-000004.pkl' in errors
+
+
+def test_trainer_keeps_a_uniform_sample(tmp_path):
+    trainer = Trainer(ModelStore(str(tmp_path)), min_samples=10 ** 9, max_samples=500, seed=3)
+    rows = np.arange(100_000, dtype=np.float64)[:, None].repeat(len(FEATURES), axis=1)
+    trainer.add(rows[:300])
+    # Until the sample is full every row is kept
+    np.testing.assert_array_equal(trainer.samples, rows[:300])
+    for start in range(300, len(rows), 7_000):
+        trainer.add(rows[start:start + 7_000])
+    assert trainer.seen == len(rows) and trainer.samples.shape == (500, len(FEATURES))
+    assert trainer.process is None
+    kept = trainer.samples[:, 0]
+    # Each row was kept with the same probability: a tenth of the sample per tenth of the stream
+    counts = np.bincount((kept // 10_000).astype(int), minlength=10)
+    assert counts.min() >= 25 and counts.max() <= 80
+    assert len(np.unique(kept)) > 450
+
+
+def test_detector_reports_unusual_windows(tmp_path, model):
+    store = ModelStore(str(tmp_path), reload_interval=0)
+    detector = _detector(store)
+    ordinary = _normal(50, scale=0.3, seed=7)
+    unusual = np.r_[ordinary, ordinary[:1] + 20.0]
+    hosts = np.arange(1, len(unusual) + 1, dtype=np.uint32)
+
+    def windows(features):
+        n = len(features)
+        return HostFeatures(features, hosts[:n], hosts[:n], np.full(n, START), np.full(n, START),
+                            np.full(n, START + NS_PER_SECOND), np.full(n, 10))
+
+    # Nothing is reported before there is a model
+    assert len(detector.score(windows(unusual))) == 0
+    store.save(model)
+    assert len(detector.score(windows(ordinary))) == 0
+    incidents = detector.score(windows(unusual))
+    assert len(incidents) == 1
+    assert incidents.type[0] == INCIDENT_TYPES.index('ANOMALY') and incidents.severity[0] == 2
+    assert incidents.src[0] == len(unusual)
+    assert incidents.value[0] == np.round(model.score(unusual[-1:])[0] * 1000)
+    # The scored windows are sampled for the next model
+    assert detector.trainer.seen == 2 * len(unusual) + len(ordinary)
+
+
+def test_detector_without_training_only_scores(tmp_path):
+    # As the live stream of generated traffic
+    store = ModelStore(str(tmp_path))
+    trainer = Trainer(store, min_samples=10 ** 9)
+    detector = AnomalyDetector(store, trainer=trainer, train=False)
+    detector.score(_features([_window()]).close())
+    assert trainer.seen == 0
+    detector.train = True
+    detector.score(_features([_window()]).close())
+    assert trainer.seen == 2
+
+
+def test_chunk_edges_leave_out_the_windows_they_cut(tmp_path):
+    # A chunk that starts in minute 0 and stops in minute 2 only scores minute 1
+    store = ModelStore(str(tmp_path))
+    counts = []
+    for resumed, cut in ((False, False), (True, False), (True, True)):
+        trainer = Trainer(store, min_samples=10 ** 9)
+        stream = StreamingDetector([AnomalyDetector(store, trainer=trainer, resumed=resumed, cut=cut)])
+        for offset in (10, 60, 120):
+            batch = _window()
+            batch.timestamp = batch.timestamp + offset * NS_PER_SECOND
+            stream.process(batch)
+        stream.flush()
+        counts.append(trainer.seen)
+    assert counts == [6, 4, 2]
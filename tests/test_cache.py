@@ -0,0 +1,88 @@
+import threading
+import time
+import pytest
+from tools import cache
+from tools.cache import TTLCache
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(cache, 'time', clock)
+    return clock
+
+
+def test_entries_expire_after_the_ttl(clock):
+    entries = TTLCache(ttl=60)
+    entries.set('a', 1)
+    clock.now += 60
+    assert entries.get('a') == 1
+    clock.now += 0.5
+    assert entries.get('a', 'gone') == 'gone' and len(entries) == 0
+    # Setting again starts a new lifetime
+    entries.set('a', 2)
+    clock.now += 30
+    assert entries.get_or_set('a', lambda: 3) == 2
+    clock.now += 31
+    assert entries.get_or_set('a', lambda: 3) == 3
+    assert (entries.hits, entries.misses) == (1, 1)
+
+
+def test_least_recently_used_is_evicted(clock):
+    entries = TTLCache(max_entries=2)
+    entries.set('a', 1)
+    entries.set('b', 2)
+    # Reading 'a' makes 'b' the oldest
+    assert entries.get('a') == 1
+    entries.set('c', 3)
+    assert list(entries.entries) == ['a', 'c']
+    assert entries.get('b') is None
+    entries.get_or_set('d', lambda: 4)
+    assert list(entries.entries) == ['c', 'd']
+    entries.clear()
+    assert len(entries) == 0
+
+
+def test_concurrent_misses_compute_once():
+    entries = TTLCache()
+    calls = []
+    started = threading.Event()
+
+    def compute():
+        calls.append(1)
+        started.set()
+        time.sleep(0.2)
+        return 'figure'
+
+    results = []
+    first = threading.Thread(target=lambda: results.append(entries.get_or_set('chart', compute)))
+    first.start()
+    started.wait()
+    others = [threading.Thread(target=lambda: results.append(entries.get_or_set('chart', compute)))
+              for _ in range(7)]
+    for thread in others:
+        thread.start()
+    for thread in [first] + others:
+        thread.join()
+    assert results == ['figure'] * 8 and len(calls) == 1
+    assert (entries.hits, entries.misses) == (7, 1)
+
+
+def test_failed_compute_is_retried():
+    entries = TTLCache()
+
+    def fail():
+        raise RuntimeError('store unavailable')
+
+    with pytest.raises(RuntimeError):
+        entries.get_or_set('chart', fail)
+    assert entries._pending == {} and len(entries) == 0
+    assert entries.get_or_set('chart', lambda: 'figure') == 'figure'
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+from visualizer.charts import lttb, traffic_volume_figure
+
+
+def _series(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.arange(1_700_000_000, 1_700_000_000 + n), rng.poisson(1000, n).astype(np.float64)
+
+
+@pytest.mark.parametrize('n, points', [(10000, 500), (1001, 500), (503, 500), (100, 3)])
+def test_lttb_keeps_the_endpoints_and_the_budget(n, points):
+    x, y = _series(n)
+    keep = lttb(x, y, points)
+    assert len(keep) == points
+    assert keep[0] == 0 and keep[-1] == n - 1
+    assert np.all(np.diff(keep) > 0)
+    # One point from each bucket between the endpoints
+    edges = np.linspace(1, n - 1, points - 1).astype(np.int64)
+    assert np.all((keep[1:-1] >= edges[:-1]) & (keep[1:-1] < edges[1:]))
+
+
+def test_lttb_keeps_spikes():
+    x, y = _series(20000)
+    y[[4321, 15000]] = [1e6, 0]
+    keep = lttb(x, y, 200)
+    assert 4321 in keep and 15000 in keep
+
+
+@pytest.mark.parametrize('points', [1000, 2, 0])
+def test_lttb_short_series_and_small_budgets_are_kept_whole(points):
+    x, y = _series(1000)
+    assert lttb(x, y, points).tolist() == list(range(1000))
+
+
+def test_volume_figure_is_downsampled():
+    seconds, byte_counts = _series(3600)
+    trace = traffic_volume_figure(seconds, byte_counts, points=300).data[0]
+    assert len(trace.x) == len(trace.y) == 300
+    # The first and last seconds are always drawn
+    assert (trace.y[0], trace.y[-1]) == (byte_counts[0], byte_counts[-1])
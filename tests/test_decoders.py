@@ -0,0 +1,147 @@
+import io
+import socket
+import struct
+import hashlib
+import pytest
+from analyzer.pcap import PcapReader, LINKTYPE_ETHERNET
+from analyzer.decoders import DecoderStage, AppSummary, FLOW_PACKETS
+
+JA3 = '771,4865-49195,0-10-11,29-23,0'
+
+
+def _frame(payload, proto=6, sport=40000, dport=443, src='10.0.0.1', dst='10.0.0.2'):
+    if proto == 6:
+        l4 = struct.pack('>HHIIBBHHH', sport, dport, 0, 0, 0x50, 0x18, 64240, 0, 0)
+    else:
+        l4 = struct.pack('>HHHH', sport, dport, 8 + len(payload), 0)
+    ip = struct.pack('>BBHHHBBH4s4s', 0x45, 0, 20 + len(l4) + len(payload), 1, 0x4000, 64, proto, 0,
+                     socket.inet_aton(src), socket.inet_aton(dst))
+    return bytes(12) + b'\x08\x00' + ip + l4 + payload
+
+
+def _decode(frames, stage=None):
+    # Records decoded from a capture of the frames, and the stage used
+    stage = stage or DecoderStage()
+    header = struct.pack('<IHHiIII', 0xA1B23C4D, 2, 4, 0, 0, 65535, LINKTYPE_ETHERNET)
+    data = header + b''.join(
+        struct.pack('<IIII', 1_700_000_000, i, len(frame), len(frame)) + frame for i, frame in enumerate(frames))
+    with PcapReader(io.BytesIO(data), decoders=stage) as reader:
+        return [record for batch in reader for record in batch.app], stage
+
+
+def _client_hello(sni='Example.com'):
+    # A ClientHello with GREASE values among its ciphers, extensions and groups
+    name = sni.encode()
+    extensions = [(0x1A1A, b''), (0, struct.pack('!HBH', len(name) + 3, 0, len(name)) + name),
+                  (10, struct.pack('!4H', 6, 0x2A2A, 29, 23)), (11, b'\x01\x00')]
+    extensions = b''.join(struct.pack('!HH', kind, len(data)) + data for kind, data in extensions)
+    ciphers = struct.pack('!3H', 0x0A0A, 4865, 49195)
+    body = (struct.pack('!H', 0x0303) + bytes(32) + b'\x00' + struct.pack('!H', len(ciphers)) + ciphers +
+            b'\x01\x00' + struct.pack('!H', len(extensions)) + extensions)
+    handshake = b'\x01' + len(body).to_bytes(3, 'big') + body
+    return b'\x16\x03\x01' + struct.pack('!H', len(handshake)) + handshake
+
+
+def _dns(flags, answers=b'', count=0, name=b'\x07example\x03com\x00', qtype=1):
+    return struct.pack('!6H', 0x1234, flags, 1, count, 0, 0) + name + struct.pack('!HH', qtype, 1) + answers
+
+
+def _answer(kind, data):
+    # Named by a pointer to the question
+    return struct.pack('!HHHIH', 0xC00C, kind, 1, 300, len(data)) + data
+
+
+def test_tls_client_hello_ja3_leaves_out_grease():
+    records, stage = _decode([_frame(_client_hello())])
+    assert stage.decoded == 1 and stage.failed == 0
+    record = records[0]
+    assert record['protocol'] == 'TLS' and record['version'] == 771 and record['sni'] == 'example.com'
+    assert record['ja3'] == hashlib.md5(JA3.encode()).hexdigest()
+    assert (record['src'], record['dst'], record['dst_port']) == ('10.0.0.1', '10.0.0.2', 443)
+
+
+def test_http_requests_and_responses():
+    records, _ = _decode([
+        _frame(b'GET /index.html HTTP/1.1\r\nUser-Agent: test\r\nHost: Example.COM:8080\r\n\r\n', dport=80),
+        _frame(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n', sport=80, dport=40000),
+        _frame(b'POST /' + b'a' * 400 + b' HTTP/1.0\r\n\r\n', sport=40001, dport=80),
+    ])
+    assert [record['protocol'] for record in records] == ['HTTP'] * 3
+    assert records[0]['method'] == 'GET' and records[0]['path'] == '/index.html'
+    assert records[0]['host'] == 'example.com:8080'
+    assert records[1] == {**records[1], 'status': 404}
+    assert len(records[2]['path']) == 256 and records[2]['host'] is None
+
+
+def test_dns_queries_and_answers():
+    answers = (_answer(1, socket.inet_aton('93.184.216.34')) +
+               _answer(28, socket.inet_pton(socket.AF_INET6, '2606:2800:220:1::1')) +
+               _answer(5, b'\x03www\xc0\x0c'))
+    records, _ = _decode([
+        _frame(_dns(0x0100), proto=17, dport=53),
+        _frame(_dns(0x8180, answers, 3), proto=17, sport=53, dport=40000),
+        _frame(_dns(0x8183, name=b'\x07missing\x03com\x00', qtype=28), proto=17, sport=53, dport=40001),
+    ])
+    query, response, failure = records
+    assert query == {**query, 'protocol': 'DNS', 'query': 'example.com', 'qtype': 'A', 'response': False}
+    assert response['rcode'] == 'NOERROR'
+    assert response['answers'] == ['93.184.216.34', '2606:2800:220:1::1', 'www.example.com']
+    assert failure['query'] == 'missing.com' and failure['qtype'] == 'AAAA' and failure['rcode'] == 'NXDOMAIN'
+
+
+def test_truncated_and_garbage_payloads_are_counted_as_failed():
+    hello = _client_hello()
+    records, stage = _decode([
+        _frame(hello[:50], sport=1),  # cut in the cipher suites
+        _frame(hello[:-1], sport=2),  # cut in the extensions, so no JA3
+        _frame(b'GET nothing-else', sport=3, dport=80),
+        _frame(b'HTTP/1.1 abc\r\n', sport=80, dport=4),
+        _frame(_dns(0x0100)[:20], proto=17, sport=5, dport=53),  # cut in the name
+        _frame(struct.pack('!6H', 1, 0x0100, 1, 0, 0, 0) + b'\xc0\x0c' + bytes(8), proto=17, sport=6,
+               dport=53),  # a name pointing at itself
+        _frame(b'\x00' * 64, sport=7),  # matches no decoder
+    ])
+    assert stage.failed == 5
+    assert [record['protocol'] for record in records] == ['TLS']
+    assert records[0]['sni'] == 'example.com' and records[0]['ja3'] is None
+
+
+def test_flows_stop_being_decoded_after_the_packet_cap():
+    request = b'GET / HTTP/1.1\r\nHost: a.example\r\n\r\n'
+    frames = [_frame(request, dport=80) for _ in range(FLOW_PACKETS + 3)]
+    # The reply is the same flow, another client a new one
+    frames += [_frame(b'HTTP/1.1 200 OK\r\n\r\n', sport=80, dport=40000, src='10.0.0.2', dst='10.0.0.1'),
+               _frame(request, sport=40001, dport=80)]
+    records, stage = _decode(frames)
+    assert stage.decoded == FLOW_PACKETS + 1
+    assert records[-1]['src_port'] == 40001
+    _, stage = _decode(frames, DecoderStage(flow_packets=1, max_flows=1))
+    # With one flow remembered, the second client pushes out the first
+    assert stage.decoded == 2 and len(stage.flows) == 1
+
+
+def test_app_summary_merge_matches_one_summary():
+    records, _ = _decode([_frame(_client_hello(), sport=port) for port in range(1000, 1003)] +
+                         [_frame(b'GET / HTTP/1.1\r\nHost: b.example\r\n\r\n', sport=2000, dport=80),
+                          _frame(_dns(0x0100), proto=17, dport=53),
+                          _frame(_dns(0x8183), proto=17, sport=53, dport=40000)])
+    whole = AppSummary()
+    whole.add(records)
+    first, second = AppSummary(), AppSummary()
+    first.add(records[:2])
+    second.add(records[2:])
+    first.merge(second)
+    first.merge(AppSummary())
+    assert first.top() == whole.top()
+    top = whole.top()
+    assert top['records'] == {'TLS': 3, 'HTTP': 1, 'DNS': 2}
+    assert top['tls_sni'] == [['example.com', 3]]
+    assert top['ja3'] == [[hashlib.md5(JA3.encode()).hexdigest(), 3]]
+    assert top['http_hosts'] == [['b.example', 1]]
+    assert top['dns_queries'] == [['example.com', 1]] and top['dns_failures'] == [['example.com', 1]]
+
+
+@pytest.mark.parametrize('decoders', [[], None])
+def test_no_payloads_no_records(decoders):
+    records, stage = _decode([_frame(b'')], DecoderStage(decoders))
+    assert records == [] and stage.decoded == 0
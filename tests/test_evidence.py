@@ -0,0 +1,122 @@
+import numpy as np
+import pytest
+from custom_types import PacketBatch, format_addresses
+from analyzer import evidence
+from analyzer.synthetic import TrafficGenerator
+from analyzer.parallel import analyze_capture
+from analyzer.pcap import PcapReader, read_pcap
+from analyzer.evidence import CaptureIndex, incident_scopes
+from detector import IncidentDetector
+
+
+@pytest.fixture(scope='module')
+def analysed(tmp_path_factory):
+    root = tmp_path_factory.mktemp('evidence')
+    path = str(root / 'traffic.pcap')
+    TrafficGenerator(seed=4, duration=600, clients=500, servers=200, scan_ports=300, sweep_hosts=200,
+                     burst_packets=3000).write(path, 60000)
+    analysis = analyze_capture(path, workers=2, chunks=5, detector=IncidentDetector(), index_root=str(root / 'index'))
+    return path, analysis, CaptureIndex.open(str(root / 'index'))
+
+
+def _packets(path, where=None):
+    with PcapReader(path, where=where) as reader:
+        return PacketBatch.concat(list(reader))
+
+
+def _names(column):
+    names, inverse = format_addresses(column)
+    return names[inverse]
+
+
+def _rows(batch):
+    # The packets as sorted rows, as carving reorders packets with equal times
+    columns = [batch.timestamp, batch.src, batch.dst, batch.src_port, batch.dst_port, batch.length,
+               batch.protocol, batch.tcp_flags]
+    return np.stack(columns)[:, np.lexsort(columns[::-1])]
+
+
+def _carve(index, path, **scope):
+    count = index.carve(str(path), **scope)
+    batch = _packets(str(path))
+    assert len(batch) == count
+    return batch
+
+
+def _expected(full, start=None, end=None, host=None, peer=None):
+    src, dst = _names(full.src), _names(full.dst)
+    keep = np.ones(len(full), dtype=bool)
+    if start is not None:
+        keep &= full.timestamp >= start
+    if end is not None:
+        keep &= full.timestamp <= end
+    if host and peer:
+        keep &= ((src == host) & (dst == peer)) | ((src == peer) & (dst == host))
+    elif host:
+        keep &= (src == host) | (dst == host)
+    return full[keep]
+
+
+def test_index_covers_every_chunk(analysed):
+    path, analysis, index = analysed
+    assert index is not None and index.captures[0].endswith('traffic.pcap')
+    assert index.rows == analysis.packets_read
+    # Each chunk writes its own part
+    assert len(index.parts) == 5
+    found = index.find()
+    assert np.all(np.diff(found['timestamp']) >= 0)
+    assert np.array_equal(np.sort(found['timestamp']), np.sort(_packets(path).timestamp))
+
+
+def test_carve_by_time_range(analysed, tmp_path):
+    path, _, index = analysed
+    full = _packets(path)
+    start, end = np.quantile(full.timestamp, [0.4, 0.45]).astype(np.int64).tolist()
+    carved = _carve(index, tmp_path / 'range.pcap', start=start, end=end)
+    assert len(carved) and np.all(np.diff(carved.timestamp) >= 0)
+    assert np.array_equal(_rows(carved), _rows(_expected(full, start, end)))
+
+
+def test_carve_by_incident_scope(analysed, tmp_path):
+    path, analysis, index = analysed
+    full = _packets(path)
+    scopes = dict(zip(analysis.incidents.type_names().tolist(), incident_scopes(analysis.incidents)))
+    # A pair of hosts, a host and all of its peers, and the whole link
+    assert scopes['PORT_SCAN']['peer'] and scopes['HOST_SCAN']['peer'] is None
+    assert scopes['TRAFFIC_BURST']['host'] is None
+    for name in ('PORT_SCAN', 'HOST_SCAN', 'TRAFFIC_BURST'):
+        carved = _carve(index, tmp_path / f'{name}.pcap', **scopes[name])
+        assert len(carved), name
+        assert np.array_equal(_rows(carved), _rows(_expected(full, **scopes[name]))), name
+
+
+def test_carve_with_a_filter_matches_a_filtered_read(analysed, tmp_path):
+    path, _, index = analysed
+    # The busiest client
+    names, counts = np.unique(_names(_packets(path).src), return_counts=True)
+    where = f'host {names[counts.argmax()]} and tcp and dst port 443'
+    carved = _carve(index, tmp_path / 'filtered.pcap', where=where)
+    assert len(carved)
+    assert np.array_equal(_rows(carved), _rows(_packets(path, where=where)))
+
+
+def test_carve_without_sendfile(analysed, tmp_path, monkeypatch):
+    path, _, index = analysed
+    full = _packets(path)
+    start, end = np.quantile(full.timestamp, [0.1, 0.3]).astype(np.int64).tolist()
+    kernel = _carve(index, tmp_path / 'sendfile.pcap', start=start, end=end)
+    monkeypatch.setattr(evidence, 'SENDFILE', False)
+    monkeypatch.delattr(evidence.os, 'sendfile', raising=False)
+    mapped = _carve(index, tmp_path / 'mmap.pcap', start=start, end=end)
+    assert (tmp_path / 'mmap.pcap').read_bytes() == (tmp_path / 'sendfile.pcap').read_bytes()
+    assert np.array_equal(_rows(mapped), _rows(kernel))
+
+
+def test_changed_capture_invalidates_the_index(tmp_path):
+    path = str(tmp_path / 'small.pcap')
+    TrafficGenerator(seed=1, duration=60, clients=50, servers=20).write(path, 2000)
+    analyze_capture(path, workers=1, index_root=str(tmp_path / 'index'))
+    assert CaptureIndex.open(str(tmp_path / 'index')).rows == sum(len(batch) for batch in read_pcap(path))
+    with open(path, 'ab') as f:
+        f.write(b'\0' * 16)
+    assert CaptureIndex.open(str(tmp_path / 'index')) is None
@@ -0,0 +1,211 @@
+import socket
+import struct
+import numpy as np
+import pytest
+from analyzer.synthetic import TrafficGenerator
+from analyzer.capture import compile_bpf
+from analyzer.pcap import decode_records, LINKTYPE_ETHERNET, LINKTYPE_RAW
+from custom_types import PROTOCOL_CODES, ipv4_to_mapped
+from storage import TrafficStore
+from tools.filters import compile_filter, Filter, FilterError
+
+# Expressions whose kernel program decides exactly as the filter does
+EXACT = [
+    'host 10.0.0.1', 'src net 10.0.0.0/16 and dst port 443', 'net 2001:db8::/32',
+    'src host 2001:db8::1 or dst host fe80::1', 'port 22 and tcpflags syn', 'udp or icmp', 'http or https',
+    'portrange 0-1000', 'not tcp', 'src and dst net 10.0.0.0/8', 'len > 1000', 'len <= 200 and not port 53',
+    'other', 'port 0', 'tcpflags syn,ack and not (port 80 or 443)', 'src or dst port 8080', 'tcp and len != 60',
+    'net ::ffff:0:0/96', '::ffff:10.0.0.1', 'not (udp and src port 53) and len >= 100',
+    'len < 300 or len = 1000 and udp',
+]
+
+V4_HOSTS = ['10.0.0.1', '10.0.1.5', '10.1.0.9', '192.168.1.7', '8.8.8.8']
+V6_HOSTS = ['2001:db8::1', '2001:db8:1::5', 'fe80::1', '2a00::2', '::ffff:10.0.0.1']
+PORTS = [22, 53, 80, 443, 8080, 1000, 50000, 0]
+LENGTHS = [60, 100, 200, 300, 1000, 1001]
+
+
+def _run_bpf(program, data, wirelen):
+    # Classic BPF as the kernel runs it over one frame, for the instructions
+    # compile_bpf emits; a load past the captured bytes rejects the packet
+    a = x = pc = 0
+    while True:
+        code, jt, jf, k = program[pc]
+        pc += 1
+        kind = code & 0x07
+        if kind in (0x00, 0x01):
+            mode, size = code & 0xE0, {0x00: 4, 0x08: 2, 0x10: 1}[code & 0x18]
+            if mode == 0x80:
+                a = wirelen
+                continue
+            offset = k + (x if mode == 0x40 else 0)
+            if offset + size > len(data):
+                return 0
+            if mode == 0xA0:
+                x = (data[offset] & 0x0F) * 4
+            else:
+                a = int.from_bytes(data[offset:offset + size], 'big')
+        elif kind == 0x04:
+            assert code & 0xF0 == 0x50
+            a &= k
+        elif kind == 0x05:
+            operation = code & 0xF0
+            if operation == 0x00:
+                pc += k
+                continue
+            taken = {0x10: a == k, 0x20: a > k, 0x30: a >= k, 0x40: a & k != 0}[operation]
+            pc += jt if taken else jf
+        elif kind == 0x06:
+            return k
+        else:
+            raise AssertionError(f"Unexpected instruction {code:#x}")
+
+
+def _frame(rng):
+    # A random Ethernet frame: IPv4 (sometimes fragmented) or IPv6, TCP, UDP,
+    # ICMP or GRE, sometimes behind a VLAN tag, sometimes not IP at all
+    version = 6 if rng.random() < 0.4 else 4
+    proto = int(rng.choice([6, 6, 17, 1 if version == 4 else 58, 47]))
+    ports = struct.pack('>HH', *rng.choice(PORTS, 2))
+    if proto == 6:
+        l4 = ports + bytes(8) + bytes([0x50, int(rng.integers(256))]) + bytes(6)
+    elif proto == 17:
+        l4 = ports + bytes(4)
+    else:
+        l4 = bytes(8)
+    if version == 4:
+        src, dst = (socket.inet_aton(address) for address in rng.choice(V4_HOSTS, 2))
+        fragment = 0x4000 if rng.random() < 0.85 else int(rng.choice([0x2000, 0x2001, 0x1000, 0x1FFF]))
+        ip = struct.pack('>BBHHHBBH4s4s', 0x45, 0, 20 + len(l4), 0, fragment, 64, proto, 0, src, dst)
+        ethertype = 0x0800
+    else:
+        src, dst = (socket.inet_pton(socket.AF_INET6, address) for address in rng.choice(V6_HOSTS, 2))
+        ip = struct.pack('>IHBB16s16s', 0x60000000, len(l4), proto, 64, src, dst)
+        ethertype = 0x86DD
+    if rng.random() < 0.05:
+        ethertype, ip, l4 = 0x0806, bytes(28), b''  # ARP
+    tag = struct.pack('>HH', 0x8100, int(rng.integers(4096))) if rng.random() < 0.2 else b''
+    frame = bytes(6) + bytes(6) + tag + struct.pack('>H', ethertype) + ip + l4
+    # Some lengths on the boundaries of the comparisons below
+    length = int(rng.choice(LENGTHS)) if rng.random() < 0.3 else int(rng.integers(60, 1600))
+    return frame, max(len(frame), length), bool(tag)
+
+
+def _decode(frames, wirelens, linktype):
+    data = np.frombuffer(b''.join(frames), dtype=np.uint8)
+    caplens = np.array([len(frame) for frame in frames])
+    offsets = np.r_[0, np.cumsum(caplens)[:-1]]
+    return decode_records(data, offsets, caplens, np.array(wirelens), np.arange(len(frames)), linktype, rows=True)
+
+
+def _frames(n=3000):
+    rng = np.random.default_rng(7)
+    frames, wirelens, tagged = zip(*(_frame(rng) for _ in range(n)))
+    return frames, wirelens, np.array(tagged)
+
+
+FRAMES = _frames()
+
+
+def _compare(text, filtered, linktype=LINKTYPE_ETHERNET):
+    # (kept by the kernel program, matched by `filtered`, IP frames, tagged
+    # frames) for each frame; raw IP frames are the untagged frames without
+    # their Ethernet header, as on a tunnel device
+    frames, wirelens, tagged = FRAMES
+    if linktype == LINKTYPE_RAW:
+        frames = [frame[14:] for frame, tag in zip(frames, tagged) if not tag]
+        wirelens = [wirelen - 14 for wirelen, tag in zip(wirelens, tagged) if not tag]
+        tagged = np.zeros(len(frames), dtype=bool)
+    batch, rows = _decode(frames, wirelens, linktype)
+    matched = np.zeros(len(frames), dtype=bool)
+    matched[rows] = compile_filter(filtered).mask(batch)
+    ip = np.zeros(len(frames), dtype=bool)
+    ip[rows] = True
+    program = compile_bpf(text, linktype)
+    kept = np.array([_run_bpf(program, frame, wirelen) != 0 for frame, wirelen in zip(frames, wirelens)])
+    return kept, matched, ip, tagged
+
+
+@pytest.mark.parametrize('text', ['', 'host', 'host 10.0.0.1/24', 'port 70000', 'portrange 10-5', 'portrange 10',
+                                  'proto gre', 'tcpflags foo', 'len >', 'len > abc', '(tcp', 'tcp)', 'tcp udp',
+                                  'host 999.1.1.1', 'src tcp', 'tcp $', 'not', 'tcp and'])
+def test_invalid_expressions_raise_filter_errors(text):
+    with pytest.raises(FilterError):
+        Filter(text)
+
+
+def test_flow_columns_are_missing_from_packets():
+    with pytest.raises(FilterError, match='packets'):
+        compile_filter('packets > 3').mask(_decode(FRAMES[0], FRAMES[1], LINKTYPE_ETHERNET)[0])
+
+
+def test_masks_follow_the_expression():
+    batch = TrafficGenerator(seed=2, duration=600, clients=200, servers=50).generate(50000)
+    src, dst = batch.src, batch.dst
+    host = socket.inet_ntoa(struct.pack('>I', src[0]))
+    tcp = np.isin(batch.protocol, [PROTOCOL_CODES[name] for name in ('TCP', 'HTTP', 'HTTPS')])
+    cases = {
+        # `port 80 or 443` repeats the qualifiers; `and` and `or` group from the left
+        'dst port 80 or 443': np.isin(batch.dst_port, (80, 443)),
+        'tcp or udp and port 53': (tcp | (batch.protocol == PROTOCOL_CODES['UDP']))
+        & ((batch.src_port == 53) | (batch.dst_port == 53)),
+        'not tcp and len > 1000': ~tcp & (batch.length > 1000),
+        'src and dst net 0.0.0.0/1': (src >> 31 == 0) & (dst >> 31 == 0),
+        'src net 10.0.0.0/8 and not dst net 0.0.0.0/1': (src >> 24 == 10) & (dst >> 31 == 1),
+        # Selective enough for the later clauses to only see the selected rows
+        f'host {host} and tcpflags syn and len < 100':
+            ((src == src[0]) | (dst == src[0])) & (batch.tcp_flags & 0x02 != 0) & (batch.length < 100),
+        'portrange 1000-2000 or not (tcp or udp)': ((batch.src_port >= 1000) & (batch.src_port <= 2000))
+        | ((batch.dst_port >= 1000) & (batch.dst_port <= 2000))
+        | ~(tcp | (batch.protocol == PROTOCOL_CODES['UDP'])),
+    }
+    for text, expected in cases.items():
+        assert 0 < np.count_nonzero(expected) < len(batch), text
+        assert np.array_equal(compile_filter(text).mask(batch), expected), text
+    # The same expression on IPv4-mapped IPv6 columns
+    mapped = {'src': ipv4_to_mapped(src), 'dst': ipv4_to_mapped(dst)}
+    assert np.array_equal(compile_filter(f'host {host}').mask(mapped), (src == src[0]) | (dst == src[0]))
+    assert compile_filter(f'host {host}').pushdown()['host'].tobytes() == mapped['src'][:1].tobytes()
+
+
+def test_pushdown_requires_every_row():
+    assert set(compile_filter('host 10.0.0.1 and dst port 22 and tcp').pushdown()) == {'host', 'dst_port'}
+    assert len(compile_filter('host 10.0.0.1 or host 10.0.0.2').pushdown()['host']) == 2
+    assert compile_filter('portrange 20-25').pushdown()['port'].tolist() == list(range(20, 26))
+    for text in ('host 10.0.0.1 or port 22', 'not port 22', 'portrange 1-1024', 'src and dst host 10.0.0.1',
+                 'net 10.0.0.0/8'):
+        assert compile_filter(text).pushdown() == {}, text
+
+
+def test_store_queries_match_the_mask(tmp_path):
+    batch = TrafficGenerator(seed=6, duration=600, clients=100, servers=40).generate(30000)
+    store = TrafficStore(str(tmp_path))
+    store.append('packets', batch)
+    store.flush()
+    host = socket.inet_ntoa(struct.pack('>I', batch.src[0]))
+    for text in (f'host {host} and port 443', f'host {host} or dst port 22', 'port 22 and tcpflags syn',
+                 'dst port 80 or 443 and len > 500', f'not host {host}'):
+        expected = compile_filter(text).apply(batch)
+        found = store.query('packets', where=text)
+        assert len(found) == len(expected), text
+        assert sorted(zip(found.timestamp.tolist(), found.src.tolist(), found.src_port.tolist())) == \
+            sorted(zip(expected.timestamp.tolist(), expected.src.tolist(), expected.src_port.tolist())), text
+
+
+@pytest.mark.parametrize('linktype', [LINKTYPE_ETHERNET, LINKTYPE_RAW])
+@pytest.mark.parametrize('text', EXACT)
+def test_kernel_program_matches_the_filter(text, linktype):
+    kept, matched, ip, tagged = _compare(text, text, linktype)
+    # Tagged frames are left to the capture, anything else but IP is dropped
+    assert kept[tagged].all()
+    assert not kept[~ip & ~tagged].any()
+    assert np.array_equal(kept[~tagged], matched[~tagged])
+
+
+@pytest.mark.parametrize('text, kept', [('port 22 and packets > 5', 'port 22'),
+                                        ('not (bytes > 100 or tcp)', 'not tcp'),
+                                        ('len > 70000 or udp', 'udp')])
+def test_kernel_program_only_widens(text, kept):
+    # Terms the kernel cannot check let packets through, under `not` as well
+    found, matched, ip, tagged = _compare(text, kept)
+    assert found[matched].all()
@@ -0,0 +1,54 @@
+import numpy as np
+from analyzer.synthetic import TrafficGenerator
+from analyzer.parallel import analyze_capture
+from analyzer.flows import FlowTable
+from custom_types import FlowBatch, FLOW_END_REASONS
+
+
+def _sorted(flows):
+    order = np.lexsort((flows.dst_port, flows.src_port, flows.first_seen))
+    return {name: getattr(flows, name)[order] for name in
+            ('first_seen', 'last_seen', 'src', 'dst', 'src_port', 'dst_port', 'packets', 'bytes',
+             'rev_packets', 'rev_bytes', 'tcp_flags', 'end_reason')}
+
+
+def _capture(tmp_path):
+    path = str(tmp_path / 'traffic.pcap')
+    TrafficGenerator(seed=3, duration=300, clients=300, servers=100).write(path, 40000)
+    return path
+
+
+def test_serial_and_parallel_flows_are_equal(tmp_path):
+    path = _capture(tmp_path)
+    serial = analyze_capture(path, workers=1).flows
+    parallel = analyze_capture(path, workers=2, chunks=9).flows
+    assert len(serial) == len(parallel)
+    expected, found = _sorted(serial), _sorted(parallel)
+    for name in expected:
+        assert np.array_equal(expected[name], found[name]), name
+
+
+def test_flows_do_not_depend_on_the_batch_size():
+    batch = TrafficGenerator(seed=5, duration=300, clients=300, servers=100).generate(20000)
+    results = []
+    for size in (20000, 1000, 77):
+        table = FlowTable()
+        flows = [table.add(batch[start:start + size]) for start in range(0, len(batch), size)]
+        results.append(_sorted(FlowBatch.concat(flows + [table.flush()])))
+    for other in results[1:]:
+        for name in results[0]:
+            assert np.array_equal(results[0][name], other[name]), name
+
+
+def test_flows_ended_between_looks_keep_their_reason():
+    batch = TrafficGenerator(seed=5, duration=300, clients=300, servers=100).generate(2000)
+    first, later = batch[:1], batch[1:2]
+    later.timestamp = first.timestamp + 70 * 1_000_000_000
+    later.src_port = later.src_port + 1
+    # No look for ended flows before the flush
+    table = FlowTable(expire_interval=3600)
+    assert not len(table.add(first)) and not len(table.add(later))
+    flows = table.flush()
+    reasons = [FLOW_END_REASONS[reason] for reason in flows.end_reason]
+    assert sorted(zip(flows.first_seen.tolist(), reasons)) == [(int(first.timestamp[0]), 'IDLE'),
+                                                               (int(later.timestamp[0]), 'FLUSH')]
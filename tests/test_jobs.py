@@ -0,0 +1,113 @@
+import os
+import sys
+import time
+import subprocess
+import pytest
+from tools.jobs import JobStore, JobQueue, JobHandle
+
+
+def _count(job, packets):
+    # Job targets run in a worker process, so they live at module level
+    job.progress(packets * 100, packets, force=True)
+    return {'packets': packets}
+
+
+def _crash(job):
+    raise ValueError('not a capture')
+
+
+def _wait(store, job_id, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = store.get(job_id)
+        if job['status'] in ('done', 'failed'):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"Job {job_id} did not finish")
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / 'jobs' / 'jobs.sqlite3'))
+
+
+def test_job_lifecycle(store, tmp_path):
+    capture = tmp_path / 'capture.pcap'
+    capture.write_bytes(b'\0' * 1000)
+    job_id = store.create('analyze', 'capture.pcap', str(capture))
+    assert JobStore.valid_id(job_id)
+    job = store.get(job_id)
+    assert job['status'] == 'queued' and job['size'] == 1000 and job['pid'] == os.getpid()
+    assert job['eta'] is None and job['result'] is None
+    store.start(job_id)
+    store.progress(job_id, 400, 12)
+    job = store.get(job_id)
+    assert job['status'] == 'running' and (job['bytes_done'], job['packets']) == (400, 12)
+    assert job['rate'] > 0 and job['eta'] == pytest.approx(600 / job['rate'])
+    store.finish(job_id, {'packets': 12})
+    job = store.get(job_id)
+    assert job['status'] == 'done' and job['result'] == {'packets': 12} and job['eta'] is None
+    failed = store.create('analyze', size=10)
+    assert store.get(failed)['size'] == 10
+    store.fail(failed, 'ValueError: bad')
+    assert store.counts() == {'done': 1, 'failed': 1}
+    assert [job['id'] for job in store.list()] == [failed, job_id]
+    assert store.get('0' * 32) is None
+
+
+def test_recover_fails_jobs_of_dead_processes(store):
+    # A process that has exited, as a worker after a restart
+    child = subprocess.Popen([sys.executable, '-c', 'pass'])
+    child.wait()
+    orphaned, queued, mine = store.create('analyze'), store.create('analyze'), store.create('analyze')
+    store._update(orphaned, status='running', pid=child.pid)
+    store._update(queued, pid=child.pid)
+    store.start(mine)
+    store.recover()
+    for job_id in (orphaned, queued):
+        job = store.get(job_id)
+        assert job['status'] == 'failed' and job['error'] == 'Interrupted before it finished'
+    assert store.get(mine)['status'] == 'running'
+
+
+def test_expire_forgets_finished_jobs(store):
+    done, failed, running = store.create('analyze'), store.create('analyze'), store.create('analyze')
+    store.finish(done, {})
+    store.fail(failed, 'ValueError: bad')
+    store.start(running)
+    store.expire(time.time() - 60)
+    assert store.counts() == {'done': 1, 'failed': 1, 'running': 1}
+    store.expire(time.time() + 1)
+    assert store.counts() == {'running': 1}
+
+
+def test_queue_runs_jobs_in_workers(store):
+    queue = JobQueue(store, workers=1)
+    try:
+        done = queue.submit('analyze', _count, 25, filename='capture.pcap', size=5000)
+        failed = queue.submit('analyze', _crash)
+        job = _wait(store, done)
+        assert job['status'] == 'done' and job['result'] == {'packets': 25}
+        assert (job['bytes_done'], job['packets'], job['filename']) == (2500, 25, 'capture.pcap')
+        assert job['pid'] != os.getpid()
+        job = _wait(store, failed)
+        assert job['status'] == 'failed' and job['error'] == 'ValueError: not a capture'
+    finally:
+        queue.shutdown()
+
+
+def test_handle_throttles_progress(store):
+    job_id = store.create('analyze')
+    handle = JobHandle(store.path, job_id)
+    handle.progress(10, 1)
+    handle.progress(20, 2)
+    assert store.get(job_id)['packets'] == 1
+    handle.progress(30, 3, force=True)
+    assert store.get(job_id)['packets'] == 3
+
+
+def test_job_ids_are_checked():
+    assert not JobStore.valid_id('')
+    assert not JobStore.valid_id('../jobs')
+    assert not JobStore.valid_id('A' * 32)
+    assert not JobStore.valid_id('0' * 31)
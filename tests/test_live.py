@@ -0,0 +1,58 @@
+import os
+from analyzer.live import _publish
+from tools.metrics import MetricsRegistry
+from tools.snapshots import SnapshotChannel
+
+
+def test_oversized_snapshot_is_trimmed_to_fit():
+    channel = SnapshotChannel(f'network-forensics-test-{os.getpid()}', size=16384, create=True)
+    errors = MetricsRegistry().counter('live_errors', 'Live snapshots', ['stage'])
+    try:
+        incidents = [{'type': 'PORT_SCAN', 'details': 'x' * 500}] * 200
+        _publish(channel, {'packets': 1, 'incidents': incidents, 'recent_incidents': incidents}, errors)
+        snapshot = channel.read()[2]
+        assert snapshot['packets'] == 1
+        assert 0 < len(snapshot['incidents']) < 200
+        assert errors.labels('publish').value == 1
+    finally:
+        channel.close(unlink=True)
+
+
+def test_producer_is_spawned_and_publishes(tmp_path):
+    # The analyzer and detector are pickled to a fresh interpreter, sink and
+    # history store included
+    from analyzer import TrafficAnalyzer, LiveFeed
+    from detector import IncidentDetector, IncidentSink, JsonLinesSink
+    from storage import TrafficStore
+    analyzer = TrafficAnalyzer()
+    analyzer.store = TrafficStore(str(tmp_path / 'store'))
+    detector = IncidentDetector()
+    detector.sink = IncidentSink([JsonLinesSink(str(tmp_path / 'incidents.log'))])
+    feed = LiveFeed(analyzer, detector, f'network-forensics-test-{os.getpid()}', str(tmp_path / 'live.lock'))
+    try:
+        sequence, snapshot = feed.current()
+        assert sequence and snapshot['packets'] > 0
+        assert feed.process.is_alive()
+    finally:
+        feed.stop()
+
+
+def test_waiting_streams_share_one_watcher(tmp_path):
+    import threading
+    from analyzer import TrafficAnalyzer, LiveFeed
+    from detector import IncidentDetector
+    feed = LiveFeed(TrafficAnalyzer(), IncidentDetector(), f'network-forensics-test-{os.getpid()}-wait',
+                    str(tmp_path / 'live.lock'))
+    results = []
+    waiters = [threading.Thread(target=lambda: results.append(feed.wait(0, 10))) for _ in range(8)]
+    try:
+        for waiter in waiters:
+            waiter.start()
+        for waiter in waiters:
+            waiter.join()
+        assert len(results) == 8 and all(result and result[0] for result in results)
+        assert [thread.name for thread in threading.enumerate()].count('live-watcher') == 1
+        sequence = results[0][0]
+        assert feed.wait(sequence, 10)[0] != sequence
+    finally:
+        feed.stop()
@@ -0,0 +1,111 @@
+import struct
+import numpy as np
+import pytest
+from custom_types import PacketBatch
+from analyzer.synthetic import TrafficGenerator
+from analyzer.pcap import encode_records, LINKTYPE_ETHERNET
+from analyzer.merge import MergedCapture, estimate_offsets, DEDUP_WINDOW
+from analyzer.parallel import analyze_captures
+
+SHIFT = 300_000  # ns a second sensor sees a packet after the first, within DEDUP_WINDOW
+
+
+@pytest.fixture(scope='module')
+def traffic():
+    batch = TrafficGenerator(seed=9, duration=120, clients=200, servers=80).generate(20000)
+    batch = batch[np.argsort(batch.timestamp, kind='stable')]
+    # Records of one encoding, so a packet has the same headers in every capture
+    data = encode_records(batch)
+    records, pos = [], 0
+    while pos < len(data):
+        size = 16 + struct.unpack_from('<I', data, pos + 8)[0]
+        records.append(data[pos:pos + size])
+        pos += size
+    return batch, records
+
+
+def _write(path, records, rows, shift=0):
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', 0xA1B23C4D, 2, 4, 0, 0, 65535, LINKTYPE_ETHERNET))
+        for row in rows:
+            record = records[row]
+            seconds, nanoseconds = struct.unpack_from('<II', record)
+            timestamp = seconds * 1_000_000_000 + nanoseconds + shift
+            f.write(struct.pack('<II', timestamp // 1_000_000_000, timestamp % 1_000_000_000) + record[8:])
+    return str(path)
+
+
+def _overlapping(tmp_path, traffic, shift):
+    # Two sensors that both saw a third of the packets
+    batch, records = traffic
+    rows = np.arange(len(batch))
+    first = _write(tmp_path / 'a.pcap', records, rows[rows % 3 != 2])
+    second = _write(tmp_path / 'b.pcap', records, rows[rows % 3 != 0], shift)
+    return first, second, int(np.count_nonzero(rows % 3 == 1))
+
+
+def _merge(sources, **kwargs):
+    with MergedCapture(sources, batch_size=997, **kwargs) as merged:
+        batches = list(merged)
+        return PacketBatch.concat(batches), merged.packets_duplicate, merged.offsets
+
+
+def _columns(batch):
+    columns = [batch.src, batch.dst, batch.src_port, batch.dst_port, batch.protocol, batch.length]
+    return np.stack(columns)[:, np.lexsort(columns[::-1])]
+
+
+def test_shared_packets_are_kept_once_in_time_order(tmp_path, traffic):
+    batch, _ = traffic
+    first, second, shared = _overlapping(tmp_path, traffic, SHIFT)
+    merged, duplicate, offsets = _merge([first, second])
+    assert duplicate == shared and offsets == [0.0, 0.0]
+    assert len(merged) == len(batch)
+    assert np.all(np.diff(merged.timestamp) >= 0)
+    # The first sensor's copy is kept; what only the second saw is at its time
+    rows = np.arange(len(batch))
+    expected = batch.timestamp + np.where(rows % 3 == 2, SHIFT, 0)
+    assert np.array_equal(merged.timestamp, np.sort(expected))
+    assert np.array_equal(_columns(merged), _columns(batch))
+
+
+def test_copies_outside_the_window_are_kept(tmp_path, traffic):
+    batch, _ = traffic
+    shift = int(3 * DEDUP_WINDOW * 1_000_000_000)
+    first, second, shared = _overlapping(tmp_path, traffic, shift)
+    merged, duplicate, _ = _merge([first, second])
+    assert duplicate == 0 and len(merged) == len(batch) + shared
+    merged, duplicate, _ = _merge([first, second], dedup_window=4 * DEDUP_WINDOW)
+    assert duplicate == shared and len(merged) == len(batch)
+
+
+def test_automatic_offsets_line_up_skewed_clocks(tmp_path, traffic):
+    batch, _ = traffic
+    # The second sensor's clock is 2.5 s behind
+    first, second, shared = _overlapping(tmp_path, traffic, -2_500_000_000)
+    assert estimate_offsets([first, second]) == [0.0, 2.5]
+    merged, duplicate, offsets = _merge([first, second])
+    assert duplicate == 0 and len(merged) == len(batch) + shared
+    merged, duplicate, offsets = _merge([first, second], offsets='auto')
+    assert offsets == [0.0, 2.5]
+    assert duplicate == shared and len(merged) == len(batch)
+    assert np.array_equal(merged.timestamp, batch.timestamp)
+    with pytest.raises(ValueError):
+        MergedCapture([first, second], offsets=[0.0])
+
+
+def test_analyze_captures_reports_duplicates_and_offsets(tmp_path, traffic):
+    batch, _ = traffic
+    first, second, shared = _overlapping(tmp_path, traffic, -1_000_000_000)
+    analysis = analyze_captures([first, second], offsets='auto')
+    assert analysis.offsets == [0.0, 1.0]
+    assert analysis.packets_duplicate == shared
+    assert analysis.packets_read == len(batch) + shared
+    assert analysis.flows.packets.sum() + analysis.flows.rev_packets.sum() == len(batch)
+
+
+def test_cli_rejects_workers_for_merged_captures(tmp_path, capsys):
+    import main
+    with pytest.raises(SystemExit):
+        main.main(['analyze', str(tmp_path / 'a.pcap'), str(tmp_path / 'b.pcap'), '--workers', '4'])
+    assert '--workers and --chunks' in capsys.readouterr().err
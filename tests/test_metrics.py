@@ -0,0 +1,89 @@
+import re
+import pytest
+from tools.metrics import MetricsRegistry, SamplingProfiler, render, PREFIX
+
+# A sample line of the text exposition format: name, optional labels, value
+SAMPLE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{([a-zA-Z_][a-zA-Z0-9_]*="([^"\\]|\\[\\n"])*",?)*\})? '
+                    r'(-?[0-9.e+-]+|\+Inf|NaN)$')
+
+
+def _lines(text):
+    assert text.endswith('\n')
+    lines = text.splitlines()
+    for line in lines:
+        assert line.startswith(('# HELP ', '# TYPE ')) or SAMPLE.match(line), line
+    return lines
+
+
+@pytest.fixture
+def registry():
+    registry = MetricsRegistry()
+    incidents = registry.counter('incidents', 'Incidents detected, by type', ['type'])
+    incidents.labels('PORT_SCAN').inc()
+    incidents.labels('PORT_SCAN').inc(2)
+    incidents.labels('say "hi"\n\\').inc()
+    registry.gauge('queue', 'Batches waiting').set(7)
+    registry.gauge('jobs', 'Jobs, by status', ['status'], function=lambda: {'done': 3, 'failed': 1})
+    seconds = registry.histogram('stage_seconds', 'Time per stage', ['stage'], buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 3.0):
+        seconds.labels('detect').observe(value)
+    return registry
+
+
+def test_exposition_format(registry):
+    lines = _lines(render((registry.collect(), {})))
+    assert lines[:5] == [
+        f'# HELP {PREFIX}incidents_total Incidents detected, by type',
+        f'# TYPE {PREFIX}incidents_total counter',
+        f'{PREFIX}incidents_total{{type="PORT_SCAN"}} 3',
+        f'{PREFIX}incidents_total{{type="say \\"hi\\"\\n\\\\"}} 1',
+        f'# HELP {PREFIX}queue Batches waiting',
+    ]
+    assert f'# TYPE {PREFIX}queue gauge' in lines and f'{PREFIX}queue 7' in lines
+    assert f'{PREFIX}jobs{{status="done"}} 3' in lines and f'{PREFIX}jobs{{status="failed"}} 1' in lines
+    # Buckets are cumulative and end at +Inf
+    start = lines.index(f'# TYPE {PREFIX}stage_seconds histogram') + 1
+    assert lines[start:] == [
+        f'{PREFIX}stage_seconds_bucket{{stage="detect",le="0.1"}} 1',
+        f'{PREFIX}stage_seconds_bucket{{stage="detect",le="1.0"}} 3',
+        f'{PREFIX}stage_seconds_bucket{{stage="detect",le="+Inf"}} 4',
+        f'{PREFIX}stage_seconds_sum{{stage="detect"}} 4.05',
+        f'{PREFIX}stage_seconds_count{{stage="detect"}} 4',
+    ]
+
+
+def test_sources_are_merged_by_family(registry):
+    other = MetricsRegistry()
+    other.counter('incidents', 'Incidents detected, by type', ['type']).labels('HOST_SCAN').inc()
+    lines = _lines(render((registry.collect(), {'process': 'web'}), (other.collect(), {'process': 'producer'})))
+    # One HELP and TYPE per family, with the samples of every process under it
+    assert lines.count(f'# TYPE {PREFIX}incidents_total counter') == 1
+    start = lines.index(f'# TYPE {PREFIX}incidents_total counter') + 1
+    assert lines[start:start + 3] == [
+        f'{PREFIX}incidents_total{{type="PORT_SCAN",process="web"}} 3',
+        f'{PREFIX}incidents_total{{type="say \\"hi\\"\\n\\\\",process="web"}} 1',
+        f'{PREFIX}incidents_total{{type="HOST_SCAN",process="producer"}} 1',
+    ]
+    assert f'{PREFIX}queue{{process="web"}} 7' in lines
+
+
+def test_failing_gauges_are_left_out(registry):
+    registry.gauge('broken', 'Owner went away', function=lambda: 1 / 0)
+    assert all(family['name'] != 'broken' for family in registry.collect())
+
+
+def test_reset_keeps_only_builtin_metrics(registry):
+    registry.builtin.add('incidents')
+    registry.reset()
+    assert list(registry.metrics) == ['incidents']
+    assert registry.collect()[0]['samples'] == []
+
+
+def test_profiler_collapses_stacks():
+    profiler = SamplingProfiler(interval=0.005)
+    text = profiler.profile(0.1)
+    assert profiler.samples > 0 and text
+    for line in text.splitlines():
+        stack, count = line.rsplit(' ', 1)
+        assert int(count) > 0 and stack
+    assert 'test_profiler_collapses_stacks' in text
@@ -0,0 +1,282 @@
+import socket
+import struct
+import numpy as np
+import pytest
+from custom_types import PacketBatch, PROTOCOL_CODES, format_addresses
+from analyzer.synthetic import TrafficGenerator
+from analyzer.pcap import (PcapReader, read_pcap, write_pcap, split_capture, find_record, capture_header,
+                           LINKTYPE_ETHERNET, LINKTYPE_RAW, LINKTYPE_NULL, LINKTYPE_LOOP, LINKTYPE_LINUX_SLL,
+                           PCAPNG_SHB, PCAPNG_IDB, PCAPNG_EPB, PCAPNG_SPB, PcapError)
+
+START = 1_700_000_000 * 1_000_000_000
+
+
+def _ipv4(src, dst, proto=6, sport=40000, dport=80, flags=0x02):
+    if proto == 6:
+        l4 = struct.pack('>HHIIBBHHH', sport, dport, 0, 0, 0x50, flags, 0, 0, 0)
+    else:
+        l4 = struct.pack('>HHHH', sport, dport, 8, 0)
+    return struct.pack('>BBHHHBBH4s4s', 0x45, 0, 20 + len(l4), 1, 0x4000, 64, proto, 0,
+                       socket.inet_aton(src), socket.inet_aton(dst)) + l4
+
+
+def _ipv6(src, dst, proto=17, sport=40000, dport=53, flags=0x02):
+    if proto == 6:
+        l4 = struct.pack('>HHIIBBHHH', sport, dport, 0, 0, 0x50, flags, 0, 0, 0)
+    else:
+        l4 = struct.pack('>HHHH', sport, dport, 8, 0)
+    return struct.pack('>IHBB16s16s', 0x60000000, len(l4), proto, 64, socket.inet_pton(socket.AF_INET6, src),
+                       socket.inet_pton(socket.AF_INET6, dst)) + l4
+
+
+def _ether(ip, ethertype=0x0800, tags=()):
+    return bytes(12) + b''.join(struct.pack('>HH', tpid, 7) for tpid in tags) + struct.pack('>H', ethertype) + ip
+
+
+def _pcap(frames, times, endian='<', nano=True, linktype=LINKTYPE_ETHERNET):
+    records = [struct.pack(endian + 'IHHiIII', 0xA1B23C4D if nano else 0xA1B2C3D4, 2, 4, 0, 0, 65535, linktype)]
+    for frame, time in zip(frames, times):
+        fraction = time % 1_000_000_000 if nano else time % 1_000_000_000 // 1000
+        records.append(struct.pack(endian + 'IIII', time // 1_000_000_000, fraction, len(frame), len(frame)) + frame)
+    return b''.join(records)
+
+
+def _block(endian, block_type, body):
+    body += bytes(-len(body) % 4)
+    return struct.pack(endian + 'II', block_type, 12 + len(body)) + body + struct.pack(endian + 'I', 12 + len(body))
+
+
+def _idb(endian, linktype, tsresol=None, snaplen=0):
+    options = b''
+    if tsresol is not None:
+        options = struct.pack(endian + 'HH', 9, 1) + bytes([tsresol, 0, 0, 0]) + struct.pack(endian + 'HH', 0, 0)
+    return _block(endian, PCAPNG_IDB, struct.pack(endian + 'HHI', linktype, 0, snaplen) + options)
+
+
+def _epb(endian, interface, ticks, frame, wirelen=None):
+    return _block(endian, PCAPNG_EPB, struct.pack(endian + 'IIIII', interface, ticks >> 32, ticks & 0xFFFFFFFF,
+                                                  len(frame), wirelen or len(frame)) + frame)
+
+
+def _shb(endian):
+    return _block(endian, PCAPNG_SHB, struct.pack(endian + 'IHHq', 0x1A2B3C4D, 1, 0, -1))
+
+
+def _read(path, **kwargs):
+    with PcapReader(str(path), **kwargs) as reader:
+        return PacketBatch.concat(list(reader))
+
+
+def _names(column):
+    names, inverse = format_addresses(column)
+    return names[inverse].tolist()
+
+
+def _assert_same(a, b):
+    for name in PacketBatch.fields:
+        np.testing.assert_array_equal(getattr(a, name), getattr(b, name), err_msg=name)
+
+
+def _records(path):
+    # Offsets, timestamps, frames and wire lengths of the records of a pcap file
+    data = open(path, 'rb').read()
+    pos, offsets, records = 24, [], []
+    while pos + 16 <= len(data):
+        seconds, nanoseconds, caplen, wirelen = struct.unpack_from('<IIII', data, pos)
+        offsets.append(pos)
+        records.append((seconds * 1_000_000_000 + nanoseconds, data[pos + 16:pos + 16 + caplen], wirelen))
+        pos += 16 + caplen
+    return offsets, records
+
+
+@pytest.fixture(scope='module')
+def many(tmp_path_factory):
+    # Thousands of records of varied sizes, addresses and ports
+    rng = np.random.default_rng(5)
+    frames = []
+    for i in range(20000):
+        src, dst = f'10.0.{i % 7}.{i % 250 + 1}', f'192.168.{i % 3}.{i % 11 + 1}'
+        if i % 5 == 0:
+            frame = _ether(_ipv6(f'2001:db8::{i % 90 + 1:x}', '2001:db8::ff', sport=i % 60000 + 1))
+        else:
+            frame = _ether(_ipv4(src, dst, proto=6 if i % 3 else 17, sport=i % 60000 + 1, dport=443))
+        frames.append(frame + bytes(int(rng.integers(0, 600))))
+    times = START + np.cumsum(rng.integers(0, 50_000_000, len(frames)))
+    path = tmp_path_factory.mktemp('pcap') / 'many.pcap'
+    path.write_bytes(_pcap(frames, times.tolist()))
+    return path
+
+
+def test_write_pcap_round_trips(tmp_path):
+    batch = TrafficGenerator(seed=2, duration=60).generate(5000)
+    path = tmp_path / 'round.pcap'
+    assert write_pcap(str(path), [batch[:2000], batch[2000:]]) == len(batch)
+    _assert_same(_read(path), batch)
+
+
+@pytest.mark.parametrize('endian', ['<', '>'])
+@pytest.mark.parametrize('nano', [True, False])
+def test_pcap_byte_orders_and_resolutions(tmp_path, endian, nano):
+    times = [START + 123_456_789, START + 1_000_000_001_000, START + 2_999_999_999_000]
+    if not nano:
+        times = [time // 1000 * 1000 for time in times]
+    frames = [_ether(_ipv4('10.0.0.1', '10.0.0.2', dport=443)), _ether(_ipv4('10.0.0.2', '10.0.0.1', proto=17)),
+              _ether(_ipv4('192.168.1.1', '8.8.8.8', dport=22, flags=0x12))]
+    path = tmp_path / 'capture.pcap'
+    path.write_bytes(_pcap(frames, times, endian, nano))
+    batch = _read(path)
+    assert batch.timestamp.tolist() == times
+    assert _names(batch.src) == ['10.0.0.1', '10.0.0.2', '192.168.1.1']
+    assert batch.protocol.tolist() == [PROTOCOL_CODES['HTTPS'], PROTOCOL_CODES['UDP'], PROTOCOL_CODES['TCP']]
+    assert batch.dst_port.tolist() == [443, 80, 22]
+    assert batch.tcp_flags.tolist() == [0x02, 0, 0x12]
+    assert batch.length.tolist() == [len(frame) for frame in frames]
+
+
+@pytest.mark.parametrize('endian', ['<', '>'])
+def test_pcapng_enhanced_and_simple_packet_blocks(tmp_path, endian):
+    # Interfaces in nanoseconds, in the default microseconds (raw IP) and in
+    # 1/1024 s; the simple packet block has no timestamp and uses interface 0
+    v4 = _ether(_ipv4('10.0.0.1', '10.0.0.2'))
+    v6 = _ipv6('2001:db8::1', '2001:db8::2')
+    data = b''.join([
+        _shb(endian),
+        _idb(endian, LINKTYPE_ETHERNET, tsresol=9),
+        _idb(endian, LINKTYPE_RAW),
+        _idb(endian, LINKTYPE_ETHERNET, tsresol=0x8A),
+        _epb(endian, 0, START + 5, v4),
+        _epb(endian, 1, (START + 7000) // 1000, v6),
+        _epb(endian, 2, (START // 1_000_000_000) << 10 | 512, v4),
+        _block(endian, PCAPNG_SPB, struct.pack(endian + 'I', len(v4)) + v4),
+    ])
+    path = tmp_path / 'capture.pcapng'
+    path.write_bytes(data)
+    batch = _read(path)
+    assert batch.timestamp.tolist() == [START + 5, START + 7000, START + 500_000_000, 0]
+    assert _names(batch.src) == ['10.0.0.1', '2001:db8::1', '10.0.0.1', '10.0.0.1']
+    assert batch.protocol.tolist() == [PROTOCOL_CODES['HTTP'], PROTOCOL_CODES['UDP'], PROTOCOL_CODES['HTTP'],
+                                       PROTOCOL_CODES['HTTP']]
+
+
+def test_link_types(tmp_path):
+    v4 = _ipv4('10.0.0.1', '10.0.0.2', dport=8080)
+    v6 = _ipv6('2001:db8::1', 'fe80::2', proto=6, dport=443)
+    captures = {
+        LINKTYPE_ETHERNET: [_ether(v4, tags=[0x8100]), _ether(v4, tags=[0x88A8, 0x8100]), _ether(v6, 0x86DD),
+                            _ether(bytes(28), 0x0806)],
+        LINKTYPE_LINUX_SLL: [bytes(14) + struct.pack('>H', 0x0800) + v4, bytes(14) + struct.pack('>H', 0x86DD) + v6],
+        LINKTYPE_NULL: [struct.pack('<I', 2) + v4, struct.pack('<I', 30) + v6],
+        LINKTYPE_LOOP: [struct.pack('>I', 2) + v4, struct.pack('>I', 24) + v6],
+        LINKTYPE_RAW: [v4, v6],
+    }
+    for linktype, frames in captures.items():
+        path = tmp_path / f'link-{linktype}.pcap'
+        path.write_bytes(_pcap(frames, [START] * len(frames), linktype=linktype))
+        with PcapReader(str(path)) as reader:
+            batch = PacketBatch.concat(list(reader))
+            # ARP carries no IP header and is skipped
+            assert reader.packets_skipped == len(frames) - len(batch)
+        expected = 3 if linktype == LINKTYPE_ETHERNET else 2
+        assert len(batch) == expected, linktype
+        assert _names(batch.src) == ['10.0.0.1'] * (expected - 1) + ['2001:db8::1']
+        assert _names(batch.dst) == ['10.0.0.2'] * (expected - 1) + ['fe80::2']
+        assert batch.dst_port.tolist() == [8080] * (expected - 1) + [443]
+        assert batch.protocol.tolist() == [PROTOCOL_CODES['HTTP']] * (expected - 1) + [PROTOCOL_CODES['HTTPS']]
+
+
+@pytest.mark.parametrize('use_mmap', [True, False])
+def test_truncated_final_record_is_left_out(tmp_path, use_mmap):
+    frames = [_ether(_ipv4('10.0.0.1', '10.0.0.2', sport=port)) for port in range(1000, 1010)]
+    data = _pcap(frames, [START + i for i in range(10)])
+    for cut in (5, len(frames[-1]) + 10):
+        path = tmp_path / f'truncated-{cut}.pcap'
+        path.write_bytes(data[:-cut])
+        with PcapReader(str(path), use_mmap=use_mmap, chunk_size=64) as reader:
+            batch = PacketBatch.concat(list(reader))
+            assert reader.packets_read == 9
+            assert reader.bytes_read == len(data) - 16 - len(frames[-1])
+            assert reader.bytes_trailing == 16 + len(frames[-1]) - cut
+        assert batch.src_port.tolist() == list(range(1000, 1009))
+
+
+def test_short_snapshot_keeps_the_addresses(tmp_path):
+    # Cut after the IP header: no ports, but still an IP packet of its wire length
+    frame = _ether(_ipv4('10.0.0.1', '10.0.0.2'))
+    record = struct.pack('<IIII', START // 1_000_000_000, 0, 34, len(frame)) + frame[:34]
+    path = tmp_path / 'snapped.pcap'
+    path.write_bytes(_pcap([], []) + record)
+    batch = _read(path)
+    assert _names(batch.dst) == ['10.0.0.2'] and batch.dst_port.tolist() == [0]
+    assert batch.length.tolist() == [len(frame)]
+
+
+@pytest.mark.parametrize('use_mmap', [True, False])
+def test_corrupt_record_length_is_rejected(tmp_path, use_mmap):
+    frame = _ether(_ipv4('10.0.0.1', '10.0.0.2'))
+    good = _pcap([frame], [START])
+    seconds = START // 1_000_000_000
+    for caplen, wirelen in ((0x7FFFFFF0, 0x7FFFFFF0), (len(frame), len(frame) - 1)):
+        path = tmp_path / 'corrupt.pcap'
+        path.write_bytes(good + struct.pack('<IIII', seconds, 0, caplen, wirelen) + frame)
+        with pytest.raises(PcapError, match=f'offset {len(good)}'):
+            _read(path, use_mmap=use_mmap, chunk_size=64)
+
+
+def test_corrupt_pcapng_block_is_rejected(tmp_path):
+    frame = _ether(_ipv4('10.0.0.1', '10.0.0.2'))
+    block = bytearray(_epb('<', 0, 0, frame))
+    struct.pack_into('<I', block, 20, len(block))
+    path = tmp_path / 'corrupt.pcapng'
+    path.write_bytes(_shb('<') + _idb('<', LINKTYPE_ETHERNET) + bytes(block))
+    with pytest.raises(PcapError):
+        _read(path)
+
+
+def test_not_a_capture(tmp_path):
+    path = tmp_path / 'notes.pcap'
+    path.write_bytes(b'not a capture at all')
+    with pytest.raises(ValueError):
+        _read(path)
+
+
+def test_find_record_resyncs_to_the_next_record(many):
+    offsets, _ = _records(many)
+    data = many.read_bytes()
+    header = capture_header(data)
+    for k in (10, 5000, 12345):
+        assert find_record(data, offsets[k], header) == offsets[k]
+        assert find_record(data, offsets[k] + 3, header) == offsets[k + 1]
+        assert find_record(data, offsets[k] + 16, header) == offsets[k + 1]
+
+
+def test_split_capture_parts_read_as_the_whole(many):
+    offsets, _ = _records(many)
+    header, ranges = split_capture(str(many), 4)
+    assert len(ranges) == 4 and ranges[0][0] == len(header) == 24
+    assert ranges[-1][1] == many.stat().st_size
+    assert all(end == start for (_, end), (start, _) in zip(ranges[:-1], ranges[1:]))
+    assert {start for start, _ in ranges} <= set(offsets)
+    parts = [_read(many, header=header, byte_range=byte_range) for byte_range in ranges]
+    _assert_same(PacketBatch.concat(parts), _read(many))
+
+
+def test_split_pcapng_parts_read_as_the_whole(many, tmp_path):
+    _, records = _records(many)
+    path = tmp_path / 'many.pcapng'
+    path.write_bytes(_shb('<') + _idb('<', LINKTYPE_ETHERNET, tsresol=9) +
+                     b''.join(_epb('<', 0, *record) for record in records))
+    header, ranges = split_capture(str(path), 3)
+    assert len(ranges) == 3
+    parts = [_read(path, header=header, byte_range=byte_range) for byte_range in ranges]
+    _assert_same(PacketBatch.concat(parts), _read(many))
+
+
+@pytest.mark.parametrize('chunk_size', [1000, 4096, 1 << 20])
+def test_chunked_reads_match_one_full_read(many, chunk_size):
+    whole = list(read_pcap(str(many), batch_size=1 << 20))
+    assert len(whole) == 1
+    with PcapReader(str(many), use_mmap=False, chunk_size=chunk_size, batch_size=1000) as reader:
+        batches = list(reader)
+        assert reader.bytes_read == many.stat().st_size
+    assert all(0 < len(batch) <= 1000 for batch in batches)
+    _assert_same(PacketBatch.concat(batches), whole[0])
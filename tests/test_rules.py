@@ -0,0 +1,47 @@
+import numpy as np
+from custom_types import PacketBatch, INCIDENT_TYPES, PROTOCOL_CODES
+from detector import IncidentDetector
+from detector.rules import NS_PER_SECOND
+
+START = 1_700_000_000 * NS_PER_SECOND
+BURST = INCIDENT_TYPES.index('TRAFFIC_BURST')
+
+
+def _second(second, packets):
+    # `packets` packets spread over one second
+    n = packets
+    return PacketBatch(
+        timestamp=START + second * NS_PER_SECOND + np.arange(n, dtype=np.int64) * (NS_PER_SECOND // n),
+        src=np.full(n, 0x0A000001, dtype=np.uint32),
+        dst=np.full(n, 0x0A000002, dtype=np.uint32),
+        protocol=np.full(n, PROTOCOL_CODES['UDP']),
+        length=np.full(n, 100),
+        src_port=np.full(n, 5000),
+        dst_port=np.full(n, 6000),
+    )
+
+
+def _bursts(incidents):
+    rows = incidents.type == BURST
+    return list(zip((incidents.window[rows] // NS_PER_SECOND - START // NS_PER_SECOND).tolist(),
+                    incidents.count[rows].tolist()))
+
+
+def test_burst_split_between_live_batches_is_counted_whole():
+    # 1200 packets in second 1, delivered as two batches of 600; the rate is 1000
+    detector = IncidentDetector()
+    second = _second(1, 1200)
+    found = _bursts(detector.detect_incidents(PacketBatch.concat([_second(0, 10), second[:600]])))
+    found += _bursts(detector.detect_incidents(second[600:]))
+    assert found == []
+    # Reported once a later second shows it complete
+    found += _bursts(detector.detect_incidents(_second(2, 10)))
+    assert found == [(1, 1200)]
+
+
+def test_held_back_second_is_reported_at_the_end_of_a_stream():
+    detector = IncidentDetector()
+    stream = detector.new_stream()
+    assert _bursts(detector.detect_incidents(_second(5, 1500), stream)) == []
+    assert _bursts(detector.finish_stream(stream)) == [(5, 1500)]
+    assert _bursts(detector.finish_stream(stream)) == []
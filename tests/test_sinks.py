@@ -0,0 +1,17 @@
+import os
+import time
+from detector.sinks import JsonLinesSink
+
+
+def test_rotation_age_survives_restarts(tmp_path):
+    # A producer restarted between batches still rotates once the file is
+    # `max_age` old, although every write moves the file's ctime
+    path = str(tmp_path / 'incidents.log')
+    for _ in range(3):
+        sink = JsonLinesSink(path, max_age=1)
+        sink.write([{'type': 'PORT_SCAN'}])
+        sink.close()
+        time.sleep(0.6)
+    assert os.path.exists(path + '.1')
+    with open(path, encoding='utf-8') as f:
+        assert len(f.readlines()) == 1
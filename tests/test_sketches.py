@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+from tools.sketches import HyperLogLog, SpaceSaving
+
+
+def _exact(keys, weights):
+    counts = {}
+    for key, weight in zip(keys.tolist(), weights.tolist()):
+        counts[key] = counts.get(key, 0) + weight
+    return counts
+
+
+def _summary(keys, weights, capacity):
+    summary = SpaceSaving(capacity, key_dtype=np.int64)
+    for start in range(0, len(keys), 100):
+        summary.update(keys[start:start + 100], weights[start:start + 100])
+    return summary
+
+
+def test_merge_counts_bound_exact_counts():
+    rng = np.random.default_rng(1)
+    parts = []
+    for _ in range(4):
+        keys = rng.zipf(1.3, 20000).astype(np.int64) % 500
+        weights = rng.integers(40, 1500, len(keys))
+        parts.append((keys, weights))
+    exact = _exact(np.concatenate([k for k, _ in parts]), np.concatenate([w for _, w in parts]))
+    merged = SpaceSaving.merged([_summary(keys, weights, 32) for keys, weights in parts], 32)
+    for key, count in zip(merged.keys.tolist(), merged.counts.tolist()):
+        # Counts only ever overestimate, and by no more than the error
+        assert exact[key] <= count <= exact[key] + merged.error
+    heaviest = sorted(exact, key=exact.get, reverse=True)[:5]
+    assert set(heaviest) <= set(merged.keys.tolist())
+
+
+def test_merge_adds_the_floor_of_a_full_summary():
+    # Key 1 was seen 50 times by the first summary, which was full and
+    # evicted it, so the merge must count it at least that often
+    first = SpaceSaving(2, key_dtype=np.int64)
+    first.update(np.array([1, 2, 3]), np.array([50, 200, 300]))
+    second = SpaceSaving(2, key_dtype=np.int64)
+    second.update(np.array([1, 4]), np.array([100, 10]))
+    merged = SpaceSaving.merged([first, second], 2)
+    counts = dict(zip(merged.keys.tolist(), merged.counts.tolist()))
+    assert counts[1] >= 150
+    assert counts[3] >= 300
+
+
+def test_summary_counts_bound_exact_counts():
+    rng = np.random.default_rng(2)
+    keys = rng.zipf(1.2, 100000).astype(np.int64) % 5000
+    weights = rng.integers(1, 100, len(keys))
+    summary = _summary(keys, weights, 32)
+    exact = _exact(keys, weights)
+    assert len(summary) == 32 and summary.error <= weights.sum() / 32
+    for key, count in zip(summary.keys.tolist(), summary.counts.tolist()):
+        assert exact[key] <= count <= exact[key] + summary.error
+    # Every key heavier than the error is held
+    assert {key for key, count in exact.items() if count > summary.error} <= set(summary.keys.tolist())
+    keys, counts = summary.top(3)
+    assert keys.tolist() == sorted(exact, key=exact.get, reverse=True)[:3]
+    assert np.all(np.diff(counts) <= 0)
+
+
+def test_summary_below_capacity_is_exact():
+    keys = np.array([5, 1, 5, 2, 5, 1])
+    summary = _summary(keys, np.arange(1, 7), 4)
+    assert summary.error == 0
+    assert dict(zip(summary.keys.tolist(), summary.counts.tolist())) == _exact(keys, np.arange(1, 7))
+
+
+@pytest.mark.parametrize('precision', [10, 12])
+@pytest.mark.parametrize('distinct', [100, 1000, 50000, 1000000])
+def test_hyperloglog_error_bound(precision, distinct):
+    rng = np.random.default_rng(distinct)
+    hashes = rng.integers(0, 2 ** 64, distinct, dtype=np.uint64)
+    sketch = HyperLogLog(precision)
+    # Repeats do not count again
+    sketch.add_hashes(hashes)
+    sketch.add_hashes(hashes[:distinct // 2])
+    # Three standard errors of the estimate
+    assert abs(sketch.count() / distinct - 1) <= 3 * 1.04 / np.sqrt(1 << precision)
+
+
+def test_hyperloglog_merge_is_the_union():
+    rng = np.random.default_rng(8)
+    hashes = rng.integers(0, 2 ** 64, 30000, dtype=np.uint64)
+    first, second, whole = HyperLogLog(), HyperLogLog(), HyperLogLog()
+    first.add_hashes(hashes[:20000])
+    second.add_hashes(hashes[10000:])
+    whole.add_hashes(hashes)
+    first.merge(second)
+    np.testing.assert_array_equal(first.registers, whole.registers)
+    assert HyperLogLog().count() == 0
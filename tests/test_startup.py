@@ -0,0 +1,62 @@
+import json
+import os
+import subprocess
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Seconds `import wsgi` may take, checked only when set; wall-clock time
+# depends on the machine, so CI and benchmark runs opt in (1.5 as for
+# main.py --profile-startup)
+STARTUP_BUDGET = os.getenv('STARTUP_BUDGET')
+HEAVY_PACKAGES = ('pandas', 'sklearn', 'matplotlib', 'plotly.express')  # imported when first used, never at startup
+
+# Prints which of the heavy packages the app loaded on the way
+_SCRIPT = f"""
+import json
+import sys
+import wsgi
+print(json.dumps([name for name in {HEAVY_PACKAGES!r} if name in sys.modules]))
+"""
+
+
+def _import_wsgi(tmp_path):
+    # A cold `import wsgi` builds the app as gunicorn's master does
+    env = dict(os.environ, UPLOAD_DIR=str(tmp_path), INCIDENT_LOG=str(tmp_path / 'incidents.log'),
+               LIVE_SEGMENT=f'network-forensics-test-{os.getpid()}', INCIDENT_CONSOLE_RATE='0')
+    return subprocess.run([sys.executable, '-X', 'importtime', '-c', _SCRIPT], cwd=ROOT, env=env,
+                          capture_output=True, text=True, check=True)
+
+
+def test_wsgi_imports_without_heavy_packages(tmp_path):
+    done = _import_wsgi(tmp_path)
+    assert json.loads(done.stdout.strip().splitlines()[-1]) == []
+
+
+@pytest.mark.skipif(not STARTUP_BUDGET, reason="set STARTUP_BUDGET (seconds) to time the import")
+def test_wsgi_imports_within_the_budget(tmp_path):
+    # Its import time is the cumulative time of the top-level imports
+    done = _import_wsgi(tmp_path)
+    total = 0
+    for line in done.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if not name.startswith('  '):
+            total += int(cumulative) / 1e6
+    assert 0 < total < float(STARTUP_BUDGET), f"import wsgi took {total:.2f}s"
+
+
+def test_analyzer_submodules_are_imported_on_first_use():
+    script = """
+import json
+import sys
+import analyzer
+before = sorted(name for name in sys.modules if name.startswith('analyzer.'))
+analyzer.CaptureIndex
+print(json.dumps([before, 'analyzer.evidence' in sys.modules]))
+"""
+    done = subprocess.run([sys.executable, '-c', script], cwd=os.path.join(ROOT, 'src'), capture_output=True,
+                          text=True, check=True)
+    before, loaded = json.loads(done.stdout)
+    assert before == ['analyzer.aggregate', 'analyzer.flows'] and loaded
@@ -0,0 +1,59 @@
+import time
+import multiprocessing
+from analyzer.synthetic import TrafficGenerator
+from storage import TrafficStore
+
+START = 1_600_000_000
+
+
+def _batch():
+    return TrafficGenerator(seed=1, duration=7200, start=START).generate(20000)
+
+
+def _churn(root, stop):
+    # Writes small segments, then compacts and drops the partitions, as the
+    # live producer and upload jobs do
+    batch = _batch()
+    store = TrafficStore(root)
+    while not stop.is_set():
+        for start in range(0, len(batch), 2000):
+            store.append('packets', batch[start:start + 2000])
+            store.flush(compact=False)
+        store.compact('packets')
+        store.retain('packets', 0)
+
+
+def test_queries_survive_compaction_and_retention_in_another_process(tmp_path):
+    root = str(tmp_path)
+    stop = multiprocessing.Event()
+    writer = multiprocessing.Process(target=_churn, args=(root, stop))
+    writer.start()
+    try:
+        store = TrafficStore(root)
+        deadline = time.monotonic() + 3
+        while time.monotonic() < deadline:
+            store.query('packets', host='10.0.0.2')
+            store.query('packets', where='tcp', limit=3000)
+    finally:
+        stop.set()
+        writer.join()
+
+
+def test_retention_skips_partitions_removed_meanwhile(tmp_path, monkeypatch):
+    store = TrafficStore(str(tmp_path))
+    store.append('packets', _batch())
+    store.flush(compact=False)
+    names = store.partitions('packets')
+    # Another worker drops the first partition between the listing and the sweep
+    monkeypatch.setattr(store, 'partitions', lambda table, **kwargs: ['1999-01-01T00'] + names)
+    assert store.retain('packets', 0) == len(names)
+
+
+def test_appends_flush_on_the_interval_and_compact_less_often(tmp_path):
+    store = TrafficStore(str(tmp_path), flush_interval=0, compact_interval=3600)
+    batch = _batch()
+    store.append('packets', batch[:1000])
+    store.append('packets', batch[1000:2000])
+    assert not any(store._buffers['packets'].values())
+    assert len(store.segments('packets')) > 1
+    assert len(store.query('packets')) == 2000
@@ -0,0 +1,145 @@
+import numpy as np
+from custom_types import PacketBatch, INCIDENT_TYPES, PROTOCOL_CODES
+from detector.streaming import (StreamingDetector, ScanDetector, BeaconDetector, ExfiltrationDetector, StateTable,
+                                NS_PER_SECOND, SYN, ACK)
+
+START = 1_700_000_040 * NS_PER_SECOND  # on a minute boundary
+HOST = 0x0A000001  # 10.0.0.1
+PEER = 0xC6336401  # 198.51.100.1
+
+
+def _minute(minute, packets, length=1000):
+    # `packets` packets from HOST to PEER spread over one minute, and a few replies
+    times = START + minute * 60 * NS_PER_SECOND + np.linspace(0, 59 * NS_PER_SECOND, packets).astype(np.int64)
+    replies = times[::50]
+    n = len(times) + len(replies)
+    return PacketBatch(
+        timestamp=np.r_[times, replies],
+        src=np.r_[np.full(len(times), HOST), np.full(len(replies), PEER)].astype(np.uint32),
+        dst=np.r_[np.full(len(times), PEER), np.full(len(replies), HOST)].astype(np.uint32),
+        protocol=np.full(n, PROTOCOL_CODES['TCP']),
+        length=np.r_[np.full(len(times), length), np.full(len(replies), 60)],
+        src_port=np.r_[np.full(len(times), 50000), np.full(len(replies), 443)],
+        dst_port=np.r_[np.full(len(times), 443), np.full(len(replies), 50000)],
+        tcp_flags=np.full(n, 0x18),
+    )
+
+
+def _packets(seconds, dst=PEER, dst_port=443, flags=SYN):
+    # TCP packets from HOST at `seconds` after START, to one or more destinations and ports
+    n = len(seconds)
+    return PacketBatch(
+        timestamp=START + (np.asarray(seconds, dtype=np.float64) * NS_PER_SECOND).astype(np.int64),
+        src=np.full(n, HOST, dtype=np.uint32),
+        dst=np.broadcast_to(np.asarray(dst, dtype=np.uint32), n),
+        protocol=np.full(n, PROTOCOL_CODES['TCP']),
+        length=np.full(n, 60),
+        src_port=np.full(n, 50000),
+        dst_port=np.broadcast_to(np.asarray(dst_port), n),
+        tcp_flags=np.full(n, flags),
+    )
+
+
+def _count(incidents, incident_type):
+    return int(np.count_nonzero(incidents.type == INCIDENT_TYPES.index(incident_type)))
+
+
+def _exfiltration(incidents):
+    return _count(incidents, 'EXFILTRATION')
+
+
+class _Entry:
+    def __init__(self, now):
+        self.updated = now
+
+
+def test_flush_closes_the_last_interval():
+    # Eight ordinary minutes, then a 30 MB upload in the last minute of the stream
+    stream = StreamingDetector([ExfiltrationDetector()])
+    found = 0
+    for minute in range(8):
+        found += _exfiltration(stream.process(_minute(minute, 100)))
+    found += _exfiltration(stream.process(_minute(8, 20000, length=1500)))
+    assert found == 0
+    assert _exfiltration(stream.flush()) == 1
+    # The interval is closed once
+    assert _exfiltration(stream.flush()) == 0
+
+
+def test_vertical_scan():
+    stream = StreamingDetector([ScanDetector(port_threshold=100, window=60)])
+    # Replies and established traffic are not connection attempts
+    assert not len(stream.process(_packets(np.zeros(200), dst_port=np.arange(1, 201), flags=SYN | ACK)))
+    assert not len(stream.process(_packets(np.zeros(99), dst_port=np.arange(1, 100))))
+    incidents = stream.process(_packets([1, 2], dst_port=[100, 100]))
+    assert _count(incidents, 'PORT_SCAN') == 1 and _count(incidents, 'HOST_SCAN') == 0
+    assert incidents.value.tolist() == [100]
+    assert incidents.first_seen.tolist() == [START] and incidents.last_seen.tolist() == [START + 2 * NS_PER_SECOND]
+
+
+def test_horizontal_scan():
+    stream = StreamingDetector([ScanDetector(host_threshold=50, window=60)])
+    incidents = stream.process(_packets(np.arange(50) / 10, dst=PEER + np.arange(50), dst_port=22))
+    assert _count(incidents, 'HOST_SCAN') == 1 and _count(incidents, 'PORT_SCAN') == 0
+    assert incidents.value.tolist() == [50]
+
+
+def test_scan_alerts_once_per_window():
+    stream = StreamingDetector([ScanDetector(port_threshold=100, window=60)])
+    assert _count(stream.process(_packets(np.zeros(100), dst_port=np.arange(1, 101))), 'PORT_SCAN') == 1
+    # More ports in the same window add nothing once the key has alerted
+    assert not len(stream.process(_packets(np.full(200, 30), dst_port=np.arange(101, 301))))
+    # The next window starts over and alerts again
+    assert _count(stream.process(_packets(np.full(100, 61), dst_port=np.arange(1, 101))), 'PORT_SCAN') == 1
+
+
+def test_scan_window_starts_over():
+    stream = StreamingDetector([ScanDetector(port_threshold=100, window=60)])
+    stream.process(_packets(np.zeros(60), dst_port=np.arange(1, 61)))
+    # Keeps the entry alive without adding ports
+    stream.process(_packets([40], dst_port=[1]))
+    # 60 + 60 distinct ports, but not within one window
+    assert not len(stream.process(_packets(np.full(60, 70), dst_port=np.arange(61, 121))))
+
+
+def _beacon(intervals):
+    return np.r_[0, np.cumsum(intervals)]
+
+
+def test_beacon_jitter_threshold():
+    regular = StreamingDetector([BeaconDetector(min_intervals=8, max_jitter=0.1)])
+    incidents = regular.process(_packets(_beacon([29, 31] * 5)))
+    assert _count(incidents, 'BEACONING') == 1
+    assert incidents.value.tolist() == [30] and incidents.count.tolist() == [10]
+    jittery = StreamingDetector([BeaconDetector(min_intervals=8, max_jitter=0.1)])
+    assert not len(jittery.process(_packets(_beacon([20, 40] * 5))))
+    # Too few intervals to tell
+    assert not len(StreamingDetector([BeaconDetector(min_intervals=8)]).process(_packets(_beacon([30] * 7))))
+
+
+def test_beacon_periods_span_batches():
+    stream = StreamingDetector([BeaconDetector(min_intervals=8, max_jitter=0.1)])
+    found = 0
+    # One packet per batch, and a burst within `gap` of each counts as one event
+    for second in _beacon([30] * 12):
+        found += _count(stream.process(_packets([second, second + 1])), 'BEACONING')
+    assert found == 1
+
+
+def test_state_table_evicts_the_least_recently_used():
+    table = StateTable(_Entry, max_entries=2, ttl=60)
+    a = table.get('a', 0)
+    table.get('b', 0)
+    assert table.get('a', 1) is a
+    table.get('c', 2)
+    assert list(table.entries) == ['a', 'c'] and table.evicted == 1
+
+
+def test_state_table_expires_stale_entries():
+    table = StateTable(_Entry, max_entries=10, ttl=10)
+    a = table.get('a', 0)
+    table.get('b', 5 * NS_PER_SECOND)
+    # Past its time-to-live an entry starts over
+    assert table.get('a', 12 * NS_PER_SECOND) is not a and table.expired == 1
+    table.expire(16 * NS_PER_SECOND)
+    assert list(table.entries) == ['a'] and table.expired == 2
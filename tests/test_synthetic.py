@@ -0,0 +1,49 @@
+import hashlib
+import numpy as np
+from custom_types import PacketBatch
+from analyzer.synthetic import TrafficGenerator
+from analyzer.pcap import read_pcap
+
+SETTINGS = {'duration': 600, 'clients': 300, 'servers': 100, 'scan_ports': 200, 'sweep_hosts': 100,
+            'burst_packets': 2000}
+
+
+def _assert_same(a, b):
+    for name in PacketBatch.fields:
+        np.testing.assert_array_equal(getattr(a, name), getattr(b, name), err_msg=name)
+
+
+def test_same_seed_same_traffic():
+    first = TrafficGenerator(seed=11, **SETTINGS)
+    second = TrafficGenerator(seed=11, **SETTINGS)
+    _assert_same(first.generate(30000), second.generate(30000))
+    assert first.events == second.events
+    other = TrafficGenerator(seed=12, **SETTINGS)
+    assert first.events != other.events
+    assert not np.array_equal(first.generate(30000).timestamp, other.generate(30000).timestamp)
+
+
+def test_traffic_does_not_depend_on_the_batch_size():
+    generator = TrafficGenerator(seed=11, **SETTINGS)
+    whole = generator.generate(30000)
+    batches = list(generator.batches(30000, batch_size=777))
+    assert all(len(batch) == 777 for batch in batches[:-1]) and 0 < len(batches[-1]) <= 777
+    _assert_same(PacketBatch.concat(batches), whole)
+    assert np.all(np.diff(whole.timestamp) >= 0)
+    # The background packets asked for, and every injected one
+    assert len(whole) == 30000 + sum(event['packets'] for event in generator.events)
+    assert len(generator.events) == 5
+
+
+def test_written_captures_are_identical(tmp_path):
+    digests = []
+    for name, batch_size in (('first.pcap', 4096), ('second.pcap', 1000)):
+        path = str(tmp_path / name)
+        TrafficGenerator(seed=11, **SETTINGS).write(path, 20000, batch_size=batch_size)
+        with open(path, 'rb') as f:
+            digests.append(hashlib.sha256(f.read()).hexdigest())
+    assert digests[0] == digests[1]
+    packets = PacketBatch.concat(list(read_pcap(str(tmp_path / 'first.pcap'))))
+    generated = TrafficGenerator(seed=11, **SETTINGS).generate(20000)
+    np.testing.assert_array_equal(packets.timestamp, generated.timestamp)
+    np.testing.assert_array_equal(packets.dst_port, generated.dst_port)
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from custom_types import PacketBatch, PROTOCOL_CODES, parse_addresses, format_addresses, address_keys
+
+START = 1_700_000_000 * 1_000_000_000
+
+
+def _batch(src, dst, start=START):
+    n = len(src)
+    return PacketBatch(timestamp=start + np.arange(n), src=parse_addresses(src), dst=parse_addresses(dst),
+                       protocol=np.full(n, PROTOCOL_CODES['TCP']), length=np.full(n, 60),
+                       src_port=np.arange(40000, 40000 + n), dst_port=np.full(n, 443),
+                       tcp_flags=np.full(n, 0x02))
+
+
+def _names(column):
+    names, inverse = format_addresses(column)
+    return names[inverse].tolist()
+
+
+@pytest.mark.parametrize('values, ndim', [
+    (['10.0.0.1', '192.168.1.20', '10.0.0.1', '255.255.255.255', '0.0.0.0'], 1),
+    (['2001:db8::1', '10.0.0.1', 'fe80::1', '2001:db8::1', '::'], 2),
+])
+def test_addresses_round_trip(values, ndim):
+    parsed = parse_addresses(values)
+    assert parsed.ndim == ndim
+    assert _names(parsed) == values
+    # The 16-byte keys format the same as the rows they came from
+    assert _names(address_keys(parsed)) == values
+
+
+def test_concat_of_ipv4_and_ipv6_batches():
+    ipv4 = _batch(['10.0.0.1', '10.0.0.2'], ['10.0.0.9', '10.0.0.9'])
+    ipv6 = _batch(['2001:db8::1'], ['10.0.0.9'], start=START + 10)
+    assert not ipv4.ipv6 and ipv6.ipv6
+    batch = PacketBatch.concat([ipv4, PacketBatch.empty(), ipv6])
+    assert batch.ipv6 and batch.src.shape == (3, 16)
+    assert _names(batch.src) == ['10.0.0.1', '10.0.0.2', '2001:db8::1']
+    assert _names(batch.dst) == ['10.0.0.9'] * 3
+    # An IPv4 host has the same key in both layouts
+    assert (address_keys(batch.dst)[:2] == address_keys(ipv4.dst)).all()
+    assert batch.timestamp.tolist() == [START, START + 1, START + 10]
+    assert batch.src_port.tolist() == [40000, 40001, 40000]
+    assert not PacketBatch.concat([ipv4, ipv4]).ipv6
+
+
+def test_to_frame_shares_memory():
+    batch = _batch(['10.0.0.1', '2001:db8::1'], ['10.0.0.9', '10.0.0.9'])
+    frame = batch.to_frame()
+    for column in ('length', 'src_port', 'dst_port', 'tcp_flags'):
+        assert np.shares_memory(frame[column].to_numpy(), getattr(batch, column)), column
+    assert np.shares_memory(frame['timestamp'].to_numpy(), batch.timestamp)
+    assert frame['src'].tolist() == ['10.0.0.1', '2001:db8::1']
+    raw = batch.to_frame(addresses=False)
+    assert np.shares_memory(raw['protocol'].to_numpy(), batch.protocol)
+    assert raw['src_lo'].tolist()[0] == 0xFFFF0A000001
+
+
+def test_slicing_drops_the_per_batch_extras():
+    batch = _batch(['10.0.0.1', '10.0.0.2', '10.0.0.3'], ['10.0.0.9'] * 3)
+    batch.app = object()
+    batch.header_hash = np.arange(3, dtype=np.uint64)
+    batch.record_offset = np.arange(3, dtype=np.int64)
+    batch.stats = {'packets': 3}
+    for part in (batch[1:], batch[batch.src_port > 40000], batch[[0, 2]]):
+        assert part.app is None and part.header_hash is None and part.stats is None
+        assert not hasattr(part, 'record_offset')
+    sliced = batch[1:]
+    assert np.shares_memory(sliced.src, batch.src) and _names(sliced.src) == ['10.0.0.2', '10.0.0.3']
@@ -0,0 +1,20 @@
+import socket
+import numpy as np
+from detector.watchlist import Watchlist
+
+
+def _v4(*addresses):
+    return np.array([int.from_bytes(socket.inet_aton(a), 'big') for a in addresses], dtype=np.uint32)
+
+
+def _v6(*addresses):
+    return np.frombuffer(b''.join(socket.inet_pton(socket.AF_INET6, a) for a in addresses),
+                         dtype=np.uint8).reshape(-1, 16)
+
+
+def test_ipv4_mapped_entries_match_ipv4_packets(tmp_path):
+    path = tmp_path / 'feed.txt'
+    path.write_text('::ffff:5.5.0.0/112\n::ffff:6.6.6.6\n2001:db8::/32\n')
+    watchlist = Watchlist([str(path)])
+    assert watchlist.lookup(_v4('5.5.1.2', '6.6.6.6', '5.6.0.1')).tolist() == [0, 0, -1]
+    assert watchlist.lookup(_v6('::ffff:5.5.9.9', '2001:db8::1', '2001:db9::1')).tolist() == [0, 0, -1]
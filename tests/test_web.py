@@ -0,0 +1,76 @@
+import os
+import time
+import pytest
+import web_interface
+from tools.jobs import JobStore, JobHandle
+from analyzer import TrafficAnalyzer
+from detector import IncidentDetector
+from visualizer import DataVisualizer
+
+
+@pytest.fixture
+def web(monkeypatch):
+    monkeypatch.setattr(web_interface, 'LIVE_STREAMS', 1)
+    interface = web_interface.WebInterface(TrafficAnalyzer(), IncidentDetector(), DataVisualizer())
+    yield interface
+    interface.live.stop()
+
+
+def test_live_streams_beyond_the_limit_are_refused(web):
+    client = web.app.server.test_client()
+    first = client.get('/api/live/stream', buffered=False)
+    assert first.status_code == 200
+    refused = client.get('/api/live/stream', buffered=False)
+    assert refused.status_code == 503 and refused.headers['Retry-After']
+    # Closing a stream, even one that never started, frees its slot
+    first.close()
+    again = client.get('/api/live/stream', buffered=False)
+    assert again.status_code == 200
+    again.close()
+
+
+def test_job_routes_check_the_id(web):
+    client = web.app.server.test_client()
+    for url in ('/api/jobs/{}', '/api/jobs/{}/evidence'):
+        assert client.get(url.format('not-a-job')).status_code == 400
+        assert client.get(url.format('0' * 32)).status_code == 404
+    job_id = web.jobs.store.create('analyze', path=os.path.join(web.upload_dir, 'missing.pcap'))
+    assert client.get(f'/api/jobs/{job_id}').get_json()['status'] == 'queued'
+    # Evidence only comes from a finished job with a packet index
+    assert client.get(f'/api/jobs/{job_id}/evidence').status_code == 409
+    web.jobs.store.finish(job_id, {'incidents': []})
+    assert client.get(f'/api/jobs/{job_id}/evidence?incident=0').status_code == 404
+
+
+def test_job_upload_checks_the_offsets(web):
+    client = web.app.server.test_client()
+    assert client.post('/api/jobs?offsets=soon', data=b'').status_code == 400
+    assert client.post('/api/jobs?offsets=0,1.5', data=b'').status_code == 400
+
+
+def test_metrics_route(web):
+    response = web.app.server.test_client().get('/metrics')
+    assert response.status_code == 200 and response.mimetype == 'text/plain'
+    assert 'version=0.0.4' in response.headers['Content-Type']
+    text = response.get_data(as_text=True)
+    assert '# TYPE network_forensics_packets_total counter' in text
+    assert 'network_forensics_threads{process="web"}' in text
+
+
+def test_expired_uploads_are_removed(tmp_path):
+    store = JobStore(str(tmp_path / 'jobs.sqlite3'))
+    old, new = tmp_path / ('a' * 32 + '-old.pcap'), tmp_path / ('b' * 32 + '-new.pcap')
+    index = tmp_path / ('a' * 32 + '-old.pcap.index')
+    index.mkdir()
+    (index / 'packets').write_bytes(b'')
+    for path in (old, new):
+        path.write_bytes(b'')
+    job_id = store.create('analyze', old.name, str(old))
+    store.finish(job_id, {})
+    expired = time.time() - web_interface.STORE_RETENTION - 60
+    store._update(job_id, finished=expired)
+    for path in (old, index):
+        os.utime(path, (expired, expired))
+    web_interface._expire_uploads(JobHandle(store.path, job_id), str(tmp_path))
+    assert not old.exists() and not index.exists() and new.exists()
+    assert store.get(job_id) is None
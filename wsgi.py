@@ -1,4 +1,14 @@
-from src.main import app
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+
+from main import create_app
+
+# WSGI servers call the Flask server behind the Dash app. With gunicorn's
+# preload_app (see gunicorn.conf.py) it is built once, in the master process.
+dash_app = create_app()
+app = dash_app.server
 
 if __name__ == '__main__':
-    app.run()
+    dash_app.run()